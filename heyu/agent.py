@@ -0,0 +1,550 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import functools
+import os
+import signal
+import uuid
+
+import cli_tools
+import gevent
+import gevent.event
+import gevent.server
+from gevent import socket
+
+from heyu import protocol
+from heyu import spool
+from heyu import submitter
+from heyu import util
+
+
+# The maximum number of notifications the agent will hold while
+# waiting to forward them to the hub
+QUEUE_SIZE = 10000
+
+# The maximum number of notifications to forward in a single
+# "notify_batch" message
+BATCH_SIZE = 100
+
+# The maximum number of batches awaiting a reply from the hub
+MAX_INFLIGHT = 16
+
+# The number of times the oldest notification is sent on its own,
+# each time losing the session with the hub, before it is given up on
+MAX_ATTEMPTS = 5
+
+# The defaults for the delays between attempts to connect to the hub;
+# see ``heyu.util.Backoff``
+MAX_SLEEP = 30
+THRESHOLD = 30
+RECOVER = 5
+
+# The listen backlog of the agent socket
+BACKLOG = 128
+
+
+class AgentException(Exception):
+    """
+    An exception for reporting errors with the agent.
+    """
+
+    pass
+
+
+def _unix_listener(path, backlog=BACKLOG):
+    """
+    Create a listening Unix socket.  A stale socket file left behind
+    by an agent that is no longer running is replaced.
+
+    :param path: The path of the socket.
+    :param backlog: The listen backlog.
+
+    :returns: The listening socket.
+    """
+
+    # See if there's an agent listening already
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # Nobody home; remove the stale socket
+            os.unlink(path)
+        else:
+            raise AgentException("An agent is already listening on '%s'" %
+                                 path)
+        finally:
+            probe.close()
+
+    # Only the owner may submit notifications; the socket file is
+    # created with the umask, which is cleared by daemonizing, so
+    # restrict it until the mode can be set
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    os.chmod(path, 0o600)
+
+    sock.listen(backlog)
+
+    return sock
+
+
+class AgentServer(object):
+    """
+    The local HeyU agent.  The agent accepts notifications from local
+    clients over a Unix socket, replying as soon as they are spooled,
+    and forwards them to the hub over a single persistent session,
+    batching notifications that queue up while the hub is slow or
+    unreachable.  Lost connections to the hub are re-established, and
+    the notifications they were carrying are sent again.  The spool
+    is kept in memory, unless a spool directory is given; the agent
+    then also forwards notifications spooled there by "heyu-notify".
+    """
+
+    def __init__(self, hub, path=util.DEFAULT_AGENT, cert_conf=None,
+                 secure=True, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 spool_dir=None):
+        """
+        Initialize an ``AgentServer`` object.
+
+        :param hub: The address of the hub, as a tuple of hostname and
+                    port.
+        :param path: The path of the Unix socket to listen on.  The
+                     path is tilde-expanded.
+        :param cert_conf: The path to the certificate configuration
+                          file.  Optional.
+        :param secure: If ``False``, SSL will not be used.  Defaults
+                       to ``True``.
+        :param queue_size: The maximum number of notifications that
+                           may be queued for forwarding.  Ignored if
+                           ``spool_dir`` is given.
+        :param batch_size: The maximum number of notifications to
+                           forward in a single message.
+        :param spool_dir: The path of a spool directory, in which to
+                          keep notifications until they have been
+                          forwarded.  Optional.
+        """
+
+        self._hub = hub
+        self._path = os.path.expanduser(path)
+        self._cert_conf = cert_conf
+        self._secure = secure
+        self._batch_size = batch_size
+
+        # The notifications waiting to be forwarded; a durable spool
+        # may also be written by other processes, so it is polled
+        if spool_dir:
+            self._spool = spool.Spool(spool_dir)
+            self._poll = spool.POLL_INTERVAL
+        else:
+            self._spool = spool.MemorySpool(queue_size)
+            self._poll = None
+        self._queue_event = gevent.event.Event()
+
+        # The batches awaiting a reply from the hub, in order; each is
+        # a list of the spool position following the batch and a flag
+        # indicating whether the hub has replied
+        self._inflight = collections.deque()
+
+        # The session with the hub, and the delays between attempts
+        # to open it
+        self._session = None
+        self._backoff = util.Backoff(MAX_SLEEP, THRESHOLD, RECOVER)
+
+        # Count of the sessions lost in a row while notifications were
+        # awaiting replies
+        self._failures = 0
+
+        # The local server and the forwarding thread
+        self._server = None
+        self._forwarder = None
+
+        # Counts of notifications accepted from clients, forwarded to
+        # the hub, and rejected by the hub
+        self.accepted = 0
+        self.forwarded = 0
+        self.rejected = 0
+
+        # Set up behavior on signals
+        gevent.signal(signal.SIGINT, self.stop)
+        gevent.signal(signal.SIGTERM, self.stop)
+
+    def start(self):
+        """
+        Start the agent.  This ensures that the agent can receive
+        notifications on its socket, and starts forwarding them.
+        """
+
+        # Don't allow redundant start
+        if self._server is not None:
+            raise ValueError('agent is already running')
+
+        # Make sure the certificate configuration is usable before we
+        # start accepting notifications
+        util.cert_wrapper(self._cert_conf, 'submitter', secure=self._secure)
+
+        # Only one agent may drain a spool
+        self._spool.lock_drain()
+
+        self._server = gevent.server.StreamServer(
+            _unix_listener(self._path), self._serve)
+        self._server.start()
+        self._forwarder = gevent.spawn(self._forward)
+
+    def stop(self, *args):
+        """
+        Stop the agent.  Notifications that have not been forwarded are
+        discarded, unless they are in a spool directory.  Extra
+        arguments are ignored, so that this method may be used as a
+        signal handler.
+        """
+
+        # Do nothing if we're not running
+        if self._server is None:
+            return
+
+        self._server.stop()
+        self._server = None
+        self._forwarder.kill()
+
+        if self._session is not None:
+            self._session.disconnect()
+            self._session = None
+
+        self._spool.close()
+
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def wait(self):
+        """
+        Wait for the agent to be stopped.
+        """
+
+        if self._forwarder is not None:
+            self._forwarder.join()
+
+    def submit(self, msg):
+        """
+        Spool a notification for forwarding to the hub.  Notifications
+        without an ID are assigned one, so that the ID may be returned
+        to the client immediately.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the notification.
+
+        :returns: A ``heyu.protocol.Message`` object describing the
+                  reply to send to the client.
+        """
+
+        notif_id = msg.id or str(uuid.uuid4())
+        try:
+            self._spool.append([{
+                'app_name': msg.app_name,
+                'summary': msg.summary,
+                'body': msg.body,
+                'urgency': msg.urgency,
+                'category': msg.category,
+                'id': notif_id,
+            }])
+            self._spool.commit()
+        except (spool.SpoolException, EnvironmentError) as e:
+            return protocol.Message('error', reason='Failed to spool '
+                                    'notification: %s' % e, seq=msg.seq)
+
+        self._queue_event.set()
+        self.accepted += 1
+
+        return protocol.Message('accepted', id=notif_id, seq=msg.seq)
+
+    def _serve(self, sock, addr):
+        """
+        Serve a client connection on the agent socket.  Each frame the
+        client sends must be a "notify" message, and is answered with
+        an "accepted" or "error" message.
+
+        :param sock: The client socket.
+        :param addr: The client address; unused.
+        """
+
+        try:
+            while True:
+                frame = util.read_frame(sock)
+                if frame is None:
+                    break
+
+                try:
+                    msg = protocol.Message.from_frame(frame)
+                except ValueError as e:
+                    reply = protocol.Message('error', reason=str(e))
+                else:
+                    if msg.msg_type == 'notify':
+                        reply = self.submit(msg)
+                    else:
+                        reply = protocol.Message(
+                            'error', reason='Unexpected message "%s"' %
+                            msg.msg_type)
+
+                util.write_frame(sock, reply.to_frame())
+        except (EnvironmentError, ValueError):
+            # The client went away or sent garbage
+            pass
+        finally:
+            sock.close()
+
+    def _connect(self):
+        """
+        Open a session with the hub, retrying with increasing delays
+        until the hub can be reached.
+
+        :returns: An instance of ``heyu.submitter.SessionApplication``.
+        """
+
+        # If the last session was lost with notifications awaiting
+        # replies, don't resend them right away; the hub may be
+        # closing the session because of one of them
+        if self._failures:
+            gevent.sleep(self._backoff.next_delay())
+
+        while True:
+            try:
+                return submitter.open_session(self._hub, self._cert_conf,
+                                              self._secure)
+            except Exception:
+                gevent.sleep(self._backoff.next_delay())
+
+    def _forward(self):
+        """
+        Forward spooled notifications to the hub.  Runs in its own
+        thread.  Notifications are sent without waiting for the
+        replies to earlier ones, up to a limit.
+        """
+
+        while True:
+            self._queue_event.wait(self._poll)
+            self._queue_event.clear()
+
+            # Wait for replies if too many batches are outstanding;
+            # after a session is lost, the oldest notification is
+            # sent on its own until the hub replies to it, so that a
+            # notification the hub can't take is singled out
+            if self._failures:
+                max_inflight, batch_size = 1, 1
+            else:
+                max_inflight, batch_size = MAX_INFLIGHT, self._batch_size
+            if len(self._inflight) >= max_inflight:
+                continue
+
+            records = self._spool.read(batch_size)
+            if not records:
+                continue
+
+            # Make sure we have a session
+            if self._session is None or not self._session.active:
+                self._session = self._connect()
+
+            self._send(self._session, records)
+
+            # There may be more to send
+            self._queue_event.set()
+
+    def _send(self, session, records):
+        """
+        Send a batch of notifications to the hub.
+
+        :param session: The ``heyu.submitter.SessionApplication``
+                        object for the session with the hub.
+        :param records: A list of tuples of spool position and
+                        notification, as returned by the spool's
+                        ``read()`` method.
+        """
+
+        batch = spool.dedup([notif for _pos, notif in records])
+        entry = [records[-1][0], False]
+        self._inflight.append(entry)
+
+        if len(batch) == 1:
+            result = session.notify(**batch[0])
+        else:
+            result = session.notify_batch(batch)
+
+        result.rawlink(functools.partial(self._sent, session, entry,
+                                         len(batch)))
+
+    def _sent(self, session, entry, count, result):
+        """
+        Called when the hub replies to a batch of notifications, or the
+        session is closed before it does.  Notifications are
+        acknowledged to the spool in order; if the session is closed,
+        all unacknowledged notifications are sent again.  A
+        notification that has lost the session ``MAX_ATTEMPTS`` times
+        on its own is counted as rejected and dropped.
+
+        :param session: The ``heyu.submitter.SessionApplication``
+                        object for the session the batch was sent on.
+        :param entry: The entry for the batch in the list of batches
+                      awaiting replies.
+        :param count: The number of notifications in the batch.
+        :param result: The ``gevent.event.AsyncResult`` object for the
+                       batch.
+        """
+
+        # Ignore batches that have already been given up on
+        if not any(inflight is entry for inflight in self._inflight):
+            return
+
+        if result.successful():
+            self.forwarded += count
+        elif isinstance(result.exception, submitter.SessionClosed):
+            # Forget the dead session and try again; the IDs were
+            # assigned before spooling, so resent notifications
+            # replace any the hub did process
+            if self._session is session:
+                self._session = None
+            self._failures += 1
+            if self._failures > MAX_ATTEMPTS:
+                # The batch is the oldest notification, sent on its
+                # own; give up on it
+                self._spool.ack(entry[0])
+                self.rejected += count
+                self._failures = 0
+            self._inflight.clear()
+            self._spool.rewind()
+            self._queue_event.set()
+            return
+        else:
+            self.rejected += count
+        entry[1] = True
+        self._failures = 0
+
+        # Acknowledge the batches that have been replied to, in order
+        position = None
+        while self._inflight and self._inflight[0][1]:
+            position = self._inflight.popleft()[0]
+        if position is not None:
+            self._spool.ack(position)
+
+        self._queue_event.set()
+
+
+@cli_tools.argument('--host', '-H',
+                    dest='hub',
+                    default=util.default_hub(),
+                    type=util.parse_hub,
+                    help='Specifies the HeyU hub to forward notifications '
+                    'to, as "hostname" or "hostname:port".')
+@cli_tools.argument('--socket', '-s',
+                    dest='path',
+                    default=util.DEFAULT_AGENT,
+                    help='Specifies the path of the Unix socket to listen '
+                    'on.  Defaults to "%(default)s".')
+@cli_tools.argument('--foreground', '-f',
+                    dest='daemon',
+                    default=True,
+                    action='store_false',
+                    help='Specifies that the agent should be run in the '
+                    'foreground.')
+@cli_tools.argument('--pid-file', '-p',
+                    default=None,
+                    help='Specifies the file that the PID should be stored '
+                    'in.  There is no default for the PID file.')
+@cli_tools.argument('--cert-conf', '-C',
+                    default=None,
+                    help='Specifies an alternate path to the certificate '
+                    'configuration file.')
+@cli_tools.argument('--insecure', '-k',
+                    dest='secure',
+                    default=True,
+                    action='store_false',
+                    help='Specifies that SSL should not be used to connect '
+                    'to the hub.')
+@cli_tools.argument('--queue-size', '-q',
+                    default=QUEUE_SIZE,
+                    type=int,
+                    help='The maximum number of notifications that may be '
+                    'queued for forwarding to the hub.  Defaults to '
+                    '%(default)s.')
+@cli_tools.argument('--spool', '-S',
+                    dest='spool_dir',
+                    default=None,
+                    help='Specifies a directory in which to spool '
+                    'notifications until they have been forwarded to the '
+                    'hub.  Notifications spooled there by "heyu-notify" '
+                    'are also forwarded.  By default, notifications are '
+                    'only kept in memory.')
+@cli_tools.argument('--batch-size', '-b',
+                    default=BATCH_SIZE,
+                    type=int,
+                    help='The maximum number of notifications to forward to '
+                    'the hub in a single message.  Defaults to %(default)s.')
+@cli_tools.argument('--debug', '-d',
+                    help='Enables debugging.')
+def start_agent(hub, path=util.DEFAULT_AGENT, cert_conf=None, secure=True,
+                queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, spool_dir=None):
+    """
+    Starts the local HeyU agent.  The agent accepts notifications from
+    "heyu-notify" over a Unix socket and forwards them to the hub,
+    so that "heyu-notify" need not wait for the hub.  The hub address
+    is read from the "~/.heyu.hub" file, as for "heyu-notify".  Note
+    that certificate configuration is specified in "~/.heyu.cert" by
+    default.
+
+    :param hub: The address of the hub, as a tuple of hostname and
+                port.
+    :param path: The path of the Unix socket to listen on.
+    :param cert_conf: The path to the certificate configuration file.
+                      Optional.
+    :param secure: If ``False``, SSL will not be used.  Defaults to
+                   ``True``.
+    :param queue_size: The maximum number of notifications that may be
+                       queued for forwarding.
+    :param batch_size: The maximum number of notifications to forward
+                       in a single message.
+    :param spool_dir: The path of a spool directory.  Optional.
+    """
+
+    # Initialize the agent
+    agent = AgentServer(hub, path, cert_conf, secure, queue_size,
+                        batch_size, spool_dir)
+
+    # Start it and run until stopped
+    agent.start()
+    agent.wait()
+
+
+@start_agent.processor
+def _normalize_args(args):
+    """
+    Pre-process arguments before calling ``start_agent()``.  This
+    ensures the arguments are normalized.
+
+    :params args: The values of the command line arguments for
+                  normalization.
+    """
+
+    # The paths must survive the change of directory
+    args.path = os.path.abspath(os.path.expanduser(args.path))
+    if args.spool_dir:
+        args.spool_dir = os.path.abspath(os.path.expanduser(args.spool_dir))
+
+    # Go into the background if requested, and not in debug mode
+    if args.daemon and not args.debug:
+        util.daemonize(pidfile=args.pid_file)
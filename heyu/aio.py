@@ -0,0 +1,855 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import functools
+import struct
+import uuid
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2 has no asyncio; the framing functions remain usable,
+    # but the protocols cannot be instantiated
+    asyncio = None
+
+from heyu import protocol
+
+
+# The maximum number of notifications a subscriber buffers before it
+# stops reading from the hub
+QUEUE_SIZE = 10000
+
+# COBS block codes, for the zero pair elimination variant used by
+# tendril.COBSFramer(True).  A code of COBS_UNTRAILED introduces a
+# block of COBS_UNTRAILED - 1 bytes which is not followed by a zero;
+# codes below it introduce a block of code - 1 bytes followed by a
+# single zero, and codes above it a block of code - COBS_UNTRAILED - 1
+# bytes followed by a pair of zeros.
+COBS_UNTRAILED = 0xe0
+COBS_MAX_PAIRED = 0xff - COBS_UNTRAILED
+
+
+class ClientException(Exception):
+    """
+    An exception for reporting errors with the asyncio client.
+    """
+
+    pass
+
+
+class SessionClosed(ClientException):
+    """
+    An exception for reporting that a request failed because the
+    connection was closed before the hub replied to it.  The request
+    may or may not have been processed by the hub.
+    """
+
+    pass
+
+
+def cobs_encode(frame):
+    """
+    Encode a frame with Consistent Overhead Byte Stuffing, using the
+    zero pair elimination variant.  This is the encoding used by
+    ``tendril.COBSFramer(True)``.
+
+    :param frame: The binary frame.
+
+    :returns: The encoded frame, including the terminating zero byte.
+    """
+
+    result = bytearray()
+
+    # Walk the zero-separated blocks; a block followed by an empty
+    # block is followed by a pair of zeros
+    blocks = frame.split(b'\0')
+    skip = False
+    for i, blk in enumerate(blocks):
+        if skip:
+            skip = False
+            continue
+
+        # Blocks too long for a single code are split off untrailed
+        while len(blk) >= COBS_UNTRAILED - 1:
+            result.append(COBS_UNTRAILED)
+            result.extend(blk[:COBS_UNTRAILED - 1])
+            blk = blk[COBS_UNTRAILED - 1:]
+
+        if (i + 1 < len(blocks) and blocks[i + 1] == b'' and
+                len(blk) < COBS_MAX_PAIRED):
+            result.append(COBS_UNTRAILED + len(blk) + 1)
+            skip = True
+        else:
+            result.append(len(blk) + 1)
+        result.extend(blk)
+
+    result.append(0)
+
+    return bytes(result)
+
+
+def cobs_decode(data):
+    """
+    Decode a frame encoded by ``cobs_encode()``.
+
+    :param data: The encoded frame, without the terminating zero
+                 byte.
+
+    :returns: The binary frame.
+    """
+
+    data = bytearray(data)
+    result = bytearray()
+
+    pos = 0
+    zeros = 0
+    while pos < len(data):
+        code = data[pos]
+        if code == COBS_UNTRAILED:
+            length, zeros = COBS_UNTRAILED, 0
+        elif code > COBS_UNTRAILED:
+            length, zeros = code - COBS_UNTRAILED, 2
+        elif code:
+            length, zeros = code, 1
+        else:
+            raise ValueError('invalid COBS block code 0')
+
+        result.extend(data[pos + 1:pos + length])
+        result.extend(b'\0' * zeros)
+        pos += length
+
+    # The encoder adds one zero to the last block
+    if zeros:
+        del result[-1]
+
+    return bytes(result)
+
+
+class COBSFramer(object):
+    """
+    A framer for the COBS framing every connection to the hub starts
+    with.  Compatible with ``tendril.COBSFramer(True)``.
+    """
+
+    def frameify(self, data):
+        """
+        Carve the first frame out of received data.
+
+        :param data: The received data.
+
+        :returns: A tuple of the frame, or ``None`` if the data does
+                  not yet contain a whole frame, and the remaining
+                  data.
+        """
+
+        frame, sep, rest = data.partition(b'\0')
+        if not sep:
+            return None, data
+
+        return cobs_decode(frame), rest
+
+    def streamify(self, frame):
+        """
+        Prepare a frame for sending.
+
+        :param frame: The binary frame.
+
+        :returns: The data to send.
+        """
+
+        return cobs_encode(frame)
+
+
+class LengthFramer(object):
+    """
+    A framer for the length-prefixed framing negotiated with the
+    ``heyu.protocol.CAP_LENGTH_FRAMING`` capability.  Compatible with
+    ``tendril.StructFramer(heyu.protocol.LENGTH_FORMAT)``.
+    """
+
+    _prefix = struct.Struct(protocol.LENGTH_FORMAT)
+
+    def frameify(self, data):
+        """
+        Carve the first frame out of received data.
+
+        :param data: The received data.
+
+        :returns: A tuple of the frame, or ``None`` if the data does
+                  not yet contain a whole frame, and the remaining
+                  data.
+        """
+
+        if len(data) < self._prefix.size:
+            return None, data
+
+        end = self._prefix.size + self._prefix.unpack(
+            data[:self._prefix.size])[0]
+        if len(data) < end:
+            return None, data
+
+        return data[self._prefix.size:end], data[end:]
+
+    def streamify(self, frame):
+        """
+        Prepare a frame for sending.
+
+        :param frame: The binary frame.
+
+        :returns: The data to send.
+        """
+
+        return self._prefix.pack(len(frame)) + frame
+
+
+class HubProtocol(asyncio.Protocol if asyncio else object):
+    """
+    Base class for asyncio protocols speaking to the HeyU hub.  The
+    connection starts with COBS framing; the protocol sends the
+    message returned by ``opening()``, and nothing else may be sent
+    until the hub replies to it, since the reply may switch the
+    framing.  Frames sent before then are held.  Subclasses implement
+    ``recv_msg()`` and call ``negotiated()`` with the capabilities in
+    the reply.
+    """
+
+    def __init__(self, loop=None):
+        """
+        Initialize a ``HubProtocol``.
+
+        :param loop: The event loop.  Defaults to the current event
+                     loop.
+        """
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+
+        self._framer = COBSFramer()
+        self._recv_buf = b''
+
+        # Frames to send once the hub replies to the opening message
+        self._held = []
+
+        # Whether to compress frames; negotiated with the hub
+        self._compress = False
+
+        # Whether the connection may still be used
+        self.active = True
+
+    def opening(self):
+        """
+        Construct the first message to send to the hub.  Must be
+        implemented by subclasses.
+
+        :returns: A ``heyu.protocol.Message`` object.
+        """
+
+        raise NotImplementedError()  # pragma: no cover
+
+    def recv_msg(self, msg):
+        """
+        Called when a message is received.  Must be implemented by
+        subclasses.
+
+        :param msg: The ``heyu.protocol.Message`` object.
+        """
+
+        raise NotImplementedError()  # pragma: no cover
+
+    def connection_made(self, transport):
+        """
+        Called when the connection to the hub is established.  Sends
+        the opening message.
+
+        :param transport: The asyncio transport.
+        """
+
+        self.transport = transport
+        self.transport.write(
+            self._framer.streamify(self.opening().to_frame()))
+
+    def data_received(self, data):
+        """
+        Called when data is received.  Splits the data into frames and
+        dispatches the messages; the framing may change between one
+        frame and the next.
+
+        :param data: The received data.
+        """
+
+        self._recv_buf += data
+        while self.active:
+            frame, self._recv_buf = self._framer.frameify(self._recv_buf)
+            if frame is None:
+                break
+
+            try:
+                msg = protocol.Message.from_frame(
+                    frame, compressed=self._compress)
+            except ValueError as e:
+                self.fail(ClientException('Failed to parse frame: %s' % e))
+                self.close()
+                break
+
+            self.recv_msg(msg)
+
+    def negotiated(self, capabilities):
+        """
+        Called when the hub replies to the opening message.  Switches to
+        the negotiated framing and compression and sends any held
+        frames.
+
+        :param capabilities: The capabilities the hub will use.
+        """
+
+        if protocol.CAP_LENGTH_FRAMING in capabilities:
+            self._framer = LengthFramer()
+        self._compress = protocol.CAP_ZLIB in capabilities
+
+        held = self._held
+        self._held = None
+        for frame in held:
+            self.send_frame(frame)
+
+    def send_frame(self, frame):
+        """
+        Send a frame to the hub, holding it if the hub has not yet
+        replied to the opening message.  The frame is compressed if
+        that has been negotiated.
+
+        :param frame: The binary frame.
+        """
+
+        if self._held is None:
+            if self._compress:
+                frame = protocol.compress_frame(frame)
+            self.transport.write(self._framer.streamify(frame))
+        else:
+            self._held.append(frame)
+
+    def fail(self, exc):
+        """
+        Called when the connection may no longer be used.  Subclasses
+        extend this to fail whatever is waiting on the connection.
+
+        :param exc: The exception describing the failure, or ``None``
+                    if the connection ended normally.
+        """
+
+        self.active = False
+
+    def close(self):
+        """
+        Close the connection.
+        """
+
+        self.active = False
+        if self.transport is not None:
+            self.transport.close()
+
+    def disconnect(self):
+        """
+        Say goodbye to the hub and close the connection.
+        """
+
+        if self.active and self.transport is not None:
+            self.transport.write(self._framer.streamify(
+                protocol.Message('goodbye').to_frame()))
+
+        self.close()
+        self.fail(None)
+
+    def connection_lost(self, exc):
+        """
+        Called when the connection has been closed.
+
+        :param exc: The exception that closed the connection, or
+                    ``None``.
+        """
+
+        self.transport = None
+        if self.active:
+            self.fail(SessionClosed('Connection to the HeyU hub closed'))
+        self.active = False
+
+
+class SubmitterProtocol(HubProtocol):
+    """
+    An asyncio protocol for submitting notifications to the hub.
+    Like ``heyu.submitter.SessionApplication``, it establishes a
+    session with a "hello" message; any number of notifications may
+    then be submitted without waiting for the replies to earlier
+    ones.  Each request returns a future, which the hub's reply
+    resolves.
+    """
+
+    def __init__(self, loop=None):
+        """
+        Initialize a ``SubmitterProtocol``.
+
+        :param loop: The event loop.  Defaults to the current event
+                     loop.
+        """
+
+        super(SubmitterProtocol, self).__init__(loop)
+
+        # The next sequence number and the outstanding requests
+        self._next_seq = 0
+        self._pending = {}
+
+    def opening(self):
+        """
+        Construct the "hello" message which establishes the session.
+
+        :returns: A ``heyu.protocol.Message`` object.
+        """
+
+        return protocol.Message('hello', capabilities=(
+            protocol.CAP_LENGTH_FRAMING, protocol.CAP_ZLIB))
+
+    def _request(self, msg_type, **kwargs):
+        """
+        Send a request to the hub.
+
+        :param msg_type: The type of the message.
+
+        Other keyword parameters are taken to be arguments for the
+        message; the sequence number is added.
+
+        :returns: A future for the reply.
+        """
+
+        result = self.loop.create_future()
+        if not self.active:
+            result.set_exception(SessionClosed('Session closed'))
+            return result
+
+        # Allocate a sequence number
+        seq = self._next_seq
+        self._next_seq += 1
+
+        # Remember the request and send it
+        self._pending[seq] = result
+        self.send_frame(protocol.Message(msg_type, seq=seq,
+                                         **kwargs).to_frame())
+
+        return result
+
+    def notify(self, app_name, summary, body,
+               urgency=None, category=None, id=None):
+        """
+        Submit a notification to the hub.  This does not wait for the
+        hub to reply.
+
+        :param app_name: The name of the application the notification
+                         is for.
+        :param summary: A summary of the notification.
+        :param body: The body of the notification.
+        :param urgency: The urgency level for the notification.
+                        Optional.
+        :param category: A category for the notification.  Optional.
+        :param id: The ID of a notification to replace.  If not
+                   given, a new ID is assigned.
+
+        :returns: A future.  Once the hub replies, its result will be
+                  the notification ID; if the notification is
+                  rejected, or the session is closed before the hub
+                  replies, it raises a ``ClientException``.
+        """
+
+        # The ID is assigned here, rather than by the hub, so that the
+        # notification has the same ID on every hub it reaches
+        kwargs = {
+            'app_name': app_name,
+            'summary': summary,
+            'body': body,
+            'id': id or str(uuid.uuid4()),
+        }
+        if urgency is not None:
+            kwargs['urgency'] = urgency
+        if category is not None:
+            kwargs['category'] = category
+
+        return self._request('notify', **kwargs)
+
+    def notify_batch(self, notifications):
+        """
+        Submit several notifications to the hub in a single message.
+        The hub accepts or rejects the batch as a whole.  This does
+        not wait for the hub to reply.
+
+        :param notifications: A list of dictionaries, each containing
+                              the keyword arguments of ``notify()``
+                              for one notification.
+
+        :returns: A future.  Once the hub replies, its result will be
+                  the list of notification IDs, in order; if the
+                  batch is rejected, or the session is closed before
+                  the hub replies, it raises a ``ClientException``.
+        """
+
+        # Encode the notifications, skipping unset optional arguments
+        # and assigning IDs as for notify()
+        frames = []
+        for notif in notifications:
+            kwargs = dict((k, v) for k, v in notif.items() if v is not None)
+            kwargs.setdefault('id', str(uuid.uuid4()))
+            frames.append(protocol.Message('notify', **kwargs).to_frame())
+
+        return self._request('notify_batch', notifications=frames)
+
+    def recv_msg(self, msg):
+        """
+        Called when a message is received.  Matches replies to the
+        outstanding requests.
+
+        :param msg: The ``heyu.protocol.Message`` object.
+        """
+
+        if msg.msg_type == 'accepted' and msg.seq in self._pending:
+            _resolve(self._pending.pop(msg.seq), msg.id)
+        elif msg.msg_type == 'accepted_batch' and msg.seq in self._pending:
+            _resolve(self._pending.pop(msg.seq), msg.ids)
+        elif msg.msg_type == 'error' and msg.seq in self._pending:
+            _resolve(self._pending.pop(msg.seq), exc=ClientException(
+                'Failed to submit notification: %s' % msg.reason))
+        elif msg.msg_type == 'error':
+            # An error not tied to a request; the hub will close the
+            # connection
+            self.fail(SessionClosed('Failed to submit notification: %s' %
+                                    msg.reason))
+        elif msg.msg_type == 'goodbye':
+            self.fail(SessionClosed('Session closed by the HeyU hub'))
+            self.close()
+        elif msg.msg_type == 'hello' and self._held is not None:
+            self.negotiated(msg.capabilities)
+
+        # Other messages are ignored
+
+    def fail(self, exc):
+        """
+        Fail all outstanding requests.
+
+        :param exc: The exception describing the failure, or ``None``
+                    if the session was closed by ``disconnect()``.
+        """
+
+        super(SubmitterProtocol, self).fail(exc)
+
+        pending = self._pending
+        self._pending = {}
+        for result in pending.values():
+            _resolve(result, exc=exc or SessionClosed('Session closed'))
+
+
+class SubscriberProtocol(HubProtocol):
+    """
+    An asyncio protocol for receiving notifications from the hub.
+    The protocol is an asynchronous iterator over the received
+    "notify" messages, as ``heyu.protocol.Message`` objects.
+    Iteration ends when the hub says goodbye or ``disconnect()`` is
+    called; if the connection fails, it raises a
+    ``ClientException``, and ``epoch`` and ``cursor`` may be passed
+    to a new subscription to replay the missed notifications.
+    """
+
+    def __init__(self, filters=None, epoch=None, since=None,
+                 queue_size=QUEUE_SIZE, loop=None):
+        """
+        Initialize a ``SubscriberProtocol``.
+
+        :param filters: A dictionary of subscription filter arguments
+                        for the "subscribe" message; see
+                        ``heyu.filters.Filter``.  Optional.
+        :param epoch: The epoch of the hub last subscribed to.
+                      Optional.
+        :param since: The cursor of the last notification received
+                      from the hub, if resubscribing.  Optional.
+        :param queue_size: The maximum number of notifications to
+                           buffer before reading from the hub is
+                           paused.
+        :param loop: The event loop.  Defaults to the current event
+                     loop.
+        """
+
+        super(SubscriberProtocol, self).__init__(loop)
+
+        self._filters = filters or {}
+        self._queue_size = queue_size
+        self._paused = False
+
+        # The hub's position
+        self.epoch = epoch
+        self.cursor = since
+        self.gap = False
+
+        # Resolved when the hub replies to the subscription
+        self.subscribed = self.loop.create_future()
+
+        # Received notifications and waiting consumers
+        self._notifications = collections.deque()
+        self._waiters = collections.deque()
+
+        # Set when the subscription ends; the exception, if any, is
+        # raised once the notifications have been consumed
+        self._ended = False
+        self._error = None
+
+    def opening(self):
+        """
+        Construct the "subscribe" message.  The hub replays anything
+        missed since the last subscription.
+
+        :returns: A ``heyu.protocol.Message`` object.
+        """
+
+        args = dict(self._filters)
+        if self.cursor is not None:
+            args.update(epoch=self.epoch, since=self.cursor)
+
+        # Batches are not requested: nested frames do not survive the
+        # differing string types of msgpack on Python 2 and Python 3
+        return protocol.Message('subscribe', capabilities=(
+            protocol.CAP_LENGTH_FRAMING, protocol.CAP_ZLIB), **args)
+
+    def recv_msg(self, msg):
+        """
+        Called when a message is received.  Queues notifications for
+        the consumers.
+
+        :param msg: The ``heyu.protocol.Message`` object.
+        """
+
+        if msg.msg_type == 'notify':
+            self._put(msg)
+        elif msg.msg_type == 'notify_batch':
+            for notif in msg.notifications:
+                self._put(protocol.Message.from_frame(notif))
+        elif msg.msg_type == 'subscribed' and self._held is not None:
+            self.negotiated(msg.capabilities)
+
+            # Within the same epoch, the missed notifications are
+            # replayed, and advance the cursor as they arrive;
+            # otherwise, they are replayed from the start of the
+            # epoch, unless this is the first subscription
+            if msg.epoch != self.epoch:
+                self.cursor = msg.cursor if self.epoch is None else 0
+                self.epoch = msg.epoch
+            self.gap = msg.gap
+            _resolve(self.subscribed, msg.cursor)
+        elif msg.msg_type == 'goodbye':
+            self.close()
+            self.fail(None)
+        elif msg.msg_type == 'error':
+            self.close()
+            self.fail(ClientException('Error from the HeyU hub: %s' %
+                                      msg.reason))
+
+        # Other messages are ignored
+
+    def _put(self, msg):
+        """
+        Hand a notification to a waiting consumer, or queue it.
+
+        :param msg: The ``heyu.protocol.Message`` object.
+        """
+
+        if msg.cursor is not None:
+            self.cursor = msg.cursor
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(msg)
+                return
+
+        self._notifications.append(msg)
+
+        # Stop reading if the consumers are falling behind
+        if (len(self._notifications) >= self._queue_size and
+                not self._paused and self.transport is not None):
+            self.transport.pause_reading()
+            self._paused = True
+
+    def fail(self, exc):
+        """
+        End the subscription.  Consumers waiting for a notification
+        stop iterating, or receive the exception.
+
+        :param exc: The exception describing the failure, or ``None``
+                    if the subscription ended normally.
+        """
+
+        super(SubscriberProtocol, self).fail(exc)
+
+        if self._ended:
+            return
+        self._ended = True
+        self._error = exc
+
+        _resolve(self.subscribed, exc=exc or SessionClosed(
+            'Subscription closed'))
+
+        waiters = self._waiters
+        self._waiters = collections.deque()
+        for waiter in waiters:
+            _resolve(waiter, exc=self._end_exc())
+
+    def _end_exc(self):
+        """
+        Construct the exception which ends iteration.
+
+        :returns: An exception instance.
+        """
+
+        return self._error or StopAsyncIteration()
+
+    def __aiter__(self):
+        """
+        Iterate over the received notifications.
+
+        :returns: The protocol itself.
+        """
+
+        return self
+
+    def __anext__(self):
+        """
+        Retrieve the next notification.
+
+        :returns: A future for the next ``heyu.protocol.Message``.
+        """
+
+        result = self.loop.create_future()
+        if self._notifications:
+            result.set_result(self._notifications.popleft())
+
+            # Start reading again once the consumers catch up
+            if (self._paused and self.transport is not None and
+                    len(self._notifications) < self._queue_size // 2):
+                self.transport.resume_reading()
+                self._paused = False
+        elif self._ended:
+            result.set_exception(self._end_exc())
+        else:
+            self._waiters.append(result)
+
+        return result
+
+
+def _resolve(future, result=None, exc=None):
+    """
+    Resolve a future, unless it has been cancelled.
+
+    :param future: The future.
+    :param result: The result to set.
+    :param exc: The exception to set.  If given, ``result`` is
+                ignored.
+    """
+
+    if future.done():
+        return
+
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+def _connect(factory, hub, ssl_context, loop):
+    """
+    Connect to the hub.
+
+    :param factory: A callable returning the ``HubProtocol``.
+    :param hub: The address of the hub, as a tuple of hostname and
+                port.
+    :param ssl_context: An ``ssl.SSLContext`` to secure the
+                        connection with, or ``None``.
+    :param loop: The event loop, or ``None`` for the current event
+                 loop.
+
+    :returns: A future for the protocol, resolved once the
+              connection is established.
+    """
+
+    loop = loop or asyncio.get_event_loop()
+    result = loop.create_future()
+
+    def connected(conn):
+        if conn.cancelled():
+            result.cancel()
+        elif conn.exception() is not None:
+            _resolve(result, exc=conn.exception())
+        else:
+            _resolve(result, conn.result()[1])
+
+    conn = asyncio.ensure_future(loop.create_connection(
+        factory, hub[0], hub[1], ssl=ssl_context), loop=loop)
+    conn.add_done_callback(connected)
+
+    return result
+
+
+def open_session(hub, ssl_context=None, loop=None):
+    """
+    Open a session with the HeyU hub.  Notifications may be submitted
+    over the session by calling its ``notify()`` method, and the
+    session should be closed by calling its ``disconnect()`` method.
+
+    :param hub: The address of the hub, as a tuple of hostname and
+                port.
+    :param ssl_context: An ``ssl.SSLContext`` to secure the
+                        connection with.  If not given, SSL will not
+                        be used.
+    :param loop: The event loop.  Defaults to the current event loop.
+
+    :returns: A future for the ``SubmitterProtocol``.
+    """
+
+    return _connect(functools.partial(SubmitterProtocol, loop=loop),
+                    hub, ssl_context, loop)
+
+
+def subscribe(hub, ssl_context=None, filters=None, epoch=None, since=None,
+              queue_size=QUEUE_SIZE, loop=None):
+    """
+    Subscribe to notifications from the HeyU hub.  The notifications
+    are retrieved by iterating over the subscription with ``async
+    for``, and the subscription should be closed by calling its
+    ``disconnect()`` method.
+
+    :param hub: The address of the hub, as a tuple of hostname and
+                port.
+    :param ssl_context: An ``ssl.SSLContext`` to secure the
+                        connection with.  If not given, SSL will not
+                        be used.
+    :param filters: A dictionary of subscription filter arguments for
+                    the "subscribe" message; see
+                    ``heyu.filters.Filter``.  Optional.
+    :param epoch: The epoch of the hub last subscribed to.  Optional.
+    :param since: The cursor of the last notification received from
+                  the hub, if resubscribing.  Optional.
+    :param queue_size: The maximum number of notifications to buffer
+                       before reading from the hub is paused.
+    :param loop: The event loop.  Defaults to the current event loop.
+
+    :returns: A future for the ``SubscriberProtocol``.
+    """
+
+    factory = functools.partial(SubscriberProtocol, filters, epoch, since,
+                                queue_size, loop=loop)
+
+    return _connect(factory, hub, ssl_context, loop)
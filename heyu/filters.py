@@ -0,0 +1,318 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fnmatch
+
+
+def _parse_category(pattern):
+    """
+    Parse a category pattern.  A pattern is either an exact category,
+    such as "network.connected"; a category prefix, such as
+    "network.*", which matches any category beginning with
+    "network."; or "*", which matches any category.
+
+    :param pattern: The category pattern.
+
+    :returns: A tuple of the list of the dot-separated components of
+              the category and a boolean indicating whether the
+              pattern is a prefix.  For "*", the list is empty.
+    """
+
+    path = pattern.split('.')
+    prefix = path[-1] == '*'
+    if prefix:
+        path.pop()
+
+    # Wildcards are only recognized as the last component
+    if '*' in path or '' in path:
+        raise ValueError("invalid category pattern '%s'" % pattern)
+
+    return path, prefix
+
+
+def _split_app_name(app_name):
+    """
+    Split the application name of a notification forwarded by the hub
+    into the origin host name and the bare application name.
+
+    :param app_name: The application name, as "[hostname]app_name".
+
+    :returns: A tuple of the host name, or ``None`` if the application
+              name does not include one, and the bare application
+              name.
+    """
+
+    if app_name.startswith('['):
+        host, sep, app = app_name[1:].partition(']')
+        if sep:
+            return host, app
+
+    return None, app_name
+
+
+class Filter(object):
+    """
+    Describe the notifications a subscriber wishes to receive.  A
+    notification must satisfy all the criteria given; a criterion that
+    is not given matches all notifications.
+    """
+
+    def __init__(self, categories=(), min_urgency=None, app_names=(),
+                 hosts=()):
+        """
+        Initialize a ``Filter`` object.
+
+        :param categories: A list of category patterns; see
+                           ``_parse_category()``.  Notifications
+                           without a category only match "*".
+        :param min_urgency: The minimum urgency level of notifications
+                            to match.
+        :param app_names: A list of shell-style patterns for the bare
+                          application name.
+        :param hosts: A list of shell-style patterns for the name of
+                      the host the notification originated from.
+        """
+
+        # Validate the category patterns
+        for pattern in categories:
+            _parse_category(pattern)
+
+        self.categories = tuple(sorted(set(categories)))
+        self.min_urgency = min_urgency
+        self.app_names = tuple(app_names)
+        self.hosts = tuple(hosts)
+
+    def match_origin(self, app_name):
+        """
+        Test the application name and origin host name criteria.
+
+        :param app_name: The application name of the notification, as
+                         forwarded by the hub.
+
+        :returns: A ``True`` value if the notification matches those
+                  criteria, ``False`` otherwise.
+        """
+
+        host, app = _split_app_name(app_name)
+
+        if self.app_names and not any(fnmatch.fnmatchcase(app, pattern)
+                                      for pattern in self.app_names):
+            return False
+
+        if self.hosts and (host is None or
+                           not any(fnmatch.fnmatchcase(host, pattern)
+                                   for pattern in self.hosts)):
+            return False
+
+        return True
+
+    def match(self, msg):
+        """
+        Test a notification against all the criteria.  This is the
+        unindexed equivalent of ``SubscriptionIndex.match()``, for
+        testing a few notifications against a single filter.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the notification.
+
+        :returns: A ``True`` value if the notification matches,
+                  ``False`` otherwise.
+        """
+
+        if self.categories:
+            components = msg.category.split('.') if msg.category else None
+            for pattern in self.categories:
+                path, prefix = _parse_category(pattern)
+                if prefix and not path:
+                    break
+                elif components is None:
+                    continue
+                elif prefix:
+                    if (len(components) > len(path) and
+                            components[:len(path)] == path):
+                        break
+                elif components == path:
+                    break
+            else:
+                return False
+
+        if self.min_urgency is not None and msg.urgency < self.min_urgency:
+            return False
+
+        return self.match_origin(msg.app_name)
+
+
+class _TrieNode(object):
+    """
+    A node of the category trie.  Each node corresponds to a category
+    prefix, and records the subscribers matching that category
+    exactly and those matching any category under it.
+    """
+
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        """
+        Initialize a ``_TrieNode`` object.
+        """
+
+        self.children = {}
+        self.exact = set()
+        self.prefix = set()
+
+
+class SubscriptionIndex(object):
+    """
+    Index subscribers by their filters, so that the subscribers
+    matching a notification may be found without testing each filter
+    in turn.  Category patterns are kept in a trie, and minimum urgency
+    levels in buckets; only the application name and host name
+    patterns are tested individually, and only for the subscribers
+    that use them.
+    """
+
+    def __init__(self):
+        """
+        Initialize a ``SubscriptionIndex`` object.
+        """
+
+        self._filters = {}
+
+        # Subscribers that match any category
+        self._any_category = set()
+
+        # The category trie
+        self._trie = _TrieNode()
+
+        # Maps minimum urgency levels to sets of subscribers; None
+        # means any urgency
+        self._urgency = {}
+
+        # Subscribers with application or host name patterns
+        self._patterned = set()
+
+    def __len__(self):
+        """
+        Retrieve the number of subscribers in the index.
+        """
+
+        return len(self._filters)
+
+    def add(self, key, sub_filter):
+        """
+        Add a subscriber to the index.  If the subscriber is already in
+        the index, its filter is replaced.
+
+        :param key: A hashable key identifying the subscriber.
+        :param sub_filter: The ``Filter`` for the subscriber.
+        """
+
+        self.remove(key)
+        self._filters[key] = sub_filter
+
+        # Index the categories
+        if not sub_filter.categories:
+            self._any_category.add(key)
+        for pattern in sub_filter.categories:
+            path, prefix = _parse_category(pattern)
+            if prefix and not path:
+                self._any_category.add(key)
+                continue
+
+            node = self._trie
+            for component in path:
+                node = node.children.setdefault(component, _TrieNode())
+            (node.prefix if prefix else node.exact).add(key)
+
+        # Index the urgency
+        self._urgency.setdefault(sub_filter.min_urgency, set()).add(key)
+
+        # Remember if there are patterns to test
+        if sub_filter.app_names or sub_filter.hosts:
+            self._patterned.add(key)
+
+    def remove(self, key):
+        """
+        Remove a subscriber from the index.  Does nothing if the
+        subscriber is not in the index.
+
+        :param key: The key identifying the subscriber.
+        """
+
+        sub_filter = self._filters.pop(key, None)
+        if sub_filter is None:
+            return
+
+        # Remove the categories, pruning empty trie nodes
+        self._any_category.discard(key)
+        for pattern in sub_filter.categories:
+            path, prefix = _parse_category(pattern)
+
+            nodes = [self._trie]
+            for component in path:
+                nodes.append(nodes[-1].children[component])
+            node = nodes[-1]
+            (node.prefix if prefix else node.exact).discard(key)
+
+            for i in range(len(path), 0, -1):
+                node = nodes[i]
+                if node.children or node.exact or node.prefix:
+                    break
+                del nodes[i - 1].children[path[i - 1]]
+
+        # Remove the urgency
+        bucket = self._urgency[sub_filter.min_urgency]
+        bucket.discard(key)
+        if not bucket:
+            del self._urgency[sub_filter.min_urgency]
+
+        self._patterned.discard(key)
+
+    def match(self, msg):
+        """
+        Find the subscribers matching a notification.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the notification.
+
+        :returns: A set of the keys of the matching subscribers.
+        """
+
+        # Walk the category trie
+        result = set(self._any_category)
+        if msg.category:
+            node = self._trie
+            for component in msg.category.split('.'):
+                result |= node.prefix
+                node = node.children.get(component)
+                if node is None:
+                    break
+            else:
+                result |= node.exact
+
+        # Select the urgency buckets
+        if len(self._urgency) > 1 or None not in self._urgency:
+            urgent = set()
+            for min_urgency, keys in self._urgency.items():
+                if min_urgency is None or msg.urgency >= min_urgency:
+                    urgent |= keys
+            result &= urgent
+
+        # Test the patterns
+        for key in result & self._patterned:
+            if not self._filters[key].match_origin(msg.app_name):
+                result.discard(key)
+
+        return result
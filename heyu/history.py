@@ -0,0 +1,476 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import json
+import os
+import re
+import sqlite3
+import time
+
+import cli_tools
+
+from heyu import filters
+from heyu import notifier
+from heyu import protocol
+
+
+# Default path of the notification history database
+DEFAULT_HISTORY = '~/.heyu.history'
+
+# The maximum number of notifications inserted by the history driver
+# in a single transaction
+HISTORY_BATCH = 1000
+
+# The schema of the history database.  The hub does not timestamp
+# notifications, so "timestamp" is the time the notifier received
+# them.  The hub forwards application names as "[hostname]app_name";
+# "host" and "app_name" are the two parts, so that both may be
+# searched using their indexes.
+_schema = [
+    'CREATE TABLE IF NOT EXISTS notifications ('
+    'timestamp REAL NOT NULL, '
+    'id TEXT, '
+    'host TEXT, '
+    'app_name TEXT NOT NULL, '
+    'summary TEXT NOT NULL, '
+    'body TEXT NOT NULL, '
+    'category TEXT, '
+    'urgency INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS notifications_timestamp '
+    'ON notifications (timestamp)',
+    'CREATE INDEX IF NOT EXISTS notifications_category '
+    'ON notifications (category, timestamp)',
+    'CREATE INDEX IF NOT EXISTS notifications_urgency '
+    'ON notifications (urgency, timestamp)',
+    'CREATE INDEX IF NOT EXISTS notifications_app_name '
+    'ON notifications (app_name, timestamp)',
+    'CREATE INDEX IF NOT EXISTS notifications_host '
+    'ON notifications (host, timestamp)',
+]
+
+# The columns of the notifications table, in order
+_columns = ('timestamp', 'id', 'host', 'app_name', 'summary', 'body',
+            'category', 'urgency')
+
+# Regular expression for parsing an age, such as "90", "30m", or "1h"
+AGE_RE = re.compile(r'^(?P<count>\d+)(?P<unit>[smhdw]?)$')
+
+# The number of seconds in each unit of an age
+_age_units = {
+    '': 1,
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+}
+
+
+class History(object):
+    """
+    A notification history, stored in an SQLite database.  The
+    database uses write-ahead logging, so that queries may run while
+    the history driver is inserting notifications.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a ``History`` object.  The database is created if
+        it does not already exist.
+
+        :param path: The path of the database file.
+        """
+
+        self.path = path
+        self._db = sqlite3.connect(path)
+
+        # Notifications are decoded as byte strings, which must be
+        # stored and returned as such
+        self._db.text_factory = str
+
+        # Write-ahead logging allows concurrent readers, and only
+        # needs a sync at checkpoints
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self._db:
+            for stmt in _schema:
+                self._db.execute(stmt)
+
+    def add(self, msgs, timestamp=None):
+        """
+        Record notifications in the history.  The notifications are
+        inserted in a single transaction.
+
+        :param msgs: A list of the notifications, as
+                     ``heyu.protocol.Message`` objects.
+        :param timestamp: The time the notifications were received.
+                          Defaults to the current time.
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        rows = []
+        for msg in msgs:
+            host, app_name = filters._split_app_name(msg.app_name)
+            rows.append((timestamp, msg.id, host, app_name, msg.summary,
+                         msg.body, msg.category, msg.urgency))
+
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO notifications (%s) VALUES (%s)' %
+                (', '.join(_columns), ', '.join('?' * len(_columns))), rows)
+
+    def query(self, since=None, until=None, categories=(), min_urgency=None,
+              app_names=(), hosts=(), limit=None):
+        """
+        Look up notifications in the history.  The criteria are
+        interpreted as for subscription filters: a notification must
+        satisfy all the criteria given, but only one of several values
+        given for the same criterion.
+
+        :param since: The earliest time a notification may have been
+                      received.  Optional.
+        :param until: The latest time a notification may have been
+                      received.  Optional.
+        :param categories: A list of category patterns, as for
+                           ``heyu.filters.Filter``.
+        :param min_urgency: The minimum urgency of the notifications.
+                            Optional.
+        :param app_names: A list of shell-style patterns for the bare
+                          application name.
+        :param hosts: A list of shell-style patterns for the name of
+                      the origin host.
+        :param limit: The maximum number of notifications to return;
+                      the most recent are returned.  Optional.
+
+        :returns: A list of dictionaries mapping the column names of
+                  the history to their values, in the order the
+                  notifications were received.
+        """
+
+        clauses = []
+        params = []
+
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('timestamp <= ?')
+            params.append(until)
+        if min_urgency is not None:
+            clauses.append('urgency >= ?')
+            params.append(min_urgency)
+
+        # Prefix patterns are turned into ranges, so that the index
+        # on the category may be used
+        if categories:
+            alternatives = []
+            values = []
+            for pattern in categories:
+                path, prefix = filters._parse_category(pattern)
+                if prefix and not path:
+                    break
+                elif prefix:
+                    base = '.'.join(path)
+                    alternatives.append('(category > ? AND category < ?)')
+                    values.extend([base + '.', base + '/'])
+                else:
+                    alternatives.append('category = ?')
+                    values.append(pattern)
+            else:
+                clauses.append('(%s)' % ' OR '.join(alternatives))
+                params.extend(values)
+
+        if app_names:
+            clauses.append('(%s)' % ' OR '.join(
+                ['app_name GLOB ?'] * len(app_names)))
+            params.extend(app_names)
+        if hosts:
+            clauses.append('(%s)' % ' OR '.join(['host GLOB ?'] * len(hosts)))
+            params.extend(hosts)
+
+        stmt = 'SELECT %s FROM notifications' % ', '.join(_columns)
+        if clauses:
+            stmt += ' WHERE ' + ' AND '.join(clauses)
+        stmt += ' ORDER BY timestamp DESC, rowid DESC'
+        if limit is not None:
+            stmt += ' LIMIT ?'
+            params.append(limit)
+
+        rows = [dict(zip(_columns, row))
+                for row in self._db.execute(stmt, params)]
+        rows.reverse()
+        return rows
+
+    def close(self):
+        """
+        Close the database.
+        """
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _parse_age(text):
+    """
+    Parse an age.  Raises a value error if the age is not recognized.
+
+    :param text: The age, as a number of seconds, optionally followed
+                 by one of the units "s", "m", "h", "d", or "w".
+
+    :returns: The age, in seconds.
+    """
+
+    match = AGE_RE.match(text)
+    if not match:
+        raise ValueError('unknown age "%s"' % text)
+
+    return int(match.group('count')) * _age_units[match.group('unit')]
+
+
+def _application(row):
+    """
+    Reconstruct the application name of a notification from the
+    history, as forwarded by the hub.
+
+    :param row: The notification, as a dictionary returned by
+                ``History.query()``.
+
+    :returns: The application name, as "[hostname]app_name" if the
+              origin host name is known.
+    """
+
+    if row['host'] is None:
+        return row['app_name']
+
+    return '[%s]%s' % (row['host'], row['app_name'])
+
+
+def _format_text(row):
+    """
+    Format a notification from the history as text, similarly to the
+    output of the "stdout" notification driver.
+
+    :param row: The notification, as a dictionary returned by
+                ``History.query()``.
+
+    :returns: The formatted notification.
+    """
+
+    return ("%s: ID %s, urgency %s\n"
+            "Application: %s\n"
+            "    Summary: %s\n"
+            "       Body: %s\n"
+            "   Category: %s\n" %
+            (time.strftime('%Y-%m-%d %H:%M:%S',
+                           time.localtime(row['timestamp'])),
+             row['id'], protocol.urgency_names[row['urgency']],
+             _application(row), row['summary'], row['body'],
+             row['category']))
+
+
+def _format_json(row):
+    """
+    Format a notification from the history as a single line of JSON.
+    The keys are those of the file driver's JSON format, with the
+    addition of "timestamp" and "host".
+
+    :param row: The notification, as a dictionary returned by
+                ``History.query()``.
+
+    :returns: The formatted notification.
+    """
+
+    return json.dumps({
+        'timestamp': row['timestamp'],
+        'id': row['id'],
+        'host': row['host'],
+        'application': _application(row),
+        'summary': row['summary'],
+        'body': row['body'],
+        'category': row['category'] or '',
+        'urgency': protocol.urgency_names[row['urgency']],
+    }, sort_keys=True) + '\n'
+
+
+# Formats for notifications printed by "heyu-history"
+_history_formats = {
+    'text': _format_text,
+    'json': _format_json,
+}
+
+
+@cli_tools.argument('history',
+                    help='The file to record notifications in.')
+def history_notification_driver(history, hub, cert_conf=None, secure=True,
+                                filters=None, queue_size=notifier.QUEUE_SIZE,
+                                overflow=notifier.OVERFLOW_DROP_OLDEST,
+                                reconnect=True, max_sleep=notifier.MAX_SLEEP,
+                                threshold=notifier.THRESHOLD,
+                                recover=notifier.RECOVER, server=None):
+    """
+    History notification driver.  This records notifications in an
+    SQLite database, which may be searched using "heyu-history".
+
+    :param history: The path of the database file.
+    :param hub: The address of the hub, as a tuple of hostname and
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
+    :param cert_conf: The path to the certificate configuration file.
+                      Optional.
+    :param secure: If ``False``, SSL will not be used.  Defaults to
+                   ``True``.
+    :param filters: A list of subscription filter criteria, as
+                    returned by ``heyu.notifier._parse_filter()``.
+                    Optional.
+    :param queue_size: The maximum number of notifications that may
+                       be queued awaiting the driver.
+    :param overflow: The policy to apply when the queue is full.
+    :param reconnect: If ``True``, reconnect to the hub whenever the
+                      connection is lost.
+    :param max_sleep: The maximum number of seconds to wait before
+                      reconnecting.
+    :param threshold: The minimum number of seconds a connection must
+                      last to be considered successful.
+    :param recover: A scaling factor for reducing the wait before
+                    reconnecting after a successful connection.
+    :param server: The ``heyu.notifier.NotificationQueue`` to
+                   retrieve the notifications from, if the driver is
+                   run by the "multi" driver.  If not given, a
+                   ``heyu.notifier.NotifierServer`` is set up using
+                   the other arguments.
+    """
+
+    # Open the database...
+    db = History(os.path.expanduser(history))
+
+    try:
+        # Set up the server
+        if server is None:
+            server = notifier.make_server(hub, cert_conf, secure,
+                                          filters=filters,
+                                          queue_size=queue_size,
+                                          overflow=overflow,
+                                          reconnect=reconnect,
+                                          max_sleep=max_sleep,
+                                          threshold=threshold,
+                                          recover=recover)
+        server.start()
+
+        # Record notifications, several at a time
+        while True:
+            try:
+                msgs = server.next_batch(HISTORY_BATCH)
+            except StopIteration:
+                break
+
+            db.add(msgs)
+    finally:
+        db.close()
+
+
+@cli_tools.argument('--history', '-F',
+                    default=DEFAULT_HISTORY,
+                    help='Specifies the notification history database to '
+                    'search.  Defaults to "%(default)s".')
+@cli_tools.argument('--since', '-s',
+                    default=None,
+                    type=_parse_age,
+                    help='Specifies how far back to search, as a number of '
+                    'seconds, optionally followed by "s", "m", "h", "d", or '
+                    '"w" for seconds, minutes, hours, days, or weeks.  By '
+                    'default, the whole history is searched.')
+@cli_tools.argument('--category', '-c',
+                    dest='categories',
+                    action='append',
+                    default=[],
+                    help='Specifies a category to search for.  May end in '
+                    '".*" to match a category prefix.  May be given multiple '
+                    'times.')
+@cli_tools.argument('--urgency', '-u',
+                    dest='min_urgency',
+                    default=None,
+                    choices=sorted(protocol.urgency_map),
+                    help='Specifies the minimum urgency of the notifications '
+                    'to search for.')
+@cli_tools.argument('--app', '-a',
+                    dest='app_names',
+                    action='append',
+                    default=[],
+                    help='Specifies a shell-style pattern for the name of '
+                    'the application to search for.  May be given multiple '
+                    'times.')
+@cli_tools.argument('--host', '-H',
+                    dest='hosts',
+                    action='append',
+                    default=[],
+                    help='Specifies a shell-style pattern for the name of '
+                    'the host to search for.  May be given multiple times.')
+@cli_tools.argument('--limit', '-n',
+                    default=None,
+                    type=int,
+                    help='Specifies the maximum number of notifications to '
+                    'display; the most recent are displayed.')
+@cli_tools.argument('--format', '-f',
+                    dest='fmt',
+                    default='text',
+                    choices=sorted(_history_formats),
+                    help='Specifies the output format: "text" for the format '
+                    'of the "stdout" notifier driver, or "json" for one JSON '
+                    'object per line.  Defaults to "text".')
+def query_history(history=DEFAULT_HISTORY, since=None, categories=(),
+                  min_urgency=None, app_names=(), hosts=(), limit=None,
+                  fmt='text'):
+    """
+    Searches the notification history recorded by the "history"
+    notifier driver.  A notification must match all the given
+    criteria, but only one of several values given for the same
+    criterion.
+
+    :param history: The path of the database file.
+    :param since: The number of seconds back to search.  Optional.
+    :param categories: A list of category patterns.
+    :param min_urgency: The name of the minimum urgency.  Optional.
+    :param app_names: A list of shell-style patterns for the
+                      application name.
+    :param hosts: A list of shell-style patterns for the host name.
+    :param limit: The maximum number of notifications to display.
+                  Optional.
+    :param fmt: The output format; one of the keys of
+                ``_history_formats``.
+    """
+
+    path = os.path.expanduser(history)
+    if not os.path.exists(path):
+        return 'No notification history in "%s"' % history
+
+    db = History(path)
+    try:
+        rows = db.query(
+            since=None if since is None else time.time() - since,
+            categories=categories,
+            min_urgency=(None if min_urgency is None else
+                         protocol.urgency_map[min_urgency]),
+            app_names=app_names, hosts=hosts, limit=limit)
+    finally:
+        db.close()
+
+    for row in rows:
+        print(_history_formats[fmt](row), end='')
@@ -13,18 +13,423 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import os
 import signal
 import socket
+import time
 import uuid
 
 import cli_tools
 import gevent
+import gevent.event
 import tendril
 
+from heyu import filters
+from heyu import journal
 from heyu import protocol
 from heyu import util
 
 
+# Overflow policies for the subscriber outbound queues
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_DISCONNECT = 'disconnect'
+overflow_policies = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST,
+                     OVERFLOW_DISCONNECT)
+
+# The default maximum number of frames queued for a subscriber
+QUEUE_SIZE = 1000
+
+# The capabilities the hub supports
+CAPABILITIES = frozenset([
+    protocol.CAP_BATCH,
+    protocol.CAP_LENGTH_FRAMING,
+    protocol.CAP_ZLIB,
+])
+
+# The framers used for HeyU connections; connections begin with COBS
+# framing, and may negotiate length framing.  Framers keep no per-frame
+# state when streamifying, so a single instance may be shared by all
+# connections, which also lets data framed once be sent to many.
+COBS_FRAMER = tendril.COBSFramer(True)
+LENGTH_FRAMER = tendril.StructFramer(protocol.LENGTH_FORMAT)
+
+# The default maximum number of notifications, and of bytes of
+# encoded notifications, kept for replay to resubscribing notifiers
+REPLAY_SIZE = 100000
+REPLAY_BYTES = 32 * 1024 * 1024
+
+# The maximum number of notifications replayed in each batch
+REPLAY_BATCH = 100
+
+# The arguments of the notifications forwarded to subscribers
+RELAY_ARGS = ('app_name', 'summary', 'body', 'urgency', 'category', 'id')
+
+# The number of bytes that may be pending in a subscriber's send
+# buffer before the drain thread stops feeding it more frames, and the
+# number of seconds to wait before checking again
+SEND_HIGHWATER = 65536
+SEND_POLL = 0.05
+
+# The number of seconds resolved client host names are cached for, the
+# number of seconds failed resolutions are cached for, and the number
+# of cache entries above which expired entries are purged
+HOSTNAME_TTL = 300
+HOSTNAME_NEGATIVE_TTL = 30
+HOSTNAME_CACHE_SIZE = 4096
+
+
+def _resolve_hostname(addr):
+    """
+    Determine the host name of a client.  This performs a blocking
+    reverse lookup.
+
+    :param addr: The address of the client, as a tuple of IP address
+                 and port.
+
+    :returns: The host name of the client.  Raises an exception if
+              the host name cannot be determined.
+    """
+
+    if addr[0] in ('127.0.0.1', '::1'):
+        return socket.getfqdn()
+
+    hostname, _port = socket.getnameinfo(addr, 0)
+    return hostname
+
+
+class HostnameCache(object):
+    """
+    Cache the host names of clients.  Lookups are performed in the
+    gevent thread pool, so that a slow resolver cannot block other
+    threads, and concurrent lookups of the same address share a
+    single resolution.  Failed lookups are cached for a shorter time,
+    with the bare IP address standing in for the host name.  The cache
+    is bounded; once full, expired entries are purged, then the oldest
+    entries are evicted.  The ``hits`` and ``misses`` attributes count
+    cache hits and misses.
+    """
+
+    def __init__(self, ttl=HOSTNAME_TTL, negative_ttl=HOSTNAME_NEGATIVE_TTL,
+                 max_size=HOSTNAME_CACHE_SIZE):
+        """
+        Initialize a ``HostnameCache`` object.
+
+        :param ttl: The number of seconds to cache host names for.
+        :param negative_ttl: The number of seconds to cache failed
+                             lookups for.
+        :param max_size: The maximum number of cache entries.
+        """
+
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_size = max_size
+
+        # Maps IP addresses to tuples of the expiration time, or None
+        # if the lookup is in progress, and a gevent.event.AsyncResult;
+        # entries are kept in the order they were last stored
+        self._cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, addr):
+        """
+        Look up the host name of a client.  This does not block.
+
+        :param addr: The address of the client, as a tuple of IP
+                     address and port.
+
+        :returns: A ``gevent.event.AsyncResult`` object, whose value
+                  will be the host name.
+        """
+
+        now = time.time()
+        entry = self._cache.get(addr[0])
+        if entry is not None and (entry[0] is None or entry[0] > now):
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+
+        # Purge expired entries if the cache is getting big
+        if len(self._cache) >= self._max_size:
+            for key, (expires, _result) in list(self._cache.items()):
+                if expires is not None and expires <= now:
+                    del self._cache[key]
+
+            # Evict the oldest entries if that wasn't enough
+            while self._cache and len(self._cache) >= self._max_size:
+                self._cache.popitem(last=False)
+
+        # Start the lookup
+        result = gevent.event.AsyncResult()
+        self._cache.pop(addr[0], None)
+        self._cache[addr[0]] = (None, result)
+        gevent.spawn(self._resolve, addr, result)
+
+        return result
+
+    def _resolve(self, addr, result):
+        """
+        Resolve the host name of a client in the thread pool, caching
+        the result.
+
+        :param addr: The address of the client, as a tuple of IP
+                     address and port.
+        :param result: The ``gevent.event.AsyncResult`` object to set
+                       to the host name.
+        """
+
+        try:
+            hostname = gevent.get_hub().threadpool.apply(
+                _resolve_hostname, (addr,))
+            ttl = self._ttl
+        except Exception:
+            # Just use the bare address
+            hostname = addr[0]
+            ttl = self._negative_ttl
+
+        # Cache the host name, unless the entry was evicted meanwhile
+        entry = self._cache.get(addr[0])
+        if entry is not None and entry[1] is result:
+            del self._cache[addr[0]]
+            self._cache[addr[0]] = (time.time() + ttl, result)
+        result.set(hostname)
+
+
+class Subscriber(object):
+    """
+    Represent a single notification subscriber.  Notifications
+    submitted to the hub are framed and placed on a bounded outbound
+    queue, which is drained by a thread dedicated to the subscriber;
+    this ensures that a slow or stalled subscriber cannot delay the
+    submitter or any other subscriber.  A queued notification is
+    replaced by a later notification with the same ID, so a slow
+    subscriber only receives the latest version of each notification.
+    """
+
+    def __init__(self, client, version, queue_size=QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST):
+        """
+        Initialize a ``Subscriber`` object.
+
+        :param client: An instance of ``HubApplication`` representing
+                       the subscribing client.
+        :param version: The protocol version to use when communicating
+                        with the client.
+        :param queue_size: The maximum number of frames that may be
+                           queued for the client.
+        :param overflow: The policy to apply when the queue is full.
+                         One of ``OVERFLOW_DROP_OLDEST``,
+                         ``OVERFLOW_DROP_NEWEST``, or
+                         ``OVERFLOW_DISCONNECT``.
+        """
+
+        self.client = client
+        self.version = version
+        self.queue_size = queue_size
+        self.overflow = overflow
+
+        # Count of frames dropped due to overflow
+        self.dropped = 0
+
+        # The outbound queue and its drain thread
+        self._queue = util.CoalescingQueue()
+        self._queue_event = gevent.event.Event()
+        self._thread = gevent.spawn(self._drain)
+
+    def _drain(self):
+        """
+        Implementation of the drain thread.  Waits for framed data to
+        be added to the queue, then sends it to the client, waiting for
+        the client's send buffer to empty out as necessary.
+        """
+
+        # Outer loop: wait for frames to send
+        while True:
+            self._queue_event.wait()
+
+            # Inner loop: send as many frames as we can
+            while self._queue:
+                # Don't overrun the client's send buffer
+                while self.client.backlog > SEND_HIGHWATER:
+                    gevent.sleep(SEND_POLL)
+
+                data = self._queue.popleft()
+                try:
+                    self.client.send_stream(data)
+                except Exception:
+                    # Ignore failures
+                    pass
+
+            # The queue is empty; clear the event so we'll sleep
+            self._queue_event.clear()
+
+    def send(self, data, key=None):
+        """
+        Queue framed data for sending to the client.  This never
+        blocks; if the queue is full, the overflow policy is applied.
+
+        :param data: The framed data to send, as returned by the
+                     client's ``streamify()`` method.
+        :param key: The ID of the notification contained in the data.
+                    Queued data with the same ID is replaced.  If
+                    ``None``, no data is replaced.
+        """
+
+        if key not in self._queue and len(self._queue) >= self.queue_size:
+            self.dropped += 1
+
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                return
+            elif self.overflow == OVERFLOW_DISCONNECT:
+                self.client.disconnect()
+                return
+
+            # Drop the oldest frame to make room
+            self._queue.popleft()
+
+        self._queue.append(data, key)
+        self._queue_event.set()
+
+    @property
+    def coalesced(self):
+        """
+        Retrieve the number of frames replaced by later frames with
+        the same notification ID before they were sent.
+        """
+
+        return self._queue.coalesced
+
+    @property
+    def free(self):
+        """
+        Retrieve the number of frames that may be queued before the
+        overflow policy is applied.
+        """
+
+        return max(self.queue_size - len(self._queue), 0)
+
+    def close(self):
+        """
+        Stop the drain thread and discard any queued frames.
+        """
+
+        if self._thread:
+            self._thread.kill()
+            self._thread = None
+
+        self._queue.clear()
+
+
+class ReplayRing(object):
+    """
+    A bounded ring of the notifications most recently forwarded by the
+    hub, for replay to notifiers which resubscribe after losing their
+    connection.  Each notification is stamped with a cursor, which
+    increases by one with each notification; since the cursors of the
+    notifications in the ring are consecutive, the slot holding a
+    notification is computed directly from its cursor, and the
+    notifications following a given cursor are found without
+    searching.
+    """
+
+    def __init__(self, max_size=REPLAY_SIZE, max_bytes=REPLAY_BYTES,
+                 epoch=None, cursor=0):
+        """
+        Initialize a ``ReplayRing`` object.
+
+        :param max_size: The maximum number of notifications to keep.
+        :param max_bytes: The maximum total size, in bytes, of the
+                          encoded notifications to keep.  The most
+                          recent notification is always kept.
+        :param epoch: The epoch within which cursors are meaningful.
+                      If not given, a new epoch is begun.
+        :param cursor: The cursor of the last notification forwarded
+                       within the epoch.
+        """
+
+        self.max_size = max(max_size, 1)
+        self.max_bytes = max_bytes
+
+        # Cursors are only meaningful within the epoch
+        self.epoch = epoch or str(uuid.uuid4())
+
+        # The slots, each None or a tuple of the notification and its
+        # size, and the cursors of the oldest and newest notifications
+        # held; the ring is empty when oldest > cursor
+        self._slots = [None] * self.max_size
+        self.oldest = cursor + 1
+        self.cursor = cursor
+
+        # The total size of the notifications held
+        self.size = 0
+
+    def __len__(self):
+        """
+        Retrieve the number of notifications in the ring.
+        """
+
+        return self.cursor - self.oldest + 1
+
+    def append(self, msg):
+        """
+        Add a notification to the ring, evicting the oldest
+        notifications as necessary to stay within the limits.
+
+        :param msg: The ``heyu.protocol.Message`` object containing
+                    the notification.
+
+        :returns: A ``heyu.protocol.Message`` object containing the
+                  notification stamped with its cursor.
+        """
+
+        msg = msg.splice(RELAY_ARGS, cursor=self.cursor + 1)
+        size = len(msg.to_frame())
+
+        # Make room for the new notification
+        while len(self) >= self.max_size or (
+                len(self) and self.size + size > self.max_bytes):
+            self._evict()
+
+        self.cursor += 1
+        self._slots[self.cursor % self.max_size] = (msg, size)
+        self.size += size
+
+        return msg
+
+    def _evict(self):
+        """
+        Discard the oldest notification in the ring.
+        """
+
+        slot = self.oldest % self.max_size
+        _msg, size = self._slots[slot]
+        self._slots[slot] = None
+        self.size -= size
+        self.oldest += 1
+
+    def since(self, cursor):
+        """
+        Retrieve the notifications following a cursor.
+
+        :param cursor: The cursor of the last notification seen.
+
+        :returns: A list of the ``heyu.protocol.Message`` objects
+                  containing the notifications following the cursor,
+                  in order, or ``None`` if some of them have already
+                  been evicted.
+        """
+
+        if cursor < self.oldest - 1:
+            return None
+
+        return [self._slots[i % self.max_size][0]
+                for i in range(cursor + 1, self.cursor + 1)]
+
+
 class HubServer(object):
     """
     The core persistent data store for the HeyU hub.  This keeps track
@@ -32,16 +437,51 @@ class HubServer(object):
     on to them.
     """
 
-    def __init__(self, endpoints):
+    def __init__(self, endpoints, queue_size=QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST, replay_size=REPLAY_SIZE,
+                 replay_bytes=REPLAY_BYTES, log=None):
         """
         Initialize a ``HubServer`` object.
 
         :param endpoints: A list of tuples of addresses and ports to
                           listen on.
+        :param queue_size: The maximum number of frames that may be
+                           queued for each subscriber.
+        :param overflow: The policy to apply when a subscriber's queue
+                         is full.  One of ``OVERFLOW_DROP_OLDEST``,
+                         ``OVERFLOW_DROP_NEWEST``, or
+                         ``OVERFLOW_DISCONNECT``.
+        :param replay_size: The maximum number of notifications kept
+                            for replay to resubscribing clients.
+        :param replay_bytes: The maximum total size, in bytes, of the
+                             notifications kept for replay.
+        :param log: An instance of ``heyu.journal.Journal`` in which
+                    to log notifications, so that they may be replayed
+                    after the hub is restarted.  Optional.
         """
 
-        # A dictionary to keep track of the subscribers
+        # A dictionary to keep track of the subscribers, and an index
+        # of their filters
         self._subscribers = {}
+        self._index = filters.SubscriptionIndex()
+        self._queue_size = queue_size
+        self._overflow = overflow
+
+        # Count of frames dropped or coalesced by departed subscribers
+        self._dropped = 0
+        self._coalesced = 0
+
+        # Cache the host names of clients
+        self.hostnames = HostnameCache()
+
+        # Keep recent notifications for replay, continuing the
+        # logged epoch
+        self.log = log
+        if log is None:
+            self.ring = ReplayRing(replay_size, replay_bytes)
+        else:
+            self.ring = ReplayRing(replay_size, replay_bytes, log.epoch,
+                                   log.cursor)
 
         # A dictionary to keep track of the listeners
         self._listeners = {}
@@ -91,8 +531,14 @@ class HubServer(object):
         if self._running:
             raise ValueError('server is already running')
 
-        # Get the wrapper
-        wrapper = util.cert_wrapper(cert_conf, 'hub', secure=secure)
+        # Get the wrapper; all connections share its context, so that
+        # clients may resume their TLS sessions
+        wrapper = util.cert_wrapper(cert_conf, 'hub', server_side=True,
+                                    secure=secure)
+
+        # Start writing the log
+        if self.log is not None:
+            self.log.start()
 
         # Walk through all managers and start them
         for manager in self._listeners.values():
@@ -116,8 +562,12 @@ class HubServer(object):
             manager.stop()
 
         # Now walk through all the subscribers and disconnect them
-        for client, _version in self._subscribers.values():
-            client.disconnect()
+        for sub in list(self._subscribers.values()):
+            sub.client.disconnect()
+
+        # Finish writing the log
+        if self.log is not None:
+            self.log.close()
 
         self._running = False
 
@@ -137,13 +587,22 @@ class HubServer(object):
         for manager in self._listeners.values():
             manager.shutdown()
 
-        # All subscriber connections were closed by shutdown, so clear
-        # the the subscribers list
+        # All subscriber connections were closed by shutdown, so stop
+        # the drain threads and clear the the subscribers list
+        for sub in self._subscribers.values():
+            sub.close()
+            self._dropped += sub.dropped
+            self._coalesced += sub.coalesced
         self._subscribers = {}
+        self._index = filters.SubscriptionIndex()
+
+        # Finish writing the log
+        if self.log is not None:
+            self.log.close()
 
         self._running = False
 
-    def subscribe(self, client, version):
+    def subscribe(self, client, version, sub_filter=None):
         """
         Subscribe a client to notifications.
 
@@ -152,10 +611,16 @@ class HubServer(object):
         :param version: The protocol version to use when communicating
                         with the client.  Currently, the only
                         recognized version is 0.
+        :param sub_filter: An instance of ``heyu.filters.Filter``
+                           describing the notifications the client
+                           wishes to receive.  If not given, the
+                           client receives all notifications.
         """
 
         # Add the client to the dictionary of subscribers
-        self._subscribers[id(client)] = (client, version)
+        self._subscribers[id(client)] = Subscriber(
+            client, version, self._queue_size, self._overflow)
+        self._index.add(id(client), sub_filter or filters.Filter())
 
     def unsubscribe(self, client):
         """
@@ -166,24 +631,259 @@ class HubServer(object):
         """
 
         # Remove the client from the dictionary of subscribers
-        self._subscribers.pop(id(client), None)
+        self._index.remove(id(client))
+        sub = self._subscribers.pop(id(client), None)
+        if sub is not None:
+            sub.close()
+            self._dropped += sub.dropped
+            self._coalesced += sub.coalesced
 
     def submit(self, msg):
         """
-        Submit a notification to all current subscribers.
+        Submit a notification to all current subscribers whose filters
+        it matches.  This only queues the notification for each
+        subscriber, so it never blocks on a slow subscriber.
 
         :param msg: The ``heyu.protocol.Message`` object containing
                     the notification to forward.
         """
 
-        # Forward the message to all subscribers
-        for client, version in self._subscribers.values():
+        msg = self.ring.append(msg)
+        if self.log is not None:
+            self.log.append(msg)
+        self._broadcast(self._index.match(msg), lambda version, batched: [
+            (msg.id, msg.to_frame(version))])
+
+    def submit_batch(self, msgs):
+        """
+        Submit several notifications to all current subscribers whose
+        filters they match.  Subscribers that support batches receive
+        a single "notify_batch" message; others receive the
+        notifications individually.
+
+        :param msgs: A list of ``heyu.protocol.Message`` objects
+                     containing the notifications to forward.
+        """
+
+        msgs = [self.ring.append(msg) for msg in msgs]
+        if self.log is not None:
+            for msg in msgs:
+                self.log.append(msg)
+
+        # Determine the notifications each subscriber is to receive
+        selections = {}
+        for i, msg in enumerate(msgs):
+            for key in self._index.match(msg):
+                selections.setdefault(key, []).append(i)
+
+        # Group the subscribers receiving the same notifications
+        groups = {}
+        for key, selection in selections.items():
+            groups.setdefault(tuple(selection), []).append(key)
+
+        for selection, keys in groups.items():
+            self._broadcast(keys, self._batch_frames(
+                [msgs[i] for i in selection]))
+
+    def missed(self, sub_filter, epoch, since, limit=None):
+        """
+        Find the notifications a resubscribing client missed.
+
+        :param sub_filter: An instance of ``heyu.filters.Filter``
+                           describing the notifications the client
+                           wishes to receive.
+        :param epoch: The epoch of the hub the client was last
+                      subscribed to.
+        :param since: The cursor of the last notification the client
+                      saw, or ``None`` if the client is not
+                      resubscribing.
+        :param limit: The maximum number of notifications to look
+                      back over.  Only the most recent are examined,
+                      and the older ones are reported as missing, so
+                      that a client returning after a long absence
+                      does not cause the whole log to be read.
+                      Optional.
+
+        :returns: A tuple of a list of the ``heyu.protocol.Message``
+                  objects containing the missed notifications matching
+                  the filter, and a boolean indicating whether some
+                  missed notifications are no longer available.
+        """
+
+        if since is None:
+            return [], False
+
+        # If the hub has been restarted, everything was missed
+        if epoch != self.ring.epoch:
+            since = 0
+
+        # Cursors are consecutive, so the window is found directly
+        gap = False
+        if limit is not None and self.ring.cursor - since > limit:
+            since = self.ring.cursor - limit
+            gap = True
+
+        msgs = self._since(since)
+        if msgs is None:
+            gap = True
+            oldest = self.ring.oldest
+            if self.log is not None:
+                oldest = min(oldest, self.log.oldest)
+            msgs = self._since(oldest - 1)
+
+        return [msg for msg in msgs if sub_filter.match(msg)], gap
+
+    def _since(self, cursor):
+        """
+        Retrieve the notifications following a cursor.  The ring is
+        consulted first, then the log, for notifications that have
+        left the ring.
+
+        :param cursor: The cursor of the last notification seen.
+
+        :returns: A list of the ``heyu.protocol.Message`` objects
+                  containing the notifications following the cursor,
+                  or ``None`` if some of them are no longer available.
+        """
+
+        msgs = self.ring.since(cursor)
+        if msgs is not None or self.log is None:
+            return msgs
+
+        frames = self.log.since(cursor, self.ring.oldest - 1)
+        if frames is None:
+            return None
+
+        return ([protocol.Message.from_frame(frame) for frame in frames] +
+                self.ring.since(self.ring.oldest - 1))
+
+    def replay_limit(self, client):
+        """
+        Determine how many missed notifications may be replayed to a
+        subscribed client without overflowing its queue.  Replaying
+        more would drop notifications from the queue, or disconnect
+        the client, without telling it of the gap.
+
+        :param client: An instance of ``HubApplication`` representing
+                       the subscribed client.
+
+        :returns: The maximum number of notifications to replay.
+        """
+
+        sub = self._subscribers.get(id(client))
+        if sub is None:
+            return 0
+
+        # Clients supporting batches receive one frame per batch
+        if protocol.CAP_BATCH in client.capabilities:
+            return sub.free * REPLAY_BATCH
+        return sub.free
+
+    def replay(self, client, msgs):
+        """
+        Queue missed notifications for a resubscribed client.  This
+        must be called after the reply to the subscription has been
+        sent, so that the notifications follow it.
+
+        :param client: An instance of ``HubApplication`` representing
+                       the subscribed client.
+        :param msgs: A list of ``heyu.protocol.Message`` objects
+                     containing the notifications, as returned by
+                     ``missed()``.
+        """
+
+        for i in range(0, len(msgs), REPLAY_BATCH):
+            self._broadcast([id(client)], self._batch_frames(
+                msgs[i:i + REPLAY_BATCH]))
+
+    @staticmethod
+    def _batch_frames(msgs):
+        """
+        Generate a function computing the frames for a batch of
+        notifications, suitable for passing to ``_broadcast()``.
+
+        :param msgs: A list of ``heyu.protocol.Message`` objects
+                     containing the notifications.
+
+        :returns: A callable taking the protocol version and a boolean
+                  indicating whether the subscriber supports batches,
+                  and returning a list of tuples of notification ID
+                  and frame to send.
+        """
+
+        def frames(version, batched):
+            encoded = [msg.to_frame(version) for msg in msgs]
+            if batched:
+                batch = protocol.Message('notify_batch',
+                                         notifications=encoded)
+                return [(None, batch.to_frame(version))]
+            return [(msg.id, frame) for msg, frame in zip(msgs, encoded)]
+
+        return frames
+
+    def _broadcast(self, keys, frames):
+        """
+        Queue frames for a set of subscribers.  The frames are
+        computed, compressed, and framed only once for each
+        combination of protocol version, framer, batch support, and
+        compression support in use, and the same data is queued for
+        every matching subscriber.
+
+        :param keys: The keys of the subscribers to queue the frames
+                     for.
+        :param frames: A callable taking the protocol version and a
+                       boolean indicating whether the subscriber
+                       supports batches, and returning a list of
+                       tuples of notification ID and frame to send.
+                       Frames containing several notifications have
+                       an ID of ``None``, and are never coalesced.
+        """
+
+        streams = {}
+        for key in keys:
+            # The disconnect overflow policy may have unsubscribed the
+            # client
+            sub = self._subscribers.get(key)
+            if sub is None:
+                continue
+
+            client = sub.client
+            batched = protocol.CAP_BATCH in client.capabilities
+            stream_key = (sub.version, client.framer, batched,
+                          protocol.CAP_ZLIB in client.capabilities)
             try:
-                client.send_frame(msg.to_frame(version))
+                data = streams.get(stream_key)
+                if data is None:
+                    data = [(notif_id, client.streamify(frame))
+                            for notif_id, frame in frames(sub.version,
+                                                          batched)]
+                    streams[stream_key] = data
+                for notif_id, item in data:
+                    sub.send(item, notif_id)
             except Exception:
                 # Ignore failures
                 pass
 
+    @property
+    def dropped(self):
+        """
+        Retrieve the total number of frames dropped due to subscriber
+        queue overflows.
+        """
+
+        return self._dropped + sum(sub.dropped
+                                   for sub in self._subscribers.values())
+
+    @property
+    def coalesced(self):
+        """
+        Retrieve the total number of frames replaced in subscriber
+        queues by later notifications with the same ID.
+        """
+
+        return self._coalesced + sum(sub.coalesced
+                                     for sub in self._subscribers.values())
+
 
 class HubApplication(tendril.Application):
     """
@@ -212,18 +912,77 @@ class HubApplication(tendril.Application):
         # Are we a persistent connection?
         self.persist = False
 
-        # Set up the desired framer
-        parent.framers = tendril.COBSFramer(True)
+        # The capabilities negotiated with the client
+        self.capabilities = frozenset()
 
-        # Determine the hostname of the client
-        try:
-            if parent.addr[0] in ('127.0.0.1', '::1'):
-                self.hostname = socket.getfqdn()
-            else:
-                self.hostname, _port = socket.getnameinfo(parent.addr, 0)
-        except Exception:
-            # Just use the bare address
-            self.hostname = parent.addr[0]
+        # Set up the desired framers; outgoing frames are framed by
+        # streamify(), so that a notification need only be framed
+        # once no matter how many subscribers it is sent to
+        self.framer = COBS_FRAMER
+        parent.framers = (tendril.IdentityFramer(), self.framer)
+
+        # Start determining the hostname of the client
+        self._hostname = server.hostnames.lookup(parent.remote_addr)
+
+    @property
+    def hostname(self):
+        """
+        Retrieve the host name of the client.  This waits for the host
+        name lookup to complete, if necessary.
+        """
+
+        return self._hostname.get()
+
+    @property
+    def backlog(self):
+        """
+        Retrieve the number of bytes queued for sending to the client
+        but not yet written to the socket.
+        """
+
+        # Tendril doesn't provide a public interface for this
+        return len(getattr(self.parent, '_sendbuf', ''))
+
+    def streamify(self, frame, compress=True):
+        """
+        Frame a protocol message for sending to the client.  The
+        message is compressed first, if the client supports it.
+
+        :param frame: The encoded protocol message.
+        :param compress: If ``False``, the message is not compressed
+                         even if the client supports it.  This is
+                         used for the reply completing the
+                         negotiation, which the client must be able
+                         to read before it knows the capabilities.
+
+        :returns: The framed data, suitable for passing to
+                  ``send_stream()``.
+        """
+
+        if compress and protocol.CAP_ZLIB in self.capabilities:
+            frame = protocol.compress_frame(frame)
+
+        return self.framer.streamify(None, frame)
+
+    def send_stream(self, data):
+        """
+        Send previously framed data to the client.
+
+        :param data: The framed data, as returned by ``streamify()``.
+        """
+
+        self.parent.send_frame(data)
+
+    def send_frame(self, frame, compress=True):
+        """
+        Send a protocol message to the client.
+
+        :param frame: The encoded protocol message.
+        :param compress: If ``False``, the message is not compressed
+                         even if the client supports it.
+        """
+
+        self.send_stream(self.streamify(frame, compress))
 
     def recv_frame(self, frame):
         """
@@ -235,9 +994,14 @@ class HubApplication(tendril.Application):
 
         # Parse the frame and dispatch to the appropriate handler
         try:
-            msg = protocol.Message.from_frame(frame)
+            msg = protocol.Message.from_frame(
+                frame, compressed=protocol.CAP_ZLIB in self.capabilities)
             if msg.msg_type == 'notify':
                 self.notify(msg)
+            elif msg.msg_type == 'notify_batch':
+                self.notify_batch(msg)
+            elif msg.msg_type == 'hello':
+                self.hello(msg)
             elif msg.msg_type == 'subscribe':
                 self.subscribe(msg)
             elif msg.msg_type == 'goodbye':
@@ -267,16 +1031,8 @@ class HubApplication(tendril.Application):
                     the message.
         """
 
-        # First, determine the message ID
-        id = msg.id or str(uuid.uuid4())
-
-        # Augment the app_name with the origin host name
-        app_name = '[%s]%s' % (self.hostname, msg.app_name)
-
-        # Generate a notification message
-        notif = protocol.Message('notify', id=id, app_name=app_name,
-                                 summary=msg.summary, body=msg.body,
-                                 urgency=msg.urgency, category=msg.category)
+        # Generate the notification message to forward
+        notif = self._relay(msg)
 
         # Submit it to the subscribers
         try:
@@ -284,16 +1040,116 @@ class HubApplication(tendril.Application):
         except Exception as e:
             # Notify of the error
             reason = 'Failed to submit notification: %s' % e
-            reply = protocol.Message('error', reason=reason)
+            reply = protocol.Message('error', reason=reason, seq=msg.seq)
         else:
             # It's been accepted; send the appropriate response
-            reply = protocol.Message('accepted', id=id)
+            reply = protocol.Message('accepted', id=notif.id, seq=msg.seq)
 
         # Send the reply and close the connection if necessary
         self.send_frame(reply.to_frame())
         if not self.persist:
             self.close()
 
+    def notify_batch(self, msg):
+        """
+        A batch of notifications was received; the notifications will be
+        forwarded to the subscribers.  The batch is accepted or
+        rejected as a whole.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the message.
+        """
+
+        try:
+            # Decode all the notifications first
+            notifs = []
+            for frame in msg.notifications:
+                notif = protocol.Message.from_frame(frame)
+                if notif.msg_type != 'notify':
+                    raise ValueError('unexpected message type "%s"' %
+                                     notif.msg_type)
+                notifs.append(self._relay(notif))
+        except (ValueError, TypeError) as e:
+            # Notify of the error
+            reason = 'Failed to decode notification batch: %s' % e
+            reply = protocol.Message('error', reason=reason, seq=msg.seq)
+        else:
+            # Submit them to the subscribers
+            try:
+                self.server.submit_batch(notifs)
+            except Exception as e:
+                # Notify of the error
+                reason = 'Failed to submit notifications: %s' % e
+                reply = protocol.Message('error', reason=reason, seq=msg.seq)
+            else:
+                # They've been accepted; send the appropriate response
+                reply = protocol.Message('accepted_batch',
+                                         ids=[notif.id for notif in notifs],
+                                         seq=msg.seq)
+
+        # Send the reply and close the connection if necessary
+        self.send_frame(reply.to_frame())
+        if not self.persist:
+            self.close()
+
+    def _relay(self, msg):
+        """
+        Generate the notification to forward to the subscribers from a
+        received notification.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the received notification.
+
+        :returns: A ``heyu.protocol.Message`` object describing the
+                  notification to forward.
+        """
+
+        # First, determine the message ID
+        id = msg.id or str(uuid.uuid4())
+
+        # Augment the app_name with the origin host name
+        app_name = '[%s]%s' % (self.hostname, msg.app_name)
+
+        # Generate a notification message; the received frame is
+        # spliced, so the notification body is not re-encoded
+        return msg.splice(('summary', 'body', 'urgency', 'category'),
+                          id=id, app_name=app_name)
+
+    def hello(self, msg):
+        """
+        A session request was received; the connection will be kept
+        open after each notification, so that the client may submit
+        several notifications over the same connection.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the message.
+        """
+
+        # Transform ourself into a persistent client
+        self.persist = True
+
+        # Determine the capabilities we'll use with the client
+        self.capabilities = CAPABILITIES & frozenset(msg.capabilities)
+
+        # Acknowledge the session, then switch to the negotiated
+        # framing; the acknowledgment itself is never compressed
+        reply = protocol.Message(
+            'hello', capabilities=tuple(sorted(self.capabilities)))
+        self.send_frame(reply.to_frame(), compress=False)
+        self._set_framing()
+
+    def _set_framing(self):
+        """
+        Switch to the framing negotiated with the client.  This must be
+        called after the reply completing the negotiation has been
+        sent; the client does not send anything further until it
+        receives that reply.
+        """
+
+        if protocol.CAP_LENGTH_FRAMING in self.capabilities:
+            self.framer = LENGTH_FRAMER
+            self.parent.recv_framer = LENGTH_FRAMER
+
     def subscribe(self, msg):
         """
         A subscription request was received; subscribe the client to
@@ -303,24 +1159,47 @@ class HubApplication(tendril.Application):
                     the message.
         """
 
-        # Subscribe the client to notifications
+        # Determine the capabilities we'll use with the client
+        self.capabilities = CAPABILITIES & frozenset(msg.capabilities)
+
+        # Subscribe the client to notifications, finding what it
+        # missed if it's resubscribing
         try:
-            self.server.subscribe(self, msg.version)
+            sub_filter = filters.Filter(msg.categories, msg.min_urgency,
+                                        msg.app_names, msg.hosts)
+            self.server.subscribe(self, msg.version, sub_filter)
+
+            # Replay only the most recent notifications that fit in
+            # the client's queue, reporting the rest as a gap
+            missed, gap = self.server.missed(
+                sub_filter, msg.epoch, msg.since,
+                self.server.replay_limit(self))
         except Exception as e:
+            # The subscription may have been made; undo it
+            self.server.unsubscribe(self)
+
             # Notify of the error
             reason = 'Failed to subscribe: %s' % e
             reply = protocol.Message('error', reason=reason)
         else:
             # It's been accepted; send the appropriate response
-            reply = protocol.Message('subscribed')
+            reply = protocol.Message(
+                'subscribed', capabilities=tuple(sorted(self.capabilities)),
+                epoch=self.server.ring.epoch,
+                cursor=self.server.ring.cursor, gap=gap)
 
             # Transform ourself into a persistent client
             self.persist = True
 
-        # Send the reply and close the connection if necessary
-        self.send_frame(reply.to_frame())
+        # Send the reply, uncompressed, then close the connection or
+        # switch to the negotiated framing and replay the missed
+        # notifications
+        self.send_frame(reply.to_frame(), compress=False)
         if not self.persist:
             self.close()
+        else:
+            self._set_framing()
+            self.server.replay(self, missed)
 
     def disconnect(self):
         """
@@ -379,9 +1258,55 @@ class HubApplication(tendril.Application):
                     action='store_false',
                     help='Specifies that SSL should not be used to connect '
                     'to the hub.')
+@cli_tools.argument('--queue-size', '-q',
+                    default=QUEUE_SIZE,
+                    type=int,
+                    help='The maximum number of notifications that may be '
+                    'queued for delivery to each notifier.  Defaults to '
+                    '%(default)s.')
+@cli_tools.argument('--overflow', '-O',
+                    default=OVERFLOW_DROP_OLDEST,
+                    choices=overflow_policies,
+                    help='Specifies what to do when a notifier\'s queue is '
+                    'full: drop the oldest queued notification, drop the '
+                    'new notification, or disconnect the notifier.  Defaults '
+                    'to "%(default)s".')
+@cli_tools.argument('--replay-size', '-r',
+                    default=REPLAY_SIZE,
+                    type=int,
+                    help='The maximum number of recent notifications kept '
+                    'for replay to notifiers which reconnect.  Defaults to '
+                    '%(default)s.')
+@cli_tools.argument('--replay-bytes', '-R',
+                    default=REPLAY_BYTES,
+                    type=int,
+                    help='The maximum total size, in bytes, of the recent '
+                    'notifications kept for replay.  Defaults to '
+                    '%(default)s.')
+@cli_tools.argument('--log-dir', '-L',
+                    default=None,
+                    help='Specifies a directory in which to keep a log of '
+                    'notifications, so that notifiers which reconnect after '
+                    'the hub is restarted may be sent the notifications they '
+                    'missed.  By default, no log is kept.')
+@cli_tools.argument('--log-size',
+                    default=journal.MAX_SIZE,
+                    type=int,
+                    help='The maximum total size, in bytes, of the '
+                    'notification log.  Defaults to %(default)s.')
+@cli_tools.argument('--log-age',
+                    default=journal.MAX_AGE,
+                    type=int,
+                    help='The maximum age, in seconds, of notifications in '
+                    'the notification log; 0 means notifications are only '
+                    'discarded when the log is too large.  Defaults to '
+                    '%(default)s.')
 @cli_tools.argument('--debug', '-d',
                     help='Enables debugging.')
-def start_hub(endpoints, cert_conf=None, secure=True):
+def start_hub(endpoints, cert_conf=None, secure=True, queue_size=QUEUE_SIZE,
+              overflow=OVERFLOW_DROP_OLDEST, replay_size=REPLAY_SIZE,
+              replay_bytes=REPLAY_BYTES, log_dir=None,
+              log_size=journal.MAX_SIZE, log_age=journal.MAX_AGE):
     """
     Starts the HeyU hub.  Note that certificate configuration is
     specified in "~/.heyu.cert" by default.
@@ -393,10 +1318,29 @@ def start_hub(endpoints, cert_conf=None, secure=True):
                       Optional.
     :param secure: If ``False``, SSL will not be used.  Defaults to
                    ``True``.
+    :param queue_size: The maximum number of frames that may be
+                       queued for each subscriber.
+    :param overflow: The policy to apply when a subscriber's queue is
+                     full.
+    :param replay_size: The maximum number of notifications kept for
+                        replay to resubscribing notifiers.
+    :param replay_bytes: The maximum total size, in bytes, of the
+                         notifications kept for replay.
+    :param log_dir: The directory in which to keep a log of
+                    notifications.  Optional.
+    :param log_size: The maximum total size, in bytes, of the log.
+    :param log_age: The maximum age, in seconds, of notifications in
+                    the log.
     """
 
+    # Open the log, if requested
+    log = None
+    if log_dir:
+        log = journal.Journal(log_dir, max_size=log_size, max_age=log_age)
+
     # Initialize the server
-    server = HubServer(endpoints)
+    server = HubServer(endpoints, queue_size, overflow, replay_size,
+                       replay_bytes, log)
 
     # Start it
     server.start(cert_conf, secure)
@@ -422,6 +1366,10 @@ def _normalize_args(args):
         args.endpoints = [util.parse_hub(endpoint)
                           for endpoint in args.endpoints]
 
+    # Make sure the log directory survives daemonization
+    if args.log_dir:
+        args.log_dir = os.path.abspath(os.path.expanduser(args.log_dir))
+
     # Go into the background if requested, and not in debug mode
     if args.daemon and not args.debug:
         util.daemonize(pidfile=args.pid_file)
@@ -0,0 +1,599 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import errno
+import mmap
+import os
+import re
+import struct
+import time
+import uuid
+import zlib
+
+import gevent
+import gevent.event
+
+
+# The size, in bytes, above which a new segment file is started
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# The default maximum total size, in bytes, of the segment files, and
+# the default maximum age, in seconds, of a segment file
+MAX_SIZE = 256 * 1024 * 1024
+MAX_AGE = 7 * 24 * 60 * 60
+
+# Every INDEX_INTERVAL-th record of a segment is entered in the
+# segment's sparse index
+INDEX_INTERVAL = 64
+
+# Each record is a header, followed by the frame of a notification
+# forwarded by the hub.  The header contains a magic number, the
+# cursor of the notification, the length of the frame, and its CRC-32.
+RECORD_MAGIC = 'HYLG'
+RECORD_HEADER = struct.Struct('!4sQII')
+
+# Each index entry is the cursor of a record and its offset within the
+# segment
+INDEX_ENTRY = struct.Struct('!QQ')
+
+# Regular expression matching segment file names; segments are named
+# for the cursor of their first record
+SEGMENT_RE = re.compile(r'^(?P<first>\d{16})\.log$')
+
+
+def _scan(data, pos, size):
+    """
+    Decode the journal records in a block of data.  Decoding stops at
+    the first damaged or incomplete record.
+
+    :param data: The data, as a string or ``mmap``.
+    :param pos: The offset of the first record.
+    :param size: The offset at which to stop.
+
+    :returns: A generator yielding tuples of the cursor of the
+              notification, the offset of the record, and the offsets
+              of the start and end of the notification frame.
+    """
+
+    while pos + RECORD_HEADER.size <= size:
+        magic, cursor, length, crc = RECORD_HEADER.unpack_from(data, pos)
+        start = pos + RECORD_HEADER.size
+        end = start + length
+        if (magic != RECORD_MAGIC or end > size or
+                zlib.crc32(data[start:end]) & 0xffffffff != crc):
+            return
+
+        yield cursor, pos, start, end
+        pos = end
+
+
+def _write_chunks(chunks):
+    """
+    Write data to files and sync them to disk.
+
+    :param chunks: A list of tuples of a file descriptor and the data
+                   to append to it.
+    """
+
+    for fd, data in chunks:
+        while data:
+            data = data[os.write(fd, data):]
+
+    for fd in set(fd for fd, _data in chunks):
+        os.fsync(fd)
+
+
+class Segment(object):
+    """
+    Describe a segment file of a journal, and its sparse index.
+    """
+
+    def __init__(self, path, first):
+        """
+        Initialize a ``Segment`` object.
+
+        :param path: The path of the journal directory.
+        :param first: The cursor of the first record in the segment.
+        """
+
+        self.first = first
+        self.path = os.path.join(path, '%016d.log' % first)
+        self.index_path = os.path.join(path, '%016d.idx' % first)
+
+        # The size of the segment file, the number of records in it,
+        # and the cursor of the last of them; these are only tracked
+        # for the last segment
+        self.size = 0
+        self.count = 0
+        self.last = first - 1
+
+        # The sparse index, as parallel lists of cursors and offsets
+        self.cursors = []
+        self.offsets = []
+
+    def load_index(self):
+        """
+        Load the sparse index.  Entries that are damaged, or refer
+        beyond the end of the segment file, are discarded.
+        """
+
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = ''
+
+        self.cursors = []
+        self.offsets = []
+        for pos in range(0, len(data) - INDEX_ENTRY.size + 1,
+                         INDEX_ENTRY.size):
+            cursor, offset = INDEX_ENTRY.unpack_from(data, pos)
+            if offset >= self.size or (self.cursors and (
+                    cursor <= self.cursors[-1] or
+                    offset <= self.offsets[-1])):
+                break
+            self.cursors.append(cursor)
+            self.offsets.append(offset)
+
+    def index(self, cursor, offset):
+        """
+        Add an entry to the sparse index, if the record is due one.
+
+        :param cursor: The cursor of the record.
+        :param offset: The offset of the record in the segment file.
+
+        :returns: The encoded index entry, or an empty string if the
+                  record is not indexed.
+        """
+
+        self.count += 1
+        if (self.count - 1) % INDEX_INTERVAL:
+            return ''
+
+        self.cursors.append(cursor)
+        self.offsets.append(offset)
+        return INDEX_ENTRY.pack(cursor, offset)
+
+    def read(self, since, until, frames, limit=None):
+        """
+        Read notification frames from the segment.  The sparse index
+        is used to find the first record to read, and the segment file
+        is mapped into memory rather than read.
+
+        :param since: Frames of notifications with cursors greater
+                      than this are read.
+        :param until: Frames of notifications with cursors up to and
+                      including this are read.
+        :param frames: A list of tuples of cursor and frame, to which
+                       the frames read are appended.
+        :param limit: The length ``frames`` may reach; reading stops
+                      there.  Optional.
+        """
+
+        # Find the last indexed record at or before the first wanted
+        i = bisect.bisect_right(self.cursors, since + 1) - 1
+        pos = self.offsets[i] if i >= 0 else 0
+
+        try:
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size <= pos:
+                    return
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except EnvironmentError:
+            return
+
+        try:
+            for cursor, _pos, start, end in _scan(data, pos, size):
+                if cursor > until or (limit is not None and
+                                      len(frames) >= limit):
+                    break
+                elif cursor > since:
+                    frames.append((cursor, data[start:end]))
+        finally:
+            data.close()
+
+
+class Journal(object):
+    """
+    A persistent log of the notifications forwarded by the hub, so
+    that notifiers may be sent the notifications they missed even
+    across hub restarts.  Notifications are appended to segment files,
+    which are deleted when the journal grows too large or they grow
+    too old; each segment has a sparse index of the positions of its
+    records, so that reading from a given cursor and recovering the
+    end of the journal at startup only decode a handful of records.
+    Appends are written and synced by a dedicated thread, in groups,
+    so that appending never waits for the disk.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_size=MAX_SIZE,
+                 max_age=MAX_AGE):
+        """
+        Initialize a ``Journal`` object.  The journal is recovered from
+        the segment files.
+
+        :param path: The path of the journal directory.  The path is
+                     tilde-expanded, and the directory is created if
+                     it does not exist.
+        :param segment_size: The size, in bytes, above which a new
+                             segment file is started.
+        :param max_size: The maximum total size, in bytes, of the
+                         segment files.
+        :param max_age: The maximum age, in seconds, of the last
+                        record in a segment file.  If 0 or ``None``,
+                        segments are not expired by age.
+        """
+
+        self._path = os.path.expanduser(path)
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+
+        try:
+            os.makedirs(self._path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # The active segment's files
+        self._fd = None
+        self._index_fd = None
+
+        # Records not yet written, and records being written, as
+        # lists of tuples of cursor and frame
+        self._pending = []
+        self._writing = []
+
+        # The writer thread, the event waking it up, and the event
+        # signaling that all records have been written
+        self._writer = None
+        self._wakeup = gevent.event.Event()
+        self._idle = gevent.event.Event()
+        self._idle.set()
+
+        # Count of records that could not be written
+        self.failed = 0
+
+        # Recover the segments; the cursor is that of the last record
+        self._segments = []
+        self._recover()
+        self.cursor = self._segments[-1].last if self._segments else 0
+
+        # Cursors are only meaningful within an epoch; a journal with
+        # no history begins a new one
+        self.epoch = self._load_epoch()
+
+    def _file(self, name):
+        """
+        Compute the path of a file in the journal directory.
+
+        :param name: The name of the file.
+
+        :returns: The path of the file.
+        """
+
+        return os.path.join(self._path, name)
+
+    def _recover(self):
+        """
+        Load the segments and their indexes.  Only the last segment is
+        scanned, starting from its last index entry; any incomplete
+        record at its end is truncated.
+        """
+
+        self._close_active()
+
+        self._segments = []
+        for name in sorted(os.listdir(self._path)):
+            match = SEGMENT_RE.match(name)
+            if not match:
+                continue
+
+            seg = Segment(self._path, int(match.group('first')))
+            seg.size = os.path.getsize(seg.path)
+            seg.load_index()
+            self._segments.append(seg)
+
+        if not self._segments:
+            return
+
+        # Find the end of the last segment, re-indexing the records
+        # following its last index entry
+        seg = self._segments[-1]
+        pos = seg.offsets[-1] if seg.offsets else 0
+        seg.count = max(len(seg.offsets) - 1, 0) * INDEX_INTERVAL
+        del seg.cursors[-1:]
+        del seg.offsets[-1:]
+        end = pos
+        with open(seg.path, 'rb') as f:
+            f.seek(pos)
+            data = f.read()
+        for cursor, rec_pos, _start, rec_end in _scan(data, 0, len(data)):
+            seg.index(cursor, pos + rec_pos)
+            seg.last = cursor
+            end = pos + rec_end
+
+        # Discard the incomplete record and rewrite the index
+        if end < seg.size:
+            with open(seg.path, 'r+b') as f:
+                f.truncate(end)
+            seg.size = end
+        with open(seg.index_path, 'wb') as f:
+            f.write(''.join(INDEX_ENTRY.pack(cursor, offset) for
+                            cursor, offset in zip(seg.cursors, seg.offsets)))
+
+    def _load_epoch(self):
+        """
+        Load the epoch of the journal, beginning a new epoch if the
+        journal has no history.
+
+        :returns: The epoch.
+        """
+
+        if self._segments:
+            try:
+                with open(self._file('epoch')) as f:
+                    epoch = f.read().strip()
+                if epoch:
+                    return epoch
+            except EnvironmentError:
+                pass
+
+        # Save a new epoch; the rename is atomic
+        epoch = str(uuid.uuid4())
+        tmp = self._file('epoch.tmp')
+        with open(tmp, 'w') as f:
+            f.write(epoch + '\n')
+        os.rename(tmp, self._file('epoch'))
+
+        return epoch
+
+    @property
+    def oldest(self):
+        """
+        Retrieve the cursor of the oldest notification in the journal.
+        """
+
+        return self._segments[0].first if self._segments else self.cursor + 1
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write)
+
+    def close(self):
+        """
+        Write any pending records, then stop the writer thread and
+        close the journal.
+        """
+
+        if self._writer is not None:
+            self.flush()
+            self._writer.kill()
+            self._writer = None
+
+        while self._pending:
+            self._write_pending()
+
+        self._close_active()
+
+    def flush(self):
+        """
+        Wait until all appended records have been written.  The writer
+        thread must be running.
+        """
+
+        self._idle.wait()
+
+    def append(self, msg):
+        """
+        Append a notification to the journal.  The notification is
+        written and synced by the writer thread; this never blocks.
+
+        :param msg: The ``heyu.protocol.Message`` object containing
+                    the notification, stamped with its cursor.
+        """
+
+        self._pending.append((msg.cursor, msg.to_frame()))
+        self.cursor = msg.cursor
+
+        self._idle.clear()
+        self._wakeup.set()
+
+    def _write(self):
+        """
+        Implementation of the writer thread.  Waits for records to be
+        appended, then writes all the appended records at once.
+        """
+
+        while True:
+            self._wakeup.wait()
+
+            # Records appended while writing are written together
+            while self._pending:
+                self._write_pending()
+
+            self._wakeup.clear()
+            self._idle.set()
+
+    def _write_pending(self):
+        """
+        Write the pending records and sync them to disk.  The writes
+        are performed in the gevent thread pool.
+        """
+
+        self._writing, self._pending = self._pending, []
+
+        # Lay the records out, rotating segments as needed
+        chunks = []
+        retired = []
+        for cursor, frame in self._writing:
+            seg = self._segments[-1] if self._segments else None
+            if self._fd is None or seg.size >= self.segment_size:
+                if self._fd is not None:
+                    retired.extend([self._fd, self._index_fd])
+                self._fd = self._index_fd = None
+                seg = self._open(cursor)
+
+            record = RECORD_HEADER.pack(RECORD_MAGIC, cursor, len(frame),
+                                        zlib.crc32(frame) & 0xffffffff)
+            chunks.append((self._fd, record + frame))
+            entry = seg.index(cursor, seg.size)
+            if entry:
+                chunks.append((self._index_fd, entry))
+            seg.size += len(record) + len(frame)
+            seg.last = cursor
+
+        try:
+            gevent.get_hub().threadpool.apply(_write_chunks, (chunks,))
+        except EnvironmentError:
+            # Recover a consistent view of the segments; the records
+            # are lost
+            self.failed += len(self._writing)
+            self._recover()
+        finally:
+            self._writing = []
+            for fd in retired:
+                os.close(fd)
+
+        self._expire()
+
+    def _open(self, first):
+        """
+        Start a new segment.
+
+        :param first: The cursor of the first record in the segment.
+
+        :returns: The ``Segment`` object.
+        """
+
+        # Replace the last segment if it is empty
+        if self._segments and not self._segments[-1].size:
+            self._remove(self._segments.pop())
+
+        seg = Segment(self._path, first)
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self._fd = os.open(seg.path, flags, 0o600)
+        self._index_fd = os.open(seg.index_path, flags, 0o600)
+        self._segments.append(seg)
+
+        return seg
+
+    def _close_active(self):
+        """
+        Close the files of the active segment.  Records are appended to
+        a new segment after this.
+        """
+
+        for fd in (self._fd, self._index_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = None
+        self._index_fd = None
+
+    def _expire(self):
+        """
+        Delete the oldest segments while the journal is too large, or
+        they are too old.  The active segment is never deleted.
+        """
+
+        total = sum(seg.size for seg in self._segments)
+        horizon = time.time() - self.max_age if self.max_age else None
+        while len(self._segments) > 1:
+            seg = self._segments[0]
+            if total <= self.max_size and (
+                    horizon is None or _mtime(seg.path) >= horizon):
+                break
+
+            self._remove(self._segments.pop(0))
+            total -= seg.size
+
+    def _remove(self, seg):
+        """
+        Delete the files of a segment.
+
+        :param seg: The ``Segment`` object.
+        """
+
+        for path in (seg.path, seg.index_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def since(self, cursor, until=None, limit=None):
+        """
+        Retrieve the notifications following a cursor.
+
+        :param cursor: The cursor of the last notification seen.
+        :param until: The cursor of the last notification to retrieve.
+                      If not given, all the following notifications
+                      are retrieved.
+        :param limit: The maximum number of notifications to retrieve;
+                      the first ones following the cursor are
+                      retrieved, and the rest of the journal is not
+                      read.  Optional.
+
+        :returns: A list of the frames of the notifications following
+                  the cursor, in order, or ``None`` if some of them are
+                  no longer in the journal.
+        """
+
+        if cursor < self.oldest - 1:
+            return None
+        if until is None:
+            until = self.cursor
+
+        # Find the segment holding the first notification wanted
+        firsts = [seg.first for seg in self._segments]
+        i = max(bisect.bisect_right(firsts, cursor + 1) - 1, 0)
+
+        frames = []
+        for seg in self._segments[i:]:
+            if seg.first > until or (limit is not None and
+                                     len(frames) >= limit):
+                break
+            seg.read(max(cursor, frames[-1][0] if frames else cursor),
+                     until, frames, limit)
+
+        # Add the records that haven't reached the disk
+        for rec_cursor, frame in self._writing + self._pending:
+            if limit is not None and len(frames) >= limit:
+                break
+            if rec_cursor <= until and rec_cursor > (
+                    frames[-1][0] if frames else cursor):
+                frames.append((rec_cursor, frame))
+
+        return [frame for _cursor, frame in frames]
+
+
+def _mtime(path):
+    """
+    Retrieve the modification time of a file.
+
+    :param path: The path of the file.
+
+    :returns: The modification time, or 0 if the file does not exist.
+    """
+
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
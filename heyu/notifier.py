@@ -15,18 +15,27 @@
 
 from __future__ import print_function
 
+import argparse
+import hashlib
+import json
 import os
+import shlex
 import signal
 import string
-import subprocess
+import struct
 import sys
+import time
 import uuid
 
 import cli_tools
 import gevent
 import gevent.event
+import gevent.pool
+import gevent.subprocess
+import msgpack
 import tendril
 
+from heyu import filters
 from heyu import protocol
 from heyu import util
 
@@ -36,16 +45,258 @@ CONNECTED = 'network.connected'
 DISCONNECTED = 'network.disconnected'
 ERROR = 'network.error'
 
+# Overflow policies for the notification queue
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+overflow_policies = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
 
-class NotifierServer(object):
+# The default maximum number of notifications queued for the driver
+QUEUE_SIZE = 10000
+
+# The defaults for remembering the notifications received from
+# several hubs, to discard duplicates; see ``heyu.util.SeenSet``
+DEDUP_WINDOW = 300
+DEDUP_SIZE = 100000
+
+# The defaults for the delays between attempts to reconnect to the
+# hub; see ``heyu.util.Backoff``
+MAX_SLEEP = 300
+THRESHOLD = 30
+RECOVER = 5
+
+
+class NotificationQueue(object):
+    """
+    A queue of notifications awaiting a notification driver.  Drivers
+    iterate over the queue, or call ``next_batch()``, to retrieve the
+    notifications.  A queued notification is replaced by a later one
+    with the same ID, so a slow driver only sees the latest version.
+    Subclasses must implement ``start()`` and ``running``.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST):
+        """
+        Initialize a ``NotificationQueue`` object.
+
+        :param queue_size: The maximum number of notifications that
+                           may be queued awaiting the driver.
+        :param overflow: The policy to apply when the queue is full.
+                         One of the values in ``overflow_policies``.
+        """
+
+        self._notifications = util.CoalescingQueue()
+        self._notify_event = gevent.event.Event()
+        self._queue_size = queue_size
+        self._overflow = overflow
+
+        # Count of notifications dropped due to overflow
+        self.dropped = 0
+
+        # The queues of the drivers sharing the notifications, if any
+        self._driver_queues = []
+
+    def __iter__(self):
+        """
+        Implementation of the iteration protocol.  Iteration over the
+        object yields an endless stream of notifications.
+
+        :returns: The server object.
+        """
+
+        # Ensure we're running
+        if not self.running:
+            self.start()
+
+        return self
+
+    def next(self):
+        """
+        Implementation of the iteration protocol.
+
+        :returns: The next notification from the queue, as a
+                  ``heyu.protocol.Message`` object.
+        """
+
+        return self.next_batch(1)[0]
+
+    def next_batch(self, max_items, timeout=None):
+        """
+        Retrieve several notifications from the queue at once, waiting
+        for at least one to arrive.  This allows drivers to handle a
+        burst of notifications with a single wakeup.  Like ``next()``,
+        raises ``StopIteration`` if the server has stopped and no
+        notifications remain.
+
+        :param max_items: The maximum number of notifications to
+                          return.
+        :param timeout: The maximum number of seconds to wait for a
+                        notification.  If ``None``, waits until a
+                        notification arrives.
+
+        :returns: A list of up to ``max_items`` notifications, as
+                  ``heyu.protocol.Message`` objects.  The list is
+                  empty only if the timeout expired.
+        """
+
+        # We may have to loop through a few times before a condition
+        # is met, but we will eventually exit either by returning
+        # notification messages or by raising StopIteration
+        while True:
+            # Pop off as many notifications as we can
+            batch = []
+            while len(batch) < max_items:
+                try:
+                    msg = self._notifications.popleft()
+                except IndexError:
+                    break
+
+                # A notification of None indicates that it's time to
+                # exit, but deliver the notifications before it first
+                if msg is None:
+                    if not batch:
+                        sys.exit()
+                    self._notifications.append(None)
+                    break
+
+                batch.append(msg)
+
+            if batch:
+                return batch
+
+            # Indicates there are no notifications...
+            self._notify_event.clear()
+
+            # Are we still running?
+            if not self.running:
+                raise StopIteration()
+
+            # OK, wait for a new notification
+            if not self._notify_event.wait(timeout):
+                return []
+
+    def put(self, msg):
+        """
+        Queue up a new notification to be produced by the iterator,
+        applying the overflow policy if the queue is full.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        # Apply the overflow policy if the queue is full; a
+        # notification replacing a queued one needs no more room
+        if (msg.id not in self._notifications and
+                len(self._notifications) >= self._queue_size):
+            self.dropped += 1
+
+            if self._overflow == OVERFLOW_DROP_NEWEST:
+                return
+
+            # Drop the oldest notification to make room
+            self._notifications.popleft()
+
+        # Append the notification and set the event
+        self._notifications.append(msg, msg.id)
+        self._notify_event.set()
+
+    def wakeup(self, sentinel=False):
+        """
+        Wake up the driver after the server has stopped, so that
+        retrieving notifications doesn't block.
+
+        :param sentinel: If ``True``, the driver exits once the queued
+                         notifications have been retrieved.
+        """
+
+        if sentinel:
+            self._notifications.append(None)
+
+        self._notify_event.set()
+
+    def discard(self):
+        """
+        Discard the queued notifications and wake up the driver, which
+        exits immediately.
+        """
+
+        self._notifications.clear()
+        self.wakeup(True)
+
+    def driver_queue(self):
+        """
+        Create a queue for one of several drivers sharing the
+        notifications.  Each driver retrieves the notifications from
+        its own queue, so that a slow driver doesn't hold up the
+        others.
+
+        :returns: A ``DriverQueue`` object.
+        """
+
+        queue = DriverQueue(self, self._queue_size, self._overflow)
+        self.add_queue(queue)
+        return queue
+
+    def add_queue(self, queue):
+        """
+        Add a queue to deliver the notifications to.  Once a queue has
+        been added, notifications are no longer queued on this object
+        itself.
+
+        :param queue: The queue.  Must provide the ``put()``,
+                      ``wakeup()``, and ``discard()`` methods of
+                      ``NotificationQueue``.
+        """
+
+        self._driver_queues.append(queue)
+
+    def _queues(self):
+        """
+        Determine the queues notifications should be added to.
+
+        :returns: A list of the driver queues, or of this queue
+                  itself if there are none.
+        """
+
+        return self._driver_queues or [self]
+
+    def start(self):
+        """
+        Start the server providing the notifications.
+        """
+
+        raise NotImplementedError()  # pragma: no cover
+
+    @property
+    def running(self):
+        """
+        Determine whether the server providing the notifications is
+        running.
+        """
+
+        raise NotImplementedError()  # pragma: no cover
+
+    @property
+    def coalesced(self):
+        """
+        Retrieve the number of queued notifications that were replaced
+        by later notifications with the same ID before being consumed.
+        """
+
+        return self._notifications.coalesced
+
+
+class NotifierServer(NotificationQueue):
     """
     Notifier server.  Notifiers instantiate this class, then iterate
     over it to retrieve the actual notifications, which they then
-    handle.
+    handle.  Several drivers may share the server by each retrieving
+    the notifications from a queue returned by ``driver_queue()``.
     """
 
     def __init__(self, hub, cert_conf=None, secure=True, app_name=None,
-                 app_id=None):
+                 app_id=None, filters=None, queue_size=QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST, reconnect=False,
+                 max_sleep=MAX_SLEEP, threshold=THRESHOLD, recover=RECOVER):
         """
         Initialize a ``NotifierServer`` object.
 
@@ -61,6 +312,29 @@ class NotifierServer(object):
         :param app_id: A UUID for notifications generated internal to
                        the notifier.  If not specified, a random UUID
                        will be generated.
+        :param filters: A list of tuples of the name and value of
+                        subscription filter criteria, as returned by
+                        ``_parse_filter()``.  If not specified, all
+                        notifications will be received.
+        :param queue_size: The maximum number of notifications that
+                           may be queued awaiting the driver.
+        :param overflow: The policy to apply when the queue is full.
+                         One of the values in ``overflow_policies``.
+        :param reconnect: If ``True``, the server reconnects to the
+                          hub whenever the connection is lost, and
+                          resubscribes; iteration only ends when the
+                          server is stopped.  Defaults to ``False``.
+        :param max_sleep: The maximum number of seconds to wait
+                          before reconnecting.
+        :param threshold: The minimum number of seconds a connection
+                          must last to be considered successful.  The
+                          wait before reconnecting is doubled after an
+                          unsuccessful connection, and reduced
+                          linearly after a successful one.
+        :param recover: A scaling factor used for linear decrease in
+                        the wait before reconnecting.  The number of
+                        seconds the connection lasted is divided by
+                        this factor and subtracted from the last wait.
         """
 
         # Handle the arguments
@@ -72,10 +346,31 @@ class NotifierServer(object):
         self._app_name = app_name or os.path.basename(sys.argv[0])
         self._app_id = app_id or str(uuid.uuid4())
 
-        # Track running status and the queue of notifications
+        # Build the subscription filter arguments; all criteria but the
+        # minimum urgency may be given several times
+        self._filters = {}
+        for name, value in filters or ():
+            if name == 'min_urgency':
+                self._filters[name] = value
+            else:
+                self._filters.setdefault(name, []).append(value)
+
+        # Set up the queue of notifications
+        super(NotifierServer, self).__init__(queue_size, overflow)
+
+        # Track running status
         self._hub_app = None
-        self._notifications = []
-        self._notify_event = gevent.event.Event()
+
+        # The reconnection delays and the pending reconnection, if any
+        self._backoff = (util.Backoff(max_sleep, threshold, recover)
+                         if reconnect else None)
+        self._retry = None
+
+        # The epoch of the hub and the cursor of the last notification
+        # it forwarded, so missed notifications may be replayed when
+        # resubscribing
+        self._epoch = None
+        self._cursor = None
 
         # Set up behavior on signals
         gevent.signal(signal.SIGINT, self.stop)
@@ -87,54 +382,6 @@ class NotifierServer(object):
             # Ignore errors; SIGUSR1 isn't everywhere
             pass
 
-    def __iter__(self):
-        """
-        Implementation of the iteration protocol.  Iteration over the
-        object yields an endless stream of notifications.
-
-        :returns: The server object.
-        """
-
-        # Ensure we're running
-        if self._hub_app is None:
-            self.start()
-
-        return self
-
-    def next(self):
-        """
-        Implementation of the iteration protocol.
-
-        :returns: The next notification from the queue, as a
-                  ``heyu.protocol.Message`` object.
-        """
-
-        # We may have to loop through a few times before a condition
-        # is met, but we will eventually exit either by returning a
-        # notification message or by raising StopIteration
-        while True:
-            # If there's a notification on the queue, pop it off and
-            # return it
-            try:
-                msg = self._notifications.pop(0)
-            except IndexError:
-                # Indicates there are no notifications...
-                self._notify_event.clear()
-            else:
-                # A notification of None indicates that it's time to
-                # exit
-                if msg is None:
-                    sys.exit()
-
-                return msg
-
-            # Are we still running?
-            if self._hub_app is None:
-                raise StopIteration()
-
-            # OK, wait for a new notification
-            self._notify_event.wait()
-
     def _acceptor(self, tend):
         """
         Called when a connection is established.  Acceptable for use as an
@@ -148,7 +395,8 @@ class NotifierServer(object):
 
         # Set up the application
         self._hub_app = NotifierApplication(tend, self, self._app_name,
-                                            self._app_id)
+                                            self._app_id, self._filters,
+                                            self._epoch, self._cursor)
 
         # Return the application
         return self._hub_app
@@ -172,7 +420,58 @@ class NotifierServer(object):
 
         # Start the manager and connect to the hub
         self._manager.start()
-        self._manager.connect(self._hub, self._acceptor, self._wrapper)
+        self._connect()
+
+    def _connect(self):
+        """
+        Connect to the HeyU hub.  If reconnection is enabled, a failure
+        to connect schedules another attempt; otherwise, the exception
+        is raised.
+        """
+
+        self._retry = None
+        try:
+            self._manager.connect(self._hub, self._acceptor, self._wrapper)
+        except Exception:
+            if self._backoff is None:
+                raise
+            self._reconnect()
+
+    def _reconnect(self):
+        """
+        Schedule an attempt to reconnect to the HeyU hub.  The attempt
+        runs from a gevent timer, so the notifications already queued
+        may still be consumed, and signals handled, while waiting.
+        """
+
+        # Don't reconnect if we've been stopped in the meantime
+        if self._hub_app is None:
+            return
+
+        # The connection is pending again
+        self._hub_app = True
+        self._retry = gevent.spawn_later(self._backoff.next_delay(),
+                                         self._connect)
+
+    def disconnected(self, app):
+        """
+        Called when the connection to the HeyU hub is lost.  If
+        reconnection is enabled, this schedules an attempt to
+        reconnect, and the missed notifications are replayed by the hub
+        once resubscribed; otherwise, the server is stopped.
+
+        :param app: The ``NotifierApplication`` of the lost
+                    connection.  Connections other than the current
+                    one are ignored, since a connection may report
+                    being closed more than once.
+        """
+
+        if app is not self._hub_app:
+            return
+        elif self._backoff is None:
+            self.stop()
+        else:
+            self._reconnect()
 
     def stop(self, *args):
         """
@@ -185,8 +484,11 @@ class NotifierServer(object):
         if self._hub_app is None:
             return
 
-        # Stop the manager
+        # Stop the manager and cancel any reconnection
         self._manager.stop()
+        if self._retry is not None:
+            self._retry.kill()
+            self._retry = None
 
         # Disconnect the client if we can
         if self._hub_app is not True:
@@ -194,13 +496,11 @@ class NotifierServer(object):
 
         self._hub_app = None
 
-        # If arguments were passed, we were called via a signal; add a
-        # sentinel to the queue to indicate that we should exit
-        if args:
-            self._notifications.append(None)
-
-        # Set the flag on the event to ensure next() doesn't block
-        self._notify_event.set()
+        # Ensure next() doesn't block; if arguments were passed, we
+        # were called via a signal, so also indicate that we should
+        # exit
+        for queue in self._queues():
+            queue.wakeup(bool(args))
 
     def shutdown(self, *args):
         """
@@ -214,17 +514,18 @@ class NotifierServer(object):
         if self._hub_app is None:
             return
 
-        # Shut down the manager
+        # Shut down the manager and cancel any reconnection
         self._manager.shutdown()
+        if self._retry is not None:
+            self._retry.kill()
+            self._retry = None
 
         # The client was closed by the shutdown, so clear _hub_app
         self._hub_app = None
 
         # This also clears the pending notifications
-        self._notifications = [None]
-
-        # Set the flag on the event to ensure next() doesn't block
-        self._notify_event.set()
+        for queue in self._queues():
+            queue.discard()
 
     def notify(self, msg):
         """
@@ -233,9 +534,38 @@ class NotifierServer(object):
         :param msg: A dictionary describing the notification.
         """
 
-        # Append the notification and set the event
-        self._notifications.append(msg)
-        self._notify_event.set()
+        # Remember how far through the hub's notifications we are
+        if msg.cursor is not None:
+            self._cursor = msg.cursor
+
+        # Queue the notification for each driver
+        for queue in self._queues():
+            queue.put(msg)
+
+    def subscribed(self, epoch, cursor):
+        """
+        Called when the subscription to the hub has been established.
+
+        :param epoch: The epoch of the hub.
+        :param cursor: The cursor of the last notification forwarded
+                       by the hub.
+        """
+
+        # Within the same epoch, the missed notifications are
+        # replayed, and advance the cursor as they arrive; otherwise,
+        # they are replayed from the start of the epoch, unless this
+        # is the first subscription
+        if epoch != self._epoch:
+            self._cursor = cursor if self._epoch is None else 0
+            self._epoch = epoch
+
+    @property
+    def running(self):
+        """
+        Determine whether the server is running.
+        """
+
+        return self._hub_app is not None
 
     @property
     def app_name(self):
@@ -254,13 +584,286 @@ class NotifierServer(object):
         return self._app_id
 
 
+class DriverQueue(NotificationQueue):
+    """
+    The queue of notifications for one of several drivers sharing a
+    ``NotifierServer`` or ``MultiHubServer``.  The driver uses it in
+    place of the server.
+    """
+
+    def __init__(self, server, queue_size=QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST):
+        """
+        Initialize a ``DriverQueue`` object.
+
+        :param server: The ``NotifierServer`` or ``MultiHubServer``
+                       providing the notifications.
+        :param queue_size: The maximum number of notifications that
+                           may be queued awaiting the driver.
+        :param overflow: The policy to apply when the queue is full.
+                         One of the values in ``overflow_policies``.
+        """
+
+        super(DriverQueue, self).__init__(queue_size, overflow)
+
+        self._server = server
+
+    def start(self):
+        """
+        Start the server, unless another driver already has.
+        """
+
+        if not self._server.running:
+            self._server.start()
+
+    @property
+    def running(self):
+        """
+        Determine whether the server is running.
+        """
+
+        return self._server.running
+
+    @property
+    def app_name(self):
+        """
+        Retrieve the application name.
+        """
+
+        return self._server.app_name
+
+    @property
+    def app_id(self):
+        """
+        Retrieve the application ID.
+        """
+
+        return self._server.app_id
+
+
+class _MergedFeed(object):
+    """
+    Deliver the notifications received from one of the hubs of a
+    ``MultiHubServer`` to the ``MultiHubServer``.  This is added as
+    the queue of the ``NotifierServer`` connected to the hub.
+    """
+
+    def __init__(self, server):
+        """
+        Initialize a ``_MergedFeed`` object.
+
+        :param server: The ``MultiHubServer``.
+        """
+
+        self.server = server
+
+    def put(self, msg):
+        """
+        Pass on a notification from the hub.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        self.server.merge(msg)
+
+    def wakeup(self, sentinel=False):
+        """
+        Wake up the drivers after the connection to the hub has been
+        stopped.
+
+        :param sentinel: If ``True``, the drivers exit once the queued
+                         notifications have been retrieved.
+        """
+
+        for queue in self.server._queues():
+            queue.wakeup(sentinel)
+
+    def discard(self):
+        """
+        Discard the queued notifications and wake up the drivers,
+        which exit immediately.
+        """
+
+        for queue in self.server._queues():
+            queue.discard()
+
+
+class MultiHubServer(NotificationQueue):
+    """
+    Notifier server subscribing to several redundant hubs at once.
+    Each hub is connected to by its own ``NotifierServer``, and the
+    notifications received from all of them are merged into a single
+    stream, with duplicates discarded.  Notifiers use it in place of a
+    ``NotifierServer``; a hub failing then causes no gap while the
+    other hubs remain connected.
+    """
+
+    def __init__(self, hubs, cert_conf=None, secure=True, app_name=None,
+                 app_id=None, filters=None, queue_size=QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST, reconnect=False,
+                 max_sleep=MAX_SLEEP, threshold=THRESHOLD, recover=RECOVER,
+                 window=DEDUP_WINDOW, max_seen=DEDUP_SIZE):
+        """
+        Initialize a ``MultiHubServer`` object.
+
+        :param hubs: A list of the addresses of the hubs, as tuples of
+                     hostname and port.
+
+        The ``window`` and ``max_seen`` parameters are passed to
+        ``heyu.util.SeenSet`` and bound the recently seen
+        notifications remembered to discard duplicates.  The other
+        parameters are as for ``NotifierServer``, and apply to the
+        connections to all the hubs.
+        """
+
+        super(MultiHubServer, self).__init__(queue_size, overflow)
+
+        # Save the app name and ID; they're shared by the connections
+        self._app_name = app_name or os.path.basename(sys.argv[0])
+        self._app_id = app_id or str(uuid.uuid4())
+
+        # Notifications recently received from any hub
+        self._seen = util.SeenSet(window, max_seen)
+
+        # Count of duplicate notifications discarded
+        self.duplicates = 0
+
+        # Set up the connections to the hubs
+        feed = _MergedFeed(self)
+        self._servers = []
+        for hub in hubs:
+            server = NotifierServer(hub, cert_conf, secure, self._app_name,
+                                    self._app_id, filters, reconnect=reconnect,
+                                    max_sleep=max_sleep, threshold=threshold,
+                                    recover=recover)
+            server.add_queue(feed)
+            self._servers.append(server)
+
+    def start(self):
+        """
+        Start the server.  This connects to all the hubs at once.  An
+        exception is raised only if no hub could be connected to.
+        """
+
+        # Don't allow redundant start
+        if self.running:
+            raise ValueError('server is already running')
+
+        threads = [gevent.spawn(server.start) for server in self._servers]
+        gevent.joinall(threads)
+
+        # Clean up after the connections that failed
+        failed = []
+        for server, thread in zip(self._servers, threads):
+            if not thread.successful():
+                server.stop()
+                failed.append(thread.exception)
+
+        if len(failed) == len(threads):
+            raise failed[0]
+
+    def stop(self, *args):
+        """
+        Stop the server.  This disconnects from all the hubs.  Extra
+        arguments are ignored, so that this method may be used as a
+        signal handler.
+        """
+
+        for server in self._servers:
+            server.stop(*args)
+
+    def shutdown(self, *args):
+        """
+        Shut the server down, dropping the connections to all the hubs
+        rather than nicely shutting them down.  Extra arguments are
+        ignored, so that this method may be used as a signal handler.
+        """
+
+        for server in self._servers:
+            server.shutdown(*args)
+
+    def merge(self, msg):
+        """
+        Queue up a notification received from one of the hubs, unless
+        it has already been received from another.  Notifications
+        generated by the connections themselves, such as the connected
+        notification, are never discarded.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        # Each hub assigns its own cursors, and the sequence numbers
+        # of submitted notifications are only meaningful on the
+        # submitter's connection, so a version of a notification is
+        # identified by its ID and a digest of its contents
+        if msg.cursor is not None:
+            _host, app_name = filters._split_app_name(msg.app_name)
+            digest = hashlib.sha1(msgpack.dumps((
+                app_name, msg.summary, msg.body, msg.urgency,
+                msg.category))).digest()
+            if not self._seen.add((msg.id, digest)):
+                self.duplicates += 1
+                return
+
+        for queue in self._queues():
+            queue.put(msg)
+
+    @property
+    def running(self):
+        """
+        Determine whether the server is running.  The server is
+        running while any of the connections is.
+        """
+
+        return any(server.running for server in self._servers)
+
+    @property
+    def app_name(self):
+        """
+        Retrieve the application name.
+        """
+
+        return self._app_name
+
+    @property
+    def app_id(self):
+        """
+        Retrieve the application ID.
+        """
+
+        return self._app_id
+
+
+def make_server(hub, *args, **kwargs):
+    """
+    Set up the server for a notification driver.
+
+    :param hub: The address of the hub, as a tuple of hostname and
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
+
+    The other parameters are as for ``NotifierServer``.
+
+    :returns: A ``MultiHubServer`` if several hubs are given;
+              otherwise, a ``NotifierServer``.
+    """
+
+    if isinstance(hub, list):
+        return MultiHubServer(hub, *args, **kwargs)
+
+    return NotifierServer(hub, *args, **kwargs)
+
+
 class NotifierApplication(tendril.Application):
     """
     The application for the notifier, which subscribes to
     notifications from the HeyU server.
     """
 
-    def __init__(self, parent, server, app_name, app_id):
+    def __init__(self, parent, server, app_name, app_id, filters=None,
+                 epoch=None, since=None):
         """
         Initialize a HeyU notifier application.
 
@@ -275,6 +878,12 @@ class NotifierApplication(tendril.Application):
                          connected notification.
         :param app_id: A UUID for notifications generated internal to
                        the notifier.
+        :param filters: A dictionary of subscription filter arguments
+                        for the "subscribe" message.  Optional.
+        :param epoch: The epoch of the hub last subscribed to.
+                      Optional.
+        :param since: The cursor of the last notification received
+                      from the hub, if resubscribing.  Optional.
         """
 
         # Initialize the application
@@ -290,8 +899,17 @@ class NotifierApplication(tendril.Application):
         # Set up the desired framer
         parent.framers = tendril.COBSFramer(True)
 
-        # We need to subscribe to receive notifications
-        subscribe = protocol.Message('subscribe')
+        # Whether the hub may compress frames; negotiated with the hub
+        self._compress = False
+
+        # We need to subscribe to receive notifications; the hub
+        # replays anything we missed since the last subscription
+        args = dict(filters or {})
+        if since is not None:
+            args.update(epoch=epoch, since=since)
+        subscribe = protocol.Message('subscribe', capabilities=(
+            protocol.CAP_BATCH, protocol.CAP_LENGTH_FRAMING,
+            protocol.CAP_ZLIB), **args)
         self.send_frame(subscribe.to_frame())
 
     def recv_frame(self, frame):
@@ -304,14 +922,32 @@ class NotifierApplication(tendril.Application):
 
         # Parse the frame and dispatch to the appropriate handler
         try:
-            msg = protocol.Message.from_frame(frame)
+            msg = protocol.Message.from_frame(frame,
+                                              compressed=self._compress)
             if msg.msg_type == 'notify':
                 # Dispatch directly to the server
                 self.server.notify(msg)
+            elif msg.msg_type == 'notify_batch':
+                # Dispatch each notification to the server
+                for notif in msg.notifications:
+                    self.server.notify(protocol.Message.from_frame(notif))
             elif msg.msg_type == 'subscribed':
+                # Switch to the negotiated framing and compression
+                if protocol.CAP_LENGTH_FRAMING in msg.capabilities:
+                    self.parent.framers = tendril.StructFramer(
+                        protocol.LENGTH_FORMAT)
+                self._compress = protocol.CAP_ZLIB in msg.capabilities
+
+                # Keep track of the hub's position
+                self.server.subscribed(msg.epoch, msg.cursor)
+
                 # Generate a notification to let the notifier know
                 self.notify('Connection Established', 'The connection to the '
                             'HeyU hub has been established.', CONNECTED)
+                if msg.gap:
+                    self.notify('Notifications Missed', 'Some notifications '
+                                'sent while disconnected from the HeyU hub '
+                                'are no longer available.', ERROR)
             elif msg.msg_type == 'goodbye':
                 # Disconnect from the server
                 self.disconnect()
@@ -327,10 +963,10 @@ class NotifierApplication(tendril.Application):
                 # Close the connection
                 self.disconnect()
 
-                # We have to manually stop the server; we don't call
+                # We have to manually tell the server; we don't call
                 # closed() because we don't want to overwrite the
                 # communication error notification
-                self.server.stop()
+                self.server.disconnected(self)
             else:
                 # Unknown message type from the server
                 self.notify('Unknown Server Message', 'An unrecognized '
@@ -346,10 +982,10 @@ class NotifierApplication(tendril.Application):
             # Close the connection
             self.disconnect()
 
-            # We have to manually stop the server; we don't call
+            # We have to manually tell the server; we don't call
             # closed() because we don't want to overwrite the
             # communication error notification
-            self.server.stop()
+            self.server.disconnected(self)
 
     def disconnect(self):
         """
@@ -368,15 +1004,15 @@ class NotifierApplication(tendril.Application):
         """
         Called to notify the application that the connection has been
         closed.  Not called if the ``close()`` method is called.  This
-        ensures that the server is stopped.
+        ensures that the server is stopped, or reconnects.
         """
 
         # Generate an informational notification
         self.notify('Connection Closed', 'The connection to the HeyU hub '
                     'has been closed.', DISCONNECTED)
 
-        # Stop the server
-        self.server.stop()
+        # Tell the server
+        self.server.disconnected(self)
 
     def notify(self, summary, body, category):
         """
@@ -395,12 +1031,105 @@ class NotifierApplication(tendril.Application):
         self.server.notify(msg)
 
 
+# Maps the names of filter criteria on the command line to the
+# arguments of the "subscribe" message
+_filter_names = {
+    'category': 'categories',
+    'urgency': 'min_urgency',
+    'app': 'app_names',
+    'host': 'hosts',
+}
+
+
+def _parse_filter(text):
+    """
+    Parse a subscription filter criterion.  Raises a value error if the
+    criterion is not recognized.
+
+    :param text: The criterion, as "name=value".  The recognized names
+                 are "category", "urgency", "app", and "host".
+
+    :returns: A tuple of the name of the "subscribe" message argument
+              and the value.
+    """
+
+    name, sep, value = text.partition('=')
+    if not sep or name not in _filter_names:
+        raise ValueError('unknown filter "%s"' % text)
+
+    # Urgency is given by name
+    if name == 'urgency':
+        if value not in protocol.urgency_map:
+            raise ValueError('unknown urgency "%s"' % value)
+        value = protocol.urgency_map[value]
+
+    return _filter_names[name], value
+
+
 @cli_tools.argument('--host', '-H',
                     dest='hub',
                     default=util.default_hub(),
-                    type=util.parse_hub,
+                    type=util.parse_hubs,
                     help='Specifies the HeyU hub to subscribe to '
-                    'notifications from, as "hostname" or "hostname:port".')
+                    'notifications from, as "hostname" or "hostname:port".  '
+                    'Several redundant hubs may be given, separated by '
+                    'commas; the notifier subscribes to all of them, and '
+                    'discards the duplicate notifications.')
+@cli_tools.argument('--filter', '-f',
+                    dest='filters',
+                    action='append',
+                    default=None,
+                    type=_parse_filter,
+                    help='Specifies a filter on the notifications to '
+                    'receive, as "category=PATTERN", "urgency=LEVEL", '
+                    '"app=PATTERN", or "host=PATTERN".  Category patterns '
+                    'may end in ".*" to match a category prefix; app and '
+                    'host patterns are shell-style.  A notification must '
+                    'match all the given criteria, but only one of several '
+                    'values given for the same criterion.  May be given '
+                    'multiple times.')
+@cli_tools.argument('--queue-size', '-q',
+                    default=QUEUE_SIZE,
+                    type=int,
+                    help='Specifies the maximum number of notifications '
+                    'queued awaiting the notification driver.  Defaults to '
+                    '%d.' % QUEUE_SIZE)
+@cli_tools.argument('--overflow', '-O',
+                    default=OVERFLOW_DROP_OLDEST,
+                    choices=overflow_policies,
+                    help='Specifies what to do when the notification queue '
+                    'is full: drop the oldest queued notification, or drop '
+                    'the new notification.  Defaults to "%s".' %
+                    OVERFLOW_DROP_OLDEST)
+@cli_tools.argument('--no-reconnect',
+                    dest='reconnect',
+                    default=True,
+                    action='store_false',
+                    help='Specifies that the notifier should exit when the '
+                    'connection to the hub is lost, rather than reconnecting.')
+@cli_tools.argument('--max-backoff', '-B',
+                    dest='max_sleep',
+                    default=MAX_SLEEP,
+                    type=int,
+                    help='The maximum amount of backoff, in seconds.  After '
+                    'a connection failure, this is the maximum amount of time '
+                    'to wait prior to the next attempt to connect.')
+@cli_tools.argument('--threshold', '-T',
+                    default=THRESHOLD,
+                    type=int,
+                    help='The minimum number of seconds before the connection '
+                    'is considered a success.  If the connection fails prior '
+                    'to this, the time before the next attempt is doubled.  '
+                    'If the connection fails after this, the time before the '
+                    'next attempt is reduced linearly.')
+@cli_tools.argument('--recover', '-R',
+                    default=RECOVER,
+                    type=int,
+                    help='The scaling factor for the linear reduction of the '
+                    'time to the next connection attempt.  The number of '
+                    'seconds since the last attempt is divided by this '
+                    'factor and used to reduce the time before the next '
+                    'connection attempt.')
 @cli_tools.argument('--cert-conf', '-C',
                     default=None,
                     help='Specifies an alternate path to the certificate '
@@ -424,25 +1153,51 @@ def notification_server():
 
 
 @cli_tools.console
-def stdout_notification_driver(hub, cert_conf=None, secure=True):
+def stdout_notification_driver(hub, cert_conf=None, secure=True,
+                               filters=None, queue_size=QUEUE_SIZE,
+                               overflow=OVERFLOW_DROP_OLDEST, reconnect=True,
+                               max_sleep=MAX_SLEEP, threshold=THRESHOLD,
+                               recover=RECOVER, server=None):
     """
     Standard output notification driver.  This emits notifications to
-    standard output.  Does not attempt to maintain a connection to the
-    HeyU hub.  This driver is mostly useful for debugging.
+    standard output.  This driver is mostly useful for debugging.
 
     :param hub: The address of the hub, as a tuple of hostname and
-                port.
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
     :param cert_conf: The path to the certificate configuration file.
                       Optional.
     :param secure: If ``False``, SSL will not be used.  Defaults to
                    ``True``.
+    :param filters: A list of subscription filter criteria, as
+                    returned by ``_parse_filter()``.  Optional.
+    :param queue_size: The maximum number of notifications that may
+                       be queued awaiting the driver.
+    :param overflow: The policy to apply when the queue is full.
+    :param reconnect: If ``True``, reconnect to the hub whenever the
+                      connection is lost.
+    :param max_sleep: The maximum number of seconds to wait before
+                      reconnecting.
+    :param threshold: The minimum number of seconds a connection must
+                      last to be considered successful.
+    :param recover: A scaling factor for reducing the wait before
+                    reconnecting after a successful connection.
+    :param server: The ``NotificationQueue`` to retrieve the
+                   notifications from, if the driver is run by the
+                   "multi" driver.  If not given, a
+                   ``NotifierServer`` is set up using the other
+                   arguments.
     """
 
     # Keep track of the number of notifications seen
     count = 0
 
     # Set up the server
-    server = NotifierServer(hub, cert_conf, secure)
+    if server is None:
+        server = make_server(hub, cert_conf, secure, filters=filters,
+                             queue_size=queue_size, overflow=overflow,
+                             reconnect=reconnect, max_sleep=max_sleep,
+                             threshold=threshold, recover=recover)
 
     # Consume notifications
     for msg in server:
@@ -464,39 +1219,342 @@ def stdout_notification_driver(hub, cert_conf=None, secure=True):
     print("\nNotifications received: %d" % count)
 
 
+def _format_text(msg):
+    """
+    Format a notification as text, similarly to the output of the
+    "stdout" notification driver.
+
+    :param msg: The notification, as a ``heyu.protocol.Message``
+                object.
+
+    :returns: The formatted notification.
+    """
+
+    return ("ID %s, urgency %s\n"
+            "Application: %s\n"
+            "    Summary: %s\n"
+            "       Body: %s\n"
+            "   Category: %s\n" %
+            (msg.id, protocol.urgency_names[msg.urgency], msg.app_name,
+             msg.summary, msg.body, msg.category))
+
+
+def _format_msgpack(msg):
+    """
+    Format a notification as a msgpack map, prefixed with its length
+    as a 4-byte big-endian integer.
+
+    :param msg: The notification, as a ``heyu.protocol.Message``
+                object.
+
+    :returns: The formatted notification.
+    """
+
+    data = msgpack.dumps(_fields(msg))
+    return struct.pack('>I', len(data)) + data
+
+
+# Formats for notifications written by the file driver
+_file_formats = {
+    'text': _format_text,
+    'json': lambda msg: json.dumps(_fields(msg), sort_keys=True) + '\n',
+    'msgpack': _format_msgpack,
+}
+
+# The defaults for buffering notifications written by the file driver
+FLUSH_SIZE = 65536
+FLUSH_INTERVAL = 1.0
+
+# The maximum number of notifications retrieved by the file driver at
+# once
+FILE_BATCH = 1000
+
+
+class FileWriter(object):
+    """
+    Write notifications to a file.  Formatted notifications are
+    buffered and written together, once enough of them accumulate or
+    enough time has passed.  If rotation is enabled, notifications are
+    instead written to numbered segments named after the file, and the
+    next segment is opened ahead of time so that rotating only swaps
+    files.
+    """
+
+    def __init__(self, filename, fmt='text', flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_size=0, max_age=0):
+        """
+        Initialize a ``FileWriter`` object.
+
+        :param filename: The name of the file to which to write the
+                         notifications.  If rotation is enabled, the
+                         segments are named by appending a segment
+                         number to this name.
+        :param fmt: The format of the notifications; one of the keys
+                    of ``_file_formats``.
+        :param flush_size: The number of bytes of buffered
+                           notifications that causes the buffer to be
+                           written out.
+        :param flush_interval: The maximum number of seconds
+                               notifications are buffered before the
+                               buffer is written out.
+        :param max_size: The size, in bytes, beyond which a segment is
+                         not extended.  If 0, segments are not rotated
+                         by size.
+        :param max_age: The number of seconds after which a segment is
+                        no longer written to.  If 0, segments are not
+                        rotated by age.
+        """
+
+        self.filename = filename
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_age = max_age
+        self._format = _file_formats[fmt]
+
+        # The buffered notifications
+        self._buf = []
+        self._buf_size = 0
+        self._last_flush = time.time()
+
+        # The open segments; with rotation disabled, there is only the
+        # one file
+        self._output = None
+        self._next = None
+        self._segment = 0
+        self._size = 0
+        self._opened = None
+
+        self._open()
+
+    def _segment_path(self, segment):
+        """
+        Compute the name of a segment file.
+
+        :param segment: The segment number.
+
+        :returns: The name of the segment file.
+        """
+
+        return '%s.%08d' % (self.filename, segment)
+
+    def _open(self):
+        """
+        Open the file.  If rotation is enabled, the last existing
+        segment is continued, and the following segment is opened.
+        """
+
+        if not (self.max_size or self.max_age):
+            self._output = open(self.filename, 'ab')
+        else:
+            # Find the last segment
+            dirname, basename = os.path.split(self.filename)
+            prefix = basename + '.'
+            for fname in os.listdir(dirname or '.'):
+                suffix = fname[len(prefix):]
+                if (fname.startswith(prefix) and len(suffix) == 8 and
+                        suffix.isdigit()):
+                    self._segment = max(self._segment, int(suffix))
+
+            self._segment = self._segment or 1
+            self._output = open(self._segment_path(self._segment), 'ab')
+            self._next = open(self._segment_path(self._segment + 1), 'ab')
+
+        self._size = os.fstat(self._output.fileno()).st_size
+        self._opened = time.time()
+
+    def _rotate(self):
+        """
+        Switch to the next segment, and open the one following it.
+        """
+
+        self._output.close()
+        self._output, self._next = self._next, None
+        self._segment += 1
+        self._size = 0
+        self._opened = time.time()
+
+        self._next = open(self._segment_path(self._segment + 1), 'ab')
+
+    def write(self, msgs):
+        """
+        Buffer notifications, writing out the buffer if it is full or
+        has not been written out recently.
+
+        :param msgs: A list of the notifications, as
+                     ``heyu.protocol.Message`` objects.
+        """
+
+        for msg in msgs:
+            data = self._format(msg)
+            self._buf.append(data)
+            self._buf_size += len(data)
+
+        if (self._buf_size >= self.flush_size or
+                time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the buffered notifications, rotating first if the
+        current segment is full or too old.
+        """
+
+        self._last_flush = time.time()
+        if not self._buf:
+            return
+
+        data = ''.join(self._buf)
+        self._buf = []
+        self._buf_size = 0
+
+        # Rotate if needed, but never leave a segment empty
+        if self._next is not None and self._size and (
+                (self.max_size and self._size + len(data) > self.max_size) or
+                (self.max_age and
+                 self._last_flush - self._opened >= self.max_age)):
+            self._rotate()
+
+        self._output.write(data)
+        self._output.flush()
+        self._size += len(data)
+
+    def close(self):
+        """
+        Write out the buffered notifications and close the file.  The
+        segment opened ahead of time is removed if it is still empty.
+        """
+
+        if self._output is None:
+            return
+
+        self.flush()
+        self._output.close()
+        self._output = None
+
+        if self._next is not None:
+            self._next.close()
+            self._next = None
+            path = self._segment_path(self._segment + 1)
+            if os.path.exists(path) and not os.path.getsize(path):
+                os.unlink(path)
+
+
 @cli_tools.argument('filename',
                     help='The file to write notifications to.')
-def file_notification_driver(filename, hub, cert_conf=None, secure=True):
+@cli_tools.argument('--format', '-f',
+                    dest='fmt',
+                    default='text',
+                    choices=sorted(_file_formats),
+                    help='Specifies the format of the notifications: "text" '
+                    'for the format of the "stdout" driver, "json" for one '
+                    'JSON object per line, or "msgpack" for msgpack maps, '
+                    'each prefixed by its length as a 4-byte big-endian '
+                    'integer.  Defaults to "text".')
+@cli_tools.argument('--flush-size', '-s',
+                    default=FLUSH_SIZE,
+                    type=int,
+                    help='Specifies the number of bytes of notifications to '
+                    'buffer before writing them to the file.  Defaults to '
+                    '%d.' % FLUSH_SIZE)
+@cli_tools.argument('--flush-interval', '-i',
+                    default=FLUSH_INTERVAL,
+                    type=float,
+                    help='Specifies the maximum number of seconds to buffer '
+                    'notifications before writing them to the file.  '
+                    'Defaults to %s.' % FLUSH_INTERVAL)
+@cli_tools.argument('--max-size', '-m',
+                    default=0,
+                    type=int,
+                    help='Specifies the size, in bytes, at which to rotate '
+                    'the file.  When the file is rotated, notifications are '
+                    'written to numbered segments named after the file.')
+@cli_tools.argument('--max-age', '-a',
+                    default=0,
+                    type=int,
+                    help='Specifies the number of seconds after which to '
+                    'rotate the file.  When the file is rotated, '
+                    'notifications are written to numbered segments named '
+                    'after the file.')
+def file_notification_driver(filename, hub, cert_conf=None, secure=True,
+                             filters=None, queue_size=QUEUE_SIZE,
+                             overflow=OVERFLOW_DROP_OLDEST, reconnect=True,
+                             max_sleep=MAX_SLEEP, threshold=THRESHOLD,
+                             recover=RECOVER, fmt='text',
+                             flush_size=FLUSH_SIZE,
+                             flush_interval=FLUSH_INTERVAL, max_size=0,
+                             max_age=0, server=None):
     """
     File notification driver.  This appends notifications to a named
-    file.  Does not attempt to maintain a connection to the HeyU hub.
-    Notifications are formatted similarly to the output of the
-    "stdout" notification driver, sans extra whitespace.
+    file.  By default, notifications are formatted similarly to the
+    output of the "stdout" notification driver, sans extra whitespace.
 
     :param filename: The name of the file to which to emit the
                      notifications.
     :param hub: The address of the hub, as a tuple of hostname and
-                port.
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
     :param cert_conf: The path to the certificate configuration file.
                       Optional.
     :param secure: If ``False``, SSL will not be used.  Defaults to
                    ``True``.
+    :param filters: A list of subscription filter criteria, as
+                    returned by ``_parse_filter()``.  Optional.
+    :param queue_size: The maximum number of notifications that may
+                       be queued awaiting the driver.
+    :param overflow: The policy to apply when the queue is full.
+    :param reconnect: If ``True``, reconnect to the hub whenever the
+                      connection is lost.
+    :param max_sleep: The maximum number of seconds to wait before
+                      reconnecting.
+    :param threshold: The minimum number of seconds a connection must
+                      last to be considered successful.
+    :param recover: A scaling factor for reducing the wait before
+                    reconnecting after a successful connection.
+    :param fmt: The format of the notifications; one of the keys of
+                ``_file_formats``.
+    :param flush_size: The number of bytes of notifications to buffer
+                       before writing them out.
+    :param flush_interval: The maximum number of seconds to buffer
+                           notifications.
+    :param max_size: The size, in bytes, at which to rotate the file.
+                     If 0, the file is not rotated by size.
+    :param max_age: The number of seconds after which to rotate the
+                    file.  If 0, the file is not rotated by age.
+    :param server: The ``NotificationQueue`` to retrieve the
+                   notifications from, if the driver is run by the
+                   "multi" driver.  If not given, a
+                   ``NotifierServer`` is set up using the other
+                   arguments.
     """
 
     # Open the file...
-    with open(filename, 'a') as output:
+    output = FileWriter(filename, fmt, flush_size, flush_interval,
+                        max_size, max_age)
+
+    try:
         # Set up the server
-        server = NotifierServer(hub, cert_conf, secure)
+        if server is None:
+            server = make_server(hub, cert_conf, secure, filters=filters,
+                                 queue_size=queue_size, overflow=overflow,
+                                 reconnect=reconnect, max_sleep=max_sleep,
+                                 threshold=threshold, recover=recover)
+        server.start()
+
+        # Consume notifications, several at a time; when the queue is
+        # idle, write out whatever has been buffered
+        while True:
+            try:
+                msgs = server.next_batch(FILE_BATCH, flush_interval or None)
+            except StopIteration:
+                break
 
-        # Consume notifications
-        for msg in server:
-            print("ID %s, urgency %s" %
-                  (msg.id, protocol.urgency_names[msg.urgency]),
-                  file=output)
-            print("Application: %s" % msg.app_name, file=output)
-            print("    Summary: %s" % msg.summary, file=output)
-            print("       Body: %s" % msg.body, file=output)
-            print("   Category: %s" % msg.category, file=output)
+            if msgs:
+                output.write(msgs)
+            else:
+                output.flush()
+    finally:
+        output.close()
 
 
 # Recognized substitution fields
@@ -522,6 +1580,240 @@ def _validate_subs(text):
     return text
 
 
+def _fields(msg):
+    """
+    Build a dictionary of the values of a notification available to
+    scripts.
+
+    :param msg: The notification, as a ``heyu.protocol.Message``
+                object.
+
+    :returns: A dictionary mapping the names in ``_known_fields`` to
+              their values.
+    """
+
+    return {
+        'id': msg.id,
+        'application': msg.app_name,
+        'summary': msg.summary,
+        'body': msg.body,
+        'category': msg.category or '',
+        'urgency': protocol.urgency_names[msg.urgency],
+    }
+
+
+class ScriptRunner(object):
+    """
+    Run a script for each notification, with a bounded number of
+    invocations running at once.  While all the workers are busy,
+    ``submit()`` blocks, so that further notifications wait on the
+    notifier queue and are subject to its overflow policy.
+    """
+
+    def __init__(self, script, workers=1, timeout=None, ordered=False):
+        """
+        Initialize a ``ScriptRunner`` object.
+
+        :param script: The script command arguments, as a list, with
+                       substitutions as described for
+                       ``script_notification_driver()``.
+        :param workers: The maximum number of script invocations to
+                        run at once.
+        :param timeout: The maximum number of seconds an invocation
+                        may run before it is killed.  If ``None``,
+                        invocations are not limited.
+        :param ordered: If ``True``, invocations for notifications
+                        with the same ID run one at a time, in the
+                        order the notifications were received.
+        """
+
+        self.script = script
+        self.timeout = timeout
+        self.ordered = ordered
+
+        self._pool = gevent.pool.Pool(workers)
+
+        # When ordered, maps the IDs of the notifications being
+        # handled to the next notification with that ID, if any; like
+        # the notifier queue, a later notification replaces one still
+        # waiting
+        self._waiting = {}
+
+    def submit(self, msg):
+        """
+        Invoke the script for a notification.  Blocks while all the
+        workers are busy.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        # Wait behind the invocation for the same notification ID
+        if self.ordered and msg.id is not None:
+            if msg.id in self._waiting:
+                self._waiting[msg.id] = msg
+                return
+            self._waiting[msg.id] = None
+
+        self._pool.spawn(self._work, msg)
+
+    def join(self):
+        """
+        Wait for all the invocations to complete.
+        """
+
+        self._pool.join()
+
+    def _work(self, msg):
+        """
+        Invoke the script for a notification, then for any
+        notifications with the same ID that arrived in the meantime.
+        Runs in its own thread.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        while msg is not None:
+            self._invoke(msg)
+
+            if not self.ordered or msg.id is None:
+                break
+
+            # Pick up the next notification with this ID, if any
+            notif_id = msg.id
+            msg = self._waiting.pop(notif_id)
+            if msg is not None:
+                self._waiting[notif_id] = None
+
+    def _invoke(self, msg):
+        """
+        Invoke the script for a single notification.
+
+        :param msg: The notification, as a ``heyu.protocol.Message``
+                    object.
+        """
+
+        # Substitute into the script list
+        subs = _fields(msg)
+        cmd = [arg.format(**subs) for arg in self.script]
+
+        # Invoke the script; the process is killed if it times out
+        try:
+            gevent.subprocess.call(cmd, timeout=self.timeout)
+        except gevent.subprocess.TimeoutExpired:
+            print("Timed out calling %s after %s seconds" %
+                  (cmd[0], self.timeout), file=sys.stderr)
+        except Exception as e:
+            print("Failed to call %s: %s" % (cmd[0], e), file=sys.stderr)
+
+
+# Encoders for the notifications streamed to a co-process; each
+# returns the encoded notification, given the dictionary returned by
+# _fields()
+_coprocess_formats = {
+    'json': lambda fields: json.dumps(fields, sort_keys=True) + '\n',
+    'msgpack': msgpack.dumps,
+}
+
+# The maximum number of notifications written to a co-process at once
+COPROCESS_BATCH = 100
+
+
+class CoProcess(object):
+    """
+    Stream notifications to a single long-running invocation of a
+    script, on its standard input.  The script is restarted if it
+    exits.  Writes wait while the pipe is full, so that further
+    notifications wait on the notifier queue and are subject to its
+    overflow policy.
+    """
+
+    def __init__(self, script, fmt='json'):
+        """
+        Initialize a ``CoProcess`` object.
+
+        :param script: The script command arguments, as a list.
+        :param fmt: The format of the notifications written to the
+                    script; one of the keys of ``_coprocess_formats``.
+        """
+
+        self.script = script
+        self._encode = _coprocess_formats[fmt]
+
+        # The running script and the number of times it was started
+        self._proc = None
+        self.starts = 0
+
+        # Don't restart a failing script in a tight loop
+        self._backoff = util.Backoff(30, 30, 5)
+
+    def _start(self):
+        """
+        Start the script, first cleaning up after the previous
+        invocation, if any.
+        """
+
+        if self._proc is not None:
+            proc, self._proc = self._proc, None
+            try:
+                proc.stdin.close()
+            except EnvironmentError:
+                pass
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+        if self.starts:
+            gevent.sleep(self._backoff.next_delay())
+        self.starts += 1
+
+        self._proc = gevent.subprocess.Popen(self.script,
+                                             stdin=gevent.subprocess.PIPE)
+
+    def send(self, msgs):
+        """
+        Write notifications to the script, starting it if necessary.
+        If the write fails, the script is restarted and the write is
+        retried once; if that also fails, the notifications are
+        discarded.
+
+        :param msgs: A list of the notifications, as
+                     ``heyu.protocol.Message`` objects.
+        """
+
+        data = ''.join(self._encode(_fields(msg)) for msg in msgs)
+
+        restart = False
+        for _attempt in range(2):
+            try:
+                if (restart or self._proc is None or
+                        self._proc.poll() is not None):
+                    self._start()
+                self._proc.stdin.write(data)
+                self._proc.stdin.flush()
+                return
+            except EnvironmentError as e:
+                print("Failed to write to %s: %s" % (self.script[0], e),
+                      file=sys.stderr)
+                restart = True
+
+    def close(self):
+        """
+        Close the script's standard input and wait for it to exit.
+        """
+
+        if self._proc is None:
+            return
+
+        try:
+            self._proc.stdin.close()
+        except EnvironmentError:
+            pass
+        self._proc.wait()
+        self._proc = None
+
+
 @cli_tools.argument('script',
                     nargs='*',
                     default=[],
@@ -532,44 +1824,213 @@ def _validate_subs(text):
                     'values from the notification.  It is recommended to '
                     'precede the script value with "--" to prevent argument '
                     'interpretation.')
-def script_notification_driver(script, hub, cert_conf=None, secure=True):
+@cli_tools.argument('--workers', '-w',
+                    default=1,
+                    type=int,
+                    help='Specifies the maximum number of script '
+                    'invocations to run at once.  While all are busy, '
+                    'notifications wait in the notifier queue.  Defaults '
+                    'to 1.')
+@cli_tools.argument('--timeout', '-t',
+                    default=None,
+                    type=float,
+                    help='Specifies the maximum number of seconds a script '
+                    'invocation may run before it is killed.  By default, '
+                    'invocations are not limited.')
+@cli_tools.argument('--ordered', '-o',
+                    default=False,
+                    action='store_true',
+                    help='Specifies that script invocations for notifications '
+                    'with the same ID must run one at a time, in order.  If '
+                    'several notifications with the same ID arrive while '
+                    'the script runs, only the latest is passed to the next '
+                    'invocation.')
+@cli_tools.argument('--coprocess', '-c',
+                    default=None,
+                    choices=sorted(_coprocess_formats),
+                    help='Specifies that the script should be started once '
+                    'and sent the notifications on its standard input, in '
+                    'the given format: "json" for one JSON object per line, '
+                    'or "msgpack" for a stream of msgpack maps.  Each has '
+                    'the keys "id", "application", "summary", "body", '
+                    '"category", and "urgency".  No substitutions are made '
+                    'in the script, which is restarted if it exits.')
+def script_notification_driver(script, hub, cert_conf=None, secure=True,
+                               filters=None, queue_size=QUEUE_SIZE,
+                               overflow=OVERFLOW_DROP_OLDEST, reconnect=True,
+                               max_sleep=MAX_SLEEP, threshold=THRESHOLD,
+                               recover=RECOVER, workers=1, timeout=None,
+                               ordered=False, coprocess=None, server=None):
     """
     Script notification driver.  This invokes a given executable for
     each notification, with notification values indicated by
-    substitutions.
+    substitutions.  Several invocations may run at once.
+    Alternatively, the executable may be started once and sent the
+    notifications on its standard input.
 
     :param script: The script command arguments, as a list.  The first
                    argument should be the executable, specified as
                    either an absolute path or the short name of an
                    executable in the current PATH.
     :param hub: The address of the hub, as a tuple of hostname and
-                port.
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
     :param cert_conf: The path to the certificate configuration file.
                       Optional.
     :param secure: If ``False``, SSL will not be used.  Defaults to
                    ``True``.
+    :param filters: A list of subscription filter criteria, as
+                    returned by ``_parse_filter()``.  Optional.
+    :param queue_size: The maximum number of notifications that may
+                       be queued awaiting the driver.
+    :param overflow: The policy to apply when the queue is full.
+    :param reconnect: If ``True``, reconnect to the hub whenever the
+                      connection is lost.
+    :param max_sleep: The maximum number of seconds to wait before
+                      reconnecting.
+    :param threshold: The minimum number of seconds a connection must
+                      last to be considered successful.
+    :param recover: A scaling factor for reducing the wait before
+                    reconnecting after a successful connection.
+    :param workers: The maximum number of script invocations to run
+                    at once.
+    :param timeout: The maximum number of seconds a script invocation
+                    may run before it is killed.  Optional.
+    :param ordered: If ``True``, script invocations for notifications
+                    with the same ID run one at a time, in order.
+    :param coprocess: If given, the format in which to send the
+                      notifications to a single long-running
+                      invocation of the script; one of the keys of
+                      ``_coprocess_formats``.  The ``workers``,
+                      ``timeout``, and ``ordered`` arguments are
+                      ignored.
+    :param server: The ``NotificationQueue`` to retrieve the
+                   notifications from, if the driver is run by the
+                   "multi" driver.  If not given, a
+                   ``NotifierServer`` is set up using the other
+                   arguments.
     """
 
     # Set up the server
-    server = NotifierServer(hub, cert_conf, secure)
+    if server is None:
+        server = make_server(hub, cert_conf, secure, filters=filters,
+                             queue_size=queue_size, overflow=overflow,
+                             reconnect=reconnect, max_sleep=max_sleep,
+                             threshold=threshold, recover=recover)
+
+    # Stream the notifications to a co-process, several at a time
+    if coprocess:
+        proc = CoProcess(script, coprocess)
+        server.start()
+        try:
+            while True:
+                try:
+                    msgs = server.next_batch(COPROCESS_BATCH)
+                except StopIteration:
+                    break
+                proc.send(msgs)
+        finally:
+            proc.close()
+        return
 
     # Consume notifications
+    runner = ScriptRunner(script, workers, timeout, ordered)
     for msg in server:
-        # Build a dictionary of substitutions
-        subs = {
-            'id': msg.id,
-            'application': msg.app_name,
-            'summary': msg.summary,
-            'body': msg.body,
-            'category': msg.category or '',
-            'urgency': protocol.urgency_names[msg.urgency],
-        }
+        runner.submit(msg)
 
-        # Substitute into the script list
-        cmd = [arg.format(**subs) for arg in script]
+    # Let the running invocations finish
+    runner.join()
 
-        # Invoke the script
-        try:
-            subprocess.call(cmd)
-        except Exception as e:
-            print("Failed to call %s: %s" % (cmd[0], e), file=sys.stderr)
+
+def _run_driver(driver, kwargs):
+    """
+    Run one of the drivers started by the "multi" driver.  Runs in
+    its own thread.  The driver exiting, as it does when the notifier
+    is stopped by a signal, doesn't affect the other drivers.
+
+    :param driver: The driver function.
+    :param kwargs: The keyword arguments for the driver.
+    """
+
+    try:
+        driver(**kwargs)
+    except SystemExit:
+        pass
+    except Exception as e:
+        print("Notification driver failed: %s" % e, file=sys.stderr)
+
+
+@cli_tools.argument('drivers',
+                    nargs='+',
+                    help='The drivers to run, each given as a single '
+                    'argument consisting of the driver name followed by its '
+                    'arguments, e.g. "file --format json /var/log/heyu".  '
+                    'Each driver receives every notification, but has its '
+                    'own queue, sized and with the overflow policy given by '
+                    'the notifier options.')
+def multi_notification_driver(drivers, hub, cert_conf=None, secure=True,
+                              filters=None, queue_size=QUEUE_SIZE,
+                              overflow=OVERFLOW_DROP_OLDEST, reconnect=True,
+                              max_sleep=MAX_SLEEP, threshold=THRESHOLD,
+                              recover=RECOVER):
+    """
+    Multiple notification driver.  This runs several other drivers,
+    sharing a single subscription to the HeyU hub.  Each driver runs
+    in its own thread, retrieving the notifications from its own
+    queue, so that a slow driver doesn't hold up the others.
+
+    :param drivers: A list of the drivers to run.  Each is a string
+                    consisting of the name of the driver followed by
+                    its arguments, quoted as for the shell.
+    :param hub: The address of the hub, as a tuple of hostname and
+                port, or a list of such tuples to subscribe to several
+                redundant hubs.
+    :param cert_conf: The path to the certificate configuration file.
+                      Optional.
+    :param secure: If ``False``, SSL will not be used.  Defaults to
+                   ``True``.
+    :param filters: A list of subscription filter criteria, as
+                    returned by ``_parse_filter()``.  Optional.
+    :param queue_size: The maximum number of notifications that may
+                       be queued awaiting each driver.
+    :param overflow: The policy to apply when a queue is full.
+    :param reconnect: If ``True``, reconnect to the hub whenever the
+                      connection is lost.
+    :param max_sleep: The maximum number of seconds to wait before
+                      reconnecting.
+    :param threshold: The minimum number of seconds a connection must
+                      last to be considered successful.
+    :param recover: A scaling factor for reducing the wait before
+                    reconnecting after a successful connection.
+    """
+
+    # Set up the server
+    server = make_server(hub, cert_conf, secure, filters=filters,
+                         queue_size=queue_size, overflow=overflow,
+                         reconnect=reconnect, max_sleep=max_sleep,
+                         threshold=threshold, recover=recover)
+
+    # Parse the arguments of all the drivers before starting any
+    available = notification_server.get_subcommands()
+    calls = []
+    for spec in drivers:
+        argv = shlex.split(spec)
+        if (not argv or argv[0] not in available or
+                available[argv[0]] is multi_notification_driver):
+            raise ValueError('unknown notification driver "%s"' % spec)
+
+        driver = available[argv[0]]
+        parser = argparse.ArgumentParser(prog=argv[0])
+        driver.setup_args(parser)
+        args = parser.parse_args(argv[1:])
+
+        # The drivers use the shared server, so they need no
+        # connection arguments
+        args.hub = hub
+        args.server = server.driver_queue()
+        calls.append((driver, driver.get_kwargs(args)))
+
+    # Run the drivers; the first to start also starts the server
+    threads = [gevent.spawn(_run_driver, driver, kwargs)
+               for driver, kwargs in calls]
+    gevent.joinall(threads)
@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import sys
+import zlib
+
 import msgpack
 
 
@@ -31,6 +34,41 @@ urgency_map = {
 # A level to name map
 urgency_names = dict((v, k) for k, v in urgency_map.items())
 
+# Capabilities that may be negotiated by clients.  CAP_BATCH
+# indicates that the client can receive "notify_batch" messages.
+# CAP_LENGTH_FRAMING indicates that, once the reply to the "hello" or
+# "subscribe" message has been sent, both ends switch from COBS
+# framing to prefixing each frame with its length, as a 4-byte
+# big-endian integer; see LENGTH_FORMAT.  CAP_ZLIB indicates that the
+# client accepts, and the hub may send, zlib-compressed frames; see
+# compress_frame().
+CAP_BATCH = 'batch'
+CAP_LENGTH_FRAMING = 'length-framing'
+CAP_ZLIB = 'zlib'
+
+# The struct format of the frame length prefix
+LENGTH_FORMAT = '!I'
+
+# Frames shorter than this are not worth compressing
+COMPRESS_THRESHOLD = 512
+
+# The maximum size of a decompressed frame
+MAX_FRAME = 16 * 1024 * 1024
+
+# Arguments for decoding msgpack data.  Python 2 code works with the
+# byte strings msgpack produces by default.  On Python 3, strings are
+# decoded to text, so that field names compare equal to ``str``; the
+# hub encodes the frames in a "notify_batch" message as strings, so
+# undecodable bytes are escaped, and ``Message.from_frame()`` turns
+# such text back into the original bytes.
+if sys.version_info[0] < 3:
+    _unpack_args = {}
+elif msgpack.version < (1, 0):
+    # Older versions only honor unicode_errors with an encoding
+    _unpack_args = {'encoding': 'utf-8', 'unicode_errors': 'surrogateescape'}
+else:
+    _unpack_args = {'raw': False, 'unicode_errors': 'surrogateescape'}
+
 # The current protocol version.  An entry for this must exist in the
 # _versions dictionary.
 _curr_version = 0
@@ -42,6 +80,32 @@ _curr_version = 0
 # message must contain, and the value of "defaults" is a dictionary
 # mapping optional arguments to the default value that should be
 # assumed for them.
+#
+# The "seq" argument of "notify" messages is an optional,
+# client-assigned request number; the hub echoes it in the
+# corresponding "accepted" or "error" reply, which allows a client
+# that has established a session with "hello" to pipeline many
+# notifications over a single connection.
+#
+# The "notifications" argument of "notify_batch" messages is a list of
+# encoded "notify" messages; the hub replies with a single
+# "accepted_batch" message listing the notification IDs in order.
+# The "capabilities" argument of "hello" and "subscribe" is a list of
+# capabilities the client supports; the hub replies with the subset it
+# will use.  The other arguments of "subscribe" filter the
+# notifications the client receives; see heyu.filters.Filter.
+#
+# The hub stamps each notification it forwards with a "cursor", a
+# sequence number which increases by one with each notification, and
+# keeps the most recent notifications in a replay ring.  Cursors are
+# only meaningful within a hub "epoch", which changes whenever the hub
+# is restarted.  The "subscribed" reply gives the epoch and the cursor
+# of the last notification forwarded so far.  A notifier that
+# resubscribes after losing its connection passes the epoch and the
+# cursor of the last notification it saw as "epoch" and "since", and
+# the hub replays the notifications it missed after the "subscribed"
+# reply; "gap" is set in the reply if some of them have already left
+# the ring.
 _versions = {
     0: {
         'notify': {
@@ -50,21 +114,270 @@ _versions = {
                 'urgency': URGENCY_LOW,
                 'category': None,
                 'id': None,
+                'seq': None,
+                'cursor': None,
             },
         },
         'accepted': {
             'required': set(['id']),
+            'defaults': {
+                'seq': None,
+            },
+        },
+        'notify_batch': {
+            'required': set(['notifications']),
+            'defaults': {
+                'seq': None,
+            },
+        },
+        'accepted_batch': {
+            'required': set(['ids']),
+            'defaults': {
+                'seq': None,
+            },
+        },
+        'hello': {
+            'defaults': {
+                'capabilities': (),
+            },
+        },
+        'subscribe': {
+            'defaults': {
+                'capabilities': (),
+                'categories': (),
+                'min_urgency': None,
+                'app_names': (),
+                'hosts': (),
+                'epoch': None,
+                'since': None,
+            },
+        },
+        'subscribed': {
+            'defaults': {
+                'capabilities': (),
+                'epoch': None,
+                'cursor': None,
+                'gap': False,
+            },
         },
-        'subscribe': {},
-        'subscribed': {},
         'goodbye': {},
         'error': {
             'required': set(['reason']),
+            'defaults': {
+                'seq': None,
+            },
         },
     },
 }
 
 
+def _encoder(required, defaults):
+    """
+    Generate a function to collect the arguments of a message for
+    encoding.  Arguments having their default values are omitted.
+
+    :param required: A tuple of the names of the required arguments.
+    :param defaults: A tuple of pairs of the names and default values
+                     of the optional arguments.
+
+    :returns: A callable which, when passed a ``Message``, returns a
+              dictionary of its arguments.
+    """
+
+    # Generate the source for the function; the default values are
+    # referenced through the namespace
+    namespace = {}
+    lines = ['def encode(msg):',
+             '    data = {%s}' % ', '.join('%r: msg.%s' % (key, key)
+                                           for key in required)]
+    for i, (key, default) in enumerate(defaults):
+        namespace['_default%d' % i] = default
+        lines.append('    if msg.%s != _default%d:' % (key, i))
+        lines.append('        data[%r] = msg.%s' % (key, key))
+    lines.append('    return data')
+
+    exec('\n'.join(lines), namespace)
+
+    return namespace['encode']
+
+
+def _compile(versions):
+    """
+    Compile protocol version descriptions into ``Message`` subclasses.
+    Each known message type of each version gets its own subclass,
+    which stores the message arguments named in the description in
+    slots, so they may be accessed directly as attributes.
+
+    :param versions: A dictionary of protocol version descriptions,
+                     as for ``_versions``.
+
+    :returns: A dictionary mapping each protocol version to a
+              dictionary mapping the message types of that version to
+              the corresponding ``Message`` subclass.
+    """
+
+    schemas = {}
+    for version, msg_types in versions.items():
+        schemas[version] = {}
+        for msg_type, desc in msg_types.items():
+            required = tuple(sorted(desc.get('required', ())))
+            defaults = tuple(sorted(desc.get('defaults', {}).items()))
+            name = 'Message_%s_v%s' % (msg_type, version)
+            schemas[version][msg_type] = type(str(name), (Message,), {
+                '__slots__': required + tuple(key for key, _default
+                                              in defaults),
+                '_required': required,
+                '_defaults': defaults,
+                '_encode': staticmethod(_encoder(required, defaults)),
+            })
+
+    return schemas
+
+
+def _build(version, msg_type, args, frame=None):
+    """
+    Construct a ``Message``.  This is the implementation of both
+    ``Message()`` and ``Message.from_frame()``.
+
+    :param version: The protocol version of the message.
+    :param msg_type: The type of the message.
+    :param args: A dictionary of the message arguments.  Note that
+                 this dictionary will be modified.
+    :param frame: The binary frame the message was decoded from, if
+                  any.  This primes the frame cache.
+
+    :returns: An instance of the appropriate ``Message`` subclass.
+    """
+
+    # Make sure we know that version
+    try:
+        msg_types = _schemas[version]
+    except (KeyError, TypeError):
+        raise ValueError("cannot handle PDUs of version %s" % version)
+
+    # Unknown message types are represented by Message itself
+    cls = msg_types.get(msg_type, Message)
+    self = object.__new__(cls)
+
+    # Save the basic data about the message
+    self._version = version
+    self._msg_type = msg_type
+
+    # Set up the frame cache
+    self._frame_version = version
+    self._frame = frame
+
+    # Make sure we have all required arguments for the message type,
+    # then fill in the defaults
+    try:
+        for key in cls._required:
+            setattr(self, key, args.pop(key))
+    except KeyError:
+        raise ValueError("missing required PDU field '%s' for '%s' "
+                         "messages" % (key, msg_type))
+    for key, default in cls._defaults:
+        setattr(self, key, args.pop(key, default))
+
+    # Save any other arguments
+    self._extra = args or None
+
+    return self
+
+
+def compress_frame(frame, threshold=COMPRESS_THRESHOLD):
+    """
+    Compress a frame with zlib, if it is long enough to be worth it.
+    A zlib stream always begins with the byte 0x78, which cannot begin
+    an encoded message, so compressed frames are recognized without
+    any further marker.
+
+    :param frame: The binary frame.
+    :param threshold: The minimum length of frame to compress.
+
+    :returns: The compressed frame, or the original frame if it was
+              not compressed.
+    """
+
+    if len(frame) < threshold:
+        return frame
+
+    # Don't use the compressed frame if it didn't help
+    compressed = zlib.compress(frame)
+    return compressed if len(compressed) < len(frame) else frame
+
+
+def decompress_frame(frame, max_size=MAX_FRAME):
+    """
+    Decompress a frame compressed by ``compress_frame()``.  Frames that
+    are not compressed are returned unchanged.
+
+    :param frame: The binary frame.
+    :param max_size: The maximum size of the decompressed frame.
+                     Larger frames are rejected rather than
+                     decompressed in full.
+
+    :returns: The decompressed frame.
+    """
+
+    if frame[:1] != b'\x78':
+        return frame
+
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(frame, max_size)
+        if not decompressor.unconsumed_tail:
+            result += decompressor.flush()
+    except zlib.error as e:
+        raise ValueError('invalid compressed PDU: %s' % e)
+
+    if decompressor.unconsumed_tail or len(result) > max_size:
+        raise ValueError('compressed PDU exceeds %d bytes' % max_size)
+
+    return result
+
+
+def splice_frame(frame, keep, update):
+    """
+    Rewrite the arguments of an encoded message without decoding and
+    re-encoding the arguments that are not changed.  The encoded
+    values of the retained arguments are copied verbatim from the
+    original frame.
+
+    :param frame: The binary frame of the original message.
+    :param keep: A collection of the names of the arguments to retain
+                 from the original frame.  Arguments not named here or
+                 in ``update`` are omitted.
+    :param update: A dictionary of arguments to set in the new frame.
+
+    :returns: The new binary frame.
+    """
+
+    unpacker = msgpack.Unpacker(**_unpack_args)
+    unpacker.feed(frame)
+
+    # Walk the top-level map, selecting the encoded entries to keep
+    parts = []
+    try:
+        size = unpacker.read_map_header()
+        start = unpacker.tell()
+        for _i in range(size):
+            key = unpacker.unpack()
+            unpacker.skip()
+            end = unpacker.tell()
+            if key in keep and key not in update:
+                parts.append(frame[start:end])
+            start = end
+    except msgpack.OutOfData:
+        raise ValueError('truncated PDU')
+
+    # Add the new values
+    packer = msgpack.Packer()
+    for key, value in update.items():
+        parts.append(packer.pack(key) + packer.pack(value))
+
+    return packer.pack_map_header(len(parts)) + b''.join(parts)
+
+
 class Message(object):
     """
     Represent a protocol message.  The ``msg_type`` property
@@ -72,20 +385,42 @@ class Message(object):
     protocol version.  Other attributes are arguments for the message.
     The interesting methods are ``from_frame()`` and ``to_frame()``.
     Note that, once constructed, a ``Message`` is immutable.
+
+    Constructing a ``Message`` actually produces an instance of a
+    subclass specific to the protocol version and message type; see
+    ``_compile()``.
     """
 
+    __slots__ = ('_version', '_msg_type', '_frame_version', '_frame',
+                 '_extra')
+
+    # Arguments of messages of unknown type are all stored in _extra
+    _required = ()
+    _defaults = ()
+    _encode = staticmethod(lambda msg: {})
+
     @classmethod
-    def from_frame(cls, frame):
+    def from_frame(cls, frame, compressed=False):
         """
         Construct a ``Message`` from a raw binary frame.
 
         :param frame: The binary frame.
+        :param compressed: If ``True``, the frame may be compressed.
+                           This should only be set on connections
+                           which have negotiated ``CAP_ZLIB``;
+                           otherwise, compressed frames are rejected.
 
         :returns: A constructed ``Message`` instance.
         """
 
-        # Load the data
-        data = msgpack.loads(frame)
+        # Load the data; see _unpack_args for frames received as text
+        if not isinstance(frame, bytes):
+            frame = frame.encode('utf-8', 'surrogateescape')
+        if compressed:
+            frame = decompress_frame(frame, MAX_FRAME)
+        elif frame[:1] == b'\x78':
+            raise ValueError('compressed PDU not negotiated')
+        data = msgpack.loads(frame, **_unpack_args)
 
         # A PDU must be a msgpack-encoded dict
         if not isinstance(data, dict):
@@ -93,18 +428,16 @@ class Message(object):
 
         # It must always have a __version__ and a type
         try:
-            version = data['__version__']
-            msg_type = data['msg_type']
+            version = data.pop('__version__')
+            msg_type = data.pop('msg_type')
         except KeyError as e:
             raise ValueError("missing required PDU field %s" % str(e))
 
         # Construct a message; we pass the frame in to prime the frame
         # cache
-        return cls(msg_type, __version__=version, __frame__=frame, **dict(
-            (k, v) for k, v in data.items()
-            if k not in ('__version__', 'msg_type')))
+        return _build(version, msg_type, data, frame)
 
-    def __init__(self, msg_type, **args):
+    def __new__(cls, msg_type, **args):
         """
         Construct a ``Message`` instance.  Keyword parameters other than
         the required ``msg_type`` parameter are taken to be arguments
@@ -117,52 +450,26 @@ class Message(object):
         version = args.pop('__version__', _curr_version)
         frame = args.pop('__frame__', None)
 
-        # Make sure we know that version
-        if version not in _versions:
-            raise ValueError("cannot handle PDUs of version %d" % version)
-
-        # Save the basic data about the message
-        self._version = version
-        self._msg_type = msg_type
-
-        # Make sure we have all required arguments for the message
-        # type and cache the defaults
-        self._defaults = {}
-        if msg_type in _versions[version]:
-            # Cache the defaults
-            self._defaults = _versions[version][msg_type].get('defaults', {})
-
-            for key in _versions[version][msg_type].get('required', set()):
-                if key not in args:
-                    raise ValueError("missing required PDU field '%s' for "
-                                     "'%s' messages" % (key, msg_type))
-
-        # Save the arguments
-        self._args = dict((k, v) for k, v in args.items()
-                          if k not in self._defaults or v != self._defaults[k])
-
-        # Set up the frame cache
-        self._frame_cache = {}
-        if frame is not None:
-            self._frame_cache[version] = frame
+        return _build(version, msg_type, args, frame)
 
     def __getattr__(self, name):
         """
-        Retrieve an argument from the message.
+        Retrieve an argument not described by the protocol version from
+        the message.  Arguments that are described are stored in slots
+        and never reach this method.
 
         :param name: The name of the message argument.
 
-        :returns: The value of that argument, or a default, if one was
-                  provided.  Note that an ``AttributeError`` is raised
-                  if the argument wasn't passed to the constructor and
-                  no default was provided.
+        :returns: The value of that argument.  Note that an
+                  ``AttributeError`` is raised if the argument wasn't
+                  passed to the constructor.
         """
 
-        if name not in self._args and name not in self._defaults:
+        if self._extra is None or name not in self._extra:
             raise AttributeError("'%s' object has no attribute '%s'" %
                                  (self.__class__.__name__, name))
 
-        return self._args.get(name, self._defaults.get(name))
+        return self._extra[name]
 
     @property
     def version(self):
@@ -187,7 +494,34 @@ class Message(object):
         A ``True`` value indicates that the message type is known.
         """
 
-        return self._msg_type in _versions[self._version]
+        return self._msg_type in _schemas[self._version]
+
+    def splice(self, keep, **args):
+        """
+        Construct a new message of the same type and version from this
+        one.  If the frame of this message is known, the frame of the
+        new message is spliced from it with ``splice_frame()``, rather
+        than being re-encoded.
+
+        :param keep: A tuple of the names of the arguments to retain
+                     from this message.  Other arguments are omitted.
+
+        Other keyword parameters are taken to be replacement arguments
+        for the new message.
+
+        :returns: The new ``Message`` instance.
+        """
+
+        new_args = dict((key, getattr(self, key)) for key in keep)
+        new_args.update(args)
+        new_args['__version__'] = self._version
+
+        # Splice the frame, if we have one in the right version
+        if self._frame is not None and self._frame_version == self._version:
+            new_args['__frame__'] = splice_frame(
+                self._frame, keep + ('msg_type', '__version__'), args)
+
+        return Message(self._msg_type, **new_args)
 
     def to_frame(self, version=_curr_version):
         """
@@ -198,17 +532,25 @@ class Message(object):
         :returns: The binary frame.
         """
 
-        if version not in self._frame_cache:
+        if self._frame is None or self._frame_version != version:
             # Can only handle _curr_version
             if version != _curr_version:
                 raise ValueError('cannot serialize into version %s' % version)
 
-            # Build the frame data
-            data = self._args.copy()
+            # Build the frame data; arguments with their default values
+            # are omitted
+            data = self._encode(self)
+            if self._extra:
+                data.update(self._extra)
             data['msg_type'] = self._msg_type
             data['__version__'] = self._version
 
             # Return the actual binary data
-            self._frame_cache[version] = msgpack.dumps(data)
+            self._frame_version = version
+            self._frame = msgpack.dumps(data)
+
+        return self._frame
+
 
-        return self._frame_cache[version]
+# The compiled message classes
+_schemas = _compile(_versions)
@@ -0,0 +1,651 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import contextlib
+import errno
+import fcntl
+import itertools
+import os
+import re
+import struct
+import zlib
+
+import gevent
+import gevent.event
+
+from heyu import protocol
+
+
+# The size, in bytes, above which a new segment file is started
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# The number of seconds to wait for more records before syncing, so
+# that concurrent writers share a single fsync
+SYNC_DELAY = 0.002
+
+# The number of seconds between checks for records written by other
+# processes
+POLL_INTERVAL = 1.0
+
+# The number of bytes read from a segment file at a time
+READ_SIZE = 64 * 1024
+
+# Each record is a header, followed by a "notify" frame.  The header
+# contains a magic number, which allows the reader to find the next
+# record after a damaged one, the length of the frame, and its CRC-32.
+RECORD_MAGIC = 'HYSP'
+RECORD_HEADER = struct.Struct('!4sII')
+
+# Regular expression matching segment file names
+SEGMENT_RE = re.compile(r'^(?P<segno>\d{16})\.seg$')
+
+# The notify arguments stored for each notification
+NOTIFY_ARGS = ('app_name', 'summary', 'body', 'urgency', 'category', 'id')
+
+
+class SpoolException(Exception):
+    """
+    An exception for reporting errors with a spool.
+    """
+
+    pass
+
+
+class SpoolFull(SpoolException):
+    """
+    An exception raised when a spool has no room for more
+    notifications.
+    """
+
+    pass
+
+
+def dedup(notifs):
+    """
+    Remove superseded notifications from a list of notifications to
+    replay.  A notification replaces any earlier notification with the
+    same ID, so only the last notification with a given ID need be
+    sent.
+
+    :param notifs: A list of dictionaries of notify arguments, each
+                   including the "id" key.
+
+    :returns: A list of the notifications to send, in order.
+    """
+
+    last = dict((notif['id'], i) for i, notif in enumerate(notifs))
+    return [notif for i, notif in enumerate(notifs) if last[notif['id']] == i]
+
+
+def _pack(notif):
+    """
+    Encode a notification as a spool record.
+
+    :param notif: A dictionary of notify arguments.
+
+    :returns: The record.
+    """
+
+    frame = protocol.Message('notify', **notif).to_frame()
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(frame),
+                              zlib.crc32(frame) & 0xffffffff) + frame
+
+
+def _unpack(data, sealed, partial=False):
+    """
+    Decode the spool records in a block of data.  Damaged records are
+    skipped.
+
+    :param data: The data.
+    :param sealed: If ``True``, no more records will be written after
+                   the data, so an incomplete record at the end is
+                   damaged, rather than still being written.
+    :param partial: If ``True``, the data is followed by more data
+                    that has not yet been read, so an incomplete
+                    record at the end is always left for the next
+                    block.
+
+    :returns: A generator yielding tuples of the offset of the end of
+              a record within the data and the notification, as a
+              dictionary of notify arguments.  Notifications that
+              cannot be decoded are yielded as ``None``, so that the
+              reader may skip over them.
+    """
+
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        magic, length, crc = RECORD_HEADER.unpack_from(data, pos)
+        start = pos + RECORD_HEADER.size
+        end = start + length
+
+        if magic == RECORD_MAGIC and end > len(data) and (partial or (
+                not sealed and data.find(RECORD_MAGIC, pos + 1) < 0)):
+            # Not read yet, or still being written
+            return
+
+        if (magic != RECORD_MAGIC or end > len(data) or
+                zlib.crc32(data[start:end]) & 0xffffffff != crc):
+            # Damaged; skip ahead to the next record
+            pos = data.find(RECORD_MAGIC, pos + 1)
+            if pos < 0:
+                if sealed:
+                    yield len(data), None
+                return
+            continue
+
+        try:
+            msg = protocol.Message.from_frame(data[start:end])
+        except ValueError:
+            msg = None
+        if msg is None or msg.msg_type != 'notify':
+            yield end, None
+        else:
+            yield end, dict((key, getattr(msg, key)) for key in NOTIFY_ARGS)
+        pos = end
+
+    # Skip garbage too short to hold a record header
+    if sealed and pos < len(data):
+        yield len(data), None
+
+
+class Spool(object):
+    """
+    A durable spool of notifications, kept in a directory.  Any number
+    of processes may append notifications to the spool; one process at
+    a time may drain it, reading the notifications in order and
+    acknowledging them once they have been delivered.  Notifications
+    are appended to segment files, which are deleted once all their
+    notifications have been acknowledged; the position of the oldest
+    unacknowledged notification is kept in the "cursor" file.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        """
+        Initialize a ``Spool`` object.
+
+        :param path: The path of the spool directory.  The path is
+                     tilde-expanded, and the directory is created if
+                     it does not exist.
+        :param segment_size: The size, in bytes, above which a new
+                             segment file is started.
+        """
+
+        self._path = os.path.expanduser(path)
+        self._segment_size = segment_size
+
+        try:
+            os.makedirs(self._path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # The segment being appended to, and segments that have been
+        # rotated out but not yet synced
+        self._fd = None
+        self._fd_segno = None
+        self._retired = []
+
+        # Whether there are appended records that have not been
+        # synced, and the result of the pending sync
+        self._dirty = False
+        self._sync_result = None
+
+        # The drain lock file, and the positions of the oldest
+        # unacknowledged notification and the next one to read
+        self._drain_fd = None
+        self._cursor = self._load_cursor()
+        self._read_pos = self._cursor
+
+    def _file(self, name):
+        """
+        Compute the path of a file in the spool directory.
+
+        :param name: The name of the file.
+
+        :returns: The path of the file.
+        """
+
+        return os.path.join(self._path, name)
+
+    def _segment_file(self, segno):
+        """
+        Compute the path of a segment file.
+
+        :param segno: The segment number.
+
+        :returns: The path of the segment file.
+        """
+
+        return self._file('%016d.seg' % segno)
+
+    def _segments(self):
+        """
+        List the segment files.
+
+        :returns: A sorted list of the segment numbers.
+        """
+
+        segments = []
+        for name in os.listdir(self._path):
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments.append(int(match.group('segno')))
+
+        return sorted(segments)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        A context manager which holds the spool lock.  Appends and
+        segment rotation are performed while holding the lock.
+        """
+
+        fd = os.open(self._file('lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def append(self, notifs):
+        """
+        Append notifications to the spool.  The notifications are not
+        guaranteed to be on disk until ``commit()`` returns.
+
+        :param notifs: A list of dictionaries of notify arguments.
+                       Each must include an ID.
+        """
+
+        data = ''.join(_pack(notif) for notif in notifs)
+
+        with self._locked():
+            # Always append to the newest segment, which other
+            # processes may have started
+            segments = self._segments()
+            segno = segments[-1] if segments else self._cursor[0] + 1
+            if segno != self._fd_segno:
+                self._retire()
+                self._open(segno)
+
+            # Start a new segment if this one is full
+            if os.fstat(self._fd).st_size >= self._segment_size:
+                self._retire()
+                self._open(segno + 1)
+
+            while data:
+                data = data[os.write(self._fd, data):]
+
+        self._dirty = True
+
+    def _open(self, segno):
+        """
+        Open a segment file for appending.
+
+        :param segno: The segment number.
+        """
+
+        self._fd = os.open(self._segment_file(segno),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._fd_segno = segno
+
+    def _retire(self):
+        """
+        Stop appending to the current segment file.  The file is closed
+        once it has been synced.
+        """
+
+        if self._fd is not None:
+            self._retired.append(self._fd)
+        self._fd = None
+        self._fd_segno = None
+
+    def commit(self):
+        """
+        Wait until all notifications appended by this object are on
+        disk.  Concurrent callers share a single sync.
+        """
+
+        if not self._dirty:
+            return
+
+        if self._sync_result is None:
+            self._sync_result = gevent.event.AsyncResult()
+            gevent.spawn_later(SYNC_DELAY, self._sync)
+
+        self._sync_result.get()
+
+    def _sync(self):
+        """
+        Sync appended notifications to disk.  The sync is performed in
+        the gevent thread pool.
+        """
+
+        result = self._sync_result
+        self._sync_result = None
+        self._dirty = False
+
+        retired = self._retired
+        self._retired = []
+        fds = retired + ([self._fd] if self._fd is not None else [])
+
+        try:
+            gevent.get_hub().threadpool.apply(_fsync_all, (fds,))
+        except Exception as e:
+            result.set_exception(e)
+        else:
+            result.set()
+        finally:
+            for fd in retired:
+                os.close(fd)
+
+    def close(self):
+        """
+        Close the spool.  Appended notifications are synced first.
+        """
+
+        if self._dirty:
+            self.commit()
+
+        self._retire()
+        for fd in self._retired:
+            os.close(fd)
+        self._retired = []
+
+        if self._drain_fd is not None:
+            os.close(self._drain_fd)
+            self._drain_fd = None
+
+    def lock_drain(self):
+        """
+        Claim the right to drain the spool.  The claim lasts until the
+        spool is closed.  Raises a ``SpoolException`` if another
+        process is draining the spool.
+        """
+
+        if self._drain_fd is not None:
+            return
+
+        fd = os.open(self._file('drain.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            raise SpoolException("Spool '%s' is being drained by another "
+                                 "process" % self._path)
+
+        self._drain_fd = fd
+
+        # Pick up where the last drainer left off
+        self._cursor = self._load_cursor()
+        self._read_pos = self._cursor
+
+    def _load_cursor(self):
+        """
+        Load the drain cursor.
+
+        :returns: The position of the oldest unacknowledged
+                  notification, as a tuple of the segment number and
+                  the offset within the segment.
+        """
+
+        try:
+            with open(self._file('cursor')) as f:
+                segno, offset = f.read().split()
+            return int(segno), int(offset)
+        except (EnvironmentError, ValueError):
+            return 0, 0
+
+    def read(self, max_records):
+        """
+        Read the next notifications from the spool.  Notifications are
+        read in order, starting after the last notification read, and
+        are read again after ``rewind()``.
+
+        :param max_records: The maximum number of notifications to
+                            read.
+
+        :returns: A list of tuples of the position following the
+                  notification, to be passed to ``ack()``, and the
+                  notification, as a dictionary of notify arguments.
+        """
+
+        records = []
+        segno, offset = self._read_pos
+
+        # Find the segment to start with
+        segments = self._segments()
+        if segments and segno not in segments:
+            later = [seg for seg in segments if seg > segno]
+            segno, offset = (later or segments)[0], 0
+
+        while segments and len(records) < max_records:
+            later = [seg for seg in segments if seg > segno]
+
+            # The listing was taken before reading, so if there were
+            # later segments then, this one is complete
+            offset = self._read_segment(segno, offset, bool(later),
+                                        max_records - len(records), records)
+            if len(records) >= max_records or not later:
+                break
+
+            segno, offset = later[0], 0
+
+        self._read_pos = (segno, offset)
+
+        return records
+
+    def _read_segment(self, segno, offset, sealed, max_records, records):
+        """
+        Read notifications from a segment file.  The file is read a
+        block at a time, so that no more of it is read than the
+        notifications wanted need.
+
+        :param segno: The segment number.
+        :param offset: The offset to begin reading at.
+        :param sealed: If ``True``, the segment will not be appended to.
+        :param max_records: The maximum number of notifications to
+                            read.
+        :param records: A list to which to append the tuples of
+                        position and notification.
+
+        :returns: The offset following the last record read.
+        """
+
+        try:
+            f = open(self._segment_file(segno), 'rb')
+        except IOError:
+            return offset
+
+        with f:
+            f.seek(offset)
+            data = ''
+            count = 0
+            while True:
+                try:
+                    block = f.read(READ_SIZE)
+                except IOError:
+                    return offset
+
+                # A record may span blocks; the part of it already
+                # read is kept
+                data += block
+                more = len(block) == READ_SIZE
+                end = 0
+                for end, notif in _unpack(data, sealed and not more, more):
+                    if notif is not None:
+                        records.append(((segno, offset + end), notif))
+                        count += 1
+                        if count >= max_records:
+                            return offset + end
+
+                offset += end
+                data = data[end:]
+                if not more:
+                    return offset
+
+    def ack(self, position):
+        """
+        Acknowledge the delivery of notifications.  Segments whose
+        notifications have all been acknowledged are deleted.
+
+        :param position: The position following the last notification
+                         delivered, as returned by ``read()``.
+        """
+
+        self._cursor = position
+
+        # Save the cursor; the rename is atomic
+        tmp = self._file('cursor.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % position)
+        os.rename(tmp, self._file('cursor'))
+
+        for segno in self._segments():
+            if segno >= position[0]:
+                break
+            try:
+                os.unlink(self._segment_file(segno))
+            except OSError:
+                pass
+
+    def rewind(self):
+        """
+        Arrange for the next ``read()`` to begin at the oldest
+        unacknowledged notification.
+        """
+
+        self._read_pos = self._cursor
+
+
+def _fsync_all(fds):
+    """
+    Sync several files to disk.
+
+    :param fds: A list of file descriptors.
+    """
+
+    for fd in fds:
+        os.fsync(fd)
+
+
+class MemorySpool(object):
+    """
+    A spool of notifications kept in memory.  This provides the same
+    interface as ``Spool``, but the notifications do not survive the
+    process.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        Initialize a ``MemorySpool`` object.
+
+        :param max_size: The maximum number of unacknowledged
+                         notifications to hold.  If ``None``, there is
+                         no limit.
+        """
+
+        self._max_size = max_size
+
+        # The unacknowledged notifications; positions are counts of
+        # notifications appended
+        self._records = collections.deque()
+        self._cursor = 0
+        self._read_pos = 0
+
+    def __len__(self):
+        """
+        Retrieve the number of unacknowledged notifications.
+        """
+
+        return len(self._records)
+
+    def append(self, notifs):
+        """
+        Append notifications to the spool.  Raises ``SpoolFull`` if
+        there is no room for them.
+
+        :param notifs: A list of dictionaries of notify arguments.
+                       Each must include an ID.
+        """
+
+        if (self._max_size is not None and
+                len(self._records) + len(notifs) > self._max_size):
+            raise SpoolFull('Spool is full')
+
+        self._records.extend(notifs)
+
+    def commit(self):
+        """
+        Wait until appended notifications are stored.  This does
+        nothing.
+        """
+
+        pass
+
+    def close(self):
+        """
+        Close the spool.  This does nothing.
+        """
+
+        pass
+
+    def lock_drain(self):
+        """
+        Claim the right to drain the spool.  This does nothing.
+        """
+
+        pass
+
+    def read(self, max_records):
+        """
+        Read the next notifications from the spool.
+
+        :param max_records: The maximum number of notifications to
+                            read.
+
+        :returns: A list of tuples of the position following the
+                  notification, to be passed to ``ack()``, and the
+                  notification.
+        """
+
+        start = self._read_pos - self._cursor
+        notifs = list(itertools.islice(self._records, start,
+                                       start + max_records))
+        records = [(self._read_pos + i + 1, notif)
+                   for i, notif in enumerate(notifs)]
+        self._read_pos += len(notifs)
+
+        return records
+
+    def ack(self, position):
+        """
+        Acknowledge the delivery of notifications.
+
+        :param position: The position following the last notification
+                         delivered, as returned by ``read()``.
+        """
+
+        while self._cursor < position:
+            self._records.popleft()
+            self._cursor += 1
+
+    def rewind(self):
+        """
+        Arrange for the next ``read()`` to begin at the oldest
+        unacknowledged notification.
+        """
+
+        self._read_pos = self._cursor
@@ -16,12 +16,16 @@
 from __future__ import print_function
 
 import os
+import socket
 import sys
+import uuid
 
 import cli_tools
+import gevent.event
 import tendril
 
 from heyu import protocol
+from heyu import spool
 from heyu import util
 
 
@@ -33,6 +37,16 @@ class SubmitterException(Exception):
     pass
 
 
+class SessionClosed(SubmitterException):
+    """
+    An exception for reporting that a request failed because the
+    session was closed before the hub replied to it.  The request may
+    or may not have been processed by the hub.
+    """
+
+    pass
+
+
 class SubmitterApplication(tendril.Application):
     """
     The application for the submitter, a HeyU client.  The submitter
@@ -57,7 +71,8 @@ class SubmitterApplication(tendril.Application):
         :param urgency: The urgency level for the notification.
                         Optional.
         :param category: A category for the notification.  Optional.
-        :param id: The ID of a notification to replace.  Optional.
+        :param id: The ID of a notification to replace.  If not
+                   given, a new ID is assigned.
         """
 
         # Initialize the application
@@ -66,18 +81,19 @@ class SubmitterApplication(tendril.Application):
         # Set up the desired framer
         parent.framers = tendril.COBSFramer(True)
 
-        # Create the notify message
+        # Create the notify message; the ID is assigned here, rather
+        # than by the hub, so that the notification has the same ID
+        # on every hub it reaches
         kwargs = {
             'app_name': app_name,
             'summary': summary,
             'body': body,
+            'id': id or str(uuid.uuid4()),
         }
         if urgency is not None:
             kwargs['urgency'] = urgency
         if category is not None:
             kwargs['category'] = category
-        if id is not None:
-            kwargs['id'] = id
         msg = protocol.Message('notify', **kwargs)
 
         # Send it
@@ -108,6 +124,343 @@ class SubmitterApplication(tendril.Application):
         self.close()
 
 
+class SessionApplication(tendril.Application):
+    """
+    The application for a submitter session.  The session is
+    established by sending a "hello" message, after which the hub
+    keeps the connection open; any number of notifications may then
+    be submitted without waiting for the replies to earlier ones.
+    Each notification carries a sequence number, which the hub echoes
+    in its reply, allowing the reply to be matched to the request.
+    Notifications submitted before the hub replies to the "hello"
+    message are held until it does.
+    """
+
+    def __init__(self, parent):
+        """
+        Initialize a submitter session application.  This sends the
+        "hello" message which establishes the session.
+
+        :param parent: The parent of the ``SessionApplication``.
+                       This will be an instance of
+                       ``tendril.Tendril``.
+        """
+
+        # Initialize the application
+        super(SessionApplication, self).__init__(parent)
+
+        # Set up the desired framer
+        parent.framers = tendril.COBSFramer(True)
+
+        # The next sequence number and the outstanding requests
+        self._next_seq = 0
+        self._pending = {}
+
+        # Frames to send once the session is established; nothing may
+        # be sent between the "hello" message and its reply, since the
+        # framing may change
+        self._held = []
+
+        # Whether to compress frames; negotiated with the hub
+        self._compress = False
+
+        # Whether the session may still be used
+        self.active = True
+
+        # Establish the session
+        hello = protocol.Message('hello', capabilities=(
+            protocol.CAP_LENGTH_FRAMING, protocol.CAP_ZLIB))
+        self.send_frame(hello.to_frame())
+
+    def notify(self, app_name, summary, body,
+               urgency=None, category=None, id=None):
+        """
+        Submit a notification to the hub.  This does not wait for the
+        hub to reply.
+
+        :param app_name: The name of the application the notification
+                         is for.
+        :param summary: A summary of the notification.
+        :param body: The body of the notification.
+        :param urgency: The urgency level for the notification.
+                        Optional.
+        :param category: A category for the notification.  Optional.
+        :param id: The ID of a notification to replace.  If not
+                   given, a new ID is assigned.
+
+        :returns: A ``gevent.event.AsyncResult`` object.  Once the hub
+                  replies, its value will be the notification ID;
+                  if the notification is rejected, or the session is
+                  closed before the hub replies, a
+                  ``SubmitterException`` will be raised by its
+                  ``get()`` method.
+        """
+
+        # Allocate a sequence number
+        seq = self._next_seq
+        self._next_seq += 1
+
+        # Create the notify message; the ID is assigned here, rather
+        # than by the hub, so that the notification has the same ID
+        # on every hub it reaches
+        kwargs = {
+            'app_name': app_name,
+            'summary': summary,
+            'body': body,
+            'seq': seq,
+            'id': id or str(uuid.uuid4()),
+        }
+        if urgency is not None:
+            kwargs['urgency'] = urgency
+        if category is not None:
+            kwargs['category'] = category
+        msg = protocol.Message('notify', **kwargs)
+
+        # Remember the request and send it
+        result = gevent.event.AsyncResult()
+        self._pending[seq] = result
+        self._send(msg.to_frame())
+
+        return result
+
+    def notify_batch(self, notifications):
+        """
+        Submit several notifications to the hub in a single message.
+        The hub accepts or rejects the batch as a whole.  This does
+        not wait for the hub to reply.
+
+        :param notifications: A list of dictionaries, each containing
+                              the keyword arguments of ``notify()``
+                              for one notification.
+
+        :returns: A ``gevent.event.AsyncResult`` object.  Once the hub
+                  replies, its value will be the list of notification
+                  IDs, in order; if the batch is rejected, or the
+                  session is closed before the hub replies, a
+                  ``SubmitterException`` will be raised by its
+                  ``get()`` method.
+        """
+
+        # Allocate a sequence number
+        seq = self._next_seq
+        self._next_seq += 1
+
+        # Encode the notifications, skipping unset optional arguments
+        # and assigning IDs as for notify()
+        frames = []
+        for notif in notifications:
+            kwargs = dict((k, v) for k, v in notif.items() if v is not None)
+            kwargs.setdefault('id', str(uuid.uuid4()))
+            frames.append(protocol.Message('notify', **kwargs).to_frame())
+        msg = protocol.Message('notify_batch', notifications=frames, seq=seq)
+
+        # Remember the request and send it
+        result = gevent.event.AsyncResult()
+        self._pending[seq] = result
+        self._send(msg.to_frame())
+
+        return result
+
+    def recv_frame(self, frame):
+        """
+        Called when a frame is received.  Matches replies to the
+        outstanding requests.
+
+        :param frame: The received frame.
+        """
+
+        # Parse the frame
+        try:
+            msg = protocol.Message.from_frame(frame,
+                                              compressed=self._compress)
+        except ValueError as e:
+            self._fail('Failed to parse frame: %s' % e)
+            self.close()
+            return
+
+        if msg.msg_type == 'accepted' and msg.seq in self._pending:
+            self._pending.pop(msg.seq).set(msg.id)
+        elif msg.msg_type == 'accepted_batch' and msg.seq in self._pending:
+            self._pending.pop(msg.seq).set(msg.ids)
+        elif msg.msg_type == 'error' and msg.seq in self._pending:
+            self._pending.pop(msg.seq).set_exception(SubmitterException(
+                'Failed to submit notification: %s' % msg.reason))
+        elif msg.msg_type == 'error':
+            # An error not tied to a request; the hub will close the
+            # connection
+            self._fail('Failed to submit notification: %s' % msg.reason)
+        elif msg.msg_type == 'goodbye':
+            self._fail('Session closed by the HeyU hub')
+            self.close()
+        elif msg.msg_type == 'hello' and self._held is not None:
+            self._established(msg)
+
+        # Other messages are ignored
+
+    def _send(self, frame):
+        """
+        Send a frame to the hub, holding it if the session has not yet
+        been established.  The frame is compressed if that has been
+        negotiated.
+
+        :param frame: The frame to send.
+        """
+
+        if self._held is None:
+            if self._compress:
+                frame = protocol.compress_frame(frame)
+            self.send_frame(frame)
+        else:
+            self._held.append(frame)
+
+    def _established(self, msg):
+        """
+        Called when the hub replies to the "hello" message.  Switches to
+        the negotiated framing and compression and sends any held
+        frames.
+
+        :param msg: The ``heyu.protocol.Message`` object describing
+                    the reply.
+        """
+
+        if protocol.CAP_LENGTH_FRAMING in msg.capabilities:
+            self.parent.framers = tendril.StructFramer(protocol.LENGTH_FORMAT)
+        self._compress = protocol.CAP_ZLIB in msg.capabilities
+
+        held = self._held
+        self._held = None
+        for frame in held:
+            self._send(frame)
+
+    def _fail(self, reason):
+        """
+        Fail all outstanding requests.  Called when the session ends;
+        the session may no longer be used.
+
+        :param reason: The reason for the failure.
+        """
+
+        self.active = False
+
+        pending = self._pending
+        self._pending = {}
+        for result in pending.values():
+            result.set_exception(SessionClosed(reason))
+
+    def disconnect(self):
+        """
+        Close the session.  Requests that have not yet been replied to
+        will fail.
+        """
+
+        # Send a "goodbye" message
+        try:
+            self.send_frame(protocol.Message('goodbye').to_frame())
+        except Exception:
+            pass
+
+        self.close()
+        self._fail('Session closed')
+
+    def closed(self, error):
+        """
+        Called to notify the application that the connection has been
+        closed.  Not called if the ``close()`` method is called.  This
+        ensures that outstanding requests fail.
+        """
+
+        self._fail('Connection to the HeyU hub closed')
+
+
+def open_session(hub, cert_conf=None, secure=True):
+    """
+    Open a session with the HeyU hub.  Notifications may be submitted
+    over the session by calling its ``notify()`` method, and the
+    session should be closed by calling its ``disconnect()`` method.
+
+    :param hub: The address of the hub, as a tuple of hostname and
+                port.
+    :param cert_conf: The path to the certificate configuration file.
+                      Optional.
+    :param secure: If ``False``, SSL will not be used.  Defaults to
+                   ``True``.
+
+    :returns: An instance of ``SessionApplication``.
+    """
+
+    # Look up the manager; it may already be running if other
+    # sessions have been opened
+    manager = tendril.get_manager('tcp', util.outgoing_endpoint(hub))
+    if not manager.running:
+        manager.start()
+
+    # Connect to the hub
+    wrapper = util.cert_wrapper(cert_conf, 'submitter', secure=secure)
+    tend = manager.connect(hub, SessionApplication, wrapper)
+
+    return tend.application
+
+
+def submit_via_agent(path, app_name, summary, body,
+                     urgency=None, category=None, id=None):
+    """
+    Submit a notification through the local HeyU agent.  The agent
+    replies as soon as it has queued the notification for forwarding
+    to the hub.
+
+    :param path: The path of the Unix socket the agent listens on.
+                 The path is tilde-expanded.
+    :param app_name: The name of the application the notification
+                     is for.
+    :param summary: A summary of the notification.
+    :param body: The body of the notification.
+    :param urgency: The urgency level for the notification.
+                    Optional.
+    :param category: A category for the notification.  Optional.
+    :param id: The ID of a notification to replace.  Optional.
+
+    :returns: The notification ID.  If the agent is not running or
+              does not accept the notification, an exception is
+              raised; this will be a ``SubmitterException``, an
+              ``EnvironmentError``, or a ``ValueError``.
+    """
+
+    # Create the notify message
+    kwargs = {
+        'app_name': app_name,
+        'summary': summary,
+        'body': body,
+    }
+    if urgency is not None:
+        kwargs['urgency'] = urgency
+    if category is not None:
+        kwargs['category'] = category
+    if id is not None:
+        kwargs['id'] = id
+    msg = protocol.Message('notify', **kwargs)
+
+    # Hand it to the agent
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(path))
+        util.write_frame(sock, msg.to_frame())
+        frame = util.read_frame(sock)
+    finally:
+        sock.close()
+
+    # Interpret the reply
+    if frame is None:
+        raise SubmitterException('Connection to the HeyU agent closed')
+    reply = protocol.Message.from_frame(frame)
+    if reply.msg_type == 'accepted':
+        return reply.id
+    elif reply.msg_type == 'error':
+        raise SubmitterException('Failed to submit notification: %s' %
+                                 reply.reason)
+    raise SubmitterException('Unrecognized protocol message "%s"' %
+                             reply.msg_type)
+
+
 @cli_tools.argument('summary',
                     help='Summary of the notification.')
 @cli_tools.argument('body',
@@ -143,11 +496,30 @@ class SubmitterApplication(tendril.Application):
                     action='store_false',
                     help='Specifies that SSL should not be used to connect '
                     'to the hub.')
+@cli_tools.argument('--agent', '-A',
+                    default=util.DEFAULT_AGENT,
+                    help='Specifies the path of the Unix socket of the local '
+                    'HeyU agent.  Defaults to "%(default)s".')
+@cli_tools.argument('--direct', '-D',
+                    dest='agent',
+                    action='store_const',
+                    const=None,
+                    help='Specifies that the notification should be sent '
+                    'directly to the hub, rather than through the local '
+                    'HeyU agent.')
+@cli_tools.argument('--spool', '-S',
+                    dest='spool_dir',
+                    default=None,
+                    help='Specifies a spool directory in which to leave the '
+                    'notification if the hub cannot be reached.  A HeyU '
+                    'agent using the same spool directory will forward it '
+                    'to the hub.')
 @cli_tools.argument('--debug', '-d',
                     help='Enables debugging.')
 def send_notification(hub, app_name, summary, body,
                       urgency=None, category=None, id=None,
-                      cert_conf=None, secure=True):
+                      cert_conf=None, secure=True, agent=None,
+                      spool_dir=None):
     """
     Sends a notification via the configured HeyU hub.  The hub address
     is read from the "~/.heyu.hub" file, which should contain either
@@ -155,7 +527,10 @@ def send_notification(hub, app_name, summary, body,
     "--host" is not given, "localhost" will be tried.  Prints out the
     notification ID if the notification is accepted.  Note that
     certificate configuration is specified in "~/.heyu.cert" by
-    default.
+    default.  If a local HeyU agent is running, the notification is
+    handed to it, and the agent forwards it to its hub; otherwise, the
+    notification is sent directly to the hub.  If that fails, and a
+    spool directory is given, the notification is left in the spool.
 
     :param hub: The address of the hub, as a tuple of hostname and
                 port.
@@ -170,8 +545,21 @@ def send_notification(hub, app_name, summary, body,
                       Optional.
     :param secure: If ``False``, SSL will not be used.  Defaults to
                    ``True``.
+    :param agent: The path of the Unix socket of the local HeyU
+                  agent.  If ``None``, the agent is not used.
+    :param spool_dir: The path of the spool directory.  Optional.
     """
 
+    # Try the agent first
+    if agent:
+        try:
+            print(submit_via_agent(agent, app_name, summary, body,
+                                   urgency, category, id))
+            return
+        except (SubmitterException, EnvironmentError, ValueError):
+            # Fall back to a direct connection
+            pass
+
     # Look up the manager
     manager = tendril.get_manager('tcp', util.outgoing_endpoint(hub))
     manager.start()
@@ -181,7 +569,29 @@ def send_notification(hub, app_name, summary, body,
                                  app_name, summary, body,
                                  urgency, category, id)
     wrapper = util.cert_wrapper(cert_conf, 'submitter', secure=secure)
-    manager.connect(hub, app, wrapper)
+    try:
+        manager.connect(hub, app, wrapper)
+    except EnvironmentError:
+        if not spool_dir:
+            raise
+
+        # Leave it in the spool; the ID must be assigned now, so that
+        # it can be reported
+        notif_id = id or str(uuid.uuid4())
+        notif_spool = spool.Spool(spool_dir)
+        try:
+            notif_spool.append([{
+                'app_name': app_name,
+                'summary': summary,
+                'body': body,
+                'urgency': (protocol.URGENCY_LOW if urgency is None
+                            else urgency),
+                'category': category,
+                'id': notif_id,
+            }])
+        finally:
+            notif_spool.close()
+        print(notif_id)
 
 
 @send_notification.processor
@@ -16,19 +16,29 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import ConfigParser
+import itertools
 import os
+import random
 import re
 import socket
+import struct
 import sys
+import time
 
 from gevent import ssl
 import tendril
 
+from heyu import protocol
+
 
 # Default port for the HeyU hub
 HEYU_PORT = 4859
 
+# Default path of the Unix socket of the local HeyU agent
+DEFAULT_AGENT = '~/.heyu.agent'
+
 # Regular expression for parsing a hub specification
 HUB_RE = re.compile(r'^(?P<hostname>[^:\s\[\]]+|\[[0-9a-fA-F:]+\])'
                     r'(?::(?P<port>\d+))?$')
@@ -83,6 +93,21 @@ def parse_hub(hub):
     return result[0][4]
 
 
+def parse_hubs(hubs):
+    """
+    Parse a specification of one or more hubs.
+
+    :param hubs: The hub specification.  Several hubs may be given,
+                 separated by commas, each as for ``parse_hub()``.
+
+    :returns: A tuple of the hostname and integer port number, if a
+              single hub is given; otherwise, a list of such tuples.
+    """
+
+    result = [parse_hub(hub.strip()) for hub in hubs.split(',')]
+    return result[0] if len(result) == 1 else result
+
+
 def default_hub():
     """
     Retrieve the default hub specification.
@@ -124,6 +149,315 @@ def outgoing_endpoint(target):
     return ('', 0)
 
 
+def _recv_exact(sock, size):
+    """
+    Receive an exact number of bytes from a socket.
+
+    :param sock: The socket to receive from.
+    :param size: The number of bytes to receive.
+
+    :returns: The received bytes, or ``None`` if the connection was
+              closed before any were received.
+    """
+
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ValueError('connection closed in mid-frame')
+            return None
+        data += chunk
+
+    return data
+
+
+def read_frame(sock):
+    """
+    Read a length-prefixed frame from a socket.  This is the framing
+    used on the local agent socket; see ``protocol.LENGTH_FORMAT``.
+
+    :param sock: The socket to read from.
+
+    :returns: The frame, or ``None`` if the connection was closed.
+    """
+
+    header = _recv_exact(sock, struct.calcsize(protocol.LENGTH_FORMAT))
+    if header is None:
+        return None
+
+    length, = struct.unpack(protocol.LENGTH_FORMAT, header)
+    frame = _recv_exact(sock, length)
+    if frame is None and length:
+        raise ValueError('connection closed in mid-frame')
+
+    return frame or ''
+
+
+def write_frame(sock, frame):
+    """
+    Write a length-prefixed frame to a socket.
+
+    :param sock: The socket to write to.
+    :param frame: The frame to write.
+    """
+
+    sock.sendall(struct.pack(protocol.LENGTH_FORMAT, len(frame)) + frame)
+
+
+class CoalescingQueue(object):
+    """
+    A first-in, first-out queue of notifications which coalesces
+    notifications by ID.  A notification replaces any queued
+    notification with the same ID, and takes its place at the end of
+    the queue, so a slow consumer only receives the latest version of
+    each notification, but never receives an older version after a
+    newer one.
+    """
+
+    def __init__(self):
+        """
+        Initialize a ``CoalescingQueue`` object.
+        """
+
+        # The order of the queued items, as tokens; the tokens of
+        # replaced items are left in place and skipped
+        self._order = collections.deque()
+        self._tokens = itertools.count()
+
+        # Maps tokens to tuples of ID and item, and IDs to the token
+        # of the queued item with that ID
+        self._items = {}
+        self._latest = {}
+
+        # Count of items replaced before they were removed
+        self.coalesced = 0
+
+    def __len__(self):
+        """
+        Retrieve the number of queued items.
+        """
+
+        return len(self._items)
+
+    def __iter__(self):
+        """
+        Iterate over the queued items, in order.
+
+        :returns: An iterator over the items.
+        """
+
+        return (self._items[token][1] for token in self._order
+                if token in self._items)
+
+    def __contains__(self, key):
+        """
+        Determine whether an item with a given ID is queued.
+
+        :param key: The ID.
+
+        :returns: A ``True`` value if an item with the ID is queued.
+        """
+
+        return key in self._latest
+
+    def append(self, item, key=None):
+        """
+        Add an item to the end of the queue.
+
+        :param item: The item.
+        :param key: The ID of the item.  Any queued item with the same
+                    ID is discarded.  If ``None``, the item does not
+                    replace any other item.
+        """
+
+        if key is not None and key in self._latest:
+            del self._items[self._latest.pop(key)]
+            self.coalesced += 1
+
+            # Don't let the tokens of replaced items accumulate
+            if len(self._order) > 2 * len(self._items) + 16:
+                self._order = collections.deque(
+                    token for token in self._order if token in self._items)
+
+        token = next(self._tokens)
+        self._order.append(token)
+        self._items[token] = (key, item)
+        if key is not None:
+            self._latest[key] = token
+
+    def extend(self, items):
+        """
+        Add several items without IDs to the end of the queue.
+
+        :param items: An iterable of the items.
+        """
+
+        for item in items:
+            self.append(item)
+
+    def popleft(self):
+        """
+        Remove the item at the front of the queue.  Raises an
+        ``IndexError`` if the queue is empty.
+
+        :returns: The item.
+        """
+
+        # Skip the tokens of replaced items
+        entry = None
+        while entry is None:
+            entry = self._items.pop(self._order.popleft(), None)
+
+        key, item = entry
+        if key is not None:
+            del self._latest[key]
+
+        return item
+
+    def clear(self):
+        """
+        Discard all the queued items.
+        """
+
+        self._order.clear()
+        self._items.clear()
+        self._latest.clear()
+
+
+class SeenSet(object):
+    """
+    A set of recently seen keys, used to discard duplicates.  Keys
+    are forgotten once they have been in the set for longer than a
+    time window, or to keep the set within a maximum size, so that
+    the set does not grow without bound.
+    """
+
+    def __init__(self, window=300, max_size=100000):
+        """
+        Initialize a ``SeenSet`` object.
+
+        :param window: The number of seconds a key is remembered.
+        :param max_size: The maximum number of keys remembered.
+        """
+
+        self.window = window
+        self.max_size = max_size
+
+        # The keys, in the order they were added, with the time they
+        # were added
+        self._order = collections.deque()
+        self._keys = set()
+
+    def __len__(self):
+        """
+        Retrieve the number of keys remembered.
+        """
+
+        return len(self._keys)
+
+    def __contains__(self, key):
+        """
+        Determine whether a key is remembered.
+
+        :param key: The key.
+
+        :returns: A ``True`` value if the key is remembered.
+        """
+
+        return key in self._keys
+
+    def add(self, key):
+        """
+        Add a key to the set, unless it was already seen.
+
+        :param key: The key.
+
+        :returns: A ``True`` value if the key was not already in the
+                  set.
+        """
+
+        # Forget keys that are too old, or that don't fit
+        now = time.time()
+        while self._order and (len(self._order) >= self.max_size or
+                               now - self._order[0][0] >= self.window):
+            self._keys.discard(self._order.popleft()[1])
+
+        if key in self._keys:
+            return False
+
+        self._order.append((now, key))
+        self._keys.add(key)
+        return True
+
+
+class Backoff(object):
+    """
+    Compute the delays between attempts to reconnect to the hub.
+    While connections fail quickly, the delay increases exponentially
+    up to a maximum; once a connection lasts long enough to be
+    considered a success, the delay is scaled back linearly.  Each
+    delay is randomly shortened a little, so that many clients
+    disconnected at once don't all reconnect at the same moment.
+    """
+
+    def __init__(self, max_sleep=300, threshold=30, recover=5, jitter=0.25):
+        """
+        Initialize a ``Backoff`` object.
+
+        :param max_sleep: The maximum number of seconds to delay.
+        :param threshold: The minimum number of seconds a connection
+                          must last to be considered successful.
+                          Before ``threshold``, the delay is increased
+                          exponentially; after ``threshold``, the
+                          delay is decreased linearly.
+        :param recover: A scaling factor used for linear decrease in
+                        the delay.  The number of seconds the
+                        connection lasted is divided by this factor,
+                        truncated to integer, and subtracted from the
+                        last delay.
+        :param jitter: The largest fraction of each delay that may be
+                       randomly removed from it.
+        """
+
+        self.max_sleep = max_sleep
+        self.threshold = threshold
+        self.recover = recover
+        self.jitter = jitter
+
+        # The time of the last attempt and the last delay
+        self.last_time = time.time()
+        self.last_sleep = 0
+
+    def next_delay(self):
+        """
+        Compute the delay before the next attempt.  Should be called
+        when the connection made by the last attempt is lost, or when
+        the attempt fails.
+
+        :returns: The number of seconds to wait before the next
+                  attempt.
+        """
+
+        curr_time = time.time()
+        elapsed = curr_time - self.last_time
+
+        # Was the connection successful?
+        if elapsed < self.threshold:
+            # No, double the last delay, capping at max_sleep
+            next_sleep = min(max(self.last_sleep * 2, 1), self.max_sleep)
+        else:
+            # Yes, linearly scale the last delay with a minimum of 0
+            next_sleep = max(self.last_sleep - int(elapsed / self.recover),
+                             0)
+
+        # The next attempt is made once the delay expires
+        self.last_time = curr_time + next_sleep
+        self.last_sleep = next_sleep
+
+        return next_sleep * (1 - self.jitter * random.random())
+
+
 # Regular expression for parsing a certificate configuration
 # specification
 CERTCONF_RE = re.compile(r'^(?P<conf_path>[^\[\]]+)'
@@ -139,10 +473,125 @@ class CertException(Exception):
     pass
 
 
+# Cache of TLS wrappers, keyed by the tuple of the certificate
+# configuration path, profile name, and server_side flag.  Each value
+# is a tuple of the paths of the files the wrapper was built from,
+# their stamps at the time (see _file_stamps()), and the wrapper.
+_tls_wrappers = {}
+
+# Protocol options disabling everything older than TLS 1.2; options
+# not known to this version of the ssl module are skipped
+_TLS_OPTIONS = 0
+for _opt in ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1',
+             'OP_NO_COMPRESSION'):
+    _TLS_OPTIONS |= getattr(ssl, _opt, 0)
+
+
+def _file_stamps(paths):
+    """
+    Compute stamps identifying the current contents of a set of files.
+
+    :param paths: A sequence of file paths.
+
+    :returns: A tuple containing, for each file, a tuple of its
+              modification time and size, or ``None`` if the file
+              cannot be examined.
+    """
+
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append((st.st_mtime, st.st_size))
+
+    return tuple(stamps)
+
+
+class TLSWrapper(object):
+    """
+    A wrapper, suitable for use with Tendril, that sets up TLS on a
+    socket using a shared ``ssl.SSLContext``.  On the client side, the
+    TLS session of the last connection is offered when making the next
+    one, so that reconnections may skip the full handshake; this
+    requires an ``ssl`` module supporting sessions.  On the server
+    side, session resumption is provided by the context itself.
+    """
+
+    def __init__(self, context, server_side=False):
+        """
+        Initialize a ``TLSWrapper`` object.
+
+        :param context: The ``ssl.SSLContext`` to use.
+        :param server_side: If ``True``, TLS will be set up for the
+                            server side of the connection, rather than
+                            the client side.
+        """
+
+        self.context = context
+        self.server_side = server_side
+        self.session = None
+
+    def __call__(self, sock):
+        """
+        Set up TLS on a socket.
+
+        :param sock: The socket to wrap.  On the client side, this
+                     must already be connected.
+
+        :returns: The wrapped socket.
+        """
+
+        if self.server_side:
+            return self.context.wrap_socket(sock, server_side=True)
+
+        kwargs = {}
+        if self.session is not None:
+            kwargs['session'] = self.session
+        wrapped = self.context.wrap_socket(sock, **kwargs)
+
+        # Remember the session for the next connection
+        self.session = getattr(wrapped, 'session', None)
+
+        return wrapped
+
+
+def _tls_context(conf, server_side):
+    """
+    Construct an ``ssl.SSLContext`` for a certificate profile.  The
+    context negotiates the highest protocol version supported by both
+    ends, but no lower than TLS 1.2, and requires a certificate signed
+    by the configured certificate authority from the peer.  Peers are
+    identified by their certificates, so host names are not checked.
+
+    :param conf: The certificate profile, as a dictionary containing
+                 the "cafile", "certfile", and "keyfile" keys.
+    :param server_side: If ``True``, the context will be used for the
+                        server side of connections, and so is set up
+                        to authenticate clients; otherwise, it is set
+                        up to authenticate servers.
+
+    :returns: The ``ssl.SSLContext`` object.
+    """
+
+    purpose = (ssl.Purpose.CLIENT_AUTH if server_side else
+               ssl.Purpose.SERVER_AUTH)
+    context = ssl.create_default_context(purpose, cafile=conf['cafile'])
+    context.options |= _TLS_OPTIONS
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_cert_chain(conf['certfile'], conf['keyfile'])
+
+    return context
+
+
 def cert_wrapper(cert_conf, profile, server_side=False, secure=True):
     """
-    Compute and return a ``tendril.TendrilPartial`` object which will
-    set up TLS on the HeyU port.
+    Compute and return a ``TLSWrapper`` object which will set up TLS
+    on the HeyU port.  Wrappers are cached, and are only rebuilt when
+    the configuration file or the files it names change.
 
     :param cert_conf: The path to the certificate profile
                       configuration file.  If ``None``, "~/.heyu.cert"
@@ -186,8 +635,16 @@ def cert_wrapper(cert_conf, profile, server_side=False, secure=True):
         if override:
             profile = override
 
-    # Look up and read the certificate configuration
+    # Use the cached wrapper if none of its files have changed
     cert_path = os.path.expanduser(cert_conf)
+    cache_key = (cert_path, profile, server_side)
+    cached = _tls_wrappers.get(cache_key)
+    if cached is not None:
+        paths, stamps, wrapper = cached
+        if _file_stamps(paths) == stamps:
+            return wrapper
+
+    # Look up and read the certificate configuration
     cp = ConfigParser.SafeConfigParser()
     if not cp.read(cert_path):
         raise CertException("Could not read certificate configuration "
@@ -211,12 +668,21 @@ def cert_wrapper(cert_conf, profile, server_side=False, secure=True):
                             "values in the [%s] profile of '%s': %s" %
                             (profile, cert_path, ', '.join(sorted(missing))))
 
-    return tendril.TendrilPartial(
-        ssl.wrap_socket,
-        keyfile=conf['keyfile'], certfile=conf['certfile'],
-        ca_certs=conf['cafile'],
-        server_side=server_side, cert_reqs=ssl.CERT_REQUIRED,
-        ssl_version=ssl.PROTOCOL_TLSv1)
+    # Stamp the files before reading them, so that a change made
+    # while we're building the context triggers a rebuild
+    paths = (cert_path, conf['cafile'], conf['certfile'], conf['keyfile'])
+    stamps = _file_stamps(paths)
+
+    try:
+        context = _tls_context(conf, server_side)
+    except (ssl.SSLError, EnvironmentError) as exc:
+        raise CertException("Could not load certificates for the [%s] "
+                            "profile of '%s': %s" % (profile, cert_path, exc))
+
+    wrapper = TLSWrapper(context, server_side)
+    _tls_wrappers[cache_key] = (paths, stamps, wrapper)
+
+    return wrapper
 
 
 def daemonize(workdir='/', pidfile=None):
@@ -41,11 +41,15 @@ setup(
             'heyu-notify = heyu.submitter:send_notification.console',
             'heyu-hub = heyu.hub:start_hub.console',
             'heyu-notifier = heyu.notifier:notification_server.console',
+            'heyu-agent = heyu.agent:start_agent.console',
+            'heyu-history = heyu.history:query_history.console',
         ],
         'heyu.notifier': [
             'stdout = heyu.notifier:stdout_notification_driver',
             'file = heyu.notifier:file_notification_driver',
             'script = heyu.notifier:script_notification_driver',
+            'multi = heyu.notifier:multi_notification_driver',
+            'history = heyu.history:history_notification_driver',
             'gtk = heyu.gtk:gtk_notification_driver',
         ],
     },
@@ -0,0 +1,719 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import signal
+import unittest
+
+import gevent.event
+import mock
+import msgpack
+
+from heyu import agent
+from heyu import protocol
+from heyu import spool
+from heyu import submitter
+from heyu import util
+
+
+class TestException(Exception):
+    pass
+
+
+class UnixListenerTest(unittest.TestCase):
+    @mock.patch('os.path.exists', return_value=False)
+    @mock.patch('os.unlink')
+    @mock.patch('os.umask', return_value=0)
+    @mock.patch('os.chmod')
+    @mock.patch('gevent.socket.socket')
+    def test_basic(self, mock_socket, mock_chmod, mock_umask, mock_unlink,
+                   mock_exists):
+        calls = mock.Mock()
+        calls.attach_mock(mock_socket.return_value.bind, 'bind')
+        calls.attach_mock(mock_umask, 'umask')
+        calls.attach_mock(mock_chmod, 'chmod')
+
+        result = agent._unix_listener('/path', 5)
+
+        self.assertEqual(mock_socket.return_value, result)
+        mock_socket.assert_called_once_with(agent.socket.AF_UNIX,
+                                            agent.socket.SOCK_STREAM)
+        mock_socket.return_value.listen.assert_called_once_with(5)
+        self.assertEqual([
+            mock.call.umask(0o177),
+            mock.call.bind('/path'),
+            mock.call.umask(0),
+            mock.call.chmod('/path', 0o600),
+        ], calls.mock_calls)
+        self.assertFalse(mock_unlink.called)
+
+    @mock.patch('os.path.exists', return_value=False)
+    @mock.patch('os.umask', return_value=0o22)
+    @mock.patch('os.chmod')
+    @mock.patch('gevent.socket.socket')
+    def test_bind_failure(self, mock_socket, mock_chmod, mock_umask,
+                          mock_exists):
+        mock_socket.return_value.bind.side_effect = TestException('in use')
+
+        self.assertRaises(TestException, agent._unix_listener, '/path')
+
+        mock_umask.assert_has_calls([mock.call(0o177), mock.call(0o22)])
+        self.assertFalse(mock_chmod.called)
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('os.unlink')
+    @mock.patch('os.umask', return_value=0)
+    @mock.patch('os.chmod')
+    @mock.patch('gevent.socket.socket', side_effect=[
+        mock.Mock(**{'connect.side_effect': agent.socket.error('refused')}),
+        mock.Mock(),
+    ])
+    def test_stale(self, mock_socket, mock_chmod, mock_umask, mock_unlink,
+                   mock_exists):
+        result = agent._unix_listener('/path')
+
+        self.assertEqual(2, mock_socket.call_count)
+        mock_unlink.assert_called_once_with('/path')
+        result.assert_has_calls([
+            mock.call.bind('/path'),
+            mock.call.listen(agent.BACKLOG),
+        ])
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('os.unlink')
+    @mock.patch('os.chmod')
+    @mock.patch('gevent.socket.socket')
+    def test_running(self, mock_socket, mock_chmod, mock_unlink, mock_exists):
+        self.assertRaises(agent.AgentException, agent._unix_listener, '/path')
+
+        mock_socket.assert_called_once_with(agent.socket.AF_UNIX,
+                                            agent.socket.SOCK_STREAM)
+        mock_socket.return_value.assert_has_calls([
+            mock.call.connect('/path'),
+            mock.call.close(),
+        ])
+        self.assertFalse(mock_unlink.called)
+        self.assertFalse(mock_chmod.called)
+
+
+class AgentServerTest(unittest.TestCase):
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x[1:])
+    @mock.patch('gevent.signal')
+    def test_init(self, mock_signal, mock_expanduser):
+        result = agent.AgentServer('hub')
+
+        self.assertEqual('hub', result._hub)
+        self.assertEqual(util.DEFAULT_AGENT[1:], result._path)
+        self.assertEqual(None, result._cert_conf)
+        self.assertEqual(True, result._secure)
+        self.assertEqual(agent.BATCH_SIZE, result._batch_size)
+        self.assertTrue(isinstance(result._spool, spool.MemorySpool))
+        self.assertEqual(agent.QUEUE_SIZE, result._spool._max_size)
+        self.assertEqual(None, result._poll)
+        self.assertTrue(isinstance(result._queue_event, gevent.event.Event))
+        self.assertEqual(collections.deque(), result._inflight)
+        self.assertEqual(None, result._session)
+        self.assertTrue(isinstance(result._backoff, util.Backoff))
+        self.assertEqual(agent.MAX_SLEEP, result._backoff.max_sleep)
+        self.assertEqual(agent.THRESHOLD, result._backoff.threshold)
+        self.assertEqual(agent.RECOVER, result._backoff.recover)
+        self.assertEqual(0, result._failures)
+        self.assertEqual(None, result._server)
+        self.assertEqual(None, result._forwarder)
+        self.assertEqual(0, result.accepted)
+        self.assertEqual(0, result.forwarded)
+        self.assertEqual(0, result.rejected)
+        mock_signal.assert_has_calls([
+            mock.call(signal.SIGINT, result.stop),
+            mock.call(signal.SIGTERM, result.stop),
+        ])
+
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x)
+    @mock.patch('gevent.signal')
+    def test_init_args(self, mock_signal, mock_expanduser):
+        result = agent.AgentServer('hub', 'path', 'cert_conf', False, 5, 2)
+
+        self.assertEqual('path', result._path)
+        self.assertEqual('cert_conf', result._cert_conf)
+        self.assertEqual(False, result._secure)
+        self.assertEqual(5, result._spool._max_size)
+        self.assertEqual(2, result._batch_size)
+
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x)
+    @mock.patch('gevent.signal')
+    @mock.patch.object(spool, 'Spool', return_value='spool')
+    def test_init_spool(self, mock_Spool, mock_signal, mock_expanduser):
+        result = agent.AgentServer('hub', spool_dir='spool_dir')
+
+        mock_Spool.assert_called_once_with('spool_dir')
+        self.assertEqual('spool', result._spool)
+        self.assertEqual(spool.POLL_INTERVAL, result._poll)
+
+    def _agent(self, **kwargs):
+        with mock.patch('gevent.signal'):
+            result = agent.AgentServer('hub', '/path', **kwargs)
+        return result
+
+    @mock.patch.object(util, 'cert_wrapper')
+    @mock.patch.object(agent, '_unix_listener', return_value='listener')
+    @mock.patch('gevent.server.StreamServer')
+    @mock.patch('gevent.spawn', return_value='forwarder')
+    def test_start(self, mock_spawn, mock_StreamServer, mock_unix_listener,
+                   mock_cert_wrapper):
+        server = self._agent(cert_conf='cert_conf')
+        server._spool = mock.Mock()
+
+        server.start()
+
+        mock_cert_wrapper.assert_called_once_with(
+            'cert_conf', 'submitter', secure=True)
+        server._spool.lock_drain.assert_called_once_with()
+        mock_unix_listener.assert_called_once_with('/path')
+        mock_StreamServer.assert_called_once_with('listener', server._serve)
+        mock_StreamServer.return_value.start.assert_called_once_with()
+        self.assertEqual(mock_StreamServer.return_value, server._server)
+        mock_spawn.assert_called_once_with(server._forward)
+        self.assertEqual('forwarder', server._forwarder)
+
+    @mock.patch.object(util, 'cert_wrapper')
+    @mock.patch.object(agent, '_unix_listener', return_value='listener')
+    @mock.patch('gevent.server.StreamServer')
+    @mock.patch('gevent.spawn', return_value='forwarder')
+    def test_start_running(self, mock_spawn, mock_StreamServer,
+                           mock_unix_listener, mock_cert_wrapper):
+        server = self._agent()
+        server._server = 'server'
+
+        self.assertRaises(ValueError, server.start)
+        self.assertFalse(mock_cert_wrapper.called)
+        self.assertFalse(mock_StreamServer.called)
+        self.assertFalse(mock_spawn.called)
+
+    @mock.patch.object(util, 'cert_wrapper',
+                       side_effect=util.CertException('bad'))
+    @mock.patch.object(agent, '_unix_listener', return_value='listener')
+    @mock.patch('gevent.server.StreamServer')
+    @mock.patch('gevent.spawn', return_value='forwarder')
+    def test_start_bad_certs(self, mock_spawn, mock_StreamServer,
+                             mock_unix_listener, mock_cert_wrapper):
+        server = self._agent()
+
+        self.assertRaises(util.CertException, server.start)
+        self.assertFalse(mock_unix_listener.called)
+        self.assertEqual(None, server._server)
+
+    @mock.patch('os.unlink')
+    def test_stop(self, mock_unlink):
+        server = self._agent()
+        srv = server._server = mock.Mock()
+        forwarder = server._forwarder = mock.Mock()
+        session = server._session = mock.Mock()
+        server._spool = mock.Mock()
+
+        server.stop()
+
+        srv.stop.assert_called_once_with()
+        forwarder.kill.assert_called_once_with()
+        session.disconnect.assert_called_once_with()
+        server._spool.close.assert_called_once_with()
+        mock_unlink.assert_called_once_with('/path')
+        self.assertEqual(None, server._server)
+        self.assertEqual(None, server._session)
+
+    @mock.patch('os.unlink', side_effect=OSError('gone'))
+    def test_stop_no_session(self, mock_unlink):
+        server = self._agent()
+        server._server = mock.Mock()
+        server._forwarder = mock.Mock()
+
+        server.stop()
+
+        mock_unlink.assert_called_once_with('/path')
+
+    @mock.patch('os.unlink')
+    def test_stop_stopped(self, mock_unlink):
+        server = self._agent()
+
+        server.stop()
+
+        self.assertFalse(mock_unlink.called)
+
+    def test_wait(self):
+        server = self._agent()
+        server._forwarder = mock.Mock()
+
+        server.wait()
+
+        server._forwarder.join.assert_called_once_with()
+
+    @mock.patch('uuid.uuid4', return_value='uuid')
+    def test_submit(self, mock_uuid4):
+        server = self._agent()
+        msg = protocol.Message('notify', app_name='app', summary='summary',
+                               body='body', seq=5)
+
+        result = server.submit(msg)
+
+        self.assertEqual('accepted', result.msg_type)
+        self.assertEqual('uuid', result.id)
+        self.assertEqual(5, result.seq)
+        self.assertEqual([(1, {
+            'app_name': 'app',
+            'summary': 'summary',
+            'body': 'body',
+            'urgency': protocol.URGENCY_LOW,
+            'category': None,
+            'id': 'uuid',
+        })], server._spool.read(10))
+        self.assertTrue(server._queue_event.is_set())
+        self.assertEqual(1, server.accepted)
+
+    @mock.patch('uuid.uuid4', return_value='uuid')
+    def test_submit_with_id(self, mock_uuid4):
+        server = self._agent()
+        server._spool = mock.Mock()
+        msg = protocol.Message('notify', app_name='app', summary='summary',
+                               body='body', urgency=2, category='cat',
+                               id='notif_id')
+
+        result = server.submit(msg)
+
+        self.assertEqual('notif_id', result.id)
+        self.assertEqual(None, result.seq)
+        server._spool.assert_has_calls([
+            mock.call.append([{
+                'app_name': 'app',
+                'summary': 'summary',
+                'body': 'body',
+                'urgency': 2,
+                'category': 'cat',
+                'id': 'notif_id',
+            }]),
+            mock.call.commit(),
+        ])
+        self.assertFalse(mock_uuid4.called)
+
+    def test_submit_full(self):
+        server = self._agent(queue_size=1)
+        server._spool.append([{'id': 'queued'}])
+        msg = protocol.Message('notify', app_name='app', summary='summary',
+                               body='body', seq=5)
+
+        result = server.submit(msg)
+
+        self.assertEqual('error', result.msg_type)
+        self.assertEqual(5, result.seq)
+        self.assertEqual(1, len(server._spool))
+        self.assertFalse(server._queue_event.is_set())
+        self.assertEqual(0, server.accepted)
+
+    def test_submit_failed(self):
+        server = self._agent()
+        server._spool = mock.Mock(**{
+            'commit.side_effect': OSError('disk full'),
+        })
+        msg = protocol.Message('notify', app_name='app', summary='summary',
+                               body='body')
+
+        result = server.submit(msg)
+
+        self.assertEqual('error', result.msg_type)
+        self.assertFalse(server._queue_event.is_set())
+        self.assertEqual(0, server.accepted)
+
+    @mock.patch.object(util, 'read_frame', side_effect=['frame1', 'frame2',
+                                                        None])
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(protocol.Message, 'from_frame', side_effect=[
+        mock.Mock(msg_type='notify'),
+        mock.Mock(msg_type='notify'),
+    ])
+    def test_serve(self, mock_from_frame, mock_write_frame, mock_read_frame):
+        sock = mock.Mock()
+        replies = [mock.Mock(**{'to_frame.return_value': 'reply%d' % i})
+                   for i in range(2)]
+        server = self._agent()
+        with mock.patch.object(server, 'submit', side_effect=replies):
+            server._serve(sock, 'addr')
+
+        mock_write_frame.assert_has_calls([
+            mock.call(sock, 'reply0'),
+            mock.call(sock, 'reply1'),
+        ])
+        sock.close.assert_called_once_with()
+
+    @mock.patch.object(util, 'read_frame', side_effect=['frame1', 'frame2',
+                                                        None])
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(protocol.Message, 'from_frame', side_effect=[
+        ValueError('bad frame'),
+        mock.Mock(msg_type='hello'),
+    ])
+    def test_serve_bad(self, mock_from_frame, mock_write_frame,
+                       mock_read_frame):
+        sock = mock.Mock()
+        server = self._agent()
+        with mock.patch.object(server, 'submit') as mock_submit:
+            server._serve(sock, 'addr')
+
+        self.assertFalse(mock_submit.called)
+        self.assertEqual(2, mock_write_frame.call_count)
+        for call in mock_write_frame.call_args_list:
+            reply = msgpack.loads(call[0][1])
+            self.assertEqual('error', reply['msg_type'])
+        sock.close.assert_called_once_with()
+
+    @mock.patch.object(util, 'read_frame', side_effect=IOError('reset'))
+    def test_serve_disconnect(self, mock_read_frame):
+        sock = mock.Mock()
+        server = self._agent()
+
+        server._serve(sock, 'addr')
+
+        sock.close.assert_called_once_with()
+
+    @mock.patch.object(submitter, 'open_session', side_effect=[
+        TestException('down'),
+        TestException('down'),
+        'session',
+    ])
+    @mock.patch('gevent.sleep')
+    def test_connect(self, mock_sleep, mock_open_session):
+        server = self._agent(cert_conf='cert_conf', secure=False)
+        server._backoff = mock.Mock(**{'next_delay.side_effect': [1, 2]})
+
+        result = server._connect()
+
+        self.assertEqual('session', result)
+        mock_open_session.assert_has_calls([
+            mock.call('hub', 'cert_conf', False),
+        ] * 3)
+        self.assertEqual(2, server._backoff.next_delay.call_count)
+        mock_sleep.assert_has_calls([mock.call(1), mock.call(2)])
+
+    @mock.patch.object(submitter, 'open_session', return_value='session')
+    @mock.patch('gevent.sleep')
+    def test_connect_after_failure(self, mock_sleep, mock_open_session):
+        server = self._agent()
+        server._failures = 1
+        server._backoff = mock.Mock(**{'next_delay.return_value': 3})
+
+        result = server._connect()
+
+        self.assertEqual('session', result)
+        mock_sleep.assert_called_once_with(3)
+        mock_open_session.assert_called_once_with('hub', None, True)
+
+    def _forward(self, server, iterations):
+        # Run the forwarder until it has waited the given number of
+        # times
+        server._queue_event = mock.Mock(**{
+            'wait.side_effect': [None] * iterations + [TestException('stop')],
+        })
+        self.assertRaises(TestException, server._forward)
+
+    def test_forward(self):
+        server = self._agent(batch_size=2)
+        server._spool = mock.Mock(**{
+            'read.side_effect': [['r1', 'r2'], ['r3'], []],
+        })
+        session = mock.Mock(active=True)
+
+        with mock.patch.object(server, '_connect',
+                               return_value=session) as mock_connect, \
+                mock.patch.object(server, '_send') as mock_send:
+            self._forward(server, 3)
+
+        mock_connect.assert_called_once_with()
+        server._spool.read.assert_has_calls([mock.call(2)] * 3)
+        mock_send.assert_has_calls([
+            mock.call(session, ['r1', 'r2']),
+            mock.call(session, ['r3']),
+        ])
+        self.assertEqual(2, mock_send.call_count)
+        server._queue_event.wait.assert_has_calls([mock.call(None)] * 4)
+        self.assertEqual(3, server._queue_event.clear.call_count)
+        self.assertEqual(2, server._queue_event.set.call_count)
+        self.assertEqual(session, server._session)
+
+    def test_forward_reconnect(self):
+        server = self._agent()
+        server._spool = mock.Mock(**{'read.return_value': ['r1']})
+        server._session = mock.Mock(active=False)
+        session = mock.Mock(active=True)
+
+        with mock.patch.object(server, '_connect', return_value=session), \
+                mock.patch.object(server, '_send') as mock_send:
+            self._forward(server, 1)
+
+        mock_send.assert_called_once_with(session, ['r1'])
+        self.assertEqual(session, server._session)
+
+    def test_forward_session(self):
+        server = self._agent()
+        server._spool = mock.Mock(**{'read.return_value': ['r1']})
+        session = server._session = mock.Mock(active=True)
+
+        with mock.patch.object(server, '_connect') as mock_connect, \
+                mock.patch.object(server, '_send') as mock_send:
+            self._forward(server, 1)
+
+        self.assertFalse(mock_connect.called)
+        mock_send.assert_called_once_with(session, ['r1'])
+
+    def test_forward_after_failure(self):
+        server = self._agent(batch_size=2)
+        server._failures = 1
+        server._spool = mock.Mock(**{'read.side_effect': [['r1'], ['r2']]})
+        session = server._session = mock.Mock(active=True)
+
+        def send(session, records):
+            server._inflight.append([records[-1], False])
+
+        with mock.patch.object(server, '_send',
+                               side_effect=send) as mock_send:
+            self._forward(server, 2)
+
+        # Only one notification at a time is sent
+        server._spool.read.assert_called_once_with(1)
+        mock_send.assert_called_once_with(session, ['r1'])
+
+    def test_forward_inflight(self):
+        server = self._agent()
+        server._spool = mock.Mock()
+        server._inflight.extend([[i, False]
+                                 for i in range(agent.MAX_INFLIGHT)])
+
+        with mock.patch.object(server, '_send') as mock_send:
+            self._forward(server, 1)
+
+        self.assertFalse(server._spool.read.called)
+        self.assertFalse(mock_send.called)
+
+    def test_send_single(self):
+        server = self._agent()
+        session = mock.Mock()
+
+        with mock.patch.object(server, '_sent') as mock_sent:
+            server._send(session, [(1, {'id': 'n1'})])
+            result = session.notify.return_value
+            result.rawlink.call_args[0][0](result)
+
+        session.notify.assert_called_once_with(id='n1')
+        self.assertFalse(session.notify_batch.called)
+        self.assertEqual(collections.deque([[1, False]]), server._inflight)
+        mock_sent.assert_called_once_with(session, server._inflight[0], 1,
+                                          result)
+
+    def test_send_batch(self):
+        server = self._agent()
+        session = mock.Mock()
+        records = [(1, {'id': 'n1'}), (2, {'id': 'n2'}), (3, {'id': 'n1'})]
+
+        with mock.patch.object(server, '_sent') as mock_sent:
+            server._send(session, records)
+            result = session.notify_batch.return_value
+            result.rawlink.call_args[0][0](result)
+
+        session.notify_batch.assert_called_once_with([
+            {'id': 'n2'},
+            {'id': 'n1'},
+        ])
+        self.assertFalse(session.notify.called)
+        self.assertEqual(collections.deque([[3, False]]), server._inflight)
+        mock_sent.assert_called_once_with(session, server._inflight[0], 2,
+                                          result)
+
+    def _sent_agent(self):
+        server = self._agent()
+        server._spool = mock.Mock()
+        server._session = 'session'
+        entries = [[1, False], [2, False], [3, False]]
+        server._inflight.extend(entries)
+        return server, entries
+
+    def test_sent_success_first(self):
+        server, entries = self._sent_agent()
+        result = gevent.event.AsyncResult()
+        result.set('ids')
+
+        server._sent('session', entries[0], 2, result)
+
+        self.assertEqual(2, server.forwarded)
+        self.assertEqual(0, server.rejected)
+        self.assertEqual(collections.deque(entries[1:]), server._inflight)
+        server._spool.ack.assert_called_once_with(1)
+        self.assertTrue(server._queue_event.is_set())
+
+    def test_sent_success_after_failure(self):
+        server, entries = self._sent_agent()
+        server._failures = 3
+        result = gevent.event.AsyncResult()
+        result.set('ids')
+
+        server._sent('session', entries[0], 1, result)
+
+        self.assertEqual(0, server._failures)
+
+    def test_sent_success_out_of_order(self):
+        server, entries = self._sent_agent()
+        result = gevent.event.AsyncResult()
+        result.set('ids')
+
+        server._sent('session', entries[1], 2, result)
+
+        self.assertEqual(2, server.forwarded)
+        self.assertEqual([2, True], entries[1])
+        self.assertEqual(3, len(server._inflight))
+        self.assertFalse(server._spool.ack.called)
+
+        server._sent('session', entries[0], 1, result)
+
+        self.assertEqual(3, server.forwarded)
+        self.assertEqual(collections.deque(entries[2:]), server._inflight)
+        server._spool.ack.assert_called_once_with(2)
+
+    def test_sent_rejected(self):
+        server, entries = self._sent_agent()
+        result = gevent.event.AsyncResult()
+        result.set_exception(submitter.SubmitterException('rejected'))
+
+        server._sent('session', entries[0], 2, result)
+
+        self.assertEqual(0, server.forwarded)
+        self.assertEqual(2, server.rejected)
+        self.assertEqual('session', server._session)
+        server._spool.ack.assert_called_once_with(1)
+        self.assertFalse(server._spool.rewind.called)
+
+    def test_sent_closed(self):
+        server, entries = self._sent_agent()
+        result = gevent.event.AsyncResult()
+        result.set_exception(submitter.SessionClosed('closed'))
+
+        server._sent('session', entries[1], 2, result)
+
+        self.assertEqual(0, server.forwarded)
+        self.assertEqual(0, server.rejected)
+        self.assertEqual(None, server._session)
+        self.assertEqual(collections.deque(), server._inflight)
+        self.assertEqual(1, server._failures)
+        server._spool.rewind.assert_called_once_with()
+        self.assertFalse(server._spool.ack.called)
+        self.assertTrue(server._queue_event.is_set())
+
+    def test_sent_closed_give_up(self):
+        server = self._agent()
+        server._spool = mock.Mock()
+        server._session = 'session'
+        server._failures = agent.MAX_ATTEMPTS
+        entry = [1, False]
+        server._inflight.append(entry)
+        result = gevent.event.AsyncResult()
+        result.set_exception(submitter.SessionClosed('closed'))
+
+        server._sent('session', entry, 1, result)
+
+        self.assertEqual(0, server.forwarded)
+        self.assertEqual(1, server.rejected)
+        self.assertEqual(0, server._failures)
+        self.assertEqual(None, server._session)
+        self.assertEqual(collections.deque(), server._inflight)
+        self.assertEqual([
+            mock.call.ack(1),
+            mock.call.rewind(),
+        ], server._spool.mock_calls)
+        self.assertTrue(server._queue_event.is_set())
+
+    def test_sent_closed_old_session(self):
+        server, entries = self._sent_agent()
+        server._session = 'new session'
+        result = gevent.event.AsyncResult()
+        result.set_exception(submitter.SessionClosed('closed'))
+
+        server._sent('old session', entries[0], 1, result)
+
+        self.assertEqual('new session', server._session)
+        server._spool.rewind.assert_called_once_with()
+
+    def test_sent_stale(self):
+        server, entries = self._sent_agent()
+        result = gevent.event.AsyncResult()
+        result.set_exception(submitter.SessionClosed('closed'))
+
+        server._sent('session', [1, False], 1, result)
+
+        self.assertEqual('session', server._session)
+        self.assertEqual(3, len(server._inflight))
+        self.assertFalse(server._spool.rewind.called)
+        self.assertFalse(server._queue_event.is_set())
+
+
+class StartAgentTest(unittest.TestCase):
+    @mock.patch.object(agent, 'AgentServer')
+    def test_basic(self, mock_AgentServer):
+        agent.start_agent('hub')
+
+        mock_AgentServer.assert_called_once_with(
+            'hub', util.DEFAULT_AGENT, None, True, agent.QUEUE_SIZE,
+            agent.BATCH_SIZE, None)
+        mock_AgentServer.return_value.assert_has_calls([
+            mock.call.start(),
+            mock.call.wait(),
+        ])
+
+    @mock.patch.object(agent, 'AgentServer')
+    def test_args(self, mock_AgentServer):
+        agent.start_agent('hub', 'path', 'cert_conf', False, 5, 2, 'spool')
+
+        mock_AgentServer.assert_called_once_with(
+            'hub', 'path', 'cert_conf', False, 5, 2, 'spool')
+
+
+class NormalizeArgsTest(unittest.TestCase):
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x[1:])
+    @mock.patch('os.path.abspath', side_effect=lambda x: '/abs' + x)
+    @mock.patch.object(util, 'daemonize')
+    def test_daemon(self, mock_daemonize, mock_abspath, mock_expanduser):
+        args = mock.Mock(path='~/sock', daemon=True, debug=False,
+                         pid_file='pid', spool_dir='~/spool')
+
+        agent._normalize_args(args)
+
+        self.assertEqual('/abs/sock', args.path)
+        self.assertEqual('/abs/spool', args.spool_dir)
+        mock_daemonize.assert_called_once_with(pidfile='pid')
+
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x)
+    @mock.patch('os.path.abspath', side_effect=lambda x: x)
+    @mock.patch.object(util, 'daemonize')
+    def test_foreground(self, mock_daemonize, mock_abspath, mock_expanduser):
+        args = mock.Mock(path='/sock', daemon=False, debug=False,
+                         pid_file=None, spool_dir=None)
+
+        agent._normalize_args(args)
+
+        self.assertFalse(mock_daemonize.called)
+
+    @mock.patch('os.path.expanduser', side_effect=lambda x: x)
+    @mock.patch('os.path.abspath', side_effect=lambda x: x)
+    @mock.patch.object(util, 'daemonize')
+    def test_debug(self, mock_daemonize, mock_abspath, mock_expanduser):
+        args = mock.Mock(path='/sock', daemon=True, debug=True,
+                         pid_file=None, spool_dir=None)
+
+        agent._normalize_args(args)
+
+        self.assertFalse(mock_daemonize.called)
@@ -0,0 +1,475 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import mock
+import msgpack
+
+from heyu import aio
+from heyu import protocol
+
+
+needs_asyncio = unittest.skipIf(aio.asyncio is None,
+                                'asyncio is not available')
+
+
+def reply(msg_type, **kwargs):
+    return protocol.Message(msg_type, **kwargs).to_frame()
+
+
+class CobsTest(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual(b'\x01\x00', aio.cobs_encode(b''))
+        self.assertEqual(b'\x03ab\x00', aio.cobs_encode(b'ab'))
+        self.assertEqual(b'\x02a\x02b\x00', aio.cobs_encode(b'a\0b'))
+        self.assertEqual(b'\xe2a\x02b\x00', aio.cobs_encode(b'a\0\0b'))
+        self.assertEqual(b'\xe2a\xe1\x00', aio.cobs_encode(b'a\0\0\0'))
+
+    def test_encode_long(self):
+        self.assertEqual(b'\xe0' + b'a' * 223 + b'\x02a\x00',
+                         aio.cobs_encode(b'a' * 224))
+        self.assertEqual(b'\x20' + b'a' * 31 + b'\xe1\x00',
+                         aio.cobs_encode(b'a' * 31 + b'\0\0'))
+
+    def test_decode(self):
+        self.assertEqual(b'', aio.cobs_decode(b'\x01'))
+        self.assertEqual(b'a\0\0b', aio.cobs_decode(b'\xe2a\x02b'))
+        self.assertEqual(b'a' * 223, aio.cobs_decode(b'\xe0' + b'a' * 223))
+
+    def test_decode_bad(self):
+        self.assertRaises(ValueError, aio.cobs_decode, b'\x02a\x00')
+
+    def test_round_trip(self):
+        frames = [
+            b'',
+            b'\0',
+            b'\0\0\0\0\0',
+            b'a\0\0b\0c',
+            b'a' * 222,
+            b'a' * 223,
+            b'a' * 500 + b'\0\0',
+            bytes(bytearray(range(256))) * 3,
+        ]
+
+        for frame in frames:
+            self.assertEqual(frame, aio.cobs_decode(
+                aio.cobs_encode(frame)[:-1]))
+
+
+class FramerTest(unittest.TestCase):
+    def test_cobs(self):
+        framer = aio.COBSFramer()
+
+        self.assertEqual(b'\x02a\x02b\x00', framer.streamify(b'a\0b'))
+        self.assertEqual((None, b'\x02a'), framer.frameify(b'\x02a'))
+        self.assertEqual((b'a\0b', b'\x03'),
+                         framer.frameify(b'\x02a\x02b\x00\x03'))
+
+    def test_length(self):
+        framer = aio.LengthFramer()
+
+        self.assertEqual(b'\0\0\0\x03abc', framer.streamify(b'abc'))
+        self.assertEqual((None, b'\0\0'), framer.frameify(b'\0\0'))
+        self.assertEqual((None, b'\0\0\0\x03ab'),
+                         framer.frameify(b'\0\0\0\x03ab'))
+        self.assertEqual((b'abc', b'\0'),
+                         framer.frameify(b'\0\0\0\x03abc\0'))
+
+
+class AsyncioTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.transport = mock.Mock()
+
+    def sent(self, framer=None):
+        framer = framer or aio.COBSFramer()
+        data = b''.join(call[0][0] for call in
+                        self.transport.write.call_args_list)
+
+        msgs = []
+        while True:
+            frame, data = framer.frameify(data)
+            if frame is None:
+                return msgs
+            msgs.append(protocol.Message.from_frame(frame))
+
+    def recv(self, proto, frame, framer=None):
+        framer = framer or aio.COBSFramer()
+        proto.data_received(framer.streamify(frame))
+
+
+@needs_asyncio
+class SubmitterProtocolTest(AsyncioTestCase):
+    def connect(self, capabilities=()):
+        proto = aio.SubmitterProtocol(loop=self.loop)
+        proto.connection_made(self.transport)
+        self.recv(proto, reply('hello', capabilities=capabilities))
+        self.transport.reset_mock()
+        return proto
+
+    def test_hello(self):
+        proto = aio.SubmitterProtocol(loop=self.loop)
+        proto.connection_made(self.transport)
+
+        msgs = self.sent()
+        self.assertEqual(1, len(msgs))
+        self.assertEqual('hello', msgs[0].msg_type)
+        self.assertEqual([protocol.CAP_LENGTH_FRAMING, protocol.CAP_ZLIB],
+                         list(msgs[0].capabilities))
+
+    def test_held(self):
+        proto = aio.SubmitterProtocol(loop=self.loop)
+        proto.connection_made(self.transport)
+        self.transport.reset_mock()
+
+        result = proto.notify('app', 'summary', 'body')
+
+        self.assertFalse(self.transport.write.called)
+        self.recv(proto, reply('hello', capabilities=[
+            protocol.CAP_LENGTH_FRAMING]))
+        msgs = self.sent(aio.LengthFramer())
+        self.assertEqual(1, len(msgs))
+        self.assertEqual('notify', msgs[0].msg_type)
+        self.assertEqual(0, msgs[0].seq)
+        self.assertFalse(result.done())
+
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    def test_notify(self, mock_uuid4):
+        proto = self.connect()
+
+        first = proto.notify('app', 'summary', 'body',
+                             urgency=protocol.URGENCY_CRITICAL,
+                             category='disk', id='notif')
+        second = proto.notify('app', 'summary2', 'body2')
+
+        msgs = self.sent()
+        self.assertEqual([0, 1], [msg.seq for msg in msgs])
+        self.assertEqual(protocol.URGENCY_CRITICAL, msgs[0].urgency)
+        self.assertEqual('disk', msgs[0].category)
+        self.assertEqual('notif', msgs[0].id)
+        self.assertEqual(None, msgs[1].category)
+        self.assertEqual('some-uuid', msgs[1].id)
+
+        # Replies may come back in any order
+        self.recv(proto, reply('accepted', id='id2', seq=1))
+        self.recv(proto, reply('accepted', id='notif', seq=0))
+        self.assertEqual('notif', first.result())
+        self.assertEqual('id2', second.result())
+
+    def test_notify_compressed(self):
+        proto = self.connect([protocol.CAP_LENGTH_FRAMING,
+                              protocol.CAP_ZLIB])
+
+        result = proto.notify('app', 'summary', 'body' * 500)
+
+        frame = self.transport.write.call_args[0][0][4:]
+        self.assertEqual(b'\x78', frame[:1])
+        self.assertEqual('body' * 500, protocol.Message.from_frame(
+            frame, compressed=True).body)
+        self.recv(proto, reply('accepted', id='id', seq=0),
+                  aio.LengthFramer())
+        self.assertEqual('id', result.result())
+
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    def test_notify_batch(self, mock_uuid4):
+        proto = self.connect()
+
+        result = proto.notify_batch([
+            {'app_name': 'app', 'summary': 's1', 'body': 'b1',
+             'category': None},
+            {'app_name': 'app', 'summary': 's2', 'body': 'b2', 'id': 'n2'},
+        ])
+
+        msgs = self.sent()
+        self.assertEqual('notify_batch', msgs[0].msg_type)
+        notifs = [protocol.Message.from_frame(notif)
+                  for notif in msgs[0].notifications]
+        self.assertEqual(['s1', 's2'], [notif.summary for notif in notifs])
+        self.assertEqual(['some-uuid', 'n2'], [notif.id for notif in notifs])
+        self.recv(proto, reply('accepted_batch', ids=['i1', 'i2'], seq=0))
+        self.assertEqual(['i1', 'i2'], result.result())
+
+    def test_error(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        self.recv(proto, reply('error', reason='bad', seq=0))
+
+        exc = result.exception()
+        self.assertTrue(isinstance(exc, aio.ClientException))
+        self.assertEqual('Failed to submit notification: bad', str(exc))
+        self.assertTrue(proto.active)
+
+    def test_error_unattached(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        self.recv(proto, reply('error', reason='bad'))
+
+        self.assertTrue(isinstance(result.exception(), aio.SessionClosed))
+        self.assertFalse(proto.active)
+        self.assertTrue(isinstance(
+            proto.notify('app', 'summary', 'body').exception(),
+            aio.SessionClosed))
+
+    def test_goodbye(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        self.recv(proto, reply('goodbye'))
+
+        self.assertEqual('Session closed by the HeyU hub',
+                         str(result.exception()))
+        self.transport.close.assert_called_once_with()
+
+    def test_bad_frame(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        proto.data_received(aio.cobs_encode(b'\x01'))
+
+        self.assertTrue(str(result.exception()).startswith(
+            'Failed to parse frame: '))
+        self.transport.close.assert_called_once_with()
+
+    def test_disconnect(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        self.transport.reset_mock()
+        proto.disconnect()
+
+        self.assertEqual(['goodbye'],
+                         [msg.msg_type for msg in self.sent()])
+        self.transport.close.assert_called_once_with()
+        self.assertEqual('Session closed', str(result.exception()))
+
+    def test_connection_lost(self):
+        proto = self.connect()
+
+        result = proto.notify('app', 'summary', 'body')
+        proto.connection_lost(None)
+
+        self.assertEqual('Connection to the HeyU hub closed',
+                         str(result.exception()))
+        self.assertEqual(None, proto.transport)
+
+
+@needs_asyncio
+class SubscriberProtocolTest(AsyncioTestCase):
+    def connect(self, queue_size=aio.QUEUE_SIZE, **kwargs):
+        proto = aio.SubscriberProtocol(queue_size=queue_size,
+                                       loop=self.loop, **kwargs)
+        proto.connection_made(self.transport)
+        return proto
+
+    def notif(self, notif_id, cursor):
+        return reply('notify', app_name='[host]app', summary='summary',
+                     body='body', id=notif_id, cursor=cursor)
+
+    def test_subscribe(self):
+        self.connect(filters={'categories': ['disk.*']})
+
+        msgs = self.sent()
+        self.assertEqual('subscribe', msgs[0].msg_type)
+        self.assertEqual([protocol.CAP_LENGTH_FRAMING, protocol.CAP_ZLIB],
+                         list(msgs[0].capabilities))
+        self.assertEqual(['disk.*'], list(msgs[0].categories))
+        self.assertEqual(None, msgs[0].since)
+
+    def test_resubscribe(self):
+        self.connect(epoch='epoch', since=5)
+
+        msgs = self.sent()
+        self.assertEqual('epoch', msgs[0].epoch)
+        self.assertEqual(5, msgs[0].since)
+
+    def test_subscribed(self):
+        proto = self.connect()
+
+        self.recv(proto, reply('subscribed', capabilities=[
+            protocol.CAP_LENGTH_FRAMING], epoch='epoch', cursor=7))
+
+        self.assertEqual(7, proto.subscribed.result())
+        self.assertEqual('epoch', proto.epoch)
+        self.assertEqual(7, proto.cursor)
+        self.assertTrue(isinstance(proto._framer, aio.LengthFramer))
+
+    def test_subscribed_new_epoch(self):
+        proto = self.connect(epoch='old', since=5)
+
+        self.recv(proto, reply('subscribed', epoch='new', cursor=7,
+                               gap=True))
+
+        self.assertEqual('new', proto.epoch)
+        self.assertEqual(0, proto.cursor)
+        self.assertTrue(proto.gap)
+
+    def test_framing_switch(self):
+        proto = self.connect()
+
+        # The reply and the first notification arrive together
+        proto.data_received(
+            aio.cobs_encode(reply('subscribed', capabilities=[
+                protocol.CAP_LENGTH_FRAMING], epoch='epoch', cursor=0)) +
+            aio.LengthFramer().streamify(self.notif('n1', 1)))
+
+        self.assertEqual('n1', proto.__anext__().result().id)
+        self.assertEqual(1, proto.cursor)
+
+    def test_iterate(self):
+        proto = self.connect()
+        self.recv(proto, reply('subscribed', epoch='epoch', cursor=0))
+
+        waiting = proto.__anext__()
+        self.assertFalse(waiting.done())
+        self.recv(proto, self.notif('n1', 1))
+        self.recv(proto, reply('notify_batch', notifications=[
+            self.notif('n2', 2), self.notif('n3', 3)]))
+
+        self.assertEqual(proto, proto.__aiter__())
+        self.assertEqual('n1', waiting.result().id)
+        self.assertEqual('n2', proto.__anext__().result().id)
+        self.assertEqual('n3', proto.__anext__().result().id)
+        self.assertEqual(3, proto.cursor)
+
+    def test_iterate_raw_strings(self):
+        proto = self.connect()
+
+        # A Python 2 hub encodes everything, frames included, as
+        # msgpack strings
+        self.recv(proto, msgpack.packb({
+            '__version__': 0,
+            'msg_type': 'notify_batch',
+            'notifications': [self.notif('n1', 1), self.notif('n2', 2)],
+        }, use_bin_type=False))
+
+        notif = proto.__anext__().result()
+        self.assertEqual('n1', notif.id)
+        self.assertEqual('summary', notif.summary)
+        self.assertEqual('n2', proto.__anext__().result().id)
+
+    def test_iterate_async_for(self):
+        proto = self.connect()
+        self.recv(proto, self.notif('n1', 1))
+        self.recv(proto, self.notif('n2', 2))
+        self.recv(proto, reply('goodbye'))
+
+        # Consume the subscription the way a coroutine would
+        ids = []
+        while True:
+            result = proto.__anext__()
+            if isinstance(result.exception(), StopAsyncIteration):
+                break
+            ids.append(result.result().id)
+
+        self.assertEqual(['n1', 'n2'], ids)
+        self.transport.close.assert_called_once_with()
+
+    def test_flow_control(self):
+        proto = self.connect(queue_size=4)
+
+        for i in range(4):
+            self.recv(proto, self.notif('n%d' % i, i))
+
+        self.transport.pause_reading.assert_called_once_with()
+        proto.__anext__()
+        proto.__anext__()
+        self.assertFalse(self.transport.resume_reading.called)
+        proto.__anext__()
+        self.transport.resume_reading.assert_called_once_with()
+
+    def test_error(self):
+        proto = self.connect()
+
+        waiting = proto.__anext__()
+        self.recv(proto, reply('error', reason='bad'))
+
+        self.assertEqual('Error from the HeyU hub: bad',
+                         str(waiting.exception()))
+        self.assertTrue(isinstance(proto.subscribed.exception(),
+                                   aio.ClientException))
+        self.transport.close.assert_called_once_with()
+
+    def test_connection_lost(self):
+        proto = self.connect()
+        self.recv(proto, self.notif('n1', 1))
+
+        proto.connection_lost(None)
+
+        # Queued notifications are delivered first
+        self.assertEqual('n1', proto.__anext__().result().id)
+        self.assertTrue(isinstance(proto.__anext__().exception(),
+                                   aio.SessionClosed))
+
+    def test_disconnect(self):
+        proto = self.connect()
+
+        waiting = proto.__anext__()
+        self.transport.reset_mock()
+        proto.disconnect()
+        proto.connection_lost(None)
+
+        self.assertEqual(['goodbye'],
+                         [msg.msg_type for msg in self.sent()])
+        self.assertTrue(isinstance(waiting.exception(), StopAsyncIteration))
+
+
+@needs_asyncio
+class ConnectTest(AsyncioTestCase):
+    def test_open_session(self):
+        proto = mock.Mock()
+        create_future = self.loop.create_future()
+        create_future.set_result((self.transport, proto))
+
+        mock_create = mock.Mock(return_value=create_future)
+        with mock.patch.object(self.loop, 'create_connection', mock_create):
+            result = self.loop.run_until_complete(aio.open_session(
+                ('hub', 4859), ssl_context='context', loop=self.loop))
+
+        self.assertEqual(proto, result)
+        factory = mock_create.call_args[0][0]
+        self.assertEqual(aio.SubmitterProtocol, factory.func)
+        mock_create.assert_called_once_with(factory, 'hub', 4859,
+                                            ssl='context')
+
+    def test_subscribe(self):
+        proto = mock.Mock()
+        create_future = self.loop.create_future()
+        create_future.set_result((self.transport, proto))
+
+        mock_create = mock.Mock(return_value=create_future)
+        with mock.patch.object(self.loop, 'create_connection', mock_create):
+            result = self.loop.run_until_complete(aio.subscribe(
+                ('hub', 4859), filters={'hosts': ['host1']}, loop=self.loop))
+
+        self.assertEqual(proto, result)
+        factory = mock_create.call_args[0][0]
+        self.assertEqual(aio.SubscriberProtocol, factory.func)
+        self.assertEqual(({'hosts': ['host1']}, None, None, aio.QUEUE_SIZE),
+                         factory.args)
+        mock_create.assert_called_once_with(factory, 'hub', 4859, ssl=None)
+
+    def test_connect_failed(self):
+        create_future = self.loop.create_future()
+        create_future.set_exception(OSError('refused'))
+
+        mock_create = mock.Mock(return_value=create_future)
+        with mock.patch.object(self.loop, 'create_connection', mock_create):
+            self.assertRaises(OSError, self.loop.run_until_complete,
+                              aio.open_session(('hub', 4859),
+                                               loop=self.loop))
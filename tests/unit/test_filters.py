@@ -0,0 +1,258 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import mock
+
+from heyu import filters
+
+
+def notification(category=None, urgency=0, app_name='[host]app'):
+    return mock.Mock(category=category, urgency=urgency, app_name=app_name)
+
+
+class ParseCategoryTest(unittest.TestCase):
+    def test_exact(self):
+        self.assertEqual((['network', 'connected'], False),
+                         filters._parse_category('network.connected'))
+
+    def test_prefix(self):
+        self.assertEqual((['network'], True),
+                         filters._parse_category('network.*'))
+
+    def test_any(self):
+        self.assertEqual(([], True), filters._parse_category('*'))
+
+    def test_inner_wildcard(self):
+        self.assertRaises(ValueError, filters._parse_category, 'a.*.b')
+
+    def test_empty_component(self):
+        self.assertRaises(ValueError, filters._parse_category, 'a..b')
+
+    def test_empty(self):
+        self.assertRaises(ValueError, filters._parse_category, '')
+
+
+class SplitAppNameTest(unittest.TestCase):
+    def test_host(self):
+        self.assertEqual(('host', 'app'), filters._split_app_name('[host]app'))
+
+    def test_no_host(self):
+        self.assertEqual((None, 'app'), filters._split_app_name('app'))
+
+    def test_unterminated(self):
+        self.assertEqual((None, '[host'), filters._split_app_name('[host'))
+
+
+class FilterTest(unittest.TestCase):
+    def test_init_defaults(self):
+        result = filters.Filter()
+
+        self.assertEqual((), result.categories)
+        self.assertEqual(None, result.min_urgency)
+        self.assertEqual((), result.app_names)
+        self.assertEqual((), result.hosts)
+
+    def test_init(self):
+        result = filters.Filter(['b.*', 'a', 'b.*'], 1, ['app*'], ['host*'])
+
+        self.assertEqual(('a', 'b.*'), result.categories)
+        self.assertEqual(1, result.min_urgency)
+        self.assertEqual(('app*',), result.app_names)
+        self.assertEqual(('host*',), result.hosts)
+
+    def test_init_bad_category(self):
+        self.assertRaises(ValueError, filters.Filter, ['a.*.b'])
+
+    def test_match_origin_unfiltered(self):
+        sub_filter = filters.Filter()
+
+        self.assertTrue(sub_filter.match_origin('[host]app'))
+        self.assertTrue(sub_filter.match_origin('app'))
+
+    def test_match_origin_app_names(self):
+        sub_filter = filters.Filter(app_names=['heyu-*', 'build'])
+
+        self.assertTrue(sub_filter.match_origin('[host]heyu-submitter'))
+        self.assertTrue(sub_filter.match_origin('[host]build'))
+        self.assertFalse(sub_filter.match_origin('[host]other'))
+        self.assertFalse(sub_filter.match_origin('[heyu-host]other'))
+
+    def test_match_origin_hosts(self):
+        sub_filter = filters.Filter(hosts=['db*'])
+
+        self.assertTrue(sub_filter.match_origin('[db1]app'))
+        self.assertFalse(sub_filter.match_origin('[web1]app'))
+        self.assertFalse(sub_filter.match_origin('app'))
+
+    def test_match_unfiltered(self):
+        sub_filter = filters.Filter()
+
+        self.assertTrue(sub_filter.match(notification()))
+        self.assertTrue(sub_filter.match(notification('network', 2)))
+
+    def test_match_categories(self):
+        sub_filter = filters.Filter(['network', 'build.*'])
+
+        self.assertFalse(sub_filter.match(notification()))
+        self.assertTrue(sub_filter.match(notification('network')))
+        self.assertFalse(sub_filter.match(notification('network.error')))
+        self.assertFalse(sub_filter.match(notification('build')))
+        self.assertTrue(sub_filter.match(notification('build.failed')))
+        self.assertFalse(sub_filter.match(notification('buildbot.failed')))
+
+    def test_match_any_category(self):
+        sub_filter = filters.Filter(['network', '*'])
+
+        self.assertTrue(sub_filter.match(notification()))
+        self.assertTrue(sub_filter.match(notification('build')))
+
+    def test_match_urgency(self):
+        sub_filter = filters.Filter(min_urgency=1)
+
+        self.assertFalse(sub_filter.match(notification(urgency=0)))
+        self.assertTrue(sub_filter.match(notification(urgency=1)))
+
+    def test_match_origin(self):
+        sub_filter = filters.Filter(hosts=['db*'])
+
+        self.assertTrue(sub_filter.match(notification(app_name='[db1]a')))
+        self.assertFalse(sub_filter.match(notification(app_name='[web]a')))
+
+
+class SubscriptionIndexTest(unittest.TestCase):
+    def _index(self, **subs):
+        index = filters.SubscriptionIndex()
+        for key, sub_filter in subs.items():
+            index.add(key, sub_filter)
+        return index
+
+    def test_unfiltered(self):
+        index = self._index(a=filters.Filter(), b=filters.Filter())
+
+        self.assertEqual(set(['a', 'b']), index.match(notification()))
+        self.assertEqual(set(['a', 'b']),
+                         index.match(notification('network.connected', 2)))
+
+    def test_categories(self):
+        index = self._index(
+            exact=filters.Filter(['network']),
+            prefix=filters.Filter(['network.*']),
+            deep=filters.Filter(['network.error.*', 'build']),
+            any=filters.Filter(['*']),
+            none=filters.Filter(),
+        )
+
+        self.assertEqual(set(['any', 'none']), index.match(notification()))
+        self.assertEqual(set(['exact', 'any', 'none']),
+                         index.match(notification('network')))
+        self.assertEqual(set(['prefix', 'any', 'none']),
+                         index.match(notification('network.connected')))
+        self.assertEqual(set(['prefix', 'deep', 'any', 'none']),
+                         index.match(notification('network.error.dns')))
+        self.assertEqual(set(['deep', 'any', 'none']),
+                         index.match(notification('build')))
+        self.assertEqual(set(['any', 'none']),
+                         index.match(notification('buildbot.failed')))
+
+    def test_urgency(self):
+        index = self._index(
+            low=filters.Filter(min_urgency=0),
+            normal=filters.Filter(min_urgency=1),
+            critical=filters.Filter(min_urgency=2),
+            any=filters.Filter(),
+        )
+
+        self.assertEqual(set(['low', 'any']), index.match(notification()))
+        self.assertEqual(set(['low', 'normal', 'any']),
+                         index.match(notification(urgency=1)))
+        self.assertEqual(set(['low', 'normal', 'critical', 'any']),
+                         index.match(notification(urgency=2)))
+
+    def test_origin(self):
+        index = self._index(
+            app=filters.Filter(app_names=['build*']),
+            host=filters.Filter(hosts=['db*'], min_urgency=1),
+            any=filters.Filter(),
+        )
+
+        self.assertEqual(set(['any']), index.match(notification()))
+        self.assertEqual(set(['app', 'any']),
+                         index.match(notification(app_name='[h]buildbot')))
+        self.assertEqual(set(['any']),
+                         index.match(notification(app_name='[db1]app')))
+        self.assertEqual(set(['host', 'any']), index.match(
+            notification(urgency=1, app_name='[db1]app')))
+
+    def test_combined(self):
+        index = self._index(
+            sub=filters.Filter(['network.*'], 1, ['heyu*'], ['host']),
+        )
+
+        self.assertEqual(set(['sub']), index.match(
+            notification('network.error', 2, '[host]heyu-hub')))
+        self.assertEqual(set(), index.match(
+            notification('build', 2, '[host]heyu-hub')))
+        self.assertEqual(set(), index.match(
+            notification('network.error', 0, '[host]heyu-hub')))
+        self.assertEqual(set(), index.match(
+            notification('network.error', 2, '[host]other')))
+        self.assertEqual(set(), index.match(
+            notification('network.error', 2, '[other]heyu-hub')))
+
+    def test_len(self):
+        index = self._index(a=filters.Filter(), b=filters.Filter())
+
+        self.assertEqual(2, len(index))
+
+    def test_add_replaces(self):
+        index = self._index(a=filters.Filter(['network.*'], 2))
+
+        index.add('a', filters.Filter(['build']))
+
+        self.assertEqual(1, len(index))
+        self.assertEqual(set(), index.match(notification('network.error', 2)))
+        self.assertEqual(set(['a']), index.match(notification('build')))
+
+    def test_remove(self):
+        index = self._index(
+            a=filters.Filter(['network.error.*', 'build', '*'], 1,
+                             hosts=['host']),
+            b=filters.Filter(['network.*']),
+        )
+
+        index.remove('a')
+
+        self.assertEqual(1, len(index))
+        self.assertEqual(set(['b']), index.match(
+            notification('network.error.dns', 2)))
+        self.assertEqual(set(), index.match(notification('build', 2)))
+        self.assertEqual(['network'], list(index._trie.children))
+        self.assertEqual({}, index._trie.children['network'].children)
+        self.assertEqual(set([None]), set(index._urgency))
+        self.assertEqual(set(), index._patterned)
+        self.assertEqual(set(), index._any_category)
+
+    def test_remove_all(self):
+        index = self._index(a=filters.Filter(['network.error.dns'], 1))
+
+        index.remove('a')
+        index.remove('a')
+
+        self.assertEqual(0, len(index))
+        self.assertEqual({}, index._trie.children)
+        self.assertEqual({}, index._urgency)
+        self.assertEqual(set(), index.match(notification('network')))
@@ -24,6 +24,7 @@ except ImportError:
 
 from heyu import fake_pynotify
 from heyu import gtk
+from heyu import notifier
 from heyu import protocol
 
 
@@ -31,56 +32,13 @@ class TestException(Exception):
     pass
 
 
-class BackoffTest(unittest.TestCase):
-    @mock.patch('time.time')
-    @mock.patch('time.sleep')
-    def test_function(self, mock_sleep, mock_time):
-        mock_time.return_value = 123456789.1
-        expected = [None, 1, 2, 4, 8, 16, 32, 64, 128, 256, 300, 300]
-
-        gen = gtk.backoff(300, 30, 5)
-
-        idx = 0
-        for _dummy in gen:
-            if expected[idx] is None:
-                self.assertFalse(mock_sleep.called)
-            else:
-                mock_sleep.assert_called_once_with(expected[idx])
-
-            # Reset the mock for the next loop around
-            mock_sleep.reset_mock()
-
-            # Need a halting condition, though
-            idx += 1
-            if idx >= len(expected):
-                break
-
-        # Now need to simulate success
-        expected = range(300, -6, -6)
-        idx = 0
-        for _dummy in gen:
-            mock_sleep.assert_called_once_with(expected[idx])
-
-            # Reset the mock and update the time for the next loop
-            # around
-            mock_sleep.reset_mock()
-            mock_time.return_value += 30.0
-
-            # Need a halting condition, though
-            idx += 1
-            if idx >= len(expected):
-                break
-
-
 class GtkNotificationDriverTest(unittest.TestCase):
     @mock.patch('heyu.notifier.NotifierServer',
                 return_value=mock.MagicMock(app_name='app_name',
                                             app_id='app_id'))
     @mock.patch.object(pynotify, 'init')
     @mock.patch.object(pynotify, 'Notification')
-    @mock.patch.object(gtk, 'backoff', return_value=range(1))
-    def test_basic(self, mock_backoff, mock_Notification, mock_init,
-                   mock_NotifierServer):
+    def test_basic(self, mock_Notification, mock_init, mock_NotifierServer):
         mock_NotifierServer.return_value.__iter__.return_value = iter([
             mock.Mock(id='notify-1', urgency=protocol.URGENCY_LOW,
                       app_name='application-1', summary='summary-1',
@@ -95,8 +53,11 @@ class GtkNotificationDriverTest(unittest.TestCase):
 
         gtk.gtk_notification_driver('hub')
 
-        mock_backoff.assert_called_once_with(300, 30, 5)
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
         mock_init.assert_called_once_with('app_name')
         mock_Notification.assert_has_calls([
             mock.call('Starting', 'app_name is starting up'),
@@ -122,8 +83,7 @@ class GtkNotificationDriverTest(unittest.TestCase):
                                             app_id='app_id'))
     @mock.patch.object(pynotify, 'init')
     @mock.patch.object(pynotify, 'Notification')
-    @mock.patch.object(gtk, 'backoff', return_value=range(1))
-    def test_replace(self, mock_backoff, mock_Notification, mock_init,
+    def test_replace(self, mock_Notification, mock_init,
                      mock_NotifierServer):
         mock_NotifierServer.return_value.__iter__.return_value = iter([
             mock.Mock(id='app_id', urgency=protocol.URGENCY_NORMAL,
@@ -133,8 +93,11 @@ class GtkNotificationDriverTest(unittest.TestCase):
 
         gtk.gtk_notification_driver('hub')
 
-        mock_backoff.assert_called_once_with(300, 30, 5)
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
         mock_init.assert_called_once_with('app_name')
         mock_Notification.assert_has_calls([
             mock.call('Starting', 'app_name is starting up'),
@@ -152,47 +115,15 @@ class GtkNotificationDriverTest(unittest.TestCase):
                                             app_id='app_id'))
     @mock.patch.object(pynotify, 'init')
     @mock.patch.object(pynotify, 'Notification')
-    @mock.patch.object(gtk, 'backoff', return_value=range(3))
-    def test_retry(self, mock_backoff, mock_Notification, mock_init,
-                   mock_NotifierServer):
-        mock_NotifierServer.return_value.__iter__.side_effect = [
-            iter([
-                mock.Mock(id='notify-1', urgency=protocol.URGENCY_LOW,
-                          app_name='application-1', summary='summary-1',
-                          body='body-1', category='cat-1'),
-            ]),
-            iter([
-                mock.Mock(id='notify-2', urgency=protocol.URGENCY_NORMAL,
-                          app_name='application-2', summary='summary-2',
-                          body='body-2', category=None),
-            ]),
-            iter([
-                mock.Mock(id='notify-3', urgency=protocol.URGENCY_CRITICAL,
-                          app_name='application-3', summary='summary-3',
-                          body='body-3', category='cat-3'),
-            ]),
-        ]
+    def test_filters(self, mock_Notification, mock_init,
+                     mock_NotifierServer):
+        mock_NotifierServer.return_value.__iter__.return_value = iter([])
 
-        gtk.gtk_notification_driver('hub')
+        gtk.gtk_notification_driver('hub', filters=['filter'])
 
-        mock_backoff.assert_called_once_with(300, 30, 5)
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
-        mock_init.assert_called_once_with('app_name')
-        mock_Notification.assert_has_calls([
-            mock.call('Starting', 'app_name is starting up'),
-            mock.call().set_category('network'),
-            mock.call().set_urgency(protocol.URGENCY_LOW),
-            mock.call().show(),
-            mock.call('summary-1', 'body-1'),
-            mock.call().set_category('cat-1'),
-            mock.call().set_urgency(protocol.URGENCY_LOW),
-            mock.call().show(),
-            mock.call('summary-2', 'body-2'),
-            mock.call().set_category(''),
-            mock.call().set_urgency(protocol.URGENCY_NORMAL),
-            mock.call().show(),
-            mock.call('summary-3', 'body-3'),
-            mock.call().set_category('cat-3'),
-            mock.call().set_urgency(protocol.URGENCY_CRITICAL),
-            mock.call().show(),
-        ])
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=['filter'],
+            queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
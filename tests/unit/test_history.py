@@ -0,0 +1,255 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from heyu import history
+from heyu import notifier
+from heyu import protocol
+
+
+def notif(notif_id, app_name='[host1]app', category=None,
+          urgency=protocol.URGENCY_LOW):
+    return protocol.Message('notify', app_name=app_name,
+                            summary='summary-%s' % notif_id,
+                            body='body-%s' % notif_id, id=notif_id,
+                            category=category, urgency=urgency)
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = history.History(':memory:')
+        self.addCleanup(self.history.close)
+
+        self.history.add([
+            notif('n1', category='disk.full',
+                  urgency=protocol.URGENCY_CRITICAL),
+            notif('n2', app_name='local', category='network.connected'),
+        ], 100.0)
+        self.history.add([
+            notif('n3', app_name='[host2]cron', category='disk',
+                  urgency=protocol.URGENCY_CRITICAL),
+            notif('n4', app_name='[host1]cron',
+                  urgency=protocol.URGENCY_NORMAL),
+        ], 200.0)
+
+    def _ids(self, **kwargs):
+        return [row['id'] for row in self.history.query(**kwargs)]
+
+    def test_wal(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        db = history.History(os.path.join(path, 'history'))
+        mode = db._db.execute('PRAGMA journal_mode').fetchone()[0]
+        db.close()
+        db.close()
+
+        self.assertEqual('wal', mode)
+
+    def test_add(self):
+        self.assertEqual({
+            'timestamp': 100.0,
+            'id': 'n1',
+            'host': 'host1',
+            'app_name': 'app',
+            'summary': 'summary-n1',
+            'body': 'body-n1',
+            'category': 'disk.full',
+            'urgency': protocol.URGENCY_CRITICAL,
+        }, self.history.query()[0])
+        self.assertEqual(None, self.history.query()[1]['host'])
+
+    def test_add_non_ascii(self):
+        summary = u'caf\xe9'.encode('utf-8')
+        body = u'\u2603 snow'.encode('utf-8')
+        self.history.add([protocol.Message.from_frame(protocol.Message(
+            'notify', app_name='[host1]app', summary=summary, body=body,
+            id='n5').to_frame())], 300.0)
+
+        row = self.history.query(since=300.0)[0]
+
+        self.assertEqual(summary, row['summary'])
+        self.assertEqual(body, row['body'])
+
+    @mock.patch('time.time', return_value=300.0)
+    def test_add_timestamp(self, mock_time):
+        self.history.add([notif('n5')])
+
+        self.assertEqual(['n5'], self._ids(since=300.0))
+
+    def test_query_all(self):
+        self.assertEqual(['n1', 'n2', 'n3', 'n4'], self._ids())
+
+    def test_query_time(self):
+        self.assertEqual(['n3', 'n4'], self._ids(since=150.0))
+        self.assertEqual(['n1', 'n2'], self._ids(until=150.0))
+
+    def test_query_category(self):
+        self.assertEqual(['n1'], self._ids(categories=['disk.*']))
+        self.assertEqual(['n2', 'n3'],
+                         self._ids(categories=['disk', 'network.*']))
+        self.assertEqual(['n1', 'n2', 'n3', 'n4'],
+                         self._ids(categories=['disk', '*']))
+
+    def test_query_urgency(self):
+        self.assertEqual(['n1', 'n3', 'n4'],
+                         self._ids(min_urgency=protocol.URGENCY_NORMAL))
+
+    def test_query_origin(self):
+        self.assertEqual(['n3', 'n4'], self._ids(app_names=['c*']))
+        self.assertEqual(['n1', 'n3', 'n4'], self._ids(hosts=['host?']))
+        self.assertEqual(['n4'], self._ids(app_names=['cron'],
+                                           hosts=['host1']))
+
+    def test_query_combined(self):
+        self.assertEqual(['n1'], self._ids(
+            since=50.0, min_urgency=protocol.URGENCY_CRITICAL,
+            hosts=['host1']))
+
+    def test_query_limit(self):
+        self.assertEqual(['n3', 'n4'], self._ids(limit=2))
+
+
+class ParseAgeTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(90, history._parse_age('90'))
+        self.assertEqual(90, history._parse_age('90s'))
+
+    def test_units(self):
+        self.assertEqual(1800, history._parse_age('30m'))
+        self.assertEqual(3600, history._parse_age('1h'))
+        self.assertEqual(172800, history._parse_age('2d'))
+        self.assertEqual(604800, history._parse_age('1w'))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, history._parse_age, '1y')
+        self.assertRaises(ValueError, history._parse_age, 'h')
+
+
+class FormatTest(unittest.TestCase):
+    row = {
+        'timestamp': 100.0,
+        'id': 'n1',
+        'host': 'host1',
+        'app_name': 'app',
+        'summary': 'summary-n1',
+        'body': 'body-n1',
+        'category': None,
+        'urgency': protocol.URGENCY_CRITICAL,
+    }
+
+    @mock.patch('time.strftime', return_value='1970-01-01 00:01:40')
+    def test_text(self, mock_strftime):
+        self.assertEqual('1970-01-01 00:01:40: ID n1, urgency critical\n'
+                         'Application: [host1]app\n'
+                         '    Summary: summary-n1\n'
+                         '       Body: body-n1\n'
+                         '   Category: None\n',
+                         history._format_text(self.row))
+
+    def test_json(self):
+        row = dict(self.row, host=None)
+
+        self.assertEqual({
+            'timestamp': 100.0,
+            'id': 'n1',
+            'host': None,
+            'application': 'app',
+            'summary': 'summary-n1',
+            'body': 'body-n1',
+            'category': '',
+            'urgency': 'critical',
+        }, json.loads(history._format_json(row)))
+
+
+class HistoryNotificationDriverTest(unittest.TestCase):
+    @mock.patch.object(history, 'History')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_record(self, mock_NotifierServer, mock_History):
+        server = mock_NotifierServer.return_value
+        server.next_batch.side_effect = [['n1', 'n2'], ['n3'],
+                                         StopIteration()]
+
+        history.history_notification_driver('/history', 'hub')
+
+        mock_History.assert_called_once_with('/history')
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
+        server.start.assert_called_once_with()
+        server.next_batch.assert_called_with(history.HISTORY_BATCH)
+        mock_History.return_value.assert_has_calls([
+            mock.call.add(['n1', 'n2']),
+            mock.call.add(['n3']),
+            mock.call.close(),
+        ])
+
+    @mock.patch.object(history, 'History')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_exit(self, mock_NotifierServer, mock_History):
+        server = mock_NotifierServer.return_value
+        server.next_batch.side_effect = [['n1'], SystemExit()]
+
+        self.assertRaises(SystemExit, history.history_notification_driver,
+                          '/history', 'hub')
+
+        mock_History.return_value.assert_has_calls([
+            mock.call.add(['n1']),
+            mock.call.close(),
+        ])
+
+
+class QueryHistoryTest(unittest.TestCase):
+    @mock.patch('os.path.exists', return_value=False)
+    @mock.patch.object(history, 'History')
+    def test_missing(self, mock_History, mock_exists):
+        result = history.query_history('/history')
+
+        self.assertEqual('No notification history in "/history"', result)
+        self.assertFalse(mock_History.called)
+
+    @mock.patch('time.time', return_value=5000.0)
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch.object(history, 'History')
+    @mock.patch.dict(history._history_formats, json=lambda row: row)
+    @mock.patch('__builtin__.print')
+    def test_query(self, mock_print, mock_History, mock_exists, mock_time):
+        db = mock_History.return_value
+        db.query.return_value = ['row1', 'row2']
+
+        result = history.query_history(
+            '/history', since=3600, categories=['disk.*'],
+            min_urgency='critical', hosts=['host1'], fmt='json')
+
+        self.assertEqual(None, result)
+        mock_History.assert_called_once_with('/history')
+        db.query.assert_called_once_with(
+            since=1400.0, categories=['disk.*'],
+            min_urgency=protocol.URGENCY_CRITICAL, app_names=(),
+            hosts=['host1'], limit=None)
+        db.close.assert_called_once_with()
+        mock_print.assert_has_calls([
+            mock.call('row1', end=''),
+            mock.call('row2', end=''),
+        ])
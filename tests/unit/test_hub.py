@@ -13,12 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import signal
 import unittest
 
 import mock
 
+from heyu import filters
 from heyu import hub
+from heyu import protocol
 from heyu import util
 
 
@@ -43,6 +46,13 @@ class HubServerTest(unittest.TestCase):
         result = hub.HubServer([])
 
         self.assertEqual({}, result._subscribers)
+        self.assertEqual(hub.QUEUE_SIZE, result._queue_size)
+        self.assertEqual(hub.OVERFLOW_DROP_OLDEST, result._overflow)
+        self.assertEqual(0, result._dropped)
+        self.assertTrue(isinstance(result.hostnames, hub.HostnameCache))
+        self.assertTrue(isinstance(result.ring, hub.ReplayRing))
+        self.assertEqual(hub.REPLAY_SIZE, result.ring.max_size)
+        self.assertEqual(hub.REPLAY_BYTES, result.ring.max_bytes)
         self.assertEqual({}, result._listeners)
         self.assertEqual(False, result._running)
         self.assertFalse(mock_get_manager.called)
@@ -67,10 +77,33 @@ class HubServerTest(unittest.TestCase):
         ], any_order=True)
         self._signal_test(result, mock_signal)
 
+    @mock.patch('tendril.get_manager', side_effect=lambda a, b: b)
+    @mock.patch('gevent.signal')
+    def test_init_queue(self, mock_signal, mock_get_manager):
+        result = hub.HubServer([], 5, hub.OVERFLOW_DISCONNECT, 10, 1000)
+
+        self.assertEqual(5, result._queue_size)
+        self.assertEqual(hub.OVERFLOW_DISCONNECT, result._overflow)
+        self.assertEqual(10, result.ring.max_size)
+        self.assertEqual(1000, result.ring.max_bytes)
+
+    @mock.patch('tendril.get_manager', side_effect=lambda a, b: b)
+    @mock.patch('gevent.signal')
+    def test_init_log(self, mock_signal, mock_get_manager):
+        log = mock.Mock(epoch='epoch', cursor=42)
+
+        result = hub.HubServer([], log=log)
+
+        self.assertEqual(log, result.log)
+        self.assertEqual('epoch', result.ring.epoch)
+        self.assertEqual(42, result.ring.cursor)
+        self.assertEqual(43, result.ring.oldest)
+
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     @mock.patch.object(hub, 'HubApplication', return_value='app')
     def test_acceptor(self, mock_HubApplication, mock_init):
         server = hub.HubServer()
+        server.log = None
 
         result = server._acceptor('tendril')
 
@@ -81,6 +114,7 @@ class HubServerTest(unittest.TestCase):
     @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
     def test_start_running(self, mock_cert_wrapper, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
@@ -95,6 +129,7 @@ class HubServerTest(unittest.TestCase):
     @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
     def test_start_basic(self, mock_cert_wrapper, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
@@ -105,36 +140,98 @@ class HubServerTest(unittest.TestCase):
         server.start()
 
         self.assertEqual(True, server._running)
-        mock_cert_wrapper.assert_called_once_with(None, 'hub', secure=True)
+        mock_cert_wrapper.assert_called_once_with(None, 'hub',
+                                                  server_side=True,
+                                                  secure=True)
         for manager in server._listeners.values():
             manager.start.assert_called_once_with(server._acceptor, 'wrapper')
 
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    @mock.patch.dict(util._tls_wrappers, clear=True)
+    @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
+        'read.return_value': ['/home/dir/.heyu.cert'],
+        'items.return_value': [
+            ('cafile', 'ca'),
+            ('keyfile', 'key'),
+            ('certfile', 'cert'),
+        ],
+    }))
+    @mock.patch.object(util, '_file_stamps', return_value='stamps')
+    @mock.patch.object(util, '_tls_context')
+    def test_start_tls(self, mock_tls_context, mock_file_stamps,
+                       mock_SafeConfigParser, mock_init):
+        context = mock_tls_context.return_value
+        servers = []
+        for _i in range(2):
+            server = hub.HubServer()
+            server.log = None
+            server._listeners = {'a': mock.Mock()}
+            server._running = False
+            server.start('/home/dir/.heyu.cert')
+            servers.append(server)
+
+        # Both servers use the same server-side wrapper
+        wrappers = [server._listeners['a'].start.call_args[0][1]
+                    for server in servers]
+        self.assertIs(wrappers[0], wrappers[1])
+        self.assertEqual(True, wrappers[0].server_side)
+        mock_tls_context.assert_called_once_with({
+            'cafile': 'ca',
+            'keyfile': 'key',
+            'certfile': 'cert',
+        }, True)
+
+        # Every connection is wrapped with the shared context, whose
+        # session cache allows clients to resume their sessions
+        wrappers[0]('sock1')
+        wrappers[1]('sock2')
+        context.wrap_socket.assert_has_calls([
+            mock.call('sock1', server_side=True),
+            mock.call('sock2', server_side=True),
+        ])
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    def test_start_log(self, mock_cert_wrapper, mock_init):
+        server = hub.HubServer()
+        server.log = mock.Mock()
+        server._listeners = {}
+        server._running = False
+
+        server.start()
+
+        server.log.start.assert_called_once_with()
+
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
     def test_start_nolisteners(self, mock_cert_wrapper, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {}
         server._running = False
 
         server.start()
 
         self.assertEqual(True, server._running)
-        mock_cert_wrapper.assert_called_once_with(None, 'hub', secure=True)
+        mock_cert_wrapper.assert_called_once_with(None, 'hub',
+                                                  server_side=True,
+                                                  secure=True)
         for manager in server._listeners.values():
             manager.start.assert_called_once_with(server._acceptor, 'wrapper')
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_stop_notrunning(self, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
             'c': mock.Mock(),
         }
         server._subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
+            'a': mock.Mock(version=0),
+            'b': mock.Mock(version=1),
+            'c': mock.Mock(version=2),
         }
         server._running = False
 
@@ -142,21 +239,22 @@ class HubServerTest(unittest.TestCase):
 
         for manager in server._listeners.values():
             self.assertFalse(manager.stop.called)
-        for client, _version in server._subscribers.values():
-            self.assertFalse(client.disconnect.called)
+        for sub in server._subscribers.values():
+            self.assertFalse(sub.client.disconnect.called)
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_stop_basic(self, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
             'c': mock.Mock(),
         }
         server._subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
+            'a': mock.Mock(version=0),
+            'b': mock.Mock(version=1),
+            'c': mock.Mock(version=2),
         }
         server._running = True
 
@@ -165,12 +263,25 @@ class HubServerTest(unittest.TestCase):
         self.assertEqual(False, server._running)
         for manager in server._listeners.values():
             manager.stop.assert_called_once_with()
-        for client, _version in server._subscribers.values():
-            client.disconnect.assert_called_once_with()
+        for sub in server._subscribers.values():
+            sub.client.disconnect.assert_called_once_with()
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_stop_log(self, mock_init):
+        server = hub.HubServer()
+        server.log = mock.Mock()
+        server._listeners = {}
+        server._subscribers = {}
+        server._running = True
+
+        server.stop()
+
+        server.log.close.assert_called_once_with()
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_stop_empty(self, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {}
         server._subscribers = {}
         server._running = True
@@ -182,11 +293,12 @@ class HubServerTest(unittest.TestCase):
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_shutdown_notrunning(self, mock_init):
         subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
+            'a': mock.Mock(version=0, dropped=1),
+            'b': mock.Mock(version=1, dropped=2),
+            'c': mock.Mock(version=2, dropped=3),
         }
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
@@ -204,17 +316,20 @@ class HubServerTest(unittest.TestCase):
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_shutdown_basic(self, mock_init):
         subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
+            'a': mock.Mock(version=0, dropped=1, coalesced=1),
+            'b': mock.Mock(version=1, dropped=2, coalesced=0),
+            'c': mock.Mock(version=2, dropped=3, coalesced=2),
         }
         server = hub.HubServer()
+        server.log = None
         server._listeners = {
             'a': mock.Mock(),
             'b': mock.Mock(),
             'c': mock.Mock(),
         }
         server._subscribers = subscribers
+        server._dropped = 4
+        server._coalesced = 1
         server._running = True
 
         server.shutdown()
@@ -223,16 +338,23 @@ class HubServerTest(unittest.TestCase):
         for manager in server._listeners.values():
             manager.shutdown.assert_called_once_with()
         self.assertEqual({}, server._subscribers)
+        self.assertEqual(10, server._dropped)
+        self.assertEqual(4, server._coalesced)
+        for sub in subscribers.values():
+            sub.close.assert_called_once_with()
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_shutdown_empty(self, mock_init):
         server = hub.HubServer()
+        server.log = None
         server._listeners = {}
         server._subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
+            'a': mock.Mock(version=0, dropped=0, coalesced=0),
+            'b': mock.Mock(version=1, dropped=0, coalesced=0),
+            'c': mock.Mock(version=2, dropped=0, coalesced=0),
         }
+        server._dropped = 0
+        server._coalesced = 0
         server._running = True
 
         server.shutdown()
@@ -241,56 +363,104 @@ class HubServerTest(unittest.TestCase):
         self.assertEqual({}, server._subscribers)
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
-    def test_subscribe(self, mock_init):
+    @mock.patch.object(hub, 'Subscriber', return_value='subscriber')
+    def test_subscribe(self, mock_Subscriber, mock_init):
         client = mock.Mock()
         server = hub.HubServer()
+        server.log = None
         server._subscribers = {}
+        server._index = mock.Mock()
+        server._queue_size = 5
+        server._overflow = 'overflow'
 
         server.subscribe(client, 1)
 
         self.assertEqual({
-            id(client): (client, 1),
+            id(client): 'subscriber',
         }, server._subscribers)
+        mock_Subscriber.assert_called_once_with(client, 1, 5, 'overflow')
+        self.assertEqual(1, server._index.add.call_count)
+        key, sub_filter = server._index.add.call_args[0]
+        self.assertEqual(id(client), key)
+        self.assertEqual((), sub_filter.categories)
+        self.assertEqual(None, sub_filter.min_urgency)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    @mock.patch.object(hub, 'Subscriber', return_value='subscriber')
+    def test_subscribe_filter(self, mock_Subscriber, mock_init):
+        client = mock.Mock()
+        server = hub.HubServer()
+        server.log = None
+        server._subscribers = {}
+        server._index = mock.Mock()
+        server._queue_size = 5
+        server._overflow = 'overflow'
+
+        server.subscribe(client, 1, 'filter')
+
+        server._index.add.assert_called_once_with(id(client), 'filter')
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_unsubscribe_unsubscribed(self, mock_init):
         client1 = mock.Mock()
         client2 = mock.Mock()
+        sub1 = mock.Mock(client=client1, version=0, dropped=1)
         server = hub.HubServer()
+        server.log = None
         server._subscribers = {
-            id(client1): (client1, 0),
+            id(client1): sub1,
         }
+        server._index = mock.Mock()
+        server._dropped = 0
 
         server.unsubscribe(client2)
 
         self.assertEqual({
-            id(client1): (client1, 0),
+            id(client1): sub1,
         }, server._subscribers)
+        self.assertFalse(sub1.close.called)
+        self.assertEqual(0, server._dropped)
+        server._index.remove.assert_called_once_with(id(client2))
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_unsubscribe_subscribed(self, mock_init):
         client1 = mock.Mock()
         client2 = mock.Mock()
+        sub1 = mock.Mock(client=client1, version=0, dropped=1)
+        sub2 = mock.Mock(client=client2, version=0, dropped=2, coalesced=3)
         server = hub.HubServer()
+        server.log = None
         server._subscribers = {
-            id(client1): (client1, 0),
-            id(client2): (client2, 0),
+            id(client1): sub1,
+            id(client2): sub2,
         }
+        server._index = mock.Mock()
+        server._dropped = 0
+        server._coalesced = 0
 
         server.unsubscribe(client2)
 
         self.assertEqual({
-            id(client1): (client1, 0),
+            id(client1): sub1,
         }, server._subscribers)
+        self.assertFalse(sub1.close.called)
+        sub2.close.assert_called_once_with()
+        self.assertEqual(2, server._dropped)
+        self.assertEqual(3, server._coalesced)
+        server._index.remove.assert_called_once_with(id(client2))
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
     def test_submit_empty(self, mock_init):
         msg = mock.Mock(**{'to_frame.side_effect': lambda x: 'version %d' % x})
         server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
         server._subscribers = {}
+        server._index = mock.Mock(**{'match.return_value': set()})
 
         server.submit(msg)
 
+        server.ring.append.assert_called_once_with(msg)
         self.assertFalse(msg.to_frame.called)
 
     @mock.patch.object(hub.HubServer, '__init__', return_value=None)
@@ -299,15 +469,24 @@ class HubServerTest(unittest.TestCase):
             if version > 2:
                 raise TestException('version too high')
             return 'version %d' % version
-        msg = mock.Mock(**{'to_frame.side_effect': fake_to_frame})
+        msg = mock.Mock(id='notif-id',
+                        **{'to_frame.side_effect': fake_to_frame})
         server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
+        client = mock.Mock(framer='framer', capabilities=frozenset(), **{
+            'streamify.side_effect': lambda x: '<%s>' % x,
+        })
         server._subscribers = {
-            'a': (mock.Mock(), 0),
-            'b': (mock.Mock(), 1),
-            'c': (mock.Mock(), 2),
-            'd': (mock.Mock(), 3),
-            'e': (mock.Mock(), 4),
+            'a': mock.Mock(version=0, client=client),
+            'b': mock.Mock(version=1, client=client),
+            'c': mock.Mock(version=2, client=client),
+            'd': mock.Mock(version=3, client=client),
+            'e': mock.Mock(version=4, client=client),
         }
+        server._index = mock.Mock(**{
+            'match.return_value': set(server._subscribers),
+        })
 
         server.submit(msg)
 
@@ -318,90 +497,935 @@ class HubServerTest(unittest.TestCase):
             mock.call(3),
             mock.call(4),
         ], any_order=True)
-        for client, version in server._subscribers.values():
-            if version > 2:
-                self.assertFalse(client.send_frame.called)
+        self.assertFalse(client.send_frame.called)
+        for sub in server._subscribers.values():
+            if sub.version > 2:
+                self.assertFalse(sub.send.called)
             else:
-                client.send_frame.assert_called_once_with(
-                    'version %d' % version)
+                sub.send.assert_called_once_with(
+                    '<version %d>' % sub.version, 'notif-id')
 
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_log(self, mock_init):
+        msg = mock.Mock()
+        server = hub.HubServer()
+        server.log = mock.Mock()
+        server.ring = mock.Mock(**{'append.return_value': 'stamped'})
+        server._subscribers = {}
+        server._index = mock.Mock(**{'match.return_value': set()})
 
-class HubApplicationTest(unittest.TestCase):
-    @mock.patch('tendril.Application.__init__', return_value=None)
-    @mock.patch('tendril.COBSFramer', return_value='framer')
+        server.submit(msg)
+
+        server.log.append.assert_called_once_with('stamped')
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_batch_log(self, mock_init):
+        server = hub.HubServer()
+        server.log = mock.Mock()
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m * 2})
+        server._subscribers = {}
+        server._index = mock.Mock(**{'match.return_value': set()})
+
+        server.submit_batch(['a', 'b'])
+
+        self.assertEqual([mock.call('aa'), mock.call('bb')],
+                         server.log.append.mock_calls)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_frame_once(self, mock_init):
+        msg = mock.Mock(**{'to_frame.side_effect': lambda x: 'version %d' % x})
+        client1 = mock.Mock(framer='framer1', capabilities=frozenset(), **{
+            'streamify.side_effect': lambda x: '<1 %s>' % x,
+        })
+        client2 = mock.Mock(framer='framer2', capabilities=frozenset(), **{
+            'streamify.side_effect': lambda x: '<2 %s>' % x,
+        })
+        server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
+        server._subscribers = {
+            'a': mock.Mock(version=0, client=client1),
+            'b': mock.Mock(version=0, client=client1),
+            'c': mock.Mock(version=0, client=client2),
+            'd': mock.Mock(version=1, client=client1),
+        }
+        server._index = mock.Mock(**{
+            'match.return_value': set(server._subscribers),
+        })
+
+        server.submit(msg)
+
+        self.assertEqual(3, msg.to_frame.call_count)
+        self.assertEqual(2, client1.streamify.call_count)
+        self.assertEqual(1, client2.streamify.call_count)
+        server._subscribers['a'].send.assert_called_once_with(
+            '<1 version 0>', msg.id)
+        server._subscribers['b'].send.assert_called_once_with(
+            '<1 version 0>', msg.id)
+        server._subscribers['c'].send.assert_called_once_with(
+            '<2 version 0>', msg.id)
+        server._subscribers['d'].send.assert_called_once_with(
+            '<1 version 1>', msg.id)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_compress_once(self, mock_init):
+        msg = mock.Mock(**{'to_frame.return_value': 'frame'})
+        client1 = mock.Mock(framer='framer', capabilities=frozenset(), **{
+            'streamify.side_effect': lambda x: '<%s>' % x,
+        })
+        client2 = mock.Mock(framer='framer', capabilities=frozenset(['zlib']),
+                            **{'streamify.side_effect': lambda x: '<z%s>' % x})
+        client3 = mock.Mock(framer='framer', capabilities=frozenset(['zlib']),
+                            **{'streamify.side_effect': lambda x: '<z%s>' % x})
+        server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
+        server._subscribers = {
+            'a': mock.Mock(version=0, client=client1),
+            'b': mock.Mock(version=0, client=client2),
+            'c': mock.Mock(version=0, client=client3),
+        }
+        server._index = mock.Mock(**{
+            'match.return_value': set(server._subscribers),
+        })
+
+        server.submit(msg)
+
+        self.assertEqual(1, client1.streamify.call_count)
+        self.assertEqual(1, client2.streamify.call_count +
+                         client3.streamify.call_count)
+        server._subscribers['a'].send.assert_called_once_with(
+            '<frame>', msg.id)
+        server._subscribers['b'].send.assert_called_once_with(
+            '<zframe>', msg.id)
+        server._subscribers['c'].send.assert_called_once_with(
+            '<zframe>', msg.id)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_batch(self, mock_init):
+        msgs = [
+            protocol.Message('notify', app_name='app', summary='one',
+                             body='body'),
+            protocol.Message('notify', app_name='app', summary='two',
+                             body='body'),
+        ]
+        client1 = mock.Mock(framer='framer',
+                            capabilities=frozenset([protocol.CAP_BATCH]),
+                            **{'streamify.side_effect': lambda x: x})
+        client2 = mock.Mock(framer='framer', capabilities=frozenset(),
+                            **{'streamify.side_effect': lambda x: x})
+        server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
+        server._subscribers = {
+            'a': mock.Mock(version=0, client=client1),
+            'b': mock.Mock(version=0, client=client1),
+            'c': mock.Mock(version=0, client=client2),
+        }
+        server._index = mock.Mock(**{
+            'match.return_value': set(server._subscribers),
+        })
+
+        server.submit_batch(msgs)
+
+        server.ring.append.assert_has_calls([mock.call(msg) for msg in msgs])
+        self.assertEqual(1, client1.streamify.call_count)
+        self.assertEqual(2, client2.streamify.call_count)
+        for key in ('a', 'b'):
+            sub = server._subscribers[key]
+            self.assertEqual(1, sub.send.call_count)
+            batch = protocol.Message.from_frame(sub.send.call_args[0][0])
+            self.assertEqual('notify_batch', batch.msg_type)
+            self.assertEqual([msg.to_frame() for msg in msgs],
+                             batch.notifications)
+        self.assertEqual(None, sub.send.call_args[0][1])
+        server._subscribers['c'].send.assert_has_calls([
+            mock.call(msgs[0].to_frame(), msgs[0].id),
+            mock.call(msgs[1].to_frame(), msgs[1].id),
+        ])
+        self.assertEqual(2, server._subscribers['c'].send.call_count)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_submit_batch_filtered(self, mock_init):
+        msgs = [
+            protocol.Message('notify', app_name='app', summary='one',
+                             body='body'),
+            protocol.Message('notify', app_name='app', summary='two',
+                             body='body'),
+            protocol.Message('notify', app_name='app', summary='three',
+                             body='body'),
+        ]
+        client = mock.Mock(framer='framer',
+                           capabilities=frozenset([protocol.CAP_BATCH]),
+                           **{'streamify.side_effect': lambda x: x})
+        server = hub.HubServer()
+        server.log = None
+        server.ring = mock.Mock(**{'append.side_effect': lambda m: m})
+        server._subscribers = {
+            'a': mock.Mock(version=0, client=client),
+            'b': mock.Mock(version=0, client=client),
+            'c': mock.Mock(version=0, client=client),
+            'd': mock.Mock(version=0, client=client),
+        }
+        matches = {
+            'one': set(['a', 'b']),
+            'two': set(['a', 'b', 'c']),
+            'three': set(['c', 'gone']),
+        }
+        server._index = mock.Mock(**{
+            'match.side_effect': lambda msg: matches[msg.summary],
+        })
+
+        server.submit_batch(msgs)
+
+        self.assertEqual(2, client.streamify.call_count)
+        for key, expected in (('a', msgs[:2]), ('b', msgs[:2]),
+                              ('c', msgs[1:])):
+            sub = server._subscribers[key]
+            self.assertEqual(1, sub.send.call_count)
+            batch = protocol.Message.from_frame(sub.send.call_args[0][0])
+            self.assertEqual([msg.to_frame() for msg in expected],
+                             batch.notifications)
+        self.assertFalse(server._subscribers['d'].send.called)
+
+    def _replay_server(self, size=hub.REPLAY_SIZE):
+        server = hub.HubServer.__new__(hub.HubServer)
+        server.ring = hub.ReplayRing(size)
+        server.log = None
+        for i in range(5):
+            server.ring.append(protocol.Message(
+                'notify', app_name='app', summary='summary %d' % i,
+                body='body', category='build' if i % 2 else 'network'))
+        return server
+
+    def test_missed_new(self):
+        server = self._replay_server()
+
+        self.assertEqual(([], False), server.missed(
+            filters.Filter(), server.ring.epoch, None))
+
+    def test_missed(self):
+        server = self._replay_server()
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 2)
+
+        self.assertEqual([3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(False, gap)
+
+    def test_missed_filtered(self):
+        server = self._replay_server()
+
+        missed, gap = server.missed(filters.Filter(['build']),
+                                    server.ring.epoch, 1)
+
+        self.assertEqual([2, 4], [msg.cursor for msg in missed])
+        self.assertEqual(False, gap)
+
+    def test_missed_restarted(self):
+        server = self._replay_server()
+
+        missed, gap = server.missed(filters.Filter(), 'other', 4)
+
+        self.assertEqual([1, 2, 3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(False, gap)
+
+    def test_missed_gap(self):
+        server = self._replay_server(3)
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 1)
+
+        self.assertEqual([3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(True, gap)
+
+    def test_missed_limit(self):
+        server = self._replay_server()
+        server.ring.since = mock.Mock(side_effect=server.ring.since)
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 0,
+                                    2)
+
+        self.assertEqual([4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(True, gap)
+        server.ring.since.assert_called_once_with(3)
+
+    def test_missed_limit_unreached(self):
+        server = self._replay_server()
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 2,
+                                    3)
+
+        self.assertEqual([3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(False, gap)
+
+    def _logged_server(self, ring_size):
+        server = self._replay_server(ring_size)
+        server.log = mock.Mock(oldest=2, **{
+            'since.side_effect': lambda cursor, until: (
+                None if cursor < 1 else
+                [protocol.Message('notify', app_name='app', summary='s',
+                                  body='b', cursor=i).to_frame()
+                 for i in range(cursor + 1, until + 1)]),
+        })
+        return server
+
+    def test_missed_logged(self):
+        server = self._logged_server(2)
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 1)
+
+        self.assertEqual([2, 3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(False, gap)
+        server.log.since.assert_called_once_with(1, 3)
+
+    def test_missed_logged_limit(self):
+        server = self._logged_server(2)
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 0,
+                                    3)
+
+        self.assertEqual([3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(True, gap)
+        server.log.since.assert_called_once_with(2, 3)
+
+    def test_missed_logged_gap(self):
+        server = self._logged_server(2)
+
+        missed, gap = server.missed(filters.Filter(), server.ring.epoch, 0)
+
+        self.assertEqual([2, 3, 4, 5], [msg.cursor for msg in missed])
+        self.assertEqual(True, gap)
+
+    @mock.patch.object(hub, 'REPLAY_BATCH', 2)
+    @mock.patch.object(hub.HubServer, '_broadcast')
+    @mock.patch.object(hub.HubServer, '_batch_frames',
+                       side_effect=lambda msgs: tuple(msgs))
+    def test_replay(self, mock_batch_frames, mock_broadcast):
+        server = hub.HubServer.__new__(hub.HubServer)
+        client = mock.Mock()
+
+        server.replay(client, ['a', 'b', 'c'])
+
+        self.assertEqual([
+            mock.call([id(client)], ('a', 'b')),
+            mock.call([id(client)], ('c',)),
+        ], mock_broadcast.mock_calls)
+
+    @mock.patch.object(hub.HubServer, '_broadcast')
+    def test_replay_empty(self, mock_broadcast):
+        server = hub.HubServer.__new__(hub.HubServer)
+
+        server.replay(mock.Mock(), [])
+
+        self.assertFalse(mock_broadcast.called)
+
+    @mock.patch.object(hub, 'REPLAY_BATCH', 10)
+    def test_replay_limit(self):
+        server = hub.HubServer.__new__(hub.HubServer)
+        client1 = mock.Mock(capabilities=frozenset())
+        client2 = mock.Mock(capabilities=frozenset([protocol.CAP_BATCH]))
+        server._subscribers = {
+            id(client1): mock.Mock(free=3),
+            id(client2): mock.Mock(free=3),
+        }
+
+        self.assertEqual(3, server.replay_limit(client1))
+        self.assertEqual(30, server.replay_limit(client2))
+        self.assertEqual(0, server.replay_limit(mock.Mock()))
+
+    @mock.patch('gevent.spawn')
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, '_set_framing')
+    def test_replay_overflow(self, mock_set_framing, mock_send_frame,
+                             mock_init, mock_spawn):
+        server = self._replay_server()
+        server._subscribers = {}
+        server._index = mock.Mock()
+        server._queue_size = 3
+        server._overflow = hub.OVERFLOW_DISCONNECT
+        app = hub.HubApplication()
+        app.persist = False
+        app.server = server
+        app.framer = mock.Mock(**{
+            'streamify.side_effect': lambda state, frame: frame,
+        })
+        msg = mock.Mock(version=0, capabilities=(), categories=(),
+                        min_urgency=None, app_names=(), hosts=(),
+                        epoch=server.ring.epoch, since=0)
+
+        with mock.patch.object(hub.HubApplication, 'disconnect') as mock_dc:
+            app.subscribe(msg)
+
+        reply = protocol.Message.from_frame(
+            mock_send_frame.call_args[0][0])
+        self.assertEqual('subscribed', reply.msg_type)
+        self.assertEqual(True, reply.gap)
+        self.assertEqual(5, reply.cursor)
+        sub = server._subscribers[id(app)]
+        self.assertEqual(0, sub.dropped)
+        self.assertEqual(0, sub.free)
+        self.assertEqual([3, 4, 5], [protocol.Message.from_frame(data).cursor
+                                     for data in sub._queue])
+        self.assertFalse(mock_dc.called)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_dropped(self, mock_init):
+        server = hub.HubServer()
+        server.log = None
+        server._subscribers = {
+            'a': mock.Mock(dropped=1),
+            'b': mock.Mock(dropped=2),
+        }
+        server._dropped = 4
+
+        self.assertEqual(7, server.dropped)
+
+    @mock.patch.object(hub.HubServer, '__init__', return_value=None)
+    def test_coalesced(self, mock_init):
+        server = hub.HubServer()
+        server.log = None
+        server._subscribers = {
+            'a': mock.Mock(coalesced=1),
+            'b': mock.Mock(coalesced=2),
+        }
+        server._coalesced = 4
+
+        self.assertEqual(7, server.coalesced)
+
+
+def relayed(i, summary=None):
+    return protocol.Message('notify', app_name='[host]app',
+                            summary=summary or 'summary %d' % i,
+                            body='body', id='id%d' % i)
+
+
+class ReplayRingTest(unittest.TestCase):
+    def test_init(self):
+        result = hub.ReplayRing()
+
+        self.assertEqual(hub.REPLAY_SIZE, result.max_size)
+        self.assertEqual(hub.REPLAY_BYTES, result.max_bytes)
+        self.assertEqual(0, len(result))
+        self.assertEqual(0, result.cursor)
+        self.assertEqual(0, result.size)
+        self.assertEqual([], result.since(0))
+        self.assertNotEqual(result.epoch, hub.ReplayRing().epoch)
+
+    def test_append(self):
+        ring = hub.ReplayRing()
+        msg = protocol.Message('notify', app_name='[host]app', summary='s',
+                               body='b', id='id', seq=5)
+
+        result = ring.append(msg)
+
+        self.assertEqual(1, result.cursor)
+        self.assertEqual(None, result.seq)
+        self.assertEqual(('[host]app', 's', 'b', 'id'),
+                         (result.app_name, result.summary, result.body,
+                          result.id))
+        decoded = protocol.Message.from_frame(result.to_frame())
+        self.assertEqual(1, decoded.cursor)
+        self.assertEqual(1, len(ring))
+        self.assertEqual(len(result.to_frame()), ring.size)
+
+    def test_since(self):
+        ring = hub.ReplayRing()
+        for i in range(5):
+            ring.append(relayed(i))
+
+        self.assertEqual(['id2', 'id3', 'id4'],
+                         [msg.id for msg in ring.since(2)])
+        self.assertEqual(5, len(ring.since(0)))
+        self.assertEqual([], ring.since(5))
+        self.assertEqual([], ring.since(7))
+
+    def test_max_size(self):
+        ring = hub.ReplayRing(3)
+        for i in range(5):
+            ring.append(relayed(i))
+
+        self.assertEqual(3, len(ring))
+        self.assertEqual(3, ring.oldest)
+        self.assertEqual(5, ring.cursor)
+        self.assertEqual(None, ring.since(1))
+        self.assertEqual(['id2', 'id3', 'id4'],
+                         [msg.id for msg in ring.since(2)])
+        self.assertEqual(sum(len(msg.to_frame()) for msg in ring.since(2)),
+                         ring.size)
+
+    def test_max_bytes(self):
+        size = len(hub.ReplayRing().append(relayed(0)).to_frame())
+        ring = hub.ReplayRing(max_bytes=size * 2)
+        for i in range(3):
+            ring.append(relayed(i))
+
+        self.assertEqual(2, len(ring))
+        self.assertEqual(['id1', 'id2'], [msg.id for msg in ring.since(1)])
+
+        # The newest notification is kept regardless
+        ring.append(relayed(3, 'x' * size * 3))
+        self.assertEqual(1, len(ring))
+        self.assertEqual(['id3'], [msg.id for msg in ring.since(3)])
+
+
+class SubscriberTest(unittest.TestCase):
+    @mock.patch('gevent.spawn', return_value='thread')
+    @mock.patch('gevent.event.Event', return_value='event')
+    def test_init(self, mock_Event, mock_spawn):
+        result = hub.Subscriber('client', 1)
+
+        self.assertEqual('client', result.client)
+        self.assertEqual(1, result.version)
+        self.assertEqual(hub.QUEUE_SIZE, result.queue_size)
+        self.assertEqual(hub.OVERFLOW_DROP_OLDEST, result.overflow)
+        self.assertEqual(0, result.dropped)
+        self.assertEqual(0, len(result._queue))
+        self.assertEqual('event', result._queue_event)
+        self.assertEqual('thread', result._thread)
+        mock_spawn.assert_called_once_with(result._drain)
+
+    @mock.patch('gevent.spawn', return_value='thread')
+    @mock.patch('gevent.event.Event', return_value='event')
+    def test_init_alt(self, mock_Event, mock_spawn):
+        result = hub.Subscriber('client', 1, 5, hub.OVERFLOW_DROP_NEWEST)
+
+        self.assertEqual(5, result.queue_size)
+        self.assertEqual(hub.OVERFLOW_DROP_NEWEST, result.overflow)
+
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.sleep')
+    def test_drain(self, mock_sleep, mock_spawn):
+        backlogs = [hub.SEND_HIGHWATER + 1, 0, 0]
+        client = mock.Mock(**{
+            'send_stream.side_effect': [None, TestException('failed')],
+        })
+        type(client).backlog = mock.PropertyMock(
+            side_effect=lambda: backlogs.pop(0))
+        sub = hub.Subscriber(client, 0)
+        sub._queue.extend(['frame1', 'frame2'])
+        sub._queue_event = mock.Mock(**{
+            'wait.side_effect': [None, TestException('stop')],
+        })
+
+        self.assertRaises(TestException, sub._drain)
+
+        client.send_stream.assert_has_calls([
+            mock.call('frame1'),
+            mock.call('frame2'),
+        ])
+        mock_sleep.assert_called_once_with(hub.SEND_POLL)
+        sub._queue_event.clear.assert_called_once_with()
+        self.assertEqual(0, len(sub._queue))
+
+    @mock.patch('gevent.spawn')
+    def test_send_basic(self, mock_spawn):
+        client = mock.Mock()
+        sub = hub.Subscriber(client, 0, 2)
+        sub._queue_event = mock.Mock()
+
+        sub.send('frame1')
+        sub.send('frame2')
+
+        self.assertEqual(['frame1', 'frame2'], list(sub._queue))
+        self.assertEqual(0, sub.dropped)
+        self.assertEqual(2, sub._queue_event.set.call_count)
+
+    @mock.patch('gevent.spawn')
+    def test_send_coalesce(self, mock_spawn):
+        client = mock.Mock()
+        sub = hub.Subscriber(client, 0, 2, hub.OVERFLOW_DISCONNECT)
+        sub._queue_event = mock.Mock()
+
+        sub.send('frame1', 'id1')
+        sub.send('frame2', 'id2')
+        sub.send('frame3', 'id1')
+
+        self.assertEqual(['frame2', 'frame3'], list(sub._queue))
+        self.assertEqual(0, sub.dropped)
+        self.assertEqual(1, sub.coalesced)
+        self.assertEqual(3, sub._queue_event.set.call_count)
+        self.assertFalse(client.disconnect.called)
+
+    @mock.patch('gevent.spawn')
+    def test_send_drop_oldest(self, mock_spawn):
+        client = mock.Mock()
+        sub = hub.Subscriber(client, 0, 2, hub.OVERFLOW_DROP_OLDEST)
+        sub._queue.extend(['frame1', 'frame2'])
+        sub._queue_event = mock.Mock()
+
+        sub.send('frame3')
+
+        self.assertEqual(['frame2', 'frame3'], list(sub._queue))
+        self.assertEqual(1, sub.dropped)
+        sub._queue_event.set.assert_called_once_with()
+        self.assertFalse(client.disconnect.called)
+
+    @mock.patch('gevent.spawn')
+    def test_send_drop_newest(self, mock_spawn):
+        client = mock.Mock()
+        sub = hub.Subscriber(client, 0, 2, hub.OVERFLOW_DROP_NEWEST)
+        sub._queue.extend(['frame1', 'frame2'])
+        sub._queue_event = mock.Mock()
+
+        sub.send('frame3')
+
+        self.assertEqual(['frame1', 'frame2'], list(sub._queue))
+        self.assertEqual(1, sub.dropped)
+        self.assertFalse(sub._queue_event.set.called)
+        self.assertFalse(client.disconnect.called)
+
+    @mock.patch('gevent.spawn')
+    def test_send_disconnect(self, mock_spawn):
+        client = mock.Mock()
+        sub = hub.Subscriber(client, 0, 2, hub.OVERFLOW_DISCONNECT)
+        sub._queue.extend(['frame1', 'frame2'])
+        sub._queue_event = mock.Mock()
+
+        sub.send('frame3')
+
+        self.assertEqual(['frame1', 'frame2'], list(sub._queue))
+        self.assertEqual(1, sub.dropped)
+        self.assertFalse(sub._queue_event.set.called)
+        client.disconnect.assert_called_once_with()
+
+    @mock.patch('gevent.spawn')
+    def test_free(self, mock_spawn):
+        sub = hub.Subscriber('client', 0, 3)
+        sub._queue.extend(['frame1', 'frame2'])
+
+        self.assertEqual(1, sub.free)
+
+        sub._queue.extend(['frame3', 'frame4'])
+
+        self.assertEqual(0, sub.free)
+
+    @mock.patch('gevent.spawn')
+    def test_close(self, mock_spawn):
+        thread = mock_spawn.return_value
+        sub = hub.Subscriber('client', 0)
+        sub._queue.extend(['frame1', 'frame2'])
+
+        sub.close()
+
+        thread.kill.assert_called_once_with()
+        self.assertEqual(None, sub._thread)
+        self.assertEqual(0, len(sub._queue))
+
+    @mock.patch('gevent.spawn')
+    def test_close_closed(self, mock_spawn):
+        sub = hub.Subscriber('client', 0)
+        sub._thread = None
+
+        sub.close()
+
+        self.assertEqual(None, sub._thread)
+
+
+class ResolveHostnameTest(unittest.TestCase):
     @mock.patch('socket.getfqdn', return_value='fqdn')
     @mock.patch('socket.getnameinfo', return_value=('host', 1234))
-    def test_init_localipv4(self, mock_getnameinfo, mock_getfqdn,
-                            mock_COBSFramer, mock_init):
-        parent = mock.Mock(addr=('127.0.0.1', 4321))
-
-        app = hub.HubApplication(parent, 'server')
+    def test_localipv4(self, mock_getnameinfo, mock_getfqdn):
+        result = hub._resolve_hostname(('127.0.0.1', 4321))
 
-        self.assertEqual('server', app.server)
-        self.assertEqual(False, app.persist)
-        self.assertEqual('fqdn', app.hostname)
-        mock_init.assert_called_once_with(parent)
-        mock_COBSFramer.assert_called_once_with(True)
-        self.assertEqual('framer', parent.framers)
+        self.assertEqual('fqdn', result)
         mock_getfqdn.assert_called_once_with()
         self.assertFalse(mock_getnameinfo.called)
 
-    @mock.patch('tendril.Application.__init__', return_value=None)
-    @mock.patch('tendril.COBSFramer', return_value='framer')
     @mock.patch('socket.getfqdn', return_value='fqdn')
     @mock.patch('socket.getnameinfo', return_value=('host', 1234))
-    def test_init_localipv6(self, mock_getnameinfo, mock_getfqdn,
-                            mock_COBSFramer, mock_init):
-        parent = mock.Mock(addr=('::1', 4321))
-
-        app = hub.HubApplication(parent, 'server')
+    def test_localipv6(self, mock_getnameinfo, mock_getfqdn):
+        result = hub._resolve_hostname(('::1', 4321))
 
-        self.assertEqual('server', app.server)
-        self.assertEqual(False, app.persist)
-        self.assertEqual('fqdn', app.hostname)
-        mock_init.assert_called_once_with(parent)
-        mock_COBSFramer.assert_called_once_with(True)
-        self.assertEqual('framer', parent.framers)
+        self.assertEqual('fqdn', result)
         mock_getfqdn.assert_called_once_with()
         self.assertFalse(mock_getnameinfo.called)
 
-    @mock.patch('tendril.Application.__init__', return_value=None)
-    @mock.patch('tendril.COBSFramer', return_value='framer')
     @mock.patch('socket.getfqdn', return_value='fqdn')
     @mock.patch('socket.getnameinfo', return_value=('host', 1234))
-    def test_init_remote(self, mock_getnameinfo, mock_getfqdn,
-                         mock_COBSFramer, mock_init):
-        parent = mock.Mock(addr=('10.0.0.1', 4321))
+    def test_remote(self, mock_getnameinfo, mock_getfqdn):
+        result = hub._resolve_hostname(('10.0.0.1', 4321))
 
-        app = hub.HubApplication(parent, 'server')
-
-        self.assertEqual('server', app.server)
-        self.assertEqual(False, app.persist)
-        self.assertEqual('host', app.hostname)
-        mock_init.assert_called_once_with(parent)
-        mock_COBSFramer.assert_called_once_with(True)
-        self.assertEqual('framer', parent.framers)
+        self.assertEqual('host', result)
         self.assertFalse(mock_getfqdn.called)
         mock_getnameinfo.assert_called_once_with(('10.0.0.1', 4321), 0)
 
+
+class HostnameCacheTest(unittest.TestCase):
+    def test_init(self):
+        cache = hub.HostnameCache(1, 2, 3)
+
+        self.assertEqual(1, cache._ttl)
+        self.assertEqual(2, cache._negative_ttl)
+        self.assertEqual(3, cache._max_size)
+        self.assertEqual({}, cache._cache)
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(0, cache.misses)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_miss(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache()
+
+        result = cache.lookup(('10.0.0.1', 4321))
+
+        self.assertEqual('result', result)
+        self.assertEqual({'10.0.0.1': (None, 'result')}, cache._cache)
+        mock_spawn.assert_called_once_with(cache._resolve,
+                                           ('10.0.0.1', 4321), 'result')
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_hit(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache()
+        cache._cache = {'10.0.0.1': (101, 'cached')}
+
+        result = cache.lookup(('10.0.0.1', 1234))
+
+        self.assertEqual('cached', result)
+        self.assertFalse(mock_spawn.called)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(0, cache.misses)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_pending(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache()
+        cache._cache = {'10.0.0.1': (None, 'pending')}
+
+        result = cache.lookup(('10.0.0.1', 1234))
+
+        self.assertEqual('pending', result)
+        self.assertFalse(mock_spawn.called)
+        self.assertEqual(1, cache.hits)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_expired(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache()
+        cache._cache = {'10.0.0.1': (100, 'cached')}
+
+        result = cache.lookup(('10.0.0.1', 1234))
+
+        self.assertEqual('result', result)
+        self.assertEqual({'10.0.0.1': (None, 'result')}, cache._cache)
+        mock_spawn.assert_called_once_with(cache._resolve,
+                                           ('10.0.0.1', 1234), 'result')
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_purge(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache(max_size=3)
+        cache._cache = {
+            'a': (99, 'expired'),
+            'b': (101, 'cached'),
+            'c': (None, 'pending'),
+        }
+
+        cache.lookup(('10.0.0.1', 1234))
+
+        self.assertEqual({
+            'b': (101, 'cached'),
+            'c': (None, 'pending'),
+            '10.0.0.1': (None, 'result'),
+        }, cache._cache)
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.spawn')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    def test_lookup_evict(self, mock_AsyncResult, mock_spawn, mock_time):
+        cache = hub.HostnameCache(max_size=2)
+        cache._cache = collections.OrderedDict([
+            ('a', (101, 'oldest')),
+            ('b', (None, 'pending')),
+            ('c', (99, 'expired')),
+            ('d', (102, 'newest')),
+        ])
+
+        cache.lookup(('10.0.0.1', 1234))
+
+        self.assertEqual([
+            ('d', (102, 'newest')),
+            ('10.0.0.1', (None, 'result')),
+        ], list(cache._cache.items()))
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.get_hub')
+    def test_resolve(self, mock_get_hub, mock_time):
+        mock_get_hub.return_value.threadpool.apply.return_value = 'host'
+        result = mock.Mock()
+        cache = hub.HostnameCache(10, 5)
+        cache._cache = collections.OrderedDict([
+            ('10.0.0.1', (None, result)),
+            ('10.0.0.2', (101, 'cached')),
+        ])
+
+        cache._resolve(('10.0.0.1', 1234), result)
+
+        mock_get_hub.return_value.threadpool.apply.assert_called_once_with(
+            hub._resolve_hostname, (('10.0.0.1', 1234),))
+        self.assertEqual([
+            ('10.0.0.2', (101, 'cached')),
+            ('10.0.0.1', (110, result)),
+        ], list(cache._cache.items()))
+        result.set.assert_called_once_with('host')
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.get_hub')
+    def test_resolve_evicted(self, mock_get_hub, mock_time):
+        mock_get_hub.return_value.threadpool.apply.return_value = 'host'
+        result = mock.Mock()
+        cache = hub.HostnameCache(10, 5)
+
+        cache._resolve(('10.0.0.1', 1234), result)
+
+        self.assertEqual({}, cache._cache)
+        result.set.assert_called_once_with('host')
+
+    @mock.patch('time.time', return_value=100)
+    @mock.patch('gevent.get_hub')
+    def test_resolve_failed(self, mock_get_hub, mock_time):
+        mock_get_hub.return_value.threadpool.apply.side_effect = (
+            TestException('failed'))
+        result = mock.Mock()
+        cache = hub.HostnameCache(10, 5)
+        cache._cache['10.0.0.1'] = (None, result)
+
+        cache._resolve(('10.0.0.1', 1234), result)
+
+        self.assertEqual({'10.0.0.1': (105, result)}, cache._cache)
+        result.set.assert_called_once_with('10.0.0.1')
+
+    @mock.patch.object(hub, '_resolve_hostname', return_value='host')
+    def test_lookup_resolves(self, mock_resolve_hostname):
+        cache = hub.HostnameCache()
+
+        result1 = cache.lookup(('10.0.0.1', 1234))
+        result2 = cache.lookup(('10.0.0.1', 4321))
+
+        self.assertEqual('host', result1.get(timeout=5))
+        self.assertEqual('host', result2.get(timeout=5))
+        mock_resolve_hostname.assert_called_once_with(('10.0.0.1', 1234))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+
+class HubApplicationTest(unittest.TestCase):
     @mock.patch('tendril.Application.__init__', return_value=None)
-    @mock.patch('tendril.COBSFramer', return_value='framer')
-    @mock.patch('socket.getfqdn', return_value='fqdn')
-    @mock.patch('socket.getnameinfo', side_effect=TestException('error'))
-    def test_init_bad_resolve(self, mock_getnameinfo, mock_getfqdn,
-                              mock_COBSFramer, mock_init):
-        parent = mock.Mock(addr=('10.0.0.1', 4321))
+    @mock.patch('tendril.IdentityFramer', return_value='identity')
+    def test_init(self, mock_IdentityFramer, mock_init):
+        parent = mock.Mock(remote_addr=('10.0.0.1', 4321))
+        server = mock.Mock(**{'hostnames.lookup.return_value': 'result'})
 
-        app = hub.HubApplication(parent, 'server')
+        app = hub.HubApplication(parent, server)
 
-        self.assertEqual('server', app.server)
+        self.assertEqual(server, app.server)
         self.assertEqual(False, app.persist)
-        self.assertEqual('10.0.0.1', app.hostname)
+        self.assertEqual('result', app._hostname)
         mock_init.assert_called_once_with(parent)
-        mock_COBSFramer.assert_called_once_with(True)
-        self.assertEqual('framer', parent.framers)
-        self.assertFalse(mock_getfqdn.called)
-        mock_getnameinfo.assert_called_once_with(('10.0.0.1', 4321), 0)
+        mock_IdentityFramer.assert_called_once_with()
+        self.assertEqual(hub.COBS_FRAMER, app.framer)
+        self.assertEqual(('identity', hub.COBS_FRAMER), parent.framers)
+        server.hostnames.lookup.assert_called_once_with(('10.0.0.1', 4321))
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_hostname(self, mock_init):
+        app = hub.HubApplication()
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
+
+        self.assertEqual('host', app.hostname)
+        app._hostname.get.assert_called_once_with()
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_backlog(self, mock_init):
+        app = hub.HubApplication()
+        app.parent = mock.Mock(_sendbuf='pending')
+
+        self.assertEqual(7, app.backlog)
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_streamify(self, mock_init):
+        app = hub.HubApplication()
+        app.capabilities = frozenset()
+        app.framer = mock.Mock(**{'streamify.return_value': 'data'})
+
+        result = app.streamify('frame')
+
+        self.assertEqual('data', result)
+        app.framer.streamify.assert_called_once_with(None, 'frame')
+
+    @mock.patch.object(protocol, 'compress_frame', return_value='compressed')
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_streamify_compressed(self, mock_init, mock_compress_frame):
+        app = hub.HubApplication()
+        app.capabilities = frozenset(['zlib'])
+        app.framer = mock.Mock(**{'streamify.return_value': 'data'})
+
+        result = app.streamify('frame')
+
+        self.assertEqual('data', result)
+        mock_compress_frame.assert_called_once_with('frame')
+        app.framer.streamify.assert_called_once_with(None, 'compressed')
+
+    @mock.patch.object(protocol, 'compress_frame', return_value='compressed')
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_streamify_uncompressed(self, mock_init, mock_compress_frame):
+        app = hub.HubApplication()
+        app.capabilities = frozenset(['zlib'])
+        app.framer = mock.Mock(**{'streamify.return_value': 'data'})
+
+        result = app.streamify('frame', False)
+
+        self.assertEqual('data', result)
+        self.assertFalse(mock_compress_frame.called)
+        app.framer.streamify.assert_called_once_with(None, 'frame')
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_send_stream(self, mock_init):
+        app = hub.HubApplication()
+        app.parent = mock.Mock()
+
+        app.send_stream('data')
+
+        app.parent.send_frame.assert_called_once_with('data')
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'streamify', return_value='data')
+    @mock.patch.object(hub.HubApplication, 'send_stream')
+    def test_send_frame(self, mock_send_stream, mock_streamify, mock_init):
+        app = hub.HubApplication()
+
+        app.send_frame('frame')
+
+        mock_streamify.assert_called_once_with('frame', True)
+        mock_send_stream.assert_called_once_with('data')
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'streamify', return_value='data')
+    @mock.patch.object(hub.HubApplication, 'send_stream')
+    def test_send_frame_uncompressed(self, mock_send_stream, mock_streamify,
+                                     mock_init):
+        app = hub.HubApplication()
+
+        app.send_frame('frame', compress=False)
+
+        mock_streamify.assert_called_once_with('frame', False)
+        mock_send_stream.assert_called_once_with('data')
+
+    def test_framing(self):
+        frame = 'a\0frame\0with\0nulls'
+        data = hub.COBS_FRAMER.streamify(None, frame)
+
+        self.assertEqual([frame], list(hub.COBS_FRAMER.frameify(
+            mock.Mock(recv_buf=''), data)))
 
     @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'some frame',
@@ -416,10 +1440,12 @@ class HubApplicationTest(unittest.TestCase):
                                     mock_notify, mock_close, mock_send_frame,
                                     mock_init, mock_Message):
         app = hub.HubApplication()
+        app.capabilities = frozenset()
 
         app.recv_frame('test')
 
-        mock_Message.from_frame.assert_called_once_with('test')
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
         mock_Message.assert_called_once_with(
             'error', reason='Failed to decode message: failed to decode')
         mock_Message.return_value.to_frame.assert_called_once_with()
@@ -429,6 +1455,30 @@ class HubApplicationTest(unittest.TestCase):
         self.assertFalse(mock_subscribe.called)
         self.assertFalse(mock_disconnect.called)
 
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    @mock.patch.object(hub.HubApplication, 'notify')
+    def test_recv_frame_compressed(self, mock_notify, mock_close,
+                                   mock_send_frame, mock_init):
+        frame = protocol.compress_frame(protocol.Message(
+            'notify', app_name='app', summary='summary',
+            body='x' * 1000).to_frame())
+        app = hub.HubApplication()
+        app.capabilities = frozenset()
+
+        app.recv_frame(frame)
+
+        reply = protocol.Message.from_frame(mock_send_frame.call_args[0][0])
+        self.assertEqual('error', reply.msg_type)
+        mock_close.assert_called_once_with()
+        self.assertFalse(mock_notify.called)
+
+        app.capabilities = frozenset([protocol.CAP_ZLIB])
+        app.recv_frame(frame)
+
+        self.assertEqual('x' * 1000, mock_notify.call_args[0][0].body)
+
     @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'some frame',
     }), **{'from_frame.return_value': mock.Mock(msg_type='unknown')})
@@ -442,10 +1492,12 @@ class HubApplicationTest(unittest.TestCase):
                                    mock_notify, mock_close, mock_send_frame,
                                    mock_init, mock_Message):
         app = hub.HubApplication()
+        app.capabilities = frozenset()
 
         app.recv_frame('test')
 
-        mock_Message.from_frame.assert_called_once_with('test')
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
         mock_Message.assert_called_once_with(
             'error', reason='Unknown message type "unknown"')
         mock_Message.return_value.to_frame.assert_called_once_with()
@@ -468,10 +1520,12 @@ class HubApplicationTest(unittest.TestCase):
                                mock_notify, mock_close, mock_send_frame,
                                mock_init, mock_Message):
         app = hub.HubApplication()
+        app.capabilities = frozenset()
 
         app.recv_frame('test')
 
-        mock_Message.from_frame.assert_called_once_with('test')
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
         self.assertFalse(mock_Message.called)
         self.assertFalse(mock_send_frame.called)
         self.assertFalse(mock_close.called)
@@ -480,6 +1534,58 @@ class HubApplicationTest(unittest.TestCase):
         self.assertFalse(mock_subscribe.called)
         self.assertFalse(mock_disconnect.called)
 
+    @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'some frame',
+    }), **{'from_frame.return_value': mock.Mock(msg_type='notify_batch')})
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    @mock.patch.object(hub.HubApplication, 'notify')
+    @mock.patch.object(hub.HubApplication, 'notify_batch')
+    def test_recv_frame_notify_batch(self, mock_notify_batch, mock_notify,
+                                     mock_close, mock_send_frame, mock_init,
+                                     mock_Message):
+        app = hub.HubApplication()
+        app.capabilities = frozenset()
+
+        app.recv_frame('test')
+
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
+        self.assertFalse(mock_Message.called)
+        self.assertFalse(mock_send_frame.called)
+        self.assertFalse(mock_close.called)
+        self.assertFalse(mock_notify.called)
+        mock_notify_batch.assert_called_once_with(
+            mock_Message.from_frame.return_value)
+
+    @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'some frame',
+    }), **{'from_frame.return_value': mock.Mock(msg_type='hello')})
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    @mock.patch.object(hub.HubApplication, 'notify')
+    @mock.patch.object(hub.HubApplication, 'hello')
+    @mock.patch.object(hub.HubApplication, 'subscribe')
+    def test_recv_frame_hello(self, mock_subscribe, mock_hello, mock_notify,
+                              mock_close, mock_send_frame, mock_init,
+                              mock_Message):
+        app = hub.HubApplication()
+        app.capabilities = frozenset()
+
+        app.recv_frame('test')
+
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
+        self.assertFalse(mock_Message.called)
+        self.assertFalse(mock_send_frame.called)
+        self.assertFalse(mock_close.called)
+        self.assertFalse(mock_notify.called)
+        mock_hello.assert_called_once_with(
+            mock_Message.from_frame.return_value)
+        self.assertFalse(mock_subscribe.called)
+
     @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'some frame',
     }), **{'from_frame.return_value': mock.Mock(msg_type='subscribe')})
@@ -493,10 +1599,12 @@ class HubApplicationTest(unittest.TestCase):
                                   mock_notify, mock_close, mock_send_frame,
                                   mock_init, mock_Message):
         app = hub.HubApplication()
+        app.capabilities = frozenset()
 
         app.recv_frame('test')
 
-        mock_Message.from_frame.assert_called_once_with('test')
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
         self.assertFalse(mock_Message.called)
         self.assertFalse(mock_send_frame.called)
         self.assertFalse(mock_close.called)
@@ -518,10 +1626,12 @@ class HubApplicationTest(unittest.TestCase):
                                 mock_notify, mock_close, mock_send_frame,
                                 mock_init, mock_Message):
         app = hub.HubApplication()
+        app.capabilities = frozenset()
 
         app.recv_frame('test')
 
-        mock_Message.from_frame.assert_called_once_with('test')
+        mock_Message.from_frame.assert_called_once_with(
+            'test', compressed=False)
         self.assertFalse(mock_Message.called)
         self.assertFalse(mock_send_frame.called)
         self.assertFalse(mock_close.called)
@@ -537,28 +1647,29 @@ class HubApplicationTest(unittest.TestCase):
     def test_notify_success(self, mock_close, mock_send_frame, mock_init,
                             mock_Message, mock_uuid4):
         msgs = {
-            'notify': 'notification',
             'error': mock.Mock(**{'to_frame.return_value': 'error'}),
             'accepted': mock.Mock(**{'to_frame.return_value': 'accepted'}),
         }
         mock_Message.side_effect = lambda x, **kw: msgs[x]
-        msg = mock.Mock(id=None, app_name='app', summary='summary',
-                        body='body', urgency='urgency', category='category')
+        msg = mock.Mock(id=None, app_name='app', seq='seq', **{
+            'splice.return_value': mock.Mock(id='some-uuid'),
+        })
         app = hub.HubApplication()
-        app.hostname = 'host'
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
         app.server = mock.Mock()
         app.persist = True
 
         app.notify(msg)
 
         mock_uuid4.assert_called_once_with()
+        msg.splice.assert_called_once_with(
+            ('summary', 'body', 'urgency', 'category'),
+            id='some-uuid', app_name='[host]app')
         mock_Message.assert_has_calls([
-            mock.call('notify', id='some-uuid', app_name='[host]app',
-                      summary='summary', body='body', urgency='urgency',
-                      category='category'),
-            mock.call('accepted', id='some-uuid'),
+            mock.call('accepted', id='some-uuid', seq='seq'),
         ])
-        app.server.submit.assert_called_once_with('notification')
+        app.server.submit.assert_called_once_with(
+            msg.splice.return_value)
         self.assertFalse(msgs['error'].to_frame.called)
         msgs['accepted'].to_frame.assert_called_once_with()
         mock_send_frame.assert_called_once_with('accepted')
@@ -572,28 +1683,29 @@ class HubApplicationTest(unittest.TestCase):
     def test_notify_provided_id(self, mock_close, mock_send_frame, mock_init,
                                 mock_Message, mock_uuid4):
         msgs = {
-            'notify': 'notification',
             'error': mock.Mock(**{'to_frame.return_value': 'error'}),
             'accepted': mock.Mock(**{'to_frame.return_value': 'accepted'}),
         }
         mock_Message.side_effect = lambda x, **kw: msgs[x]
-        msg = mock.Mock(id='my-id', app_name='app', summary='summary',
-                        body='body', urgency='urgency', category='category')
+        msg = mock.Mock(id='my-id', app_name='app', seq='seq', **{
+            'splice.return_value': mock.Mock(id='my-id'),
+        })
         app = hub.HubApplication()
-        app.hostname = 'host'
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
         app.server = mock.Mock()
         app.persist = True
 
         app.notify(msg)
 
         self.assertFalse(mock_uuid4.called)
+        msg.splice.assert_called_once_with(
+            ('summary', 'body', 'urgency', 'category'),
+            id='my-id', app_name='[host]app')
         mock_Message.assert_has_calls([
-            mock.call('notify', id='my-id', app_name='[host]app',
-                      summary='summary', body='body', urgency='urgency',
-                      category='category'),
-            mock.call('accepted', id='my-id'),
+            mock.call('accepted', id='my-id', seq='seq'),
         ])
-        app.server.submit.assert_called_once_with('notification')
+        app.server.submit.assert_called_once_with(
+            msg.splice.return_value)
         self.assertFalse(msgs['error'].to_frame.called)
         msgs['accepted'].to_frame.assert_called_once_with()
         mock_send_frame.assert_called_once_with('accepted')
@@ -607,28 +1719,29 @@ class HubApplicationTest(unittest.TestCase):
     def test_notify_no_persist(self, mock_close, mock_send_frame, mock_init,
                                mock_Message, mock_uuid4):
         msgs = {
-            'notify': 'notification',
             'error': mock.Mock(**{'to_frame.return_value': 'error'}),
             'accepted': mock.Mock(**{'to_frame.return_value': 'accepted'}),
         }
         mock_Message.side_effect = lambda x, **kw: msgs[x]
-        msg = mock.Mock(id=None, app_name='app', summary='summary',
-                        body='body', urgency='urgency', category='category')
+        msg = mock.Mock(id=None, app_name='app', seq='seq', **{
+            'splice.return_value': mock.Mock(id='some-uuid'),
+        })
         app = hub.HubApplication()
-        app.hostname = 'host'
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
         app.server = mock.Mock()
         app.persist = False
 
         app.notify(msg)
 
         mock_uuid4.assert_called_once_with()
+        msg.splice.assert_called_once_with(
+            ('summary', 'body', 'urgency', 'category'),
+            id='some-uuid', app_name='[host]app')
         mock_Message.assert_has_calls([
-            mock.call('notify', id='some-uuid', app_name='[host]app',
-                      summary='summary', body='body', urgency='urgency',
-                      category='category'),
-            mock.call('accepted', id='some-uuid'),
+            mock.call('accepted', id='some-uuid', seq='seq'),
         ])
-        app.server.submit.assert_called_once_with('notification')
+        app.server.submit.assert_called_once_with(
+            msg.splice.return_value)
         self.assertFalse(msgs['error'].to_frame.called)
         msgs['accepted'].to_frame.assert_called_once_with()
         mock_send_frame.assert_called_once_with('accepted')
@@ -642,15 +1755,15 @@ class HubApplicationTest(unittest.TestCase):
     def test_notify_failure(self, mock_close, mock_send_frame, mock_init,
                             mock_Message, mock_uuid4):
         msgs = {
-            'notify': 'notification',
             'error': mock.Mock(**{'to_frame.return_value': 'error'}),
             'accepted': mock.Mock(**{'to_frame.return_value': 'accepted'}),
         }
         mock_Message.side_effect = lambda x, **kw: msgs[x]
-        msg = mock.Mock(id=None, app_name='app', summary='summary',
-                        body='body', urgency='urgency', category='category')
+        msg = mock.Mock(id=None, app_name='app', seq='seq', **{
+            'splice.return_value': mock.Mock(id='some-uuid'),
+        })
         app = hub.HubApplication()
-        app.hostname = 'host'
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
         app.server = mock.Mock(**{
             'submit.side_effect': TestException('failed'),
         })
@@ -659,37 +1772,194 @@ class HubApplicationTest(unittest.TestCase):
         app.notify(msg)
 
         mock_uuid4.assert_called_once_with()
+        msg.splice.assert_called_once_with(
+            ('summary', 'body', 'urgency', 'category'),
+            id='some-uuid', app_name='[host]app')
         mock_Message.assert_has_calls([
-            mock.call('notify', id='some-uuid', app_name='[host]app',
-                      summary='summary', body='body', urgency='urgency',
-                      category='category'),
-            mock.call('error', reason='Failed to submit notification: failed'),
+            mock.call('error', reason='Failed to submit notification: failed',
+                      seq='seq'),
         ])
-        app.server.submit.assert_called_once_with('notification')
+        app.server.submit.assert_called_once_with(
+            msg.splice.return_value)
         msgs['error'].to_frame.assert_called_once_with()
         self.assertFalse(msgs['accepted'].to_frame.called)
         mock_send_frame.assert_called_once_with('error')
         self.assertFalse(mock_close.called)
 
+    def _batch_app(self, persist=True):
+        app = hub.HubApplication()
+        app._hostname = mock.Mock(**{'get.return_value': 'host'})
+        app.server = mock.Mock()
+        app.persist = persist
+        return app
+
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    def test_notify_batch_success(self, mock_close, mock_send_frame,
+                                  mock_init, mock_uuid4):
+        msg = protocol.Message('notify_batch', seq=3, notifications=[
+            protocol.Message('notify', app_name='app', summary='one',
+                             body='body', id='id1').to_frame(),
+            protocol.Message('notify', app_name='app', summary='two',
+                             body='body').to_frame(),
+        ])
+        app = self._batch_app()
+
+        app.notify_batch(msg)
+
+        self.assertEqual(1, app.server.submit_batch.call_count)
+        notifs = app.server.submit_batch.call_args[0][0]
+        self.assertEqual(['id1', 'some-uuid'], [n.id for n in notifs])
+        self.assertEqual(['[host]app', '[host]app'],
+                         [n.app_name for n in notifs])
+        self.assertEqual(['one', 'two'], [n.summary for n in notifs])
+        relayed = protocol.Message.from_frame(notifs[1].to_frame())
+        self.assertEqual('some-uuid', relayed.id)
+        self.assertEqual('[host]app', relayed.app_name)
+        self.assertEqual('two', relayed.summary)
+        self.assertEqual('body', relayed.body)
+        reply = protocol.Message.from_frame(mock_send_frame.call_args[0][0])
+        self.assertEqual('accepted_batch', reply.msg_type)
+        self.assertEqual(['id1', 'some-uuid'], reply.ids)
+        self.assertEqual(3, reply.seq)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    def test_notify_batch_bad_type(self, mock_close, mock_send_frame,
+                                   mock_init):
+        msg = protocol.Message('notify_batch', seq=3, notifications=[
+            protocol.Message('notify', app_name='app', summary='one',
+                             body='body').to_frame(),
+            protocol.Message('goodbye').to_frame(),
+        ])
+        app = self._batch_app(False)
+
+        app.notify_batch(msg)
+
+        self.assertFalse(app.server.submit_batch.called)
+        reply = protocol.Message.from_frame(mock_send_frame.call_args[0][0])
+        self.assertEqual('error', reply.msg_type)
+        self.assertEqual('Failed to decode notification batch: unexpected '
+                         'message type "goodbye"', reply.reason)
+        self.assertEqual(3, reply.seq)
+        mock_close.assert_called_once_with()
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    def test_notify_batch_failure(self, mock_close, mock_send_frame,
+                                  mock_init):
+        msg = protocol.Message('notify_batch', notifications=[
+            protocol.Message('notify', app_name='app', summary='one',
+                             body='body').to_frame(),
+        ])
+        app = self._batch_app()
+        app.server.submit_batch.side_effect = TestException('failed')
+
+        app.notify_batch(msg)
+
+        reply = protocol.Message.from_frame(mock_send_frame.call_args[0][0])
+        self.assertEqual('error', reply.msg_type)
+        self.assertEqual('Failed to submit notifications: failed',
+                         reply.reason)
+        self.assertFalse(mock_close.called)
+
     @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'frame',
     }))
     @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
     @mock.patch.object(hub.HubApplication, 'send_frame')
     @mock.patch.object(hub.HubApplication, 'close')
-    def test_subscribe_success(self, mock_close, mock_send_frame, mock_init,
-                               mock_Message):
-        msg = mock.Mock(version=1)
+    @mock.patch.object(hub.HubApplication, '_set_framing')
+    def test_hello(self, mock_set_framing, mock_close, mock_send_frame,
+                   mock_init, mock_Message):
         app = hub.HubApplication()
         app.persist = False
-        app.server = mock.Mock()
+
+        app.hello(mock.Mock(capabilities=['length-framing', 'other']))
+
+        self.assertEqual(frozenset(['length-framing']), app.capabilities)
+        mock_Message.assert_called_once_with(
+            'hello', capabilities=('length-framing',))
+        mock_Message.return_value.to_frame.assert_called_once_with()
+        mock_send_frame.assert_called_once_with('frame', compress=False)
+        mock_set_framing.assert_called_once_with()
+        self.assertFalse(mock_close.called)
+        self.assertEqual(True, app.persist)
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_set_framing_cobs(self, mock_init):
+        app = hub.HubApplication()
+        app.capabilities = frozenset(['batch'])
+        app.framer = hub.COBS_FRAMER
+        app.parent = mock.Mock(recv_framer=hub.COBS_FRAMER)
+
+        app._set_framing()
+
+        self.assertEqual(hub.COBS_FRAMER, app.framer)
+        self.assertEqual(hub.COBS_FRAMER, app.parent.recv_framer)
+
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    def test_set_framing_length(self, mock_init):
+        app = hub.HubApplication()
+        app.capabilities = frozenset(['batch', 'length-framing'])
+        app.framer = hub.COBS_FRAMER
+        app.parent = mock.Mock(recv_framer=hub.COBS_FRAMER)
+
+        app._set_framing()
+
+        self.assertEqual(hub.LENGTH_FRAMER, app.framer)
+        self.assertEqual(hub.LENGTH_FRAMER, app.parent.recv_framer)
+        self.assertEqual('\x00\x00\x00\x05frame', app.streamify('frame'))
+
+    @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'frame',
+    }))
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    @mock.patch.object(hub.HubApplication, '_set_framing')
+    def test_subscribe_success(self, mock_set_framing, mock_close,
+                               mock_send_frame, mock_init, mock_Message):
+        msg = mock.Mock(version=1, capabilities=['batch', 'other'],
+                        categories=['network.*'], min_urgency=1,
+                        app_names=['app*'], hosts=[], epoch='epoch',
+                        since=5)
+        app = hub.HubApplication()
+        app.persist = False
+        app.server = mock.Mock(ring=mock.Mock(epoch='epoch', cursor=7), **{
+            'missed.return_value': (['missed'], True),
+            'replay_limit.return_value': 1,
+        })
+        calls = mock.Mock()
+        calls.attach_mock(mock_send_frame, 'send_frame')
+        calls.attach_mock(mock_set_framing, '_set_framing')
+        calls.attach_mock(app.server.replay, 'replay')
 
         app.subscribe(msg)
 
-        app.server.subscribe.assert_called_once_with(app, 1)
-        mock_Message.assert_called_once_with('subscribed')
+        self.assertEqual(frozenset(['batch']), app.capabilities)
+        app.server.subscribe.assert_called_once_with(app, 1, mock.ANY)
+        sub_filter = app.server.subscribe.call_args[0][2]
+        self.assertEqual(('network.*',), sub_filter.categories)
+        self.assertEqual(1, sub_filter.min_urgency)
+        self.assertEqual(('app*',), sub_filter.app_names)
+        self.assertEqual((), sub_filter.hosts)
+        app.server.replay_limit.assert_called_once_with(app)
+        app.server.missed.assert_called_once_with(sub_filter, 'epoch', 5, 1)
+        mock_Message.assert_called_once_with(
+            'subscribed', capabilities=('batch',), epoch='epoch', cursor=7,
+            gap=True)
         mock_Message.return_value.to_frame.assert_called_once_with()
-        mock_send_frame.assert_called_once_with('frame')
+        self.assertEqual([
+            mock.call.send_frame('frame', compress=False),
+            mock.call._set_framing(),
+            mock.call.replay(app, ['missed']),
+        ], calls.mock_calls)
         self.assertFalse(mock_close.called)
         self.assertEqual(True, app.persist)
 
@@ -699,22 +1969,51 @@ class HubApplicationTest(unittest.TestCase):
     @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
     @mock.patch.object(hub.HubApplication, 'send_frame')
     @mock.patch.object(hub.HubApplication, 'close')
-    def test_subscribe_failure(self, mock_close, mock_send_frame, mock_init,
-                               mock_Message):
-        msg = mock.Mock(version=1)
+    def test_subscribe_bad_filter(self, mock_close, mock_send_frame,
+                                  mock_init, mock_Message):
+        msg = mock.Mock(version=1, capabilities=(), categories=('a.*.b',),
+                        min_urgency=None, app_names=(), hosts=())
+        app = hub.HubApplication()
+        app.persist = False
+        app.server = mock.Mock()
+
+        app.subscribe(msg)
+
+        self.assertFalse(app.server.subscribe.called)
+        mock_Message.assert_called_once_with(
+            'error', reason="Failed to subscribe: invalid category "
+            "pattern 'a.*.b'")
+        mock_send_frame.assert_called_once_with('frame', compress=False)
+        mock_close.assert_called_once_with()
+
+    @mock.patch('heyu.protocol.Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'frame',
+    }))
+    @mock.patch.object(hub.HubApplication, '__init__', return_value=None)
+    @mock.patch.object(hub.HubApplication, 'send_frame')
+    @mock.patch.object(hub.HubApplication, 'close')
+    @mock.patch.object(hub.HubApplication, '_set_framing')
+    def test_subscribe_failure(self, mock_set_framing, mock_close,
+                               mock_send_frame, mock_init, mock_Message):
+        msg = mock.Mock(version=1, capabilities=(), categories=(),
+                        min_urgency=None, app_names=(), hosts=())
         app = hub.HubApplication()
         app.persist = False
         app.server = mock.Mock(**{
+            'missed.return_value': ([], False),
             'subscribe.side_effect': TestException('failed'),
         })
 
         app.subscribe(msg)
 
-        app.server.subscribe.assert_called_once_with(app, 1)
+        app.server.subscribe.assert_called_once_with(app, 1, mock.ANY)
+        self.assertFalse(app.server.missed.called)
+        app.server.unsubscribe.assert_called_once_with(app)
         mock_Message.assert_called_once_with(
             'error', reason='Failed to subscribe: failed')
         mock_Message.return_value.to_frame.assert_called_once_with()
-        mock_send_frame.assert_called_once_with('frame')
+        mock_send_frame.assert_called_once_with('frame', compress=False)
+        self.assertFalse(mock_set_framing.called)
         mock_close.assert_called_once_with()
         self.assertEqual(False, app.persist)
 
@@ -772,14 +2071,29 @@ class StartHubTest(unittest.TestCase):
     def test_basic(self, mock_HubServer):
         hub.start_hub(['ep1', 'ep2', 'ep3'])
 
-        mock_HubServer.assert_called_once_with(['ep1', 'ep2', 'ep3'])
+        mock_HubServer.assert_called_once_with(
+            ['ep1', 'ep2', 'ep3'], hub.QUEUE_SIZE, hub.OVERFLOW_DROP_OLDEST,
+            hub.REPLAY_SIZE, hub.REPLAY_BYTES, None)
         mock_HubServer.return_value.start.assert_called_once_with(None, True)
 
+    @mock.patch.object(hub.journal, 'Journal', return_value='log')
+    @mock.patch.object(hub, 'HubServer')
+    def test_log(self, mock_HubServer, mock_Journal):
+        hub.start_hub(['ep1'], log_dir='/log', log_size=100, log_age=0)
+
+        mock_Journal.assert_called_once_with('/log', max_size=100, max_age=0)
+        mock_HubServer.assert_called_once_with(
+            ['ep1'], hub.QUEUE_SIZE, hub.OVERFLOW_DROP_OLDEST,
+            hub.REPLAY_SIZE, hub.REPLAY_BYTES, 'log')
+
     @mock.patch.object(hub, 'HubServer')
     def test_alts(self, mock_HubServer):
-        hub.start_hub(['ep1', 'ep2', 'ep3'], 'cert_conf', False)
+        hub.start_hub(['ep1', 'ep2', 'ep3'], 'cert_conf', False, 5,
+                      hub.OVERFLOW_DISCONNECT, 10, 1000)
 
-        mock_HubServer.assert_called_once_with(['ep1', 'ep2', 'ep3'])
+        mock_HubServer.assert_called_once_with(
+            ['ep1', 'ep2', 'ep3'], 5, hub.OVERFLOW_DISCONNECT, 10, 1000,
+            None)
         mock_HubServer.return_value.start.assert_called_once_with(
             'cert_conf', False)
 
@@ -791,6 +2105,7 @@ class NormalizeArgsTest(unittest.TestCase):
     def test_no_endpoints_v4(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
             endpoints=[],
+            log_dir=None,
             daemon=True,
             debug=False,
             pid_file=None,
@@ -808,6 +2123,7 @@ class NormalizeArgsTest(unittest.TestCase):
     def test_no_endpoints_v6(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
             endpoints=[],
+            log_dir=None,
             daemon=True,
             debug=False,
             pid_file=None,
@@ -825,6 +2141,7 @@ class NormalizeArgsTest(unittest.TestCase):
     @mock.patch.object(util, 'daemonize')
     def test_with_endpoints(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
+            log_dir=None,
             endpoints=['ep1', 'ep2', 'ep3'],
             daemon=True,
             debug=False,
@@ -842,12 +2159,31 @@ class NormalizeArgsTest(unittest.TestCase):
         ])
         mock_daemonize.assert_called_once_with(pidfile=None)
 
+    @mock.patch('os.path.expanduser', side_effect=lambda x: '/home' + x[1:])
+    @mock.patch('os.path.abspath', side_effect=lambda x: '/abs' + x)
+    @mock.patch.object(util, 'parse_hub', side_effect=lambda x: x)
+    @mock.patch.object(util, 'daemonize')
+    def test_log_dir(self, mock_daemonize, mock_parse_hub, mock_abspath,
+                     mock_expanduser):
+        args = mock.Mock(
+            log_dir='~/log',
+            endpoints=['ep1'],
+            daemon=False,
+            debug=False,
+            pid_file=None,
+        )
+
+        hub._normalize_args(args)
+
+        self.assertEqual('/abs/home/log', args.log_dir)
+
     @mock.patch('socket.has_ipv6', True)
     @mock.patch.object(util, 'parse_hub', side_effect=lambda x: x)
     @mock.patch.object(util, 'daemonize')
     def test_daemonize_debug(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
             endpoints=[],
+            log_dir=None,
             daemon=True,
             debug=True,
             pid_file=None,
@@ -866,6 +2202,7 @@ class NormalizeArgsTest(unittest.TestCase):
     def test_daemonize_nodaemon(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
             endpoints=[],
+            log_dir=None,
             daemon=False,
             debug=False,
             pid_file=None,
@@ -884,6 +2221,7 @@ class NormalizeArgsTest(unittest.TestCase):
     def test_daemonize_pidfile(self, mock_daemonize, mock_parse_hub):
         args = mock.Mock(
             endpoints=[],
+            log_dir=None,
             daemon=True,
             debug=False,
             pid_file='/path/to/pid',
@@ -0,0 +1,304 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from heyu import journal
+from heyu import protocol
+
+
+def notif(cursor):
+    return protocol.Message('notify', app_name='[host]app',
+                            summary='summary %d' % cursor, body='body',
+                            id='id%d' % cursor, cursor=cursor)
+
+
+def cursors(frames):
+    return [protocol.Message.from_frame(frame).cursor for frame in frames]
+
+
+def record(cursor):
+    frame = notif(cursor).to_frame()
+    return journal.RECORD_HEADER.pack(
+        journal.RECORD_MAGIC, cursor, len(frame),
+        journal.zlib.crc32(frame) & 0xffffffff) + frame
+
+
+class ScanTest(unittest.TestCase):
+    def test_scan(self):
+        data = record(1) + record(2)
+
+        result = list(journal._scan(data, 0, len(data)))
+
+        self.assertEqual([
+            (1, 0, journal.RECORD_HEADER.size, len(record(1))),
+            (2, len(record(1)), len(record(1)) + journal.RECORD_HEADER.size,
+             len(data)),
+        ], result)
+
+    def test_incomplete(self):
+        data = record(1) + record(2)[:-1]
+
+        self.assertEqual([1], [c for c, _p, _s, _e in
+                               journal._scan(data, 0, len(data))])
+
+    def test_damaged(self):
+        data = record(1) + record(2)[:-1] + 'x' + record(3)
+
+        self.assertEqual([1], [c for c, _p, _s, _e in
+                               journal._scan(data, 0, len(data))])
+
+
+class SegmentTest(unittest.TestCase):
+    def test_index(self):
+        seg = journal.Segment('/log', 10)
+        entries = [seg.index(10 + i, i * 100)
+                   for i in range(journal.INDEX_INTERVAL + 1)]
+
+        self.assertEqual('/log/0000000000000010.log', seg.path)
+        self.assertEqual('/log/0000000000000010.idx', seg.index_path)
+        self.assertEqual(journal.INDEX_ENTRY.pack(10, 0), entries[0])
+        self.assertEqual(
+            journal.INDEX_ENTRY.pack(10 + journal.INDEX_INTERVAL,
+                                     journal.INDEX_INTERVAL * 100),
+            entries[-1])
+        self.assertEqual([''] * (journal.INDEX_INTERVAL - 1), entries[1:-1])
+        self.assertEqual([10, 10 + journal.INDEX_INTERVAL], seg.cursors)
+
+    def test_load_index(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        seg = journal.Segment(path, 1)
+        with open(seg.index_path, 'wb') as f:
+            f.write(journal.INDEX_ENTRY.pack(1, 0) +
+                    journal.INDEX_ENTRY.pack(65, 500) +
+                    journal.INDEX_ENTRY.pack(129, 1000) + 'xx')
+        seg.size = 1000
+
+        seg.load_index()
+
+        self.assertEqual([1, 65], seg.cursors)
+        self.assertEqual([0, 500], seg.offsets)
+
+
+@mock.patch.object(journal, 'INDEX_INTERVAL', 4)
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _journal(self, count=0, **kwargs):
+        log = journal.Journal(self.path, **kwargs)
+        for i in range(1, count + 1):
+            log.append(notif(i))
+        log.close()
+        return log
+
+    def _files(self):
+        return sorted(os.listdir(self.path))
+
+    def test_init_empty(self):
+        log = journal.Journal(os.path.join(self.path, 'log'))
+
+        self.assertEqual(0, log.cursor)
+        self.assertEqual(1, log.oldest)
+        self.assertEqual([], log.since(0))
+        with open(os.path.join(self.path, 'log', 'epoch')) as f:
+            self.assertEqual(log.epoch + '\n', f.read())
+
+    def test_append_since(self):
+        log = self._journal(10)
+
+        self.assertEqual(['0000000000000001.idx', '0000000000000001.log',
+                          'epoch'], self._files())
+        self.assertEqual(10, log.cursor)
+        self.assertEqual([1, 5, 9], log._segments[0].cursors)
+        self.assertEqual(range(1, 11), cursors(log.since(0)))
+        self.assertEqual([6, 7, 8], cursors(log.since(5, 8)))
+        self.assertEqual([], log.since(10))
+
+    def test_pending(self):
+        log = self._journal(3)
+
+        for i in range(4, 7):
+            log.append(notif(i))
+        log._writing, log._pending = log._pending[:2], log._pending[2:]
+
+        self.assertEqual([3, 4, 5, 6], cursors(log.since(2)))
+        self.assertEqual([3, 4], cursors(log.since(2, 4)))
+
+    def test_flush(self):
+        log = journal.Journal(self.path)
+        log.start()
+
+        log.append(notif(1))
+        log.append(notif(2))
+        log.flush()
+
+        self.assertEqual([], log._pending)
+        self.assertEqual(os.path.getsize(log._segments[0].path),
+                         log._segments[0].size)
+        log.close()
+        self.assertEqual(None, log._writer)
+
+    def test_rotation(self):
+        size = len(record(1))
+        log = self._journal(5, segment_size=size * 2)
+
+        self.assertEqual([1, 3, 5], [seg.first for seg in log._segments])
+        self.assertEqual([2, 3], cursors(log.since(1, 3)))
+        self.assertEqual(range(1, 6), cursors(log.since(0)))
+
+    def test_recover(self):
+        size = len(record(1))
+        old = self._journal(10, segment_size=size * 4)
+
+        log = journal.Journal(self.path, segment_size=size * 4)
+
+        self.assertEqual(old.epoch, log.epoch)
+        self.assertEqual(10, log.cursor)
+        self.assertEqual(1, log.oldest)
+        self.assertEqual(range(1, 11), cursors(log.since(0)))
+
+        # Appends go to a new segment
+        log.append(notif(11))
+        log.close()
+        self.assertEqual([1, 5, 9, 11], [seg.first for seg in log._segments])
+        self.assertEqual(range(1, 12), cursors(log.since(0)))
+
+    @mock.patch.object(journal, '_scan', side_effect=journal._scan)
+    def test_recover_sparse(self, mock_scan):
+        self._journal(10)
+        first = journal.Segment(self.path, 1)
+
+        journal.Journal(self.path)
+
+        # Only the records after the last index entry are scanned
+        (data, pos, size), _kwargs = mock_scan.call_args
+        self.assertEqual(0, pos)
+        self.assertEqual(len(record(9)) + len(record(10)), size)
+        with open(first.index_path, 'rb') as f:
+            self.assertEqual(3 * journal.INDEX_ENTRY.size, len(f.read()))
+
+    def test_recover_torn(self):
+        self._journal(5)
+        seg = journal.Segment(self.path, 1)
+        with open(seg.path, 'ab') as f:
+            f.write(record(6)[:-2])
+        os.unlink(seg.index_path)
+
+        log = journal.Journal(self.path)
+
+        self.assertEqual(5, log.cursor)
+        self.assertEqual(sum(len(record(i)) for i in range(1, 6)),
+                         os.path.getsize(seg.path))
+        self.assertEqual([1, 5], log._segments[0].cursors)
+        with open(seg.index_path, 'rb') as f:
+            self.assertEqual(2 * journal.INDEX_ENTRY.size, len(f.read()))
+
+    def test_recover_empty_segment(self):
+        self._journal(3)
+        open(os.path.join(self.path, '0000000000000004.log'), 'w').close()
+
+        log = journal.Journal(self.path)
+        self.assertEqual(3, log.cursor)
+        log.append(notif(4))
+        log.append(notif(5))
+        log.close()
+
+        self.assertEqual([1, 4], [seg.first for seg in log._segments])
+        self.assertEqual(range(1, 6), cursors(log.since(0)))
+
+    def test_recover_missing_epoch(self):
+        old = self._journal(3)
+        os.unlink(os.path.join(self.path, 'epoch'))
+
+        log = journal.Journal(self.path)
+
+        self.assertNotEqual(old.epoch, log.epoch)
+        self.assertEqual(3, log.cursor)
+
+    def test_since_sparse(self):
+        log = self._journal(10)
+        seg = log._segments[0]
+
+        with mock.patch.object(journal, '_scan',
+                               side_effect=journal._scan) as mock_scan:
+            self.assertEqual([7, 8], cursors(log.since(6, 8)))
+
+        (data, pos, size), _kwargs = mock_scan.call_args
+        self.assertEqual(seg.offsets[1], pos)
+
+    def test_since_limit(self):
+        size = len(record(1))
+        log = self._journal(200, segment_size=size * 10)
+
+        with mock.patch.object(journal, '_scan',
+                               side_effect=journal._scan) as mock_scan:
+            self.assertEqual([6, 7, 8], cursors(log.since(5, limit=3)))
+            self.assertEqual([9, 10, 11, 12],
+                             cursors(log.since(8, 150, limit=4)))
+
+        # Only the segments holding the notifications wanted are read
+        self.assertEqual(3, mock_scan.call_count)
+
+    def test_since_limit_pending(self):
+        log = self._journal(3)
+        log._pending = [(4, notif(4).to_frame()), (5, notif(5).to_frame())]
+
+        self.assertEqual([2, 3, 4], cursors(log.since(1, 5, limit=3)))
+
+    def test_expire_size(self):
+        size = len(record(1))
+        log = self._journal(6, segment_size=size, max_size=size * 3)
+
+        self.assertEqual([4, 5, 6], [seg.first for seg in log._segments])
+        self.assertEqual(4, log.oldest)
+        self.assertEqual(None, log.since(2))
+        self.assertEqual([4, 5, 6], cursors(log.since(3)))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, '0000000000000001.idx')))
+
+    def test_expire_age(self):
+        size = len(record(1))
+        log = self._journal(2, segment_size=size, max_age=60)
+        old = time.time() - 120
+        os.utime(log._segments[0].path, (old, old))
+
+        log.append(notif(3))
+        log.close()
+
+        self.assertEqual([2, 3], [seg.first for seg in log._segments])
+
+    def test_expire_keeps_active(self):
+        log = self._journal(3, max_size=1)
+
+        self.assertEqual([1], [seg.first for seg in log._segments])
+
+    @mock.patch.object(journal, '_write_chunks',
+                       side_effect=OSError(28, 'No space left on device'))
+    def test_write_failed(self, mock_write_chunks):
+        log = self._journal(2)
+
+        self.assertEqual(2, log.failed)
+        self.assertEqual([], log._writing)
+        self.assertEqual(None, log._fd)
+        self.assertEqual([], log.since(0))
@@ -13,11 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import io
+import os
+import shutil
 import signal
 import sys
+import tempfile
 import unittest
 
+import gevent
+import gevent.event
+import gevent.subprocess
 import mock
 
 from heyu import notifier
@@ -29,6 +36,12 @@ class TestException(Exception):
     pass
 
 
+def queue(*items):
+    result = util.CoalescingQueue()
+    result.extend(items)
+    return result
+
+
 class NotifierServerTest(unittest.TestCase):
     def _signal_test(self, notifier_server, mock_signal):
         signals = [
@@ -56,9 +69,18 @@ class NotifierServerTest(unittest.TestCase):
         self.assertEqual('wrapper', result._wrapper)
         self.assertEqual('notifier.py', result._app_name)
         self.assertEqual('some-uuid', result._app_id)
+        self.assertEqual({}, result._filters)
         self.assertEqual(None, result._hub_app)
-        self.assertEqual([], result._notifications)
+        self.assertEqual([], result._driver_queues)
+        self.assertEqual([], list(result._notifications))
         self.assertEqual('event', result._notify_event)
+        self.assertEqual(notifier.QUEUE_SIZE, result._queue_size)
+        self.assertEqual(notifier.OVERFLOW_DROP_OLDEST, result._overflow)
+        self.assertEqual(0, result.dropped)
+        self.assertEqual(None, result._backoff)
+        self.assertEqual(None, result._retry)
+        self.assertEqual(None, result._epoch)
+        self.assertEqual(None, result._cursor)
         mock_outgoing_endpoint.assert_called_once_with('hub')
         mock_get_manager.assert_called_once_with('tcp', 'endpoint')
         mock_cert_wrapper.assert_called_once_with(
@@ -75,16 +97,34 @@ class NotifierServerTest(unittest.TestCase):
     def test_init_alt(self, mock_outgoing_endpoint, mock_cert_wrapper,
                       mock_Event, mock_uuid4, mock_signal, mock_get_manager):
         result = notifier.NotifierServer('hub', 'cert_conf', False, 'app',
-                                         'app-uuid')
+                                         'app-uuid', [
+                                             ('categories', 'network.*'),
+                                             ('min_urgency', 0),
+                                             ('categories', 'build'),
+                                             ('min_urgency', 1),
+                                             ('hosts', 'host*'),
+                                         ], 5, notifier.OVERFLOW_DROP_NEWEST,
+                                         True, 60, 10, 2)
 
         self.assertEqual('hub', result._hub)
         self.assertEqual('manager', result._manager)
         self.assertEqual('wrapper', result._wrapper)
         self.assertEqual('app', result._app_name)
         self.assertEqual('app-uuid', result._app_id)
+        self.assertEqual({
+            'categories': ['network.*', 'build'],
+            'min_urgency': 1,
+            'hosts': ['host*'],
+        }, result._filters)
         self.assertEqual(None, result._hub_app)
-        self.assertEqual([], result._notifications)
+        self.assertEqual([], list(result._notifications))
         self.assertEqual('event', result._notify_event)
+        self.assertEqual(5, result._queue_size)
+        self.assertEqual(notifier.OVERFLOW_DROP_NEWEST, result._overflow)
+        self.assertEqual((60, 10, 2), (result._backoff.max_sleep,
+                                       result._backoff.threshold,
+                                       result._backoff.recover))
+        self.assertEqual(None, result._retry)
         mock_outgoing_endpoint.assert_called_once_with('hub')
         mock_get_manager.assert_called_once_with('tcp', 'endpoint')
         mock_cert_wrapper.assert_called_once_with(
@@ -117,7 +157,7 @@ class NotifierServerTest(unittest.TestCase):
     @mock.patch.object(sys, 'exit', side_effect=TestException())
     def test_next_notification(self, mock_exit, mock_init):
         server = notifier.NotifierServer()
-        server._notifications = ['notification']
+        server._notifications = queue('notification')
         server._notify_event = mock.Mock()
         server._hub_app = None
 
@@ -130,7 +170,7 @@ class NotifierServerTest(unittest.TestCase):
     @mock.patch.object(sys, 'exit', side_effect=TestException())
     def test_next_exit(self, mock_exit, mock_init):
         server = notifier.NotifierServer()
-        server._notifications = [None]
+        server._notifications = queue(None)
         server._notify_event = mock.Mock()
         server._hub_app = None
 
@@ -142,7 +182,7 @@ class NotifierServerTest(unittest.TestCase):
     @mock.patch.object(sys, 'exit', side_effect=TestException())
     def test_next_empty_stop(self, mock_exit, mock_init):
         server = notifier.NotifierServer()
-        server._notifications = []
+        server._notifications = queue()
         server._notify_event = mock.Mock()
         server._hub_app = None
 
@@ -156,12 +196,13 @@ class NotifierServerTest(unittest.TestCase):
     @mock.patch.object(sys, 'exit', side_effect=TestException())
     def test_next_empty_loop(self, mock_exit, mock_init):
         server = notifier.NotifierServer()
-        server._notifications = []
+        server._notifications = queue()
         server._notify_event = mock.Mock()
         server._hub_app = 'app'
 
-        def fake_wait():
+        def fake_wait(timeout):
             server._notifications.append('waited')
+            return True
         server._notify_event.wait.side_effect = fake_wait
 
         result = server.next()
@@ -169,10 +210,60 @@ class NotifierServerTest(unittest.TestCase):
         self.assertEqual('waited', result)
         server._notify_event.assert_has_calls([
             mock.call.clear(),
-            mock.call.wait(),
+            mock.call.wait(None),
         ])
         self.assertEqual(2, len(server._notify_event.method_calls))
 
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(sys, 'exit', side_effect=TestException())
+    def test_next_batch(self, mock_exit, mock_init):
+        server = notifier.NotifierServer()
+        server._notifications = queue('n1', 'n2', 'n3')
+        server._notify_event = mock.Mock()
+        server._hub_app = 'app'
+
+        self.assertEqual(['n1', 'n2'], server.next_batch(2))
+        self.assertEqual(['n3'], server.next_batch(2))
+        self.assertEqual(0, len(server._notify_event.method_calls))
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(sys, 'exit', side_effect=TestException())
+    def test_next_batch_exit(self, mock_exit, mock_init):
+        server = notifier.NotifierServer()
+        server._notifications = queue('n1', None)
+        server._notify_event = mock.Mock()
+        server._hub_app = None
+
+        self.assertEqual(['n1'], server.next_batch(5))
+        self.assertFalse(mock_exit.called)
+        self.assertRaises(TestException, server.next_batch, 5)
+        mock_exit.assert_called_once_with()
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(sys, 'exit', side_effect=TestException())
+    def test_next_batch_timeout(self, mock_exit, mock_init):
+        server = notifier.NotifierServer()
+        server._notifications = queue()
+        server._notify_event = mock.Mock(**{'wait.return_value': False})
+        server._hub_app = 'app'
+
+        self.assertEqual([], server.next_batch(5, 0.5))
+        server._notify_event.assert_has_calls([
+            mock.call.clear(),
+            mock.call.wait(0.5),
+        ])
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(sys, 'exit', side_effect=TestException())
+    def test_next_batch_stopped(self, mock_exit, mock_init):
+        server = notifier.NotifierServer()
+        server._notifications = queue()
+        server._notify_event = mock.Mock()
+        server._hub_app = None
+
+        self.assertRaises(StopIteration, server.next_batch, 5, 0.5)
+        self.assertFalse(server._notify_event.wait.called)
+
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     @mock.patch.object(notifier, 'NotifierApplication', return_value='app')
     def test_acceptor(self, mock_NotifierApplication, mock_init):
@@ -180,12 +271,15 @@ class NotifierServerTest(unittest.TestCase):
         server._hub_app = True
         server._app_name = 'app_name'
         server._app_id = 'app_id'
+        server._filters = 'filters'
+        server._epoch = 'epoch'
+        server._cursor = 5
 
         result = server._acceptor('tendril')
 
         self.assertEqual('app', result)
         mock_NotifierApplication.assert_called_once_with(
-            'tendril', server, 'app_name', 'app_id')
+            'tendril', server, 'app_name', 'app_id', 'filters', 'epoch', 5)
 
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     def test_start_running(self, mock_init):
@@ -216,18 +310,120 @@ class NotifierServerTest(unittest.TestCase):
         ])
         self.assertEqual(2, len(server._manager.method_calls))
 
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_connect_failed(self, mock_init):
+        server = notifier.NotifierServer()
+        server._manager = mock.Mock(**{
+            'connect.side_effect': TestException('refused'),
+        })
+        server._hub = 'hub'
+        server._wrapper = 'wrapper'
+        server._backoff = None
+        server._retry = 'retry'
+
+        self.assertRaises(TestException, server._connect)
+        self.assertEqual(None, server._retry)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(notifier.NotifierServer, '_reconnect')
+    def test_connect_failed_reconnect(self, mock_reconnect, mock_init):
+        server = notifier.NotifierServer()
+        server._manager = mock.Mock(**{
+            'connect.side_effect': TestException('refused'),
+        })
+        server._hub = 'hub'
+        server._wrapper = 'wrapper'
+        server._backoff = 'backoff'
+        server._retry = 'retry'
+
+        server._connect()
+
+        server._manager.connect.assert_called_once_with(
+            'hub', server._acceptor, 'wrapper')
+        mock_reconnect.assert_called_once_with()
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch('gevent.spawn_later', return_value='retry')
+    def test_reconnect(self, mock_spawn_later, mock_init):
+        server = notifier.NotifierServer()
+        server._hub_app = 'app'
+        server._backoff = mock.Mock(**{'next_delay.return_value': 4.5})
+        server._retry = None
+
+        server._reconnect()
+
+        self.assertEqual(True, server._hub_app)
+        self.assertEqual('retry', server._retry)
+        mock_spawn_later.assert_called_once_with(4.5, server._connect)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch('gevent.spawn_later', return_value='retry')
+    def test_reconnect_stopped(self, mock_spawn_later, mock_init):
+        server = notifier.NotifierServer()
+        server._hub_app = None
+        server._backoff = mock.Mock()
+        server._retry = None
+
+        server._reconnect()
+
+        self.assertEqual(None, server._hub_app)
+        self.assertEqual(None, server._retry)
+        self.assertFalse(mock_spawn_later.called)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(notifier.NotifierServer, 'stop')
+    @mock.patch.object(notifier.NotifierServer, '_reconnect')
+    def test_disconnected(self, mock_reconnect, mock_stop, mock_init):
+        server = notifier.NotifierServer()
+        server._hub_app = 'app'
+        server._backoff = None
+
+        server.disconnected('app')
+
+        mock_stop.assert_called_once_with()
+        self.assertFalse(mock_reconnect.called)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(notifier.NotifierServer, 'stop')
+    @mock.patch.object(notifier.NotifierServer, '_reconnect')
+    def test_disconnected_reconnect(self, mock_reconnect, mock_stop,
+                                    mock_init):
+        server = notifier.NotifierServer()
+        server._hub_app = 'app'
+        server._backoff = 'backoff'
+
+        server.disconnected('app')
+
+        mock_reconnect.assert_called_once_with()
+        self.assertFalse(mock_stop.called)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(notifier.NotifierServer, 'stop')
+    @mock.patch.object(notifier.NotifierServer, '_reconnect')
+    def test_disconnected_stale(self, mock_reconnect, mock_stop, mock_init):
+        server = notifier.NotifierServer()
+        server._hub_app = True
+        server._backoff = 'backoff'
+
+        server.disconnected('app')
+
+        self.assertFalse(mock_reconnect.called)
+        self.assertFalse(mock_stop.called)
+
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     def test_stop_stopped(self, mock_init):
         server = notifier.NotifierServer()
         server._hub_app = None
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.stop()
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([], server._notifications)
+        self.assertEqual([], list(server._notifications))
         self.assertEqual(0, len(server._manager.method_calls))
         self.assertEqual(0, len(server._notify_event.method_calls))
 
@@ -237,13 +433,15 @@ class NotifierServerTest(unittest.TestCase):
         server = notifier.NotifierServer()
         server._hub_app = app
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.stop()
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([], server._notifications)
+        self.assertEqual([], list(server._notifications))
         server._manager.stop.assert_called_once_with()
         self.assertEqual(1, len(server._manager.method_calls))
         app.disconnect.assert_called_once_with()
@@ -256,13 +454,15 @@ class NotifierServerTest(unittest.TestCase):
         server = notifier.NotifierServer()
         server._hub_app = True
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.stop()
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([], server._notifications)
+        self.assertEqual([], list(server._notifications))
         server._manager.stop.assert_called_once_with()
         self.assertEqual(1, len(server._manager.method_calls))
         server._notify_event.set.assert_called_once_with()
@@ -274,13 +474,15 @@ class NotifierServerTest(unittest.TestCase):
         server = notifier.NotifierServer()
         server._hub_app = app
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.stop('signal', 'arguments')
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([None], server._notifications)
+        self.assertEqual([None], list(server._notifications))
         server._manager.stop.assert_called_once_with()
         self.assertEqual(1, len(server._manager.method_calls))
         app.disconnect.assert_called_once_with()
@@ -288,18 +490,38 @@ class NotifierServerTest(unittest.TestCase):
         server._notify_event.set.assert_called_once_with()
         self.assertEqual(1, len(server._notify_event.method_calls))
 
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_stop_reconnecting(self, mock_init):
+        retry = mock.Mock()
+        server = notifier.NotifierServer()
+        server._hub_app = True
+        server._manager = mock.Mock()
+        server._retry = retry
+        server._notifications = queue()
+        server._notify_event = mock.Mock()
+        server._driver_queues = []
+
+        server.stop()
+
+        self.assertEqual(None, server._hub_app)
+        self.assertEqual(None, server._retry)
+        retry.kill.assert_called_once_with()
+        server._manager.stop.assert_called_once_with()
+
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     def test_shutdown_stopped(self, mock_init):
         server = notifier.NotifierServer()
         server._hub_app = None
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.shutdown()
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([], server._notifications)
+        self.assertEqual([], list(server._notifications))
         self.assertEqual(0, len(server._manager.method_calls))
         self.assertEqual(0, len(server._notify_event.method_calls))
 
@@ -308,13 +530,15 @@ class NotifierServerTest(unittest.TestCase):
         server = notifier.NotifierServer()
         server._hub_app = 'running'
         server._manager = mock.Mock()
-        server._notifications = []
+        server._retry = None
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
 
         server.shutdown()
 
         self.assertEqual(None, server._hub_app)
-        self.assertEqual([None], server._notifications)
+        self.assertEqual([None], list(server._notifications))
         server._manager.shutdown.assert_called_once_with()
         self.assertEqual(1, len(server._manager.method_calls))
         server._notify_event.set.assert_called_once_with()
@@ -322,16 +546,127 @@ class NotifierServerTest(unittest.TestCase):
 
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     def test_notify(self, mock_init):
+        msg = mock.Mock(cursor=None, id='id')
         server = notifier.NotifierServer()
-        server._notifications = []
+        server._notifications = queue()
         server._notify_event = mock.Mock()
+        server._driver_queues = []
+        server._queue_size = 2
+        server._cursor = 5
 
-        server.notify('notification')
+        server.notify(msg)
 
-        self.assertEqual(['notification'], server._notifications)
+        self.assertEqual([msg], list(server._notifications))
+        self.assertEqual(5, server._cursor)
         server._notify_event.set.assert_called_once_with()
         self.assertEqual(1, len(server._notify_event.method_calls))
 
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_notify_cursor(self, mock_init):
+        msg = mock.Mock(cursor=7, id='id')
+        server = notifier.NotifierServer()
+        server._notifications = queue()
+        server._notify_event = mock.Mock()
+        server._driver_queues = []
+        server._queue_size = 2
+        server._cursor = 5
+
+        server.notify(msg)
+
+        self.assertEqual([msg], list(server._notifications))
+        self.assertEqual(7, server._cursor)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_notify_coalesce(self, mock_init):
+        msgs = [mock.Mock(cursor=None, id=notif_id)
+                for notif_id in ('id1', 'id2', 'id1')]
+        server = notifier.NotifierServer()
+        server._notifications = queue()
+        server._notify_event = mock.Mock()
+        server._driver_queues = []
+        server._queue_size = 2
+        server._overflow = notifier.OVERFLOW_DROP_NEWEST
+        server.dropped = 0
+        server._cursor = None
+
+        for msg in msgs:
+            server.notify(msg)
+
+        self.assertEqual(msgs[1:], list(server._notifications))
+        self.assertEqual(1, server.coalesced)
+        self.assertEqual(0, server.dropped)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_notify_drop_oldest(self, mock_init):
+        msg = mock.Mock(cursor=7, id='id')
+        server = notifier.NotifierServer()
+        server._notifications = queue('n1', 'n2')
+        server._notify_event = mock.Mock()
+        server._driver_queues = []
+        server._queue_size = 2
+        server._overflow = notifier.OVERFLOW_DROP_OLDEST
+        server.dropped = 0
+        server._cursor = 5
+
+        server.notify(msg)
+
+        self.assertEqual(['n2', msg], list(server._notifications))
+        self.assertEqual(1, server.dropped)
+        self.assertEqual(7, server._cursor)
+        server._notify_event.set.assert_called_once_with()
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_notify_drop_newest(self, mock_init):
+        msg = mock.Mock(cursor=7, id='id')
+        server = notifier.NotifierServer()
+        server._notifications = queue('n1', 'n2')
+        server._notify_event = mock.Mock()
+        server._driver_queues = []
+        server._queue_size = 2
+        server._overflow = notifier.OVERFLOW_DROP_NEWEST
+        server.dropped = 0
+        server._cursor = 5
+
+        server.notify(msg)
+
+        self.assertEqual(['n1', 'n2'], list(server._notifications))
+        self.assertEqual(1, server.dropped)
+        self.assertEqual(7, server._cursor)
+        self.assertFalse(server._notify_event.set.called)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_subscribed_first(self, mock_init):
+        server = notifier.NotifierServer()
+        server._epoch = None
+        server._cursor = None
+
+        server.subscribed('epoch', 5)
+
+        self.assertEqual('epoch', server._epoch)
+        self.assertEqual(5, server._cursor)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_subscribed_same_epoch(self, mock_init):
+        server = notifier.NotifierServer()
+        server._epoch = 'epoch'
+        server._cursor = 3
+
+        server.subscribed('epoch', 5)
+
+        self.assertEqual('epoch', server._epoch)
+        self.assertEqual(3, server._cursor)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_subscribed_new_epoch(self, mock_init):
+        server = notifier.NotifierServer()
+        server._epoch = 'old'
+        server._cursor = 3
+
+        server.subscribed('new', 5)
+
+        self.assertEqual('new', server._epoch)
+        self.assertEqual(0, server._cursor)
+
     @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
     def test_app_name(self, mock_init):
         server = notifier.NotifierServer()
@@ -346,6 +681,332 @@ class NotifierServerTest(unittest.TestCase):
 
         self.assertEqual('app_id', server.app_id)
 
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    @mock.patch.object(notifier, 'DriverQueue')
+    def test_driver_queue(self, mock_DriverQueue, mock_init):
+        server = notifier.NotifierServer()
+        server._queue_size = 5
+        server._overflow = notifier.OVERFLOW_DROP_NEWEST
+        server._driver_queues = []
+
+        result = server.driver_queue()
+
+        self.assertEqual(mock_DriverQueue.return_value, result)
+        self.assertEqual([result], server._driver_queues)
+        mock_DriverQueue.assert_called_once_with(
+            server, 5, notifier.OVERFLOW_DROP_NEWEST)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_notify_driver_queues(self, mock_init):
+        msg = mock.Mock(cursor=7, id='id')
+        queues = [mock.Mock(), mock.Mock()]
+        server = notifier.NotifierServer()
+        server._notifications = queue()
+        server._notify_event = mock.Mock()
+        server._driver_queues = queues
+        server._cursor = 5
+
+        server.notify(msg)
+
+        self.assertEqual([], list(server._notifications))
+        self.assertEqual(7, server._cursor)
+        for driver_queue in queues:
+            driver_queue.put.assert_called_once_with(msg)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_stop_driver_queues(self, mock_init):
+        queues = [mock.Mock(), mock.Mock()]
+        server = notifier.NotifierServer()
+        server._hub_app = True
+        server._manager = mock.Mock()
+        server._retry = None
+        server._notify_event = mock.Mock()
+        server._driver_queues = queues
+
+        server.stop('signal', 'arguments')
+
+        self.assertEqual(0, len(server._notify_event.method_calls))
+        for driver_queue in queues:
+            driver_queue.wakeup.assert_called_once_with(True)
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_shutdown_driver_queues(self, mock_init):
+        queues = [mock.Mock(), mock.Mock()]
+        server = notifier.NotifierServer()
+        server._hub_app = True
+        server._manager = mock.Mock()
+        server._retry = None
+        server._notify_event = mock.Mock()
+        server._driver_queues = queues
+
+        server.shutdown()
+
+        self.assertEqual(0, len(server._notify_event.method_calls))
+        for driver_queue in queues:
+            driver_queue.discard.assert_called_once_with()
+
+    @mock.patch.object(notifier.NotifierServer, '__init__', return_value=None)
+    def test_running(self, mock_init):
+        server = notifier.NotifierServer()
+
+        server._hub_app = None
+        self.assertFalse(server.running)
+        server._hub_app = True
+        self.assertTrue(server.running)
+
+
+class DriverQueueTest(unittest.TestCase):
+    def test_init(self):
+        server = mock.Mock()
+
+        result = notifier.DriverQueue(server, 5, notifier.OVERFLOW_DROP_NEWEST)
+
+        self.assertEqual(server, result._server)
+        self.assertEqual([], list(result._notifications))
+        self.assertEqual(5, result._queue_size)
+        self.assertEqual(notifier.OVERFLOW_DROP_NEWEST, result._overflow)
+        self.assertEqual(0, result.dropped)
+
+    def test_start(self):
+        server = mock.Mock(running=False)
+        driver_queue = notifier.DriverQueue(server)
+
+        driver_queue.start()
+
+        server.start.assert_called_once_with()
+
+    def test_start_running(self):
+        server = mock.Mock(running=True)
+        driver_queue = notifier.DriverQueue(server)
+
+        driver_queue.start()
+
+        self.assertFalse(server.start.called)
+
+    def test_iter(self):
+        server = mock.Mock(running=False)
+        driver_queue = notifier.DriverQueue(server)
+
+        self.assertEqual(driver_queue, iter(driver_queue))
+        server.start.assert_called_once_with()
+
+    def test_next_batch_stopped(self):
+        server = mock.Mock(running=False)
+        driver_queue = notifier.DriverQueue(server)
+        driver_queue.put(mock.Mock(id='id1'))
+
+        self.assertEqual(1, len(driver_queue.next_batch(5)))
+        self.assertRaises(StopIteration, driver_queue.next_batch, 5)
+
+    def test_put_overflow(self):
+        driver_queue = notifier.DriverQueue(mock.Mock(), 2,
+                                            notifier.OVERFLOW_DROP_OLDEST)
+
+        for notif_id in ('id1', 'id2', 'id3'):
+            driver_queue.put(mock.Mock(id=notif_id))
+
+        self.assertEqual(['id2', 'id3'],
+                         [msg.id for msg in driver_queue._notifications])
+        self.assertEqual(1, driver_queue.dropped)
+
+    @mock.patch.object(sys, 'exit', side_effect=TestException())
+    def test_wakeup(self, mock_exit):
+        driver_queue = notifier.DriverQueue(mock.Mock(running=True))
+        driver_queue.put(mock.Mock(id='id1'))
+
+        driver_queue.wakeup(True)
+
+        self.assertTrue(driver_queue._notify_event.is_set())
+        self.assertEqual(1, len(driver_queue.next_batch(5)))
+        self.assertRaises(TestException, driver_queue.next_batch, 5)
+
+    def test_discard(self):
+        driver_queue = notifier.DriverQueue(mock.Mock())
+        driver_queue.put(mock.Mock(id='id1'))
+
+        driver_queue.discard()
+
+        self.assertEqual([None], list(driver_queue._notifications))
+        self.assertTrue(driver_queue._notify_event.is_set())
+
+    def test_app(self):
+        server = mock.Mock(app_name='app_name', app_id='app_id')
+        driver_queue = notifier.DriverQueue(server)
+
+        self.assertEqual('app_name', driver_queue.app_name)
+        self.assertEqual('app_id', driver_queue.app_id)
+
+
+class MergedFeedTest(unittest.TestCase):
+    def test_put(self):
+        server = mock.Mock()
+        feed = notifier._MergedFeed(server)
+
+        feed.put('msg')
+
+        server.merge.assert_called_once_with('msg')
+
+    def test_wakeup(self):
+        queues = [mock.Mock(), mock.Mock()]
+        feed = notifier._MergedFeed(mock.Mock(**{
+            '_queues.return_value': queues}))
+
+        feed.wakeup(True)
+
+        for queue in queues:
+            queue.wakeup.assert_called_once_with(True)
+
+    def test_discard(self):
+        queues = [mock.Mock(), mock.Mock()]
+        feed = notifier._MergedFeed(mock.Mock(**{
+            '_queues.return_value': queues}))
+
+        feed.discard()
+
+        for queue in queues:
+            queue.discard.assert_called_once_with()
+
+
+def hub_notif(notif_id, cursor, summary='summary', app_name='[host]app'):
+    return protocol.Message('notify', app_name=app_name, summary=summary,
+                            body='body', id=notif_id, cursor=cursor)
+
+
+class MultiHubServerTest(unittest.TestCase):
+    def _server(self, running=(False, False)):
+        server = notifier.MultiHubServer.__new__(notifier.MultiHubServer)
+        notifier.NotificationQueue.__init__(server)
+        server._seen = util.SeenSet()
+        server.duplicates = 0
+        server._servers = [mock.Mock(running=value) for value in running]
+        return server
+
+    @mock.patch.object(sys, 'argv', ['/bin/notifier.py'])
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_init(self, mock_NotifierServer, mock_uuid4):
+        servers = [mock.Mock(), mock.Mock()]
+        mock_NotifierServer.side_effect = servers
+
+        result = notifier.MultiHubServer(['hub1', 'hub2'], 'cert_conf',
+                                         filters=['filter'], queue_size=5,
+                                         reconnect=True)
+
+        self.assertEqual('notifier.py', result.app_name)
+        self.assertEqual('some-uuid', result.app_id)
+        self.assertEqual(5, result._queue_size)
+        self.assertEqual(0, result.duplicates)
+        self.assertEqual(servers, result._servers)
+        mock_NotifierServer.assert_has_calls([
+            mock.call(hub, 'cert_conf', True, 'notifier.py', 'some-uuid',
+                      ['filter'], reconnect=True, max_sleep=notifier.MAX_SLEEP,
+                      threshold=notifier.THRESHOLD, recover=notifier.RECOVER)
+            for hub in ('hub1', 'hub2')
+        ])
+        for server in servers:
+            feed = server.add_queue.call_args[0][0]
+            self.assertEqual(result, feed.server)
+
+    def test_start(self):
+        server = self._server()
+
+        server.start()
+
+        for hub_server in server._servers:
+            hub_server.start.assert_called_once_with()
+            self.assertFalse(hub_server.stop.called)
+
+    def test_start_running(self):
+        server = self._server((False, True))
+
+        self.assertRaises(ValueError, server.start)
+        self.assertFalse(server._servers[0].start.called)
+
+    def test_start_partial_failure(self):
+        server = self._server()
+        server._servers[0].start.side_effect = TestException()
+
+        server.start()
+
+        server._servers[0].stop.assert_called_once_with()
+        self.assertFalse(server._servers[1].stop.called)
+
+    def test_start_failure(self):
+        server = self._server()
+        for hub_server in server._servers:
+            hub_server.start.side_effect = TestException()
+
+        self.assertRaises(TestException, server.start)
+
+    def test_stop(self):
+        server = self._server()
+
+        server.stop('signal', 'arguments')
+        server.shutdown()
+
+        for hub_server in server._servers:
+            hub_server.stop.assert_called_once_with('signal', 'arguments')
+            hub_server.shutdown.assert_called_once_with()
+
+    def test_running(self):
+        self.assertFalse(self._server((False, False)).running)
+        self.assertTrue(self._server((False, True)).running)
+
+    def test_merge(self):
+        msgs = [
+            hub_notif('id1', 5),
+            hub_notif('id1', 9),
+            hub_notif('id1', 10, app_name='[other]app'),
+            hub_notif('id1', 6, summary='updated'),
+            hub_notif('id2', 7),
+            hub_notif('app-id', None),
+            hub_notif('app-id', None),
+        ]
+        server = self._server()
+
+        for msg in msgs:
+            server.merge(msg)
+
+        self.assertEqual([msgs[3], msgs[4], msgs[6]],
+                         list(server._notifications))
+        self.assertEqual(2, server.duplicates)
+        self.assertEqual(2, server.coalesced)
+
+    def test_merge_driver_queues(self):
+        queues = [mock.Mock(), mock.Mock()]
+        server = self._server()
+        server._driver_queues = queues
+
+        server.merge(hub_notif('id1', 5))
+        server.merge(hub_notif('id1', 9))
+
+        for queue in queues:
+            self.assertEqual(1, queue.put.call_count)
+        self.assertEqual([], list(server._notifications))
+
+
+class MakeServerTest(unittest.TestCase):
+    @mock.patch.object(notifier, 'MultiHubServer')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_single(self, mock_NotifierServer, mock_MultiHubServer):
+        result = notifier.make_server(('hub', 1), 'cert_conf', queue_size=5)
+
+        self.assertEqual(mock_NotifierServer.return_value, result)
+        mock_NotifierServer.assert_called_once_with(('hub', 1), 'cert_conf',
+                                                    queue_size=5)
+        self.assertFalse(mock_MultiHubServer.called)
+
+    @mock.patch.object(notifier, 'MultiHubServer')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_several(self, mock_NotifierServer, mock_MultiHubServer):
+        result = notifier.make_server([('hub1', 1), ('hub2', 1)], 'cert_conf',
+                                      queue_size=5)
+
+        self.assertEqual(mock_MultiHubServer.return_value, result)
+        mock_MultiHubServer.assert_called_once_with(
+            [('hub1', 1), ('hub2', 1)], 'cert_conf', queue_size=5)
+        self.assertFalse(mock_NotifierServer.called)
+
 
 class NotifierApplicationTest(unittest.TestCase):
     @mock.patch('tendril.Application.__init__', return_value=None)
@@ -366,10 +1027,52 @@ class NotifierApplicationTest(unittest.TestCase):
         self.assertEqual('framer', parent.framers)
         mock_init.assert_called_once_with(parent)
         mock_COBSFramer.assert_called_once_with(True)
-        mock_Message.assert_called_once_with('subscribe')
+        mock_Message.assert_called_once_with(
+            'subscribe', capabilities=(protocol.CAP_BATCH,
+                                       protocol.CAP_LENGTH_FRAMING,
+                                       protocol.CAP_ZLIB))
         mock_Message.return_value.to_frame.assert_called_once_with()
         mock_send_frame.assert_called_once_with('some frame')
 
+    @mock.patch('tendril.Application.__init__', return_value=None)
+    @mock.patch('tendril.COBSFramer', return_value='framer')
+    @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'some frame',
+    }))
+    @mock.patch.object(notifier.NotifierApplication, 'send_frame')
+    def test_init_filters(self, mock_send_frame, mock_Message,
+                          mock_COBSFramer, mock_init):
+        parent = mock.Mock()
+        notifier.NotifierApplication(parent, 'server', 'app_name', 'app_id',
+                                     {'categories': ['network.*'],
+                                      'min_urgency': 1})
+
+        mock_Message.assert_called_once_with(
+            'subscribe', capabilities=(protocol.CAP_BATCH,
+                                       protocol.CAP_LENGTH_FRAMING,
+                                       protocol.CAP_ZLIB),
+            categories=['network.*'], min_urgency=1)
+        mock_send_frame.assert_called_once_with('some frame')
+
+    @mock.patch('tendril.Application.__init__', return_value=None)
+    @mock.patch('tendril.COBSFramer', return_value='framer')
+    @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'some frame',
+    }))
+    @mock.patch.object(notifier.NotifierApplication, 'send_frame')
+    def test_init_resubscribe(self, mock_send_frame, mock_Message,
+                              mock_COBSFramer, mock_init):
+        parent = mock.Mock()
+        notifier.NotifierApplication(parent, 'server', 'app_name', 'app_id',
+                                     {'min_urgency': 1}, 'epoch', 0)
+
+        mock_Message.assert_called_once_with(
+            'subscribe', capabilities=(protocol.CAP_BATCH,
+                                       protocol.CAP_LENGTH_FRAMING,
+                                       protocol.CAP_ZLIB),
+            min_urgency=1, epoch='epoch', since=0)
+        mock_send_frame.assert_called_once_with('some frame')
+
     @mock.patch.object(protocol.Message, 'from_frame',
                        side_effect=ValueError('failed to decode'))
     @mock.patch.object(notifier.NotifierApplication, '__init__',
@@ -380,18 +1083,20 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_decodeerror(self, mock_closed, mock_disconnect,
                                     mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         mock_notify.assert_called_once_with(
             'Failed To Parse Server Message',
             'Unable to parse a message from the server: failed to decode',
             notifier.ERROR)
         mock_disconnect.assert_called_once_with()
         self.assertFalse(mock_closed.called)
-        app.server.stop.assert_called_once_with()
+        app.server.disconnected.assert_called_once_with(app)
         self.assertFalse(app.server.notify.called)
 
     @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
@@ -404,11 +1109,13 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_unknownmsg(self, mock_closed, mock_disconnect,
                                    mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         mock_notify.assert_called_once_with(
             'Unknown Server Message',
             'An unrecognized server message of type "unknown" was received.',
@@ -428,18 +1135,20 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_error(self, mock_closed, mock_disconnect,
                               mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         mock_notify.assert_called_once_with(
             'Communication Error',
             'An error occurred communicating with the HeyU hub: some error',
             notifier.ERROR)
         mock_disconnect.assert_called_once_with()
         self.assertFalse(mock_closed.called)
-        app.server.stop.assert_called_once_with()
+        app.server.disconnected.assert_called_once_with(app)
         self.assertFalse(app.server.notify.called)
 
     @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
@@ -452,11 +1161,13 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_goodbye(self, mock_closed, mock_disconnect,
                                 mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         self.assertFalse(mock_notify.called)
         mock_disconnect.assert_called_once_with()
         mock_closed.assert_called_once_with(None)
@@ -464,7 +1175,8 @@ class NotifierApplicationTest(unittest.TestCase):
         self.assertFalse(app.server.notify.called)
 
     @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
-        msg_type='subscribed'))
+        msg_type='subscribed', capabilities=(), epoch='epoch', cursor=5,
+        gap=False))
     @mock.patch.object(notifier.NotifierApplication, '__init__',
                        return_value=None)
     @mock.patch.object(notifier.NotifierApplication, 'notify')
@@ -473,11 +1185,14 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_subscribed(self, mock_closed, mock_disconnect,
                                    mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
+        app.parent = mock.Mock(framers='cobs')
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         mock_notify.assert_called_once_with(
             'Connection Established',
             'The connection to the HeyU hub has been established.',
@@ -486,6 +1201,67 @@ class NotifierApplicationTest(unittest.TestCase):
         self.assertFalse(mock_closed.called)
         self.assertFalse(app.server.stop.called)
         self.assertFalse(app.server.notify.called)
+        app.server.subscribed.assert_called_once_with('epoch', 5)
+        self.assertEqual('cobs', app.parent.framers)
+
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='subscribed', capabilities=(), epoch='epoch', cursor=5,
+        gap=True))
+    @mock.patch.object(notifier.NotifierApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(notifier.NotifierApplication, 'notify')
+    def test_recv_frame_subscribed_gap(self, mock_notify, mock_init,
+                                       mock_from_frame):
+        app = notifier.NotifierApplication()
+        app._compress = False
+        app.server = mock.Mock()
+        app.parent = mock.Mock(framers='cobs')
+
+        app.recv_frame('test')
+
+        mock_notify.assert_has_calls([
+            mock.call('Connection Established',
+                      'The connection to the HeyU hub has been established.',
+                      notifier.CONNECTED),
+            mock.call('Notifications Missed',
+                      'Some notifications sent while disconnected from the '
+                      'HeyU hub are no longer available.', notifier.ERROR),
+        ])
+        self.assertEqual(2, mock_notify.call_count)
+        app.server.subscribed.assert_called_once_with('epoch', 5)
+
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='subscribed', capabilities=('length-framing',),
+        epoch='epoch', cursor=5, gap=False))
+    @mock.patch.object(notifier.NotifierApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(notifier.NotifierApplication, 'notify')
+    @mock.patch.object(notifier.NotifierApplication, 'disconnect')
+    @mock.patch.object(notifier.NotifierApplication, 'closed')
+    @mock.patch('tendril.StructFramer', return_value='framer')
+    def test_recv_frame_subscribed_length(self, mock_StructFramer,
+                                          mock_closed, mock_disconnect,
+                                          mock_notify, mock_init,
+                                          mock_from_frame):
+        app = notifier.NotifierApplication()
+        app._compress = False
+        app.server = mock.Mock()
+        app.parent = mock.Mock(framers='cobs')
+
+        app.recv_frame('test')
+
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
+        mock_notify.assert_called_once_with(
+            'Connection Established',
+            'The connection to the HeyU hub has been established.',
+            notifier.CONNECTED)
+        self.assertFalse(mock_disconnect.called)
+        self.assertFalse(mock_closed.called)
+        self.assertFalse(app.server.stop.called)
+        self.assertFalse(app.server.notify.called)
+        mock_StructFramer.assert_called_once_with('!I')
+        self.assertEqual('framer', app.parent.framers)
 
     @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
         msg_type='notify'))
@@ -497,17 +1273,52 @@ class NotifierApplicationTest(unittest.TestCase):
     def test_recv_frame_notify(self, mock_closed, mock_disconnect,
                                mock_notify, mock_init, mock_from_frame):
         app = notifier.NotifierApplication()
+        app._compress = False
         app.server = mock.Mock()
 
         app.recv_frame('test')
 
-        mock_from_frame.assert_called_once_with('test')
+        mock_from_frame.assert_called_once_with('test',
+                                                compressed=False)
         self.assertFalse(mock_notify.called)
         self.assertFalse(mock_disconnect.called)
         self.assertFalse(mock_closed.called)
         self.assertFalse(app.server.stop.called)
         app.server.notify.assert_called_once_with(mock_from_frame.return_value)
 
+    @mock.patch.object(protocol.Message, 'from_frame', side_effect=[
+        mock.Mock(msg_type='notify_batch', notifications=['n1', 'n2']),
+        'notif1',
+        'notif2',
+    ])
+    @mock.patch.object(notifier.NotifierApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(notifier.NotifierApplication, 'notify')
+    @mock.patch.object(notifier.NotifierApplication, 'disconnect')
+    @mock.patch.object(notifier.NotifierApplication, 'closed')
+    def test_recv_frame_notify_batch(self, mock_closed, mock_disconnect,
+                                     mock_notify, mock_init, mock_from_frame):
+        app = notifier.NotifierApplication()
+        app._compress = False
+        app.server = mock.Mock()
+
+        app.recv_frame('test')
+
+        mock_from_frame.assert_has_calls([
+            mock.call('test', compressed=False),
+            mock.call('n1'),
+            mock.call('n2'),
+        ])
+        self.assertFalse(mock_notify.called)
+        self.assertFalse(mock_disconnect.called)
+        self.assertFalse(mock_closed.called)
+        self.assertFalse(app.server.stop.called)
+        app.server.notify.assert_has_calls([
+            mock.call('notif1'),
+            mock.call('notif2'),
+        ])
+        self.assertEqual(2, app.server.notify.call_count)
+
     @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'frame',
     }))
@@ -558,7 +1369,7 @@ class NotifierApplicationTest(unittest.TestCase):
             'Connection Closed',
             'The connection to the HeyU hub has been closed.',
             notifier.DISCONNECTED)
-        app.server.stop.assert_called_once_with()
+        app.server.disconnected.assert_called_once_with(app)
 
     @mock.patch.object(protocol, 'Message', return_value='notification')
     @mock.patch.object(notifier.NotifierApplication, '__init__',
@@ -593,7 +1404,11 @@ class StdoutNotificationDriverTest(unittest.TestCase):
     def test_output(self, mock_NotifierServer):
         notifier.stdout_notification_driver('hub')
 
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
         self.assertEqual(
             'ID notify-1, urgency low\n'
             'Application: application-1\n'
@@ -617,51 +1432,230 @@ class StdoutNotificationDriverTest(unittest.TestCase):
             sys.stdout.getvalue())
 
 
-class MyBytesIO(io.BytesIO):
-    """
-    Override close() to preserve the emitted contents.
-    """
+def notif(notif_id, urgency=protocol.URGENCY_LOW, category=None):
+    return mock.Mock(id=notif_id, urgency=urgency,
+                     app_name='app-%s' % notif_id,
+                     summary='summary-%s' % notif_id,
+                     body='body-%s' % notif_id, category=category)
+
 
-    def close(self):
-        self.contents = self.getvalue()
-        super(MyBytesIO, self).close()
+class FormatTest(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(
+            'ID n1, urgency normal\n'
+            'Application: app-n1\n'
+            '    Summary: summary-n1\n'
+            '       Body: body-n1\n'
+            '   Category: None\n',
+            notifier._format_text(notif('n1', protocol.URGENCY_NORMAL)))
+
+    def test_json(self):
+        self.assertEqual(
+            '{"application": "app-n1", "body": "body-n1", "category": "cat", '
+            '"id": "n1", "summary": "summary-n1", "urgency": "low"}\n',
+            notifier._file_formats['json'](notif('n1', category='cat')))
+
+    def test_msgpack(self):
+        result = notifier._format_msgpack(notif('n1'))
+
+        self.assertEqual(len(result) - 4,
+                         notifier.struct.unpack('>I', result[:4])[0])
+        self.assertEqual({
+            'id': 'n1',
+            'application': 'app-n1',
+            'summary': 'summary-n1',
+            'body': 'body-n1',
+            'category': '',
+            'urgency': 'low',
+        }, notifier.msgpack.loads(result[4:]))
+
+
+class FileWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.filename = os.path.join(self.path, 'notifs')
+
+    def _files(self):
+        return sorted(os.listdir(self.path))
+
+    def _read(self, fname):
+        with open(os.path.join(self.path, fname)) as f:
+            return f.read()
+
+    def test_buffered(self):
+        writer = notifier.FileWriter(self.filename, 'json', flush_size=300,
+                                     flush_interval=60)
+
+        writer.write([notif('n1')])
+        self.assertEqual('', self._read('notifs'))
+
+        writer.write([notif('n2'), notif('n3')])
+        self.assertEqual(3, len(self._read('notifs').splitlines()))
+        self.assertEqual([], writer._buf)
+
+        writer.write([notif('n4')])
+        writer.close()
+        writer.close()
+        self.assertEqual(['notifs'], self._files())
+        self.assertEqual(4, len(self._read('notifs').splitlines()))
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_flush_interval(self, mock_time):
+        writer = notifier.FileWriter(self.filename, flush_interval=1)
+
+        writer.write([notif('n1')])
+        self.assertEqual('', self._read('notifs'))
+
+        mock_time.return_value = 1001.0
+        writer.write([notif('n2')])
+        self.assertEqual(notifier._format_text(notif('n1')) +
+                         notifier._format_text(notif('n2')),
+                         self._read('notifs'))
+
+    def test_append(self):
+        with open(self.filename, 'w') as f:
+            f.write('existing\n')
+
+        writer = notifier.FileWriter(self.filename, 'json')
+        writer.write([notif('n1')])
+        writer.close()
+
+        self.assertEqual(2, len(self._read('notifs').splitlines()))
+
+    def test_rotate_size(self):
+        size = len(notifier._format_msgpack(notif('n1')))
+        writer = notifier.FileWriter(self.filename, 'msgpack', flush_size=0,
+                                     max_size=size * 2)
+
+        for i in range(5):
+            writer.write([notif('n%d' % i)])
+
+        self.assertEqual(['notifs.00000001', 'notifs.00000002',
+                          'notifs.00000003', 'notifs.00000004'],
+                         self._files())
+        writer.close()
+        self.assertEqual(['notifs.00000001', 'notifs.00000002',
+                          'notifs.00000003'], self._files())
+        self.assertEqual([size * 2, size * 2, size],
+                         [len(self._read(fname)) for fname in self._files()])
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_rotate_age(self, mock_time):
+        writer = notifier.FileWriter(self.filename, 'json', flush_size=0,
+                                     max_age=60)
+
+        writer.write([notif('n1')])
+        mock_time.return_value = 1030.0
+        writer.write([notif('n2')])
+        mock_time.return_value = 1100.0
+        writer.flush()
+        writer.write([notif('n3')])
+        writer.close()
+
+        self.assertEqual(['notifs.00000001', 'notifs.00000002'],
+                         self._files())
+        self.assertEqual(2, len(self._read('notifs.00000001').splitlines()))
+
+    def test_rotate_resume(self):
+        for fname in ('notifs.00000002', 'notifs.00000003', 'notifs.x'):
+            with open(os.path.join(self.path, fname), 'w') as f:
+                f.write('existing\n')
+
+        writer = notifier.FileWriter(self.filename, 'json', max_size=1000)
+        writer.write([notif('n1')])
+        writer.close()
+
+        self.assertEqual(['notifs.00000002', 'notifs.00000003', 'notifs.x'],
+                         self._files())
+        self.assertEqual(2, len(self._read('notifs.00000003').splitlines()))
 
 
 class FileNotificationDriverTest(unittest.TestCase):
-    @mock.patch('__builtin__.open', return_value=MyBytesIO())
-    @mock.patch.object(notifier, 'NotifierServer', return_value=[
-        mock.Mock(id='notify-1', urgency=protocol.URGENCY_LOW,
-                  app_name='application-1', summary='summary-1', body='body-1',
-                  category='cat-1'),
-        mock.Mock(id='notify-2', urgency=protocol.URGENCY_NORMAL,
-                  app_name='application-2', summary='summary-2', body='body-2',
-                  category=None),
-        mock.Mock(id='notify-3', urgency=protocol.URGENCY_CRITICAL,
-                  app_name='application-3', summary='summary-3', body='body-3',
-                  category='cat-3'),
-    ])
-    def test_output(self, mock_NotifierServer, mock_open):
+    @mock.patch.object(notifier, 'FileWriter')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_output(self, mock_NotifierServer, mock_FileWriter):
+        server = mock_NotifierServer.return_value
+        server.next_batch.side_effect = [['n1', 'n2'], [], ['n3'],
+                                         StopIteration()]
+
         notifier.file_notification_driver('file', 'hub')
 
-        mock_open.assert_called_once_with('file', 'a')
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
-        self.assertEqual(
-            'ID notify-1, urgency low\n'
-            'Application: application-1\n'
-            '    Summary: summary-1\n'
-            '       Body: body-1\n'
-            '   Category: cat-1\n'
-            'ID notify-2, urgency normal\n'
-            'Application: application-2\n'
-            '    Summary: summary-2\n'
-            '       Body: body-2\n'
-            '   Category: None\n'
-            'ID notify-3, urgency critical\n'
-            'Application: application-3\n'
-            '    Summary: summary-3\n'
-            '       Body: body-3\n'
-            '   Category: cat-3\n',
-            mock_open.return_value.contents)
+        mock_FileWriter.assert_called_once_with(
+            'file', 'text', notifier.FLUSH_SIZE, notifier.FLUSH_INTERVAL, 0, 0)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
+        server.start.assert_called_once_with()
+        server.next_batch.assert_called_with(notifier.FILE_BATCH,
+                                             notifier.FLUSH_INTERVAL)
+        mock_FileWriter.return_value.assert_has_calls([
+            mock.call.write(['n1', 'n2']),
+            mock.call.flush(),
+            mock.call.write(['n3']),
+            mock.call.close(),
+        ])
+
+    @mock.patch.object(notifier, 'FileWriter')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_exit(self, mock_NotifierServer, mock_FileWriter):
+        server = mock_NotifierServer.return_value
+        server.next_batch.side_effect = [['n1'], SystemExit()]
+
+        self.assertRaises(SystemExit, notifier.file_notification_driver,
+                          'file', 'hub', fmt='json', flush_interval=0)
+
+        mock_FileWriter.assert_called_once_with(
+            'file', 'json', notifier.FLUSH_SIZE, 0, 0, 0)
+        server.next_batch.assert_called_with(notifier.FILE_BATCH, None)
+        mock_FileWriter.return_value.assert_has_calls([
+            mock.call.write(['n1']),
+            mock.call.close(),
+        ])
+
+    @mock.patch.object(notifier, 'FileWriter')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_shared_server(self, mock_NotifierServer, mock_FileWriter):
+        server = mock.Mock(**{'next_batch.side_effect': StopIteration()})
+
+        notifier.file_notification_driver('file', 'hub', server=server)
+
+        self.assertFalse(mock_NotifierServer.called)
+        server.start.assert_called_once_with()
+        mock_FileWriter.return_value.close.assert_called_once_with()
+
+
+class ParseFilterTest(unittest.TestCase):
+    def test_category(self):
+        result = notifier._parse_filter('category=network.*')
+
+        self.assertEqual(('categories', 'network.*'), result)
+
+    def test_urgency(self):
+        result = notifier._parse_filter('urgency=critical')
+
+        self.assertEqual(('min_urgency', protocol.URGENCY_CRITICAL), result)
+
+    def test_app(self):
+        result = notifier._parse_filter('app=heyu-*')
+
+        self.assertEqual(('app_names', 'heyu-*'), result)
+
+    def test_host(self):
+        result = notifier._parse_filter('host=db=1')
+
+        self.assertEqual(('hosts', 'db=1'), result)
+
+    def test_bad_urgency(self):
+        self.assertRaises(ValueError, notifier._parse_filter, 'urgency=high')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, notifier._parse_filter, 'spam=spam')
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, notifier._parse_filter, 'category')
 
 
 class ValidateSubsTest(unittest.TestCase):
@@ -693,9 +1687,215 @@ class ValidateSubsTest(unittest.TestCase):
         self.assertRaises(ValueError, notifier._validate_subs, '{unknown}')
 
 
+class ScriptRunnerTest(unittest.TestCase):
+    def _msg(self, notif_id, summary):
+        return mock.Mock(id=notif_id, urgency=protocol.URGENCY_LOW,
+                         app_name='app', summary=summary, body='body',
+                         category=None)
+
+    def _handshake(self, mock_call):
+        # Each invocation signals that it has started, then waits to
+        # be released, so the tests control the interleaving
+        started = collections.defaultdict(gevent.event.Event)
+        release = collections.defaultdict(gevent.event.Event)
+        calls = []
+        running = []
+        peak = []
+
+        def fake_call(cmd, timeout):
+            calls.append(cmd[1])
+            running.append(cmd[1])
+            peak.append(len(running))
+            started[cmd[1]].set()
+            release[cmd[1]].wait()
+            running.remove(cmd[1])
+        mock_call.side_effect = fake_call
+
+        return started, release, calls, running, peak
+
+    @mock.patch('gevent.subprocess.call')
+    def test_concurrent(self, mock_call):
+        started, release, calls, running, peak = self._handshake(mock_call)
+        runner = notifier.ScriptRunner(['cmd', '{summary}'], 2, 5)
+
+        # Submitting blocks while both workers are busy
+        feeder = gevent.spawn(lambda: [
+            runner.submit(self._msg('id%d' % i, 's%d' % i))
+            for i in range(5)])
+        started['s0'].wait()
+        started['s1'].wait()
+        self.assertEqual(['s0', 's1'], sorted(running))
+        self.assertFalse(feeder.ready())
+
+        # Finishing one invocation lets the next start
+        release['s0'].set()
+        started['s2'].wait()
+        self.assertEqual(['s1', 's2'], sorted(running))
+
+        for i in range(1, 5):
+            release['s%d' % i].set()
+        feeder.join()
+        runner.join()
+
+        self.assertEqual(5, mock_call.call_count)
+        self.assertEqual(2, max(peak))
+        mock_call.assert_any_call(['cmd', 's0'], timeout=5)
+
+    @mock.patch('gevent.subprocess.call')
+    def test_ordered(self, mock_call):
+        started, release, calls, running, peak = self._handshake(mock_call)
+        runner = notifier.ScriptRunner(['cmd', '{summary}'], 4, ordered=True)
+
+        runner.submit(self._msg('a', 'a1'))
+        runner.submit(self._msg('b', 'b1'))
+        runner.submit(self._msg('a', 'a2'))
+        runner.submit(self._msg('a', 'a3'))
+        runner.submit(self._msg(None, 'n1'))
+
+        # The later notifications for "a" wait behind the first, and
+        # the last replaces the one before
+        for summary in ('a1', 'b1', 'n1'):
+            started[summary].wait()
+        self.assertEqual(['a1', 'b1', 'n1'], sorted(calls))
+        self.assertEqual('a3', runner._waiting['a'].summary)
+
+        for summary in ('b1', 'n1', 'a1', 'a3'):
+            release[summary].set()
+        runner.join()
+
+        self.assertEqual('a3', calls[-1])
+        self.assertEqual(4, len(calls))
+        self.assertEqual({}, runner._waiting)
+
+    @mock.patch.object(sys, 'stderr', io.BytesIO())
+    @mock.patch('gevent.subprocess.call',
+                side_effect=gevent.subprocess.TimeoutExpired(['cmd'], 5))
+    def test_timeout(self, mock_call):
+        runner = notifier.ScriptRunner(['cmd'], timeout=5)
+
+        runner.submit(self._msg('a', 'a1'))
+        runner.join()
+
+        self.assertEqual('Timed out calling cmd after 5 seconds\n',
+                         sys.stderr.getvalue())
+
+
+class CoProcessTest(unittest.TestCase):
+    def _msg(self, notif_id, summary):
+        return mock.Mock(id=notif_id, urgency=protocol.URGENCY_LOW,
+                         app_name='app', summary=summary, body='body',
+                         category=None)
+
+    @mock.patch('gevent.subprocess.Popen', **{'return_value.poll.return_value':
+                                              None})
+    def test_send_json(self, mock_Popen):
+        proc = notifier.CoProcess(['cmd'])
+
+        proc.send([self._msg('a', 's1'), self._msg('b', 's2')])
+        proc.send([self._msg('c', 's3')])
+
+        mock_Popen.assert_called_once_with(['cmd'],
+                                           stdin=gevent.subprocess.PIPE)
+        stdin = mock_Popen.return_value.stdin
+        self.assertEqual([
+            mock.call('{"application": "app", "body": "body", '
+                      '"category": "", "id": "a", "summary": "s1", '
+                      '"urgency": "low"}\n'
+                      '{"application": "app", "body": "body", '
+                      '"category": "", "id": "b", "summary": "s2", '
+                      '"urgency": "low"}\n'),
+            mock.call('{"application": "app", "body": "body", '
+                      '"category": "", "id": "c", "summary": "s3", '
+                      '"urgency": "low"}\n'),
+        ], stdin.write.call_args_list)
+        self.assertEqual(2, stdin.flush.call_count)
+        self.assertEqual(1, proc.starts)
+
+    @mock.patch('gevent.subprocess.Popen', **{'return_value.poll.return_value':
+                                              None})
+    def test_send_msgpack(self, mock_Popen):
+        proc = notifier.CoProcess(['cmd'], 'msgpack')
+
+        proc.send([self._msg('a', 's1')])
+
+        data = mock_Popen.return_value.stdin.write.call_args[0][0]
+        self.assertEqual({
+            'id': 'a',
+            'application': 'app',
+            'summary': 's1',
+            'body': 'body',
+            'category': '',
+            'urgency': 'low',
+        }, notifier.msgpack.loads(data))
+
+    @mock.patch('gevent.sleep')
+    @mock.patch('gevent.subprocess.Popen')
+    def test_send_exited(self, mock_Popen, mock_sleep):
+        procs = [mock.Mock(**{'poll.return_value': None}) for _i in range(2)]
+        mock_Popen.side_effect = procs
+        proc = notifier.CoProcess(['cmd'])
+        proc.send([self._msg('a', 's1')])
+        procs[0].poll.return_value = 1
+
+        proc.send([self._msg('b', 's2')])
+
+        self.assertEqual(2, proc.starts)
+        self.assertEqual(1, mock_sleep.call_count)
+        procs[0].stdin.close.assert_called_once_with()
+        self.assertFalse(procs[0].kill.called)
+        procs[0].wait.assert_called_once_with()
+        self.assertEqual(1, procs[1].stdin.write.call_count)
+
+    @mock.patch.object(sys, 'stderr', io.BytesIO())
+    @mock.patch('gevent.sleep')
+    @mock.patch('gevent.subprocess.Popen')
+    def test_send_failed(self, mock_Popen, mock_sleep):
+        procs = [mock.Mock(**{'poll.return_value': None}) for _i in range(2)]
+        procs[0].stdin.write.side_effect = IOError(32, 'Broken pipe')
+        mock_Popen.side_effect = procs
+        proc = notifier.CoProcess(['cmd'])
+
+        proc.send([self._msg('a', 's1')])
+
+        self.assertEqual('Failed to write to cmd: [Errno 32] Broken pipe\n',
+                         sys.stderr.getvalue())
+        self.assertEqual(2, proc.starts)
+        procs[0].kill.assert_called_once_with()
+        procs[1].stdin.write.assert_called_once_with(
+            procs[0].stdin.write.call_args[0][0])
+
+    @mock.patch.object(sys, 'stderr', io.BytesIO())
+    @mock.patch('gevent.sleep')
+    @mock.patch('gevent.subprocess.Popen', **{
+        'return_value.poll.return_value': None,
+        'return_value.stdin.write.side_effect': IOError(32, 'Broken pipe'),
+    })
+    def test_send_discarded(self, mock_Popen, mock_sleep):
+        proc = notifier.CoProcess(['cmd'])
+
+        proc.send([self._msg('a', 's1')])
+
+        self.assertEqual(2, proc.starts)
+        self.assertEqual(2, len(sys.stderr.getvalue().splitlines()))
+
+    @mock.patch('gevent.subprocess.Popen', **{'return_value.poll.return_value':
+                                              None})
+    def test_close(self, mock_Popen):
+        proc = notifier.CoProcess(['cmd'])
+        proc.close()
+        proc.send([self._msg('a', 's1')])
+        child = mock_Popen.return_value
+
+        proc.close()
+
+        child.stdin.close.assert_called_once_with()
+        child.wait.assert_called_once_with()
+        self.assertEqual(None, proc._proc)
+
+
 class ScriptNotificationDriverTest(unittest.TestCase):
     @mock.patch.object(sys, 'stderr', io.BytesIO())
-    @mock.patch('subprocess.call')
+    @mock.patch('gevent.subprocess.call')
     @mock.patch.object(notifier, 'NotifierServer', return_value=[
         mock.Mock(id='notify-1', urgency=protocol.URGENCY_LOW,
                   app_name='application-1', summary='summary-1', body='body-1',
@@ -714,28 +1914,33 @@ class ScriptNotificationDriverTest(unittest.TestCase):
             'urgency={urgency}',
         ], 'hub')
 
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
         self.assertEqual('', sys.stderr.getvalue())
         mock_call.assert_has_calls([
             mock.call([
                 'command', 'id=notify-1', 'application=application-1',
                 'summary=summary-1', 'body=body-1', 'category=cat-1',
                 'urgency=low',
-            ]),
+            ], timeout=None),
             mock.call([
                 'command', 'id=notify-2', 'application=application-2',
                 'summary=summary-2', 'body=body-2', 'category=',
                 'urgency=normal',
-            ]),
+            ], timeout=None),
             mock.call([
                 'command', 'id=notify-3', 'application=application-3',
                 'summary=summary-3', 'body=body-3', 'category=cat-3',
                 'urgency=critical',
-            ]),
+            ], timeout=None),
         ])
 
     @mock.patch.object(sys, 'stderr', io.BytesIO())
-    @mock.patch('subprocess.call', side_effect=TestException('bad command'))
+    @mock.patch('gevent.subprocess.call',
+                side_effect=TestException('bad command'))
     @mock.patch.object(notifier, 'NotifierServer', return_value=[
         mock.Mock(id='notify-1', urgency=protocol.URGENCY_LOW,
                   app_name='application-1', summary='summary-1', body='body-1',
@@ -754,7 +1959,11 @@ class ScriptNotificationDriverTest(unittest.TestCase):
             'urgency={urgency}',
         ], 'hub')
 
-        mock_NotifierServer.assert_called_once_with('hub', None, True)
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=notifier.QUEUE_SIZE,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
         self.assertEqual('Failed to call command: bad command\n'
                          'Failed to call command: bad command\n'
                          'Failed to call command: bad command\n',
@@ -764,15 +1973,108 @@ class ScriptNotificationDriverTest(unittest.TestCase):
                 'command', 'id=notify-1', 'application=application-1',
                 'summary=summary-1', 'body=body-1', 'category=cat-1',
                 'urgency=low',
-            ]),
+            ], timeout=None),
             mock.call([
                 'command', 'id=notify-2', 'application=application-2',
                 'summary=summary-2', 'body=body-2', 'category=',
                 'urgency=normal',
-            ]),
+            ], timeout=None),
             mock.call([
                 'command', 'id=notify-3', 'application=application-3',
                 'summary=summary-3', 'body=body-3', 'category=cat-3',
                 'urgency=critical',
-            ]),
+            ], timeout=None),
         ])
+
+    @mock.patch.object(notifier, 'CoProcess')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_coprocess(self, mock_NotifierServer, mock_CoProcess):
+        server = mock_NotifierServer.return_value
+        server.next_batch.side_effect = [['n1', 'n2'], ['n3'],
+                                         StopIteration()]
+
+        notifier.script_notification_driver(['command'], 'hub',
+                                            coprocess='msgpack')
+
+        mock_CoProcess.assert_called_once_with(['command'], 'msgpack')
+        server.start.assert_called_once_with()
+        server.next_batch.assert_called_with(notifier.COPROCESS_BATCH)
+        mock_CoProcess.return_value.assert_has_calls([
+            mock.call.send(['n1', 'n2']),
+            mock.call.send(['n3']),
+            mock.call.close(),
+        ])
+
+
+class RunDriverTest(unittest.TestCase):
+    def test_run(self):
+        driver = mock.Mock()
+
+        notifier._run_driver(driver, {'a': 1})
+
+        driver.assert_called_once_with(a=1)
+
+    def test_exit(self):
+        driver = mock.Mock(side_effect=SystemExit())
+
+        notifier._run_driver(driver, {})
+
+    @mock.patch.object(sys, 'stderr', io.BytesIO())
+    def test_error(self):
+        driver = mock.Mock(side_effect=TestException('failed'))
+
+        notifier._run_driver(driver, {})
+
+        self.assertEqual('Notification driver failed: failed\n',
+                         sys.stderr.getvalue())
+
+
+def driver(*arguments):
+    def setup_args(parser):
+        for argument in arguments:
+            parser.add_argument(argument)
+
+    return mock.Mock(**{
+        'setup_args.side_effect': setup_args,
+        'get_kwargs.side_effect': lambda args: vars(args),
+    })
+
+
+class MultiNotificationDriverTest(unittest.TestCase):
+    @mock.patch.object(notifier.notification_server, 'get_subcommands')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_run(self, mock_NotifierServer, mock_get_subcommands):
+        drivers = {
+            'file': driver('filename'),
+            'stdout': driver(),
+        }
+        mock_get_subcommands.return_value = drivers
+        server = mock_NotifierServer.return_value
+        server.driver_queue.side_effect = ['queue1', 'queue2']
+
+        notifier.multi_notification_driver(['file "/tmp/a file"', 'stdout'],
+                                           'hub', queue_size=5)
+
+        mock_NotifierServer.assert_called_once_with(
+            'hub', None, True, filters=None, queue_size=5,
+            overflow=notifier.OVERFLOW_DROP_OLDEST, reconnect=True,
+            max_sleep=notifier.MAX_SLEEP, threshold=notifier.THRESHOLD,
+            recover=notifier.RECOVER)
+        drivers['file'].assert_called_once_with(
+            filename='/tmp/a file', hub='hub', server='queue1')
+        drivers['stdout'].assert_called_once_with(hub='hub', server='queue2')
+
+    @mock.patch.object(notifier.notification_server, 'get_subcommands')
+    @mock.patch.object(notifier, 'NotifierServer')
+    def test_unknown(self, mock_NotifierServer, mock_get_subcommands):
+        drivers = {
+            'stdout': driver(),
+            'multi': notifier.multi_notification_driver,
+        }
+        mock_get_subcommands.return_value = drivers
+
+        for spec in ('', 'bogus', 'multi stdout'):
+            self.assertRaises(ValueError, notifier.multi_notification_driver,
+                              ['stdout', spec], 'hub')
+
+        self.assertFalse(drivers['stdout'].called)
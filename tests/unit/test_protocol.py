@@ -13,38 +13,161 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import unittest
 
 import mock
+import msgpack
 
 from heyu import protocol
 
 
+def schemas(versions):
+    return mock.patch.dict(protocol._schemas, protocol._compile(versions),
+                           clear=True)
+
+
+class EncoderTest(unittest.TestCase):
+    def test_required(self):
+        msg = mock.Mock(a=1, b=2)
+
+        encode = protocol._encoder(('a', 'b'), ())
+
+        self.assertEqual(encode(msg), {'a': 1, 'b': 2})
+
+    def test_defaults(self):
+        msg = mock.Mock(a=1, b=2, c=3, d=None)
+
+        encode = protocol._encoder(('a',), (('b', 5), ('c', 3), ('d', None)))
+
+        self.assertEqual(encode(msg), {'a': 1, 'b': 2})
+
+
+class CompileTest(unittest.TestCase):
+    def test_compile(self):
+        result = protocol._compile({
+            0: {
+                'test': {
+                    'required': set(['b', 'a']),
+                    'defaults': {'d': 4, 'c': 3},
+                },
+                'other': {},
+            },
+            1: {'test': {}},
+        })
+
+        self.assertEqual(set(result.keys()), set([0, 1]))
+        self.assertEqual(set(result[0].keys()), set(['test', 'other']))
+        self.assertEqual(set(result[1].keys()), set(['test']))
+        cls = result[0]['test']
+        self.assertTrue(issubclass(cls, protocol.Message))
+        self.assertEqual(cls.__name__, 'Message_test_v0')
+        self.assertEqual(cls.__slots__, ('a', 'b', 'c', 'd'))
+        self.assertEqual(cls._required, ('a', 'b'))
+        self.assertEqual(cls._defaults, (('c', 3), ('d', 4)))
+        cls = result[0]['other']
+        self.assertEqual(cls.__slots__, ())
+        self.assertEqual(cls._required, ())
+        self.assertEqual(cls._defaults, ())
+        self.assertIsNot(result[0]['test'], result[1]['test'])
+
+
+class CompressFrameTest(unittest.TestCase):
+    def test_compress_short(self):
+        frame = msgpack.dumps({'body': 'x' * 100})
+
+        self.assertEqual(protocol.compress_frame(frame), frame)
+
+    def test_compress_long(self):
+        frame = msgpack.dumps({'body': 'x' * 1000})
+
+        result = protocol.compress_frame(frame)
+
+        self.assertTrue(len(result) < len(frame))
+        self.assertEqual(result[0], '\x78')
+        self.assertEqual(protocol.decompress_frame(result), frame)
+
+    def test_compress_incompressible(self):
+        frame = msgpack.dumps({'body': os.urandom(1000)})
+
+        self.assertEqual(protocol.compress_frame(frame), frame)
+
+    def test_compress_threshold(self):
+        frame = msgpack.dumps({'body': 'x' * 100})
+
+        result = protocol.compress_frame(frame, 10)
+
+        self.assertNotEqual(result, frame)
+        self.assertEqual(protocol.decompress_frame(result), frame)
+
+    def test_decompress_uncompressed(self):
+        frame = msgpack.dumps({'body': 'x' * 100})
+
+        self.assertEqual(protocol.decompress_frame(frame), frame)
+
+    def test_decompress_corrupt(self):
+        self.assertRaises(ValueError, protocol.decompress_frame,
+                          '\x78 corrupt')
+
+    def test_decompress_oversized(self):
+        frame = msgpack.dumps({'body': 'x' * 1000})
+        compressed = protocol.compress_frame(frame)
+
+        self.assertEqual(protocol.decompress_frame(compressed, len(frame)),
+                         frame)
+        self.assertRaises(ValueError, protocol.decompress_frame,
+                          compressed, len(frame) - 1)
+
+
+class SpliceFrameTest(unittest.TestCase):
+    def test_splice(self):
+        frame = msgpack.dumps({'a': 1, 'b': 'x' * 100, 'c': [2, 3], 'd': 4})
+
+        result = protocol.splice_frame(frame, set(['a', 'b', 'd']),
+                                       {'d': 5, 'e': 6})
+
+        self.assertEqual(msgpack.loads(result), {
+            'a': 1, 'b': 'x' * 100, 'd': 5, 'e': 6,
+        })
+        self.assertTrue(frame[frame.index('\xa1b'):frame.index('x' * 100)]
+                        in result)
+
+    def test_splice_not_map(self):
+        self.assertRaises(ValueError, protocol.splice_frame,
+                          msgpack.dumps([1, 2]), set(), {})
+
+    def test_splice_truncated(self):
+        frame = msgpack.dumps({'a': 1, 'b': 'x' * 100})
+
+        self.assertRaises(ValueError, protocol.splice_frame, frame[:-10],
+                          set(['a', 'b']), {})
+
+
 class MessageTest(unittest.TestCase):
     @mock.patch('msgpack.loads', return_value=[])
-    @mock.patch.object(protocol.Message, '__init__', return_value=None)
-    def test_from_frame_bad_pdu(self, mock_init, mock_loads):
+    @mock.patch.object(protocol, '_build')
+    def test_from_frame_bad_pdu(self, mock_build, mock_loads):
         self.assertRaises(ValueError, protocol.Message.from_frame, 'frame')
         mock_loads.assert_called_once_with('frame')
-        self.assertFalse(mock_init.called)
+        self.assertFalse(mock_build.called)
 
     @mock.patch('msgpack.loads', return_value={
         '__version__': 5,
     })
-    @mock.patch.object(protocol.Message, '__init__', return_value=None)
-    def test_from_frame_no_type(self, mock_init, mock_loads):
+    @mock.patch.object(protocol, '_build')
+    def test_from_frame_no_type(self, mock_build, mock_loads):
         self.assertRaises(ValueError, protocol.Message.from_frame, 'frame')
         mock_loads.assert_called_once_with('frame')
-        self.assertFalse(mock_init.called)
+        self.assertFalse(mock_build.called)
 
     @mock.patch('msgpack.loads', return_value={
         'msg_type': 'test',
     })
-    @mock.patch.object(protocol.Message, '__init__', return_value=None)
-    def test_from_frame_no_version(self, mock_init, mock_loads):
+    @mock.patch.object(protocol, '_build')
+    def test_from_frame_no_version(self, mock_build, mock_loads):
         self.assertRaises(ValueError, protocol.Message.from_frame, 'frame')
         mock_loads.assert_called_once_with('frame')
-        self.assertFalse(mock_init.called)
+        self.assertFalse(mock_build.called)
 
     @mock.patch('msgpack.loads', return_value={
         '__version__': 5,
@@ -53,40 +176,48 @@ class MessageTest(unittest.TestCase):
         'b': 2,
         'c': 3,
     })
-    @mock.patch.object(protocol.Message, '__init__', return_value=None)
-    def test_from_frame_happy_path(self, mock_init, mock_loads):
+    @mock.patch.object(protocol, '_build', return_value='msg')
+    def test_from_frame_happy_path(self, mock_build, mock_loads):
         msg = protocol.Message.from_frame('frame')
 
-        self.assertTrue(isinstance(msg, protocol.Message))
+        self.assertEqual(msg, 'msg')
         mock_loads.assert_called_once_with('frame')
-        mock_init.assert_called_once_with(
-            'test', __version__=5, __frame__='frame', a=1, b=2, c=3)
+        mock_build.assert_called_once_with(
+            5, 'test', {'a': 1, 'b': 2, 'c': 3}, 'frame')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_init_wrong_version(self):
         self.assertRaises(ValueError, protocol.Message, 'test', __version__=2)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
+        0: {'test': {}},
+    })
+    def test_init_unhashable_version(self):
+        self.assertRaises(ValueError, protocol.Message, 'test',
+                          __version__=[])
+
+    @schemas({
         0: {'test': {'required': set(['spam'])}},
     })
     def test_init_missing_argument(self):
         self.assertRaises(ValueError, protocol.Message, 'test')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_init_basic(self):
         msg = protocol.Message('test', a=1, b=2, c=3)
 
+        self.assertTrue(isinstance(msg, protocol._schemas[0]['test']))
         self.assertEqual(msg._version, protocol._curr_version)
         self.assertEqual(msg._msg_type, 'test')
-        self.assertEqual(msg._defaults, {})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(msg._frame_version, protocol._curr_version)
+        self.assertEqual(msg._frame, None)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_init_primed(self):
@@ -94,60 +225,65 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg._version, protocol._curr_version)
         self.assertEqual(msg._msg_type, 'test')
-        self.assertEqual(msg._defaults, {})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3})
-        self.assertEqual(msg._frame_cache, {protocol._curr_version: 'frame'})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(msg._frame_version, protocol._curr_version)
+        self.assertEqual(msg._frame, 'frame')
 
-    @mock.patch.dict(protocol._versions, {
-        0: {'test': {'defaults': {'def': 'ault'}}},
+    @schemas({
+        0: {'test': {'defaults': {'spam': 'default'}}},
     })
     def test_init_defaults(self):
         msg = protocol.Message('test', a=1, b=2, c=3)
 
         self.assertEqual(msg._version, protocol._curr_version)
         self.assertEqual(msg._msg_type, 'test')
-        self.assertEqual(msg._defaults, {'def': 'ault'})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(msg.spam, 'default')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {'defaults': {'b': 2, 'c': 4, 'd': 5}}},
     })
-    def test_init_defaults_collapse(self):
+    def test_init_defaults_override(self):
         msg = protocol.Message('test', a=1, b=2, c=3)
 
-        self.assertEqual(msg._version, protocol._curr_version)
-        self.assertEqual(msg._msg_type, 'test')
-        self.assertEqual(msg._defaults, {'b': 2, 'c': 4, 'd': 5})
-        self.assertEqual(msg._args, {'a': 1, 'c': 3})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1})
+        self.assertEqual(msg.b, 2)
+        self.assertEqual(msg.c, 3)
+        self.assertEqual(msg.d, 5)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
+        0: {'test': {'required': set(['a']), 'defaults': {'b': 2}}},
+    })
+    def test_init_no_extra(self):
+        msg = protocol.Message('test', a=1)
+
+        self.assertEqual(msg._extra, None)
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+    @schemas({
         0: {'test': {}},
         1: {'test1': {}},
     })
     def test_init_alt_version(self):
         msg = protocol.Message('test1', a=1, b=2, c=3, __version__=1)
 
+        self.assertTrue(isinstance(msg, protocol._schemas[1]['test1']))
         self.assertEqual(msg._version, 1)
         self.assertEqual(msg._msg_type, 'test1')
-        self.assertEqual(msg._defaults, {})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_init_unknown_type(self):
         msg = protocol.Message('other', a=1, b=2, c=3)
 
+        self.assertEqual(type(msg), protocol.Message)
         self.assertEqual(msg._version, protocol._curr_version)
         self.assertEqual(msg._msg_type, 'other')
-        self.assertEqual(msg._defaults, {})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {'required': set(['spam'])}},
     })
     def test_init_required(self):
@@ -155,12 +291,10 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg._version, protocol._curr_version)
         self.assertEqual(msg._msg_type, 'test')
-        self.assertEqual(msg._defaults, {})
-        self.assertEqual(msg._args, {'a': 1, 'b': 2, 'c': 3,
-                                     'spam': 'spam'})
-        self.assertEqual(msg._frame_cache, {})
+        self.assertEqual(msg._extra, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(msg.spam, 'spam')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_getattr_undefined(self):
@@ -168,7 +302,15 @@ class MessageTest(unittest.TestCase):
 
         self.assertRaises(AttributeError, lambda: msg.spam)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
+        0: {'test': {}},
+    })
+    def test_getattr_undefined_extra(self):
+        msg = protocol.Message('test', a=1)
+
+        self.assertRaises(AttributeError, lambda: msg.spam)
+
+    @schemas({
         0: {'test': {}},
     })
     def test_getattr_argument_nodefault(self):
@@ -176,7 +318,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.spam, 'spam')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {'defaults': {'spam': 'default'}}},
     })
     def test_getattr_argument_withdefault(self):
@@ -184,7 +326,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.spam, 'spam')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {'defaults': {'spam': 'default'}}},
     })
     def test_getattr_default(self):
@@ -192,7 +334,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.spam, 'default')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_version(self):
@@ -200,7 +342,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.version, protocol._curr_version)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_msg_type(self):
@@ -208,7 +350,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.msg_type, 'test')
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_known_known(self):
@@ -216,7 +358,7 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.known, True)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     def test_known_unknown(self):
@@ -224,7 +366,38 @@ class MessageTest(unittest.TestCase):
 
         self.assertEqual(msg.known, False)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
+        0: {'test': {'required': set(['a']), 'defaults': {'b': 2}}},
+    })
+    @mock.patch.object(protocol, 'splice_frame', return_value='spliced')
+    def test_splice_unframed(self, mock_splice_frame):
+        msg = protocol.Message('test', a=1, b=3, c=4)
+
+        result = msg.splice(('a', 'c'), b=5, d=6)
+
+        self.assertFalse(mock_splice_frame.called)
+        self.assertEqual(result.msg_type, 'test')
+        self.assertEqual(result.a, 1)
+        self.assertEqual(result.b, 5)
+        self.assertEqual(result._extra, {'c': 4, 'd': 6})
+        self.assertEqual(result._frame, None)
+
+    @schemas({
+        0: {'test': {'required': set(['a']), 'defaults': {'b': 2}}},
+    })
+    @mock.patch.object(protocol, 'splice_frame', return_value='spliced')
+    def test_splice_framed(self, mock_splice_frame):
+        msg = protocol.Message('test', a=1, b=3, __frame__='frame')
+
+        result = msg.splice(('a',), b=5)
+
+        mock_splice_frame.assert_called_once_with(
+            'frame', ('a', 'msg_type', '__version__'), {'b': 5})
+        self.assertEqual(result.a, 1)
+        self.assertEqual(result.b, 5)
+        self.assertEqual(result._frame, 'spliced')
+
+    @schemas({
         0: {'test': {}},
     })
     @mock.patch('msgpack.dumps', return_value='frame')
@@ -234,6 +407,7 @@ class MessageTest(unittest.TestCase):
         result = msg.to_frame()
 
         self.assertEqual(result, 'frame')
+        self.assertEqual(msg._frame, 'frame')
         mock_dumps.assert_called_once_with({
             'msg_type': 'test',
             '__version__': 0,
@@ -242,7 +416,26 @@ class MessageTest(unittest.TestCase):
             'c': 3,
         })
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
+        0: {'test': {'required': set(['a']),
+                     'defaults': {'b': 2, 'c': 4, 'd': 5}}},
+    })
+    @mock.patch('msgpack.dumps', return_value='frame')
+    def test_to_frame_defaults(self, mock_dumps):
+        msg = protocol.Message('test', a=1, b=2, c=3, e=6)
+
+        result = msg.to_frame()
+
+        self.assertEqual(result, 'frame')
+        mock_dumps.assert_called_once_with({
+            'msg_type': 'test',
+            '__version__': 0,
+            'a': 1,
+            'c': 3,
+            'e': 6,
+        })
+
+    @schemas({
         0: {'test': {}},
     })
     @mock.patch('msgpack.dumps', return_value='frame')
@@ -254,7 +447,7 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(result, 'cached')
         self.assertFalse(mock_dumps.called)
 
-    @mock.patch.dict(protocol._versions, {
+    @schemas({
         0: {'test': {}},
     })
     @mock.patch('msgpack.dumps', return_value='frame')
@@ -263,3 +456,56 @@ class MessageTest(unittest.TestCase):
 
         self.assertRaises(ValueError, msg.to_frame, -1)
         self.assertFalse(mock_dumps.called)
+
+    def test_round_trip(self):
+        msg = protocol.Message('notify', app_name='app', summary='summary',
+                               body='body', urgency=protocol.URGENCY_CRITICAL)
+
+        result = protocol.Message.from_frame(msg.to_frame())
+
+        self.assertEqual(result.msg_type, 'notify')
+        self.assertEqual(result.app_name, 'app')
+        self.assertEqual(result.summary, 'summary')
+        self.assertEqual(result.body, 'body')
+        self.assertEqual(result.urgency, protocol.URGENCY_CRITICAL)
+        self.assertEqual(result.category, None)
+        self.assertEqual(result._extra, None)
+
+    def test_splice_round_trip(self):
+        frame = protocol.Message('notify', app_name='app', summary='summary',
+                                 body='body', seq=5).to_frame()
+        msg = protocol.Message.from_frame(frame)
+
+        result = protocol.Message.from_frame(
+            msg.splice(('summary', 'body'), app_name='[host]app').to_frame())
+
+        self.assertEqual(result.msg_type, 'notify')
+        self.assertEqual(result.app_name, '[host]app')
+        self.assertEqual(result.summary, 'summary')
+        self.assertEqual(result.body, 'body')
+        self.assertEqual(result.seq, None)
+
+    def test_from_frame_compressed(self):
+        frame = protocol.Message('notify', app_name='app', summary='summary',
+                                 body='x' * 1000).to_frame()
+
+        result = protocol.Message.from_frame(protocol.compress_frame(frame),
+                                             compressed=True)
+
+        self.assertEqual(result.body, 'x' * 1000)
+        self.assertEqual(result.to_frame(), frame)
+
+    def test_from_frame_compressed_unnegotiated(self):
+        frame = protocol.Message('notify', app_name='app', summary='summary',
+                                 body='x' * 1000).to_frame()
+
+        self.assertRaises(ValueError, protocol.Message.from_frame,
+                          protocol.compress_frame(frame))
+
+    @mock.patch.object(protocol, 'MAX_FRAME', 100)
+    def test_from_frame_compressed_oversized(self):
+        frame = protocol.Message('notify', app_name='app', summary='summary',
+                                 body='x' * 1000).to_frame()
+
+        self.assertRaises(ValueError, protocol.Message.from_frame,
+                          protocol.compress_frame(frame), compressed=True)
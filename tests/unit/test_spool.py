@@ -0,0 +1,363 @@
+# Copyright 2014 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from heyu import protocol
+from heyu import spool
+
+
+def notif(i, notif_id=None):
+    return {
+        'app_name': 'app',
+        'summary': 'summary %d' % i,
+        'body': 'body',
+        'urgency': protocol.URGENCY_LOW,
+        'category': None,
+        'id': notif_id or 'id%d' % i,
+    }
+
+
+class DedupTest(unittest.TestCase):
+    def test_unique(self):
+        notifs = [notif(0), notif(1), notif(2)]
+
+        self.assertEqual(notifs, spool.dedup(notifs))
+
+    def test_replaced(self):
+        notifs = [notif(0, 'a'), notif(1, 'b'), notif(2, 'a')]
+
+        self.assertEqual([notifs[1], notifs[2]], spool.dedup(notifs))
+
+
+class UnpackTest(unittest.TestCase):
+    def test_roundtrip(self):
+        data = spool._pack(notif(0)) + spool._pack(notif(1))
+
+        result = list(spool._unpack(data, False))
+
+        self.assertEqual([
+            (len(spool._pack(notif(0))), notif(0)),
+            (len(data), notif(1)),
+        ], result)
+
+    def test_incomplete(self):
+        data = spool._pack(notif(0))
+        partial = data + spool._pack(notif(1))[:-3]
+
+        self.assertEqual([(len(data), notif(0))],
+                         list(spool._unpack(partial, False)))
+        self.assertEqual([(len(data), notif(0)), (len(partial), None)],
+                         list(spool._unpack(partial, True)))
+
+    def test_incomplete_partial(self):
+        data = spool._pack(notif(0))
+        magic = dict(notif(1), body='body HYSP body')
+        partial = data + spool._pack(magic)[:-3]
+
+        self.assertEqual([(len(data), notif(0))],
+                         list(spool._unpack(partial, False, True)))
+        self.assertEqual([(len(data), notif(0)), (len(partial), None)],
+                         list(spool._unpack(partial, True)))
+
+    def test_short_garbage(self):
+        data = spool._pack(notif(0))
+
+        self.assertEqual([(len(data), notif(0))],
+                         list(spool._unpack(data + 'HY', False)))
+        self.assertEqual([(len(data), notif(0)), (len(data) + 2, None)],
+                         list(spool._unpack(data + 'HY', True)))
+
+    def test_torn_then_appended(self):
+        torn = spool._pack(notif(0))[:-3]
+        good = spool._pack(notif(1))
+
+        result = list(spool._unpack(torn + good, False))
+
+        self.assertEqual([(len(torn + good), notif(1))], result)
+
+    def test_bad_crc(self):
+        bad = spool._pack(notif(0))
+        bad = bad[:-1] + chr(ord(bad[-1]) ^ 1)
+        good = spool._pack(notif(1))
+
+        result = list(spool._unpack(bad + good, False))
+
+        self.assertEqual([(len(bad + good), notif(1))], result)
+
+    def test_garbage(self):
+        good = spool._pack(notif(1))
+
+        result = list(spool._unpack('garbage' + good, False))
+
+        self.assertEqual([(len(good) + 7, notif(1))], result)
+
+    def test_undecodable(self):
+        frame = protocol.Message('goodbye').to_frame()
+        record = spool.RECORD_HEADER.pack(
+            spool.RECORD_MAGIC, len(frame),
+            spool.zlib.crc32(frame) & 0xffffffff) + frame
+
+        self.assertEqual([(len(record), None)],
+                         list(spool._unpack(record, False)))
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_init_creates(self):
+        path = os.path.join(self.path, 'sub', 'spool')
+
+        spool.Spool(path)
+
+        self.assertTrue(os.path.isdir(path))
+
+    @mock.patch('os.makedirs', side_effect=OSError(13, 'Permission denied'))
+    def test_init_failed(self, mock_makedirs):
+        self.assertRaises(OSError, spool.Spool, self.path)
+
+    def test_append_read(self):
+        sp = spool.Spool(self.path)
+
+        sp.append([notif(0), notif(1)])
+        sp.commit()
+
+        self.assertEqual(['0000000000000001.seg', 'lock'],
+                         sorted(os.listdir(self.path)))
+        result = sp.read(10)
+        self.assertEqual([notif(0), notif(1)], [n for _pos, n in result])
+        self.assertEqual(1, result[0][0][0])
+        self.assertEqual([], sp.read(10))
+
+        sp.append([notif(2)])
+        self.assertEqual([notif(2)], [n for _pos, n in sp.read(10)])
+
+    def test_read_empty(self):
+        sp = spool.Spool(self.path)
+
+        self.assertEqual([], sp.read(10))
+
+    def test_read_max(self):
+        sp = spool.Spool(self.path)
+        sp.append([notif(i) for i in range(5)])
+
+        self.assertEqual([notif(0), notif(1)],
+                         [n for _pos, n in sp.read(2)])
+        self.assertEqual([notif(2), notif(3)],
+                         [n for _pos, n in sp.read(2)])
+        self.assertEqual([notif(4)], [n for _pos, n in sp.read(2)])
+
+    def test_read_blocks(self):
+        sp = spool.Spool(self.path)
+        sp.append([notif(i) for i in range(5)])
+        record_size = len(spool._pack(notif(0)))
+
+        # Records span the blocks
+        with mock.patch.object(spool, 'READ_SIZE', record_size // 2 + 1):
+            self.assertEqual([notif(0), notif(1)],
+                             [n for _pos, n in sp.read(2)])
+            self.assertEqual([notif(2), notif(3), notif(4)],
+                             [n for _pos, n in sp.read(10)])
+
+    def test_read_bounded(self):
+        sp = spool.Spool(self.path)
+        sp.append([notif(i) for i in range(100)])
+        record_size = len(spool._pack(notif(0)))
+        real_open = open
+        reads = []
+
+        def fake_open(path, mode='r'):
+            f = mock.Mock(wraps=real_open(path, mode))
+            f.__enter__ = mock.Mock(return_value=f)
+            f.__exit__ = mock.Mock(return_value=False)
+            reads.append(f.read)
+            return f
+
+        with mock.patch.object(spool, 'READ_SIZE', record_size * 3), \
+                mock.patch('__builtin__.open', side_effect=fake_open):
+            result = sp.read(2)
+
+        self.assertEqual([notif(0), notif(1)], [n for _pos, n in result])
+        self.assertEqual(1, len(reads))
+        reads[0].assert_called_once_with(record_size * 3)
+
+    def test_rotation(self):
+        sp = spool.Spool(self.path, segment_size=1)
+
+        for i in range(3):
+            sp.append([notif(i)])
+        sp.commit()
+
+        self.assertEqual(['0000000000000001.seg', '0000000000000002.seg',
+                          '0000000000000003.seg', 'lock'],
+                         sorted(os.listdir(self.path)))
+        self.assertEqual([], sp._retired)
+        result = sp.read(10)
+        self.assertEqual([notif(0), notif(1), notif(2)],
+                         [n for _pos, n in result])
+        self.assertEqual([1, 2, 3], [pos[0] for pos, _n in result])
+
+    def test_rotation_other_writer(self):
+        sp1 = spool.Spool(self.path, segment_size=1)
+        sp2 = spool.Spool(self.path, segment_size=1)
+
+        sp1.append([notif(0)])
+        sp2.append([notif(1)])
+        sp1.append([notif(2)])
+
+        self.assertEqual(['0000000000000001.seg', '0000000000000002.seg',
+                          '0000000000000003.seg', 'lock'],
+                         sorted(os.listdir(self.path)))
+        self.assertEqual([notif(0), notif(1), notif(2)],
+                         [n for _pos, n in sp1.read(10)])
+
+    def test_ack(self):
+        sp = spool.Spool(self.path, segment_size=1)
+        for i in range(3):
+            sp.append([notif(i)])
+        result = sp.read(10)
+
+        sp.ack(result[1][0])
+
+        self.assertEqual(['0000000000000002.seg', '0000000000000003.seg',
+                          'cursor', 'lock'], sorted(os.listdir(self.path)))
+        with open(os.path.join(self.path, 'cursor')) as f:
+            self.assertEqual('%d %d\n' % result[1][0], f.read())
+
+        # A new drainer picks up after the acknowledged notifications
+        sp2 = spool.Spool(self.path)
+        sp2.lock_drain()
+        self.assertEqual([notif(2)], [n for _pos, n in sp2.read(10)])
+
+    def test_rewind(self):
+        sp = spool.Spool(self.path)
+        sp.append([notif(i) for i in range(3)])
+        result = sp.read(10)
+        sp.ack(result[0][0])
+
+        sp.rewind()
+
+        self.assertEqual([notif(1), notif(2)], [n for _pos, n in sp.read(10)])
+
+    def test_read_missing_segment(self):
+        sp = spool.Spool(self.path)
+        sp._read_pos = (5, 100)
+        sp.append([notif(0)])
+
+        self.assertEqual([notif(0)], [n for _pos, n in sp.read(10)])
+
+    def test_append_after_cursor(self):
+        with open(os.path.join(self.path, 'cursor'), 'w') as f:
+            f.write('5 100\n')
+        sp = spool.Spool(self.path)
+
+        sp.append([notif(0)])
+
+        self.assertTrue(os.path.exists(
+            os.path.join(self.path, '0000000000000006.seg')))
+        self.assertEqual([notif(0)], [n for _pos, n in sp.read(10)])
+
+    def test_bad_cursor(self):
+        with open(os.path.join(self.path, 'cursor'), 'w') as f:
+            f.write('garbage\n')
+
+        sp = spool.Spool(self.path)
+
+        self.assertEqual((0, 0), sp._cursor)
+
+    def test_lock_drain(self):
+        sp1 = spool.Spool(self.path)
+        sp2 = spool.Spool(self.path)
+
+        sp1.lock_drain()
+        sp1.lock_drain()
+
+        self.assertRaises(spool.SpoolException, sp2.lock_drain)
+
+        sp1.close()
+        sp2.lock_drain()
+
+    @mock.patch('os.fsync')
+    def test_commit(self, mock_fsync):
+        sp = spool.Spool(self.path)
+
+        sp.commit()
+        self.assertFalse(mock_fsync.called)
+
+        sp.append([notif(0)])
+        sp.commit()
+
+        mock_fsync.assert_called_once_with(sp._fd)
+        self.assertEqual(False, sp._dirty)
+        self.assertEqual(None, sp._sync_result)
+
+    @mock.patch('os.fsync', side_effect=OSError(5, 'I/O error'))
+    def test_commit_failed(self, mock_fsync):
+        sp = spool.Spool(self.path)
+        sp.append([notif(0)])
+
+        self.assertRaises(OSError, sp.commit)
+
+    @mock.patch('os.fsync')
+    def test_close(self, mock_fsync):
+        sp = spool.Spool(self.path)
+        sp.append([notif(0)])
+        fd = sp._fd
+
+        sp.close()
+
+        mock_fsync.assert_called_once_with(fd)
+        self.assertEqual(None, sp._fd)
+        self.assertEqual([], sp._retired)
+
+
+class MemorySpoolTest(unittest.TestCase):
+    def test_append_read_ack(self):
+        sp = spool.MemorySpool()
+
+        sp.append(['a', 'b', 'c'])
+
+        self.assertEqual(3, len(sp))
+        self.assertEqual([(1, 'a'), (2, 'b')], sp.read(2))
+        self.assertEqual([(3, 'c')], sp.read(2))
+        self.assertEqual([], sp.read(2))
+
+        sp.ack(2)
+        self.assertEqual(1, len(sp))
+
+        sp.rewind()
+        self.assertEqual([(3, 'c')], sp.read(2))
+
+    def test_full(self):
+        sp = spool.MemorySpool(2)
+        sp.append(['a'])
+
+        self.assertRaises(spool.SpoolFull, sp.append, ['b', 'c'])
+        sp.append(['b'])
+        self.assertEqual(2, len(sp))
+
+    def test_noops(self):
+        sp = spool.MemorySpool()
+
+        sp.commit()
+        sp.lock_drain()
+        sp.close()
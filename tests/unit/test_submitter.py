@@ -15,23 +15,31 @@
 
 from __future__ import print_function
 
+import socket
 import sys
 import unittest
 
 import mock
 
 from heyu import protocol
+from heyu import spool
 from heyu import submitter
 from heyu import util
 
 
+class TestException(Exception):
+    pass
+
+
 class SubmitterApplicationTest(unittest.TestCase):
     @mock.patch('tendril.COBSFramer', return_value='framer')
     @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
         'to_frame.return_value': 'message',
     }))
     @mock.patch.object(submitter.SubmitterApplication, 'send_frame')
-    def test_init_basic(self, mock_send_frame, mock_Message, mock_COBSFramer):
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    def test_init_basic(self, mock_uuid4, mock_send_frame, mock_Message,
+                        mock_COBSFramer):
         parent = mock.Mock()
 
         app = submitter.SubmitterApplication(parent, 'app', 'summary', 'body')
@@ -40,7 +48,8 @@ class SubmitterApplicationTest(unittest.TestCase):
         mock_COBSFramer.assert_called_once_with(True)
         self.assertEqual('framer', parent.framers)
         mock_Message.assert_called_once_with(
-            'notify', app_name='app', summary='summary', body='body')
+            'notify', app_name='app', summary='summary', body='body',
+            id='some-uuid')
         mock_send_frame.assert_called_once_with('message')
 
     @mock.patch('tendril.COBSFramer', return_value='framer')
@@ -133,6 +142,544 @@ class SubmitterApplicationTest(unittest.TestCase):
         mock_close.assert_called_once_with()
 
 
+class SessionApplicationTest(unittest.TestCase):
+    @mock.patch('tendril.COBSFramer', return_value='framer')
+    @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'message',
+    }))
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_init(self, mock_send_frame, mock_Message, mock_COBSFramer):
+        parent = mock.Mock()
+
+        app = submitter.SessionApplication(parent)
+
+        self.assertEqual(parent, app.parent)
+        mock_COBSFramer.assert_called_once_with(True)
+        self.assertEqual('framer', parent.framers)
+        self.assertEqual(0, app._next_seq)
+        self.assertEqual({}, app._pending)
+        self.assertEqual([], app._held)
+        self.assertEqual(False, app._compress)
+        self.assertEqual(True, app.active)
+        mock_Message.assert_called_once_with(
+            'hello', capabilities=(protocol.CAP_LENGTH_FRAMING,
+                                   protocol.CAP_ZLIB))
+        mock_send_frame.assert_called_once_with('message')
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'message',
+    }))
+    @mock.patch('gevent.event.AsyncResult', side_effect=['res1', 'res2'])
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    def test_notify(self, mock_uuid4, mock_AsyncResult, mock_Message,
+                    mock_send_frame, mock_init):
+        app = submitter.SessionApplication()
+        app._next_seq = 5
+        app._pending = {}
+        app._held = None
+        app._compress = False
+
+        result1 = app.notify('app', 'summary', 'body')
+        result2 = app.notify('app', 'summary', 'body', 'urgency',
+                             'category', 'id')
+
+        self.assertEqual('res1', result1)
+        self.assertEqual('res2', result2)
+        self.assertEqual(7, app._next_seq)
+        self.assertEqual({5: 'res1', 6: 'res2'}, app._pending)
+        mock_Message.assert_has_calls([
+            mock.call('notify', app_name='app', summary='summary',
+                      body='body', seq=5, id='some-uuid'),
+            mock.call('notify', app_name='app', summary='summary',
+                      body='body', seq=6, urgency='urgency',
+                      category='category', id='id'),
+        ], any_order=True)
+        mock_send_frame.assert_has_calls([
+            mock.call('message'),
+            mock.call('message'),
+        ])
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    @mock.patch('gevent.event.AsyncResult', return_value='result')
+    @mock.patch('uuid.uuid4', return_value='some-uuid')
+    def test_notify_batch(self, mock_uuid4, mock_AsyncResult,
+                          mock_send_frame, mock_init):
+        app = submitter.SessionApplication()
+        app._next_seq = 5
+        app._pending = {}
+        app._held = None
+        app._compress = False
+
+        result = app.notify_batch([
+            {'app_name': 'app', 'summary': 'one', 'body': 'body'},
+            {'app_name': 'app', 'summary': 'two', 'body': 'body',
+             'urgency': None, 'id': 'id2'},
+        ])
+
+        self.assertEqual('result', result)
+        self.assertEqual(6, app._next_seq)
+        self.assertEqual({5: 'result'}, app._pending)
+        self.assertEqual(1, mock_send_frame.call_count)
+        msg = protocol.Message.from_frame(mock_send_frame.call_args[0][0])
+        self.assertEqual('notify_batch', msg.msg_type)
+        self.assertEqual(5, msg.seq)
+        notifs = [protocol.Message.from_frame(frame)
+                  for frame in msg.notifications]
+        self.assertEqual(['one', 'two'], [n.summary for n in notifs])
+        self.assertEqual(['some-uuid', 'id2'], [n.id for n in notifs])
+        self.assertEqual(protocol.URGENCY_LOW, notifs[1].urgency)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='accepted', id='notification-id', seq=5))
+    def test_recv_frame_accepted(self, mock_from_frame, mock_fail,
+                                 mock_close, mock_init):
+        result = mock.Mock()
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: result, 6: 'other'}
+
+        app.recv_frame('frame')
+
+        mock_from_frame.assert_called_once_with('frame',
+                                                compressed=False)
+        result.set.assert_called_once_with('notification-id')
+        self.assertEqual({6: 'other'}, app._pending)
+        self.assertFalse(mock_fail.called)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='accepted_batch', ids=['id1', 'id2'], seq=5))
+    def test_recv_frame_accepted_batch(self, mock_from_frame, mock_fail,
+                                       mock_close, mock_init):
+        result = mock.Mock()
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: result, 6: 'other'}
+
+        app.recv_frame('frame')
+
+        result.set.assert_called_once_with(['id1', 'id2'])
+        self.assertEqual({6: 'other'}, app._pending)
+        self.assertFalse(mock_fail.called)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='error', reason='bad things', seq=5))
+    def test_recv_frame_error(self, mock_from_frame, mock_fail,
+                              mock_close, mock_init):
+        result = mock.Mock()
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: result, 6: 'other'}
+
+        app.recv_frame('frame')
+
+        mock_from_frame.assert_called_once_with('frame',
+                                                compressed=False)
+        self.assertEqual(1, result.set_exception.call_count)
+        exc = result.set_exception.call_args[0][0]
+        self.assertTrue(isinstance(exc, submitter.SubmitterException))
+        self.assertEqual('Failed to submit notification: bad things',
+                         str(exc))
+        self.assertEqual({6: 'other'}, app._pending)
+        self.assertFalse(mock_fail.called)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='error', reason='bad things', seq=None))
+    def test_recv_frame_error_unmatched(self, mock_from_frame, mock_fail,
+                                        mock_close, mock_init):
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: 'result'}
+
+        app.recv_frame('frame')
+
+        mock_fail.assert_called_once_with(
+            'Failed to submit notification: bad things')
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='goodbye'))
+    def test_recv_frame_goodbye(self, mock_from_frame, mock_fail,
+                                mock_close, mock_init):
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: 'result'}
+
+        app.recv_frame('frame')
+
+        mock_fail.assert_called_once_with('Session closed by the HeyU hub')
+        mock_close.assert_called_once_with()
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(submitter.SessionApplication, '_established')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='hello'))
+    def test_recv_frame_hello(self, mock_from_frame, mock_established,
+                              mock_fail, mock_close, mock_init):
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: 'result'}
+        app._held = []
+
+        app.recv_frame('frame')
+
+        self.assertEqual({5: 'result'}, app._pending)
+        mock_established.assert_called_once_with(
+            mock_from_frame.return_value)
+        self.assertFalse(mock_fail.called)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(submitter.SessionApplication, '_established')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='hello'))
+    def test_recv_frame_hello_established(self, mock_from_frame,
+                                          mock_established, mock_fail,
+                                          mock_close, mock_init):
+        app = submitter.SessionApplication()
+        app._compress = False
+        app._pending = {5: 'result'}
+        app._held = None
+
+        app.recv_frame('frame')
+
+        self.assertFalse(mock_established.called)
+        self.assertFalse(mock_fail.called)
+        self.assertFalse(mock_close.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_send_held(self, mock_send_frame, mock_init):
+        app = submitter.SessionApplication()
+        app._held = ['frame1']
+
+        app._send('frame2')
+
+        self.assertEqual(['frame1', 'frame2'], app._held)
+        self.assertFalse(mock_send_frame.called)
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_send_established(self, mock_send_frame, mock_init):
+        app = submitter.SessionApplication()
+        app._held = None
+        app._compress = False
+
+        app._send('frame')
+
+        mock_send_frame.assert_called_once_with('frame')
+
+    @mock.patch.object(protocol, 'compress_frame', return_value='compressed')
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_send_compressed(self, mock_send_frame, mock_init,
+                             mock_compress_frame):
+        app = submitter.SessionApplication()
+        app._held = None
+        app._compress = True
+
+        app._send('frame')
+
+        mock_compress_frame.assert_called_once_with('frame')
+        mock_send_frame.assert_called_once_with('compressed')
+
+    @mock.patch('tendril.StructFramer', return_value='framer')
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_established_cobs(self, mock_send_frame, mock_init,
+                              mock_StructFramer):
+        app = submitter.SessionApplication()
+        app.parent = mock.Mock(framers='cobs')
+        app._held = ['frame1', 'frame2']
+
+        app._established(mock.Mock(capabilities=()))
+
+        self.assertEqual(None, app._held)
+        self.assertEqual(False, app._compress)
+        self.assertFalse(mock_StructFramer.called)
+        self.assertEqual('cobs', app.parent.framers)
+        mock_send_frame.assert_has_calls([
+            mock.call('frame1'),
+            mock.call('frame2'),
+        ])
+
+    @mock.patch('tendril.StructFramer', return_value='framer')
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_established_length(self, mock_send_frame, mock_init,
+                                mock_StructFramer):
+        app = submitter.SessionApplication()
+        app.parent = mock.Mock(framers='cobs')
+        app._held = ['frame1']
+
+        app._established(mock.Mock(capabilities=('length-framing',)))
+
+        self.assertEqual(None, app._held)
+        self.assertEqual(False, app._compress)
+        mock_StructFramer.assert_called_once_with('!I')
+        self.assertEqual('framer', app.parent.framers)
+        mock_send_frame.assert_called_once_with('frame1')
+
+    @mock.patch.object(protocol, 'compress_frame', return_value='compressed')
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame')
+    def test_established_zlib(self, mock_send_frame, mock_init,
+                              mock_compress_frame):
+        app = submitter.SessionApplication()
+        app.parent = mock.Mock(framers='cobs')
+        app._held = ['frame1']
+
+        app._established(mock.Mock(capabilities=('zlib',)))
+
+        self.assertEqual(None, app._held)
+        self.assertEqual(True, app._compress)
+        self.assertEqual('cobs', app.parent.framers)
+        mock_compress_frame.assert_called_once_with('frame1')
+        mock_send_frame.assert_called_once_with('compressed')
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol.Message, 'from_frame',
+                       side_effect=ValueError('bad frame'))
+    def test_recv_frame_parse_error(self, mock_from_frame, mock_fail,
+                                    mock_close, mock_init):
+        app = submitter.SessionApplication()
+        app._compress = False
+
+        app.recv_frame('frame')
+
+        mock_fail.assert_called_once_with('Failed to parse frame: bad frame')
+        mock_close.assert_called_once_with()
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    def test_fail(self, mock_init):
+        results = [mock.Mock(), mock.Mock()]
+        app = submitter.SessionApplication()
+        app._pending = {1: results[0], 2: results[1]}
+
+        app._fail('reason')
+
+        self.assertEqual({}, app._pending)
+        self.assertEqual(False, app.active)
+        for result in results:
+            exc = result.set_exception.call_args[0][0]
+            self.assertTrue(isinstance(exc, submitter.SessionClosed))
+            self.assertEqual('reason', str(exc))
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, 'send_frame',
+                       side_effect=TestException('test'))
+    @mock.patch.object(submitter.SessionApplication, 'close')
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    @mock.patch.object(protocol, 'Message', return_value=mock.Mock(**{
+        'to_frame.return_value': 'frame',
+    }))
+    def test_disconnect(self, mock_Message, mock_fail, mock_close,
+                        mock_send_frame, mock_init):
+        app = submitter.SessionApplication()
+
+        app.disconnect()
+
+        mock_Message.assert_called_once_with('goodbye')
+        mock_send_frame.assert_called_once_with('frame')
+        mock_close.assert_called_once_with()
+        mock_fail.assert_called_once_with('Session closed')
+
+    @mock.patch.object(submitter.SessionApplication, '__init__',
+                       return_value=None)
+    @mock.patch.object(submitter.SessionApplication, '_fail')
+    def test_closed(self, mock_fail, mock_init):
+        app = submitter.SessionApplication()
+
+        app.closed(None)
+
+        mock_fail.assert_called_once_with('Connection to the HeyU hub closed')
+
+
+class OpenSessionTest(unittest.TestCase):
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager')
+    def test_basic(self, mock_get_manager, mock_cert_wrapper,
+                   mock_outgoing_endpoint):
+        manager = mock_get_manager.return_value
+        manager.running = False
+        manager.connect.return_value = mock.Mock(application='session')
+
+        result = submitter.open_session('hub', 'cert_conf', False)
+
+        self.assertEqual('session', result)
+        mock_outgoing_endpoint.assert_called_once_with('hub')
+        mock_get_manager.assert_called_once_with('tcp', 'outgoing')
+        manager.assert_has_calls([
+            mock.call.start(),
+            mock.call.connect('hub', submitter.SessionApplication,
+                              'wrapper'),
+        ])
+        mock_cert_wrapper.assert_called_once_with(
+            'cert_conf', 'submitter', secure=False)
+
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager')
+    def test_running(self, mock_get_manager, mock_cert_wrapper,
+                     mock_outgoing_endpoint):
+        manager = mock_get_manager.return_value
+        manager.running = True
+        manager.connect.return_value = mock.Mock(application='session')
+
+        result = submitter.open_session('hub')
+
+        self.assertEqual('session', result)
+        self.assertFalse(manager.start.called)
+        manager.connect.assert_called_once_with(
+            'hub', submitter.SessionApplication, 'wrapper')
+        mock_cert_wrapper.assert_called_once_with(
+            None, 'submitter', secure=True)
+
+
+class SubmitViaAgentTest(unittest.TestCase):
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket')
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value='reply')
+    @mock.patch.object(protocol, 'Message', **{
+        'return_value.to_frame.return_value': 'frame',
+        'from_frame.return_value': mock.Mock(msg_type='accepted',
+                                             id='notif_id'),
+    })
+    def test_basic(self, mock_Message, mock_read_frame, mock_write_frame,
+                   mock_socket, mock_expanduser):
+        sock = mock_socket.return_value
+
+        result = submitter.submit_via_agent('~/.heyu.agent', 'app',
+                                            'summary', 'body')
+
+        self.assertEqual('notif_id', result)
+        mock_Message.assert_called_once_with(
+            'notify', app_name='app', summary='summary', body='body')
+        mock_socket.assert_called_once_with(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+        mock_expanduser.assert_called_once_with('~/.heyu.agent')
+        sock.assert_has_calls([
+            mock.call.connect('/home/dir/.heyu.agent'),
+            mock.call.close(),
+        ])
+        mock_write_frame.assert_called_once_with(sock, 'frame')
+        mock_read_frame.assert_called_once_with(sock)
+        mock_Message.from_frame.assert_called_once_with('reply')
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket')
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value='reply')
+    @mock.patch.object(protocol, 'Message', **{
+        'return_value.to_frame.return_value': 'frame',
+        'from_frame.return_value': mock.Mock(msg_type='accepted',
+                                             id='notif_id'),
+    })
+    def test_extra(self, mock_Message, mock_read_frame, mock_write_frame,
+                   mock_socket, mock_expanduser):
+        result = submitter.submit_via_agent('~/.heyu.agent', 'app',
+                                            'summary', 'body', 'urgency',
+                                            'category', 'id')
+
+        self.assertEqual('notif_id', result)
+        mock_Message.assert_called_once_with(
+            'notify', app_name='app', summary='summary', body='body',
+            urgency='urgency', category='category', id='id')
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket', return_value=mock.Mock(**{
+        'connect.side_effect': socket.error(2, 'No such file or directory'),
+    }))
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value='reply')
+    def test_no_agent(self, mock_read_frame, mock_write_frame, mock_socket,
+                      mock_expanduser):
+        self.assertRaises(socket.error, submitter.submit_via_agent,
+                          '~/.heyu.agent', 'app', 'summary', 'body')
+        mock_socket.return_value.close.assert_called_once_with()
+        self.assertFalse(mock_write_frame.called)
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket')
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value=None)
+    def test_closed(self, mock_read_frame, mock_write_frame, mock_socket,
+                    mock_expanduser):
+        self.assertRaises(submitter.SubmitterException,
+                          submitter.submit_via_agent,
+                          '~/.heyu.agent', 'app', 'summary', 'body')
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket')
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value='reply')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='error', reason='full'))
+    def test_error(self, mock_from_frame, mock_read_frame, mock_write_frame,
+                   mock_socket, mock_expanduser):
+        self.assertRaises(submitter.SubmitterException,
+                          submitter.submit_via_agent,
+                          '~/.heyu.agent', 'app', 'summary', 'body')
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.agent')
+    @mock.patch('socket.socket')
+    @mock.patch.object(util, 'write_frame')
+    @mock.patch.object(util, 'read_frame', return_value='reply')
+    @mock.patch.object(protocol.Message, 'from_frame', return_value=mock.Mock(
+        msg_type='other'))
+    def test_unknown(self, mock_from_frame, mock_read_frame, mock_write_frame,
+                     mock_socket, mock_expanduser):
+        self.assertRaises(submitter.SubmitterException,
+                          submitter.submit_via_agent,
+                          '~/.heyu.agent', 'app', 'summary', 'body')
+
+
 class SendNotificationTest(unittest.TestCase):
     @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
     @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
@@ -176,6 +723,108 @@ class SendNotificationTest(unittest.TestCase):
         mock_cert_wrapper.assert_called_once_with(
             'cert_conf', 'submitter', secure=False)
 
+    @mock.patch.object(submitter, 'submit_via_agent', return_value='notif_id')
+    @mock.patch('tendril.get_manager')
+    @mock.patch('__builtin__.print')
+    def test_agent(self, mock_print, mock_get_manager, mock_submit_via_agent):
+        submitter.send_notification('hub', 'app', 'summary', 'body',
+                                    agent='agent')
+
+        mock_submit_via_agent.assert_called_once_with(
+            'agent', 'app', 'summary', 'body', None, None, None)
+        mock_print.assert_called_once_with('notif_id')
+        self.assertFalse(mock_get_manager.called)
+
+    @mock.patch.object(submitter, 'submit_via_agent',
+                       side_effect=socket.error(111, 'Connection refused'))
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager')
+    @mock.patch('tendril.TendrilPartial', return_value='the_app')
+    @mock.patch('__builtin__.print')
+    def test_agent_fallback(self, mock_print, mock_TendrilPartial,
+                            mock_get_manager, mock_cert_wrapper,
+                            mock_outgoing_endpoint, mock_submit_via_agent):
+        submitter.send_notification('hub', 'app', 'summary', 'body',
+                                    'urgency', 'category', 'id',
+                                    agent='agent')
+
+        mock_submit_via_agent.assert_called_once_with(
+            'agent', 'app', 'summary', 'body', 'urgency', 'category', 'id')
+        self.assertFalse(mock_print.called)
+        mock_get_manager.return_value.assert_has_calls([
+            mock.call.start(),
+            mock.call.connect('hub', 'the_app', 'wrapper'),
+        ])
+
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager', return_value=mock.Mock(**{
+        'connect.side_effect': socket.error(111, 'Connection refused'),
+    }))
+    @mock.patch('tendril.TendrilPartial', return_value='the_app')
+    @mock.patch.object(spool, 'Spool')
+    @mock.patch('uuid.uuid4', return_value='uuid')
+    @mock.patch('__builtin__.print')
+    def test_spool(self, mock_print, mock_uuid4, mock_Spool,
+                   mock_TendrilPartial, mock_get_manager, mock_cert_wrapper,
+                   mock_outgoing_endpoint):
+        submitter.send_notification('hub', 'app', 'summary', 'body',
+                                    spool_dir='spool_dir')
+
+        mock_Spool.assert_called_once_with('spool_dir')
+        mock_Spool.return_value.assert_has_calls([
+            mock.call.append([{
+                'app_name': 'app',
+                'summary': 'summary',
+                'body': 'body',
+                'urgency': protocol.URGENCY_LOW,
+                'category': None,
+                'id': 'uuid',
+            }]),
+            mock.call.close(),
+        ])
+        mock_print.assert_called_once_with('uuid')
+
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager', return_value=mock.Mock(**{
+        'connect.side_effect': socket.error(111, 'Connection refused'),
+    }))
+    @mock.patch('tendril.TendrilPartial', return_value='the_app')
+    @mock.patch.object(spool, 'Spool')
+    @mock.patch('uuid.uuid4', return_value='uuid')
+    @mock.patch('__builtin__.print')
+    def test_spool_extra(self, mock_print, mock_uuid4, mock_Spool,
+                         mock_TendrilPartial, mock_get_manager,
+                         mock_cert_wrapper, mock_outgoing_endpoint):
+        submitter.send_notification('hub', 'app', 'summary', 'body',
+                                    2, 'category', 'id',
+                                    spool_dir='spool_dir')
+
+        mock_Spool.return_value.append.assert_called_once_with([{
+            'app_name': 'app',
+            'summary': 'summary',
+            'body': 'body',
+            'urgency': 2,
+            'category': 'category',
+            'id': 'id',
+        }])
+        mock_print.assert_called_once_with('id')
+
+    @mock.patch.object(util, 'outgoing_endpoint', return_value='outgoing')
+    @mock.patch.object(util, 'cert_wrapper', return_value='wrapper')
+    @mock.patch('tendril.get_manager', return_value=mock.Mock(**{
+        'connect.side_effect': socket.error(111, 'Connection refused'),
+    }))
+    @mock.patch('tendril.TendrilPartial', return_value='the_app')
+    @mock.patch.object(spool, 'Spool')
+    def test_no_spool(self, mock_Spool, mock_TendrilPartial, mock_get_manager,
+                      mock_cert_wrapper, mock_outgoing_endpoint):
+        self.assertRaises(socket.error, submitter.send_notification,
+                          'hub', 'app', 'summary', 'body')
+        self.assertFalse(mock_Spool.called)
+
 
 class NormalizeArgsTest(unittest.TestCase):
     @mock.patch('sys.argv', ['my/submitter'])
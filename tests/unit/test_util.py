@@ -122,6 +122,17 @@ class ParseHubTest(unittest.TestCase):
             '::1', 1234, 0, socket.SOCK_STREAM)
 
 
+class ParseHubsTest(unittest.TestCase):
+    @mock.patch.object(util, 'parse_hub', side_effect=lambda hub: (hub, 1))
+    def test_single(self, mock_parse_hub):
+        self.assertEqual(('hub1', 1), util.parse_hubs('hub1'))
+
+    @mock.patch.object(util, 'parse_hub', side_effect=lambda hub: (hub, 1))
+    def test_several(self, mock_parse_hub):
+        self.assertEqual([('hub1', 1), ('[::1]:4859', 1)],
+                         util.parse_hubs('hub1, [::1]:4859'))
+
+
 class DefaultHubTest(unittest.TestCase):
     @mock.patch('os.path.expanduser', return_value='/home/user/.heyu.hub')
     @mock.patch('__builtin__.open', side_effect=IOError())
@@ -170,29 +181,220 @@ class OutgoingEndpointTest(unittest.TestCase):
         mock_addr_info.assert_called_once_with('target')
 
 
+class FakeSocket(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+
+    def recv(self, size):
+        if not self.chunks:
+            return ''
+        chunk = self.chunks.pop(0)
+        if len(chunk) > size:
+            self.chunks.insert(0, chunk[size:])
+            chunk = chunk[:size]
+        return chunk
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class FrameTest(unittest.TestCase):
+    def test_read_frame(self):
+        sock = FakeSocket(['\x00\x00', '\x00\x05he', 'llo\x00\x00\x00\x00'])
+
+        self.assertEqual('hello', util.read_frame(sock))
+        self.assertEqual('', util.read_frame(sock))
+        self.assertEqual(None, util.read_frame(sock))
+
+    def test_read_frame_truncated_header(self):
+        sock = FakeSocket(['\x00\x00'])
+
+        self.assertRaises(ValueError, util.read_frame, sock)
+
+    def test_read_frame_truncated_body(self):
+        sock = FakeSocket(['\x00\x00\x00\x05'])
+
+        self.assertRaises(ValueError, util.read_frame, sock)
+
+    def test_read_frame_truncated_partial_body(self):
+        sock = FakeSocket(['\x00\x00\x00\x05he'])
+
+        self.assertRaises(ValueError, util.read_frame, sock)
+
+    def test_write_frame(self):
+        sock = FakeSocket([])
+
+        util.write_frame(sock, 'hello')
+
+        self.assertEqual(['\x00\x00\x00\x05hello'], sock.sent)
+
+
+class CoalescingQueueTest(unittest.TestCase):
+    def test_fifo(self):
+        queue = util.CoalescingQueue()
+
+        queue.extend(['a', 'b'])
+        queue.append('c', 'id')
+
+        self.assertEqual(3, len(queue))
+        self.assertEqual(['a', 'b', 'c'], list(queue))
+        self.assertTrue('id' in queue)
+        self.assertFalse(None in queue)
+        self.assertEqual('a', queue.popleft())
+        self.assertEqual('b', queue.popleft())
+        self.assertEqual('c', queue.popleft())
+        self.assertFalse('id' in queue)
+        self.assertRaises(IndexError, queue.popleft)
+
+    def test_coalesce(self):
+        queue = util.CoalescingQueue()
+
+        queue.append('a1', 'a')
+        queue.append('b1', 'b')
+        queue.append(None)
+        queue.append('a2', 'a')
+        queue.append('n1')
+        queue.append('n2')
+
+        self.assertEqual(5, len(queue))
+        self.assertEqual(1, queue.coalesced)
+        self.assertEqual(['b1', None, 'a2', 'n1', 'n2'], list(queue))
+        self.assertEqual('b1', queue.popleft())
+        self.assertEqual(None, queue.popleft())
+        self.assertEqual('a2', queue.popleft())
+
+    def test_compact(self):
+        queue = util.CoalescingQueue()
+
+        for i in range(100):
+            queue.append(i, 'id')
+
+        self.assertEqual(1, len(queue))
+        self.assertEqual(99, queue.coalesced)
+        self.assertTrue(len(queue._order) <= 18)
+        self.assertEqual([99], list(queue))
+
+    def test_clear(self):
+        queue = util.CoalescingQueue()
+        queue.append('a', 'id')
+        queue.append('b')
+
+        queue.clear()
+
+        self.assertEqual(0, len(queue))
+        self.assertFalse('id' in queue)
+        self.assertEqual([], list(queue))
+
+
+class SeenSetTest(unittest.TestCase):
+    @mock.patch('time.time', return_value=1000.0)
+    def test_add(self, mock_time):
+        seen = util.SeenSet()
+
+        self.assertTrue(seen.add('k1'))
+        self.assertTrue(seen.add('k2'))
+        self.assertFalse(seen.add('k1'))
+        self.assertEqual(2, len(seen))
+        self.assertTrue('k1' in seen)
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_window(self, mock_time):
+        seen = util.SeenSet(window=10)
+        seen.add('k1')
+        mock_time.return_value = 1005.0
+        seen.add('k2')
+
+        mock_time.return_value = 1010.0
+        self.assertTrue(seen.add('k1'))
+        self.assertFalse(seen.add('k2'))
+        self.assertEqual(2, len(seen))
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_max_size(self, mock_time):
+        seen = util.SeenSet(max_size=2)
+
+        for key in ('k1', 'k2', 'k3'):
+            seen.add(key)
+
+        self.assertEqual(2, len(seen))
+        self.assertFalse('k1' in seen)
+        self.assertTrue(seen.add('k1'))
+
+
+class BackoffTest(unittest.TestCase):
+    @mock.patch('time.time', return_value=1000.0)
+    def test_failures(self, mock_time):
+        backoff = util.Backoff(300, 30, 5, jitter=0)
+
+        result = []
+        for _i in range(11):
+            delay = backoff.next_delay()
+            result.append(delay)
+            mock_time.return_value += delay + 1
+
+        self.assertEqual([1, 2, 4, 8, 16, 32, 64, 128, 256, 300, 300],
+                         result)
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_recovery(self, mock_time):
+        backoff = util.Backoff(300, 30, 5, jitter=0)
+        backoff.last_sleep = 300
+
+        result = []
+        for _i in range(4):
+            mock_time.return_value += 60.0
+            delay = backoff.next_delay()
+            result.append(delay)
+            mock_time.return_value += delay
+
+        self.assertEqual([288, 276, 264, 252], result)
+
+    @mock.patch('time.time', return_value=1000.0)
+    @mock.patch('random.random', return_value=1.0)
+    def test_jitter(self, mock_random, mock_time):
+        backoff = util.Backoff(300, 30, 5)
+        backoff.last_sleep = 8
+
+        self.assertEqual(12.0, backoff.next_delay())
+        self.assertEqual(16, backoff.last_sleep)
+        self.assertEqual(1016.0, backoff.last_time)
+
+
 class CertWrapperTest(unittest.TestCase):
+    def setUp(self):
+        # Start each test with an empty wrapper cache
+        patcher = mock.patch.dict(util._tls_wrappers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(util, '_file_stamps',
+                                    return_value='stamps')
+        self.mock_file_stamps = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': [],
         'items.return_value': [],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_insecure(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_insecure(self, mock_tls_context, mock_SafeConfigParser,
                       mock_expanduser):
         result = util.cert_wrapper(None, 'test', secure=False)
 
         self.assertEqual(None, result)
         self.assertFalse(mock_expanduser.called)
         self.assertFalse(mock_SafeConfigParser.called)
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': [],
         'items.return_value': [],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_missing_conf(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_missing_conf(self, mock_tls_context, mock_SafeConfigParser,
                           mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -201,15 +403,15 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         self.assertFalse(cp.items.called)
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': [],
         'items.return_value': [],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_bad_conf(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_bad_conf(self, mock_tls_context, mock_SafeConfigParser,
                       mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -218,15 +420,15 @@ class CertWrapperTest(unittest.TestCase):
         self.assertFalse(mock_expanduser.called)
         self.assertFalse(mock_SafeConfigParser.called)
         self.assertFalse(cp.items.called)
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': ['/home/dir/.heyu.cert'],
         'items.side_effect': ConfigParser.NoSectionError('test'),
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_missing_profile(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_missing_profile(self, mock_tls_context, mock_SafeConfigParser,
                              mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -235,15 +437,15 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': ['/home/dir/.heyu.cert'],
         'items.side_effect': TestException('test'),
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_unloadable_profile(self, mock_TendrilPartial,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_unloadable_profile(self, mock_tls_context,
                                 mock_SafeConfigParser, mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -252,15 +454,15 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': ['/home/dir/.heyu.cert'],
         'items.return_value': [('cafile', 'ca'), ('certfile', 'cert')],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_missing_keyfile(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_missing_keyfile(self, mock_tls_context, mock_SafeConfigParser,
                              mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -269,15 +471,15 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': ['/home/dir/.heyu.cert'],
         'items.return_value': [('keyfile', 'key'), ('certfile', 'cert')],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_missing_cafile(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_missing_cafile(self, mock_tls_context, mock_SafeConfigParser,
                             mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -286,15 +488,15 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
         'read.return_value': ['/home/dir/.heyu.cert'],
         'items.return_value': [('cafile', 'ca'), ('keyfile', 'key')],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_missing_certfile(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_missing_certfile(self, mock_tls_context, mock_SafeConfigParser,
                               mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
@@ -303,7 +505,7 @@ class CertWrapperTest(unittest.TestCase):
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        self.assertFalse(mock_TendrilPartial.called)
+        self.assertFalse(mock_tls_context.called)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
@@ -314,22 +516,29 @@ class CertWrapperTest(unittest.TestCase):
             ('certfile', 'cert'),
         ],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_basic(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_basic(self, mock_tls_context, mock_SafeConfigParser,
                    mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
         result = util.cert_wrapper(None, 'test')
 
-        self.assertEqual(result, 'wrapper')
+        self.assertTrue(isinstance(result, util.TLSWrapper))
         mock_expanduser.assert_called_once_with('~/.heyu.cert')
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        mock_TendrilPartial.assert_called_once_with(
-            ssl.wrap_socket, keyfile='key', certfile='cert', ca_certs='ca',
-            server_side=False, cert_reqs=ssl.CERT_REQUIRED,
-            ssl_version=ssl.PROTOCOL_TLSv1)
+        mock_tls_context.assert_called_once_with({
+            'cafile': 'ca',
+            'keyfile': 'key',
+            'certfile': 'cert',
+        }, False)
+        self.assertEqual('context', result.context)
+        self.assertEqual(False, result.server_side)
+        self.assertEqual({
+            ('/home/dir/.heyu.cert', 'test', False):
+            (('/home/dir/.heyu.cert', 'ca', 'cert', 'key'), 'stamps', result),
+        }, util._tls_wrappers)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
@@ -340,22 +549,29 @@ class CertWrapperTest(unittest.TestCase):
             ('certfile', 'cert'),
         ],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_server(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_server(self, mock_tls_context, mock_SafeConfigParser,
                     mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
         result = util.cert_wrapper(None, 'test', True)
 
-        self.assertEqual(result, 'wrapper')
+        self.assertTrue(isinstance(result, util.TLSWrapper))
         mock_expanduser.assert_called_once_with('~/.heyu.cert')
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        mock_TendrilPartial.assert_called_once_with(
-            ssl.wrap_socket, keyfile='key', certfile='cert', ca_certs='ca',
-            server_side=True, cert_reqs=ssl.CERT_REQUIRED,
-            ssl_version=ssl.PROTOCOL_TLSv1)
+        mock_tls_context.assert_called_once_with({
+            'cafile': 'ca',
+            'keyfile': 'key',
+            'certfile': 'cert',
+        }, True)
+        self.assertEqual('context', result.context)
+        self.assertEqual(True, result.server_side)
+        self.assertEqual({
+            ('/home/dir/.heyu.cert', 'test', True):
+            (('/home/dir/.heyu.cert', 'ca', 'cert', 'key'), 'stamps', result),
+        }, util._tls_wrappers)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
@@ -366,22 +582,29 @@ class CertWrapperTest(unittest.TestCase):
             ('certfile', 'cert'),
         ],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_alt_conf(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_alt_conf(self, mock_tls_context, mock_SafeConfigParser,
                       mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
         result = util.cert_wrapper('alt_conf', 'test')
 
-        self.assertEqual(result, 'wrapper')
+        self.assertTrue(isinstance(result, util.TLSWrapper))
         mock_expanduser.assert_called_once_with('alt_conf')
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('test')
-        mock_TendrilPartial.assert_called_once_with(
-            ssl.wrap_socket, keyfile='key', certfile='cert', ca_certs='ca',
-            server_side=False, cert_reqs=ssl.CERT_REQUIRED,
-            ssl_version=ssl.PROTOCOL_TLSv1)
+        mock_tls_context.assert_called_once_with({
+            'cafile': 'ca',
+            'keyfile': 'key',
+            'certfile': 'cert',
+        }, False)
+        self.assertEqual('context', result.context)
+        self.assertEqual(False, result.server_side)
+        self.assertEqual({
+            ('/home/dir/.heyu.cert', 'test', False):
+            (('/home/dir/.heyu.cert', 'ca', 'cert', 'key'), 'stamps', result),
+        }, util._tls_wrappers)
 
     @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
     @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
@@ -392,22 +615,200 @@ class CertWrapperTest(unittest.TestCase):
             ('certfile', 'cert'),
         ],
     }))
-    @mock.patch('tendril.TendrilPartial', return_value='wrapper')
-    def test_alt_profile(self, mock_TendrilPartial, mock_SafeConfigParser,
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_alt_profile(self, mock_tls_context, mock_SafeConfigParser,
                          mock_expanduser):
         cp = mock_SafeConfigParser.return_value
 
         result = util.cert_wrapper('alt_conf[alt_profile]', 'test')
 
-        self.assertEqual(result, 'wrapper')
+        self.assertTrue(isinstance(result, util.TLSWrapper))
         mock_expanduser.assert_called_once_with('alt_conf')
         mock_SafeConfigParser.assert_called_once_with()
         cp.read.assert_called_once_with('/home/dir/.heyu.cert')
         cp.items.assert_called_once_with('alt_profile')
-        mock_TendrilPartial.assert_called_once_with(
-            ssl.wrap_socket, keyfile='key', certfile='cert', ca_certs='ca',
-            server_side=False, cert_reqs=ssl.CERT_REQUIRED,
-            ssl_version=ssl.PROTOCOL_TLSv1)
+        mock_tls_context.assert_called_once_with({
+            'cafile': 'ca',
+            'keyfile': 'key',
+            'certfile': 'cert',
+        }, False)
+        self.assertEqual('context', result.context)
+        self.assertEqual(False, result.server_side)
+        self.assertEqual({
+            ('/home/dir/.heyu.cert', 'alt_profile', False):
+            (('/home/dir/.heyu.cert', 'ca', 'cert', 'key'), 'stamps', result),
+        }, util._tls_wrappers)
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
+    @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
+        'read.return_value': ['/home/dir/.heyu.cert'],
+        'items.return_value': [
+            ('cafile', 'ca'),
+            ('keyfile', 'key'),
+            ('certfile', 'cert'),
+        ],
+    }))
+    @mock.patch.object(util, '_tls_context',
+                       side_effect=ssl.SSLError('bad cert'))
+    def test_bad_certs(self, mock_tls_context, mock_SafeConfigParser,
+                       mock_expanduser):
+        self.assertRaises(util.CertException, util.cert_wrapper, None, 'test')
+        self.assertEqual({}, util._tls_wrappers)
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
+    @mock.patch('ConfigParser.SafeConfigParser')
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_cached(self, mock_tls_context, mock_SafeConfigParser,
+                    mock_expanduser):
+        util._tls_wrappers[('/home/dir/.heyu.cert', 'test', False)] = (
+            'paths', 'stamps', 'cached')
+
+        result = util.cert_wrapper(None, 'test')
+
+        self.assertEqual('cached', result)
+        self.mock_file_stamps.assert_called_once_with('paths')
+        self.assertFalse(mock_SafeConfigParser.called)
+        self.assertFalse(mock_tls_context.called)
+
+    @mock.patch('os.path.expanduser', return_value='/home/dir/.heyu.cert')
+    @mock.patch('ConfigParser.SafeConfigParser', return_value=mock.Mock(**{
+        'read.return_value': ['/home/dir/.heyu.cert'],
+        'items.return_value': [
+            ('cafile', 'ca'),
+            ('keyfile', 'key'),
+            ('certfile', 'cert'),
+        ],
+    }))
+    @mock.patch.object(util, '_tls_context', return_value='context')
+    def test_cached_stale(self, mock_tls_context, mock_SafeConfigParser,
+                          mock_expanduser):
+        util._tls_wrappers[('/home/dir/.heyu.cert', 'test', False)] = (
+            'paths', 'old stamps', 'cached')
+
+        result = util.cert_wrapper(None, 'test')
+
+        self.assertTrue(isinstance(result, util.TLSWrapper))
+        self.mock_file_stamps.assert_has_calls([
+            mock.call('paths'),
+            mock.call(('/home/dir/.heyu.cert', 'ca', 'cert', 'key')),
+        ])
+        mock_SafeConfigParser.assert_called_once_with()
+        self.assertEqual(1, mock_tls_context.call_count)
+        self.assertEqual({
+            ('/home/dir/.heyu.cert', 'test', False):
+            (('/home/dir/.heyu.cert', 'ca', 'cert', 'key'), 'stamps', result),
+        }, util._tls_wrappers)
+
+
+class FileStampsTest(unittest.TestCase):
+    @mock.patch('os.stat', side_effect=lambda p: mock.Mock(
+        st_mtime=len(p), st_size=len(p) * 2))
+    def test_basic(self, mock_stat):
+        result = util._file_stamps(('a', 'bb'))
+
+        self.assertEqual(((1, 2), (2, 4)), result)
+
+    @mock.patch('os.stat', side_effect=OSError('missing'))
+    def test_missing(self, mock_stat):
+        result = util._file_stamps(('a', 'bb'))
+
+        self.assertEqual((None, None), result)
+
+
+class TLSContextTest(unittest.TestCase):
+    @mock.patch.object(ssl, 'create_default_context',
+                       return_value=mock.Mock(options=0, check_hostname=True))
+    def test_client(self, mock_create_default_context):
+        result = util._tls_context({
+            'cafile': 'ca',
+            'certfile': 'cert',
+            'keyfile': 'key',
+        }, False)
+
+        self.assertEqual(mock_create_default_context.return_value, result)
+        mock_create_default_context.assert_called_once_with(
+            ssl.Purpose.SERVER_AUTH, cafile='ca')
+        self.assertEqual(util._TLS_OPTIONS, result.options)
+        self.assertEqual(False, result.check_hostname)
+        self.assertEqual(ssl.CERT_REQUIRED, result.verify_mode)
+        result.load_cert_chain.assert_called_once_with('cert', 'key')
+
+    @mock.patch.object(ssl, 'create_default_context',
+                       return_value=mock.Mock(options=0, check_hostname=False))
+    def test_server(self, mock_create_default_context):
+        result = util._tls_context({
+            'cafile': 'ca',
+            'certfile': 'cert',
+            'keyfile': 'key',
+        }, True)
+
+        self.assertEqual(mock_create_default_context.return_value, result)
+        mock_create_default_context.assert_called_once_with(
+            ssl.Purpose.CLIENT_AUTH, cafile='ca')
+        self.assertEqual(util._TLS_OPTIONS, result.options)
+        self.assertEqual(False, result.check_hostname)
+        self.assertEqual(ssl.CERT_REQUIRED, result.verify_mode)
+        result.load_cert_chain.assert_called_once_with('cert', 'key')
+
+    def test_options(self):
+        for opt in ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1',
+                    'OP_NO_TLSv1_1'):
+            value = getattr(ssl, opt, 0)
+            self.assertEqual(value, util._TLS_OPTIONS & value)
+
+
+class TLSWrapperTest(unittest.TestCase):
+    def test_init(self):
+        result = util.TLSWrapper('context', True)
+
+        self.assertEqual('context', result.context)
+        self.assertEqual(True, result.server_side)
+        self.assertEqual(None, result.session)
+
+    def test_server(self):
+        context = mock.Mock()
+        wrapper = util.TLSWrapper(context, True)
+
+        result = wrapper('sock')
+
+        self.assertEqual(context.wrap_socket.return_value, result)
+        context.wrap_socket.assert_called_once_with('sock', server_side=True)
+        self.assertEqual(None, wrapper.session)
+
+    def test_client_first(self):
+        context = mock.Mock(**{
+            'wrap_socket.return_value': mock.Mock(session='session'),
+        })
+        wrapper = util.TLSWrapper(context)
+
+        result = wrapper('sock')
+
+        self.assertEqual(context.wrap_socket.return_value, result)
+        context.wrap_socket.assert_called_once_with('sock')
+        self.assertEqual('session', wrapper.session)
+
+    def test_client_resume(self):
+        context = mock.Mock(**{
+            'wrap_socket.return_value': mock.Mock(session='new session'),
+        })
+        wrapper = util.TLSWrapper(context)
+        wrapper.session = 'session'
+
+        result = wrapper('sock')
+
+        self.assertEqual(context.wrap_socket.return_value, result)
+        context.wrap_socket.assert_called_once_with('sock', session='session')
+        self.assertEqual('new session', wrapper.session)
+
+    def test_client_no_sessions(self):
+        context = mock.Mock(**{
+            'wrap_socket.return_value': mock.Mock(spec=[]),
+        })
+        wrapper = util.TLSWrapper(context)
+
+        wrapper('sock')
+
+        self.assertEqual(None, wrapper.session)
 
 
 class MyBytesIO(io.BytesIO):